@@ -4,9 +4,11 @@ This file has all the common functions that are used for aurora connections and
 import logging
 import os
 import json
+import time
 import psycopg2
 from psycopg2 import sql
 import psycopg2.extras
+import psycopg2.pool
 from pgvector.psycopg2 import register_vector
 
 import commonUtil
@@ -19,7 +21,30 @@ RAG_PORT = os.environ['RAGPort']
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
+# connections are pooled at module level so that they are reused across warm lambda invocations
+CONNECTION_POOL = None
+CONNECTION_POOL_USER = None
+CONNECTION_POOL_MAX_SIZE = 4
+# connections idle for longer than this are checked with a query before they are handed out
+CONNECTION_HEALTH_CHECK_IDLE_SECONDS = 60
+CONNECTION_LAST_USED_TIME = {}
 
+VECTOR_INDEX_OPERATOR_CLASSES = {
+    "cosine": "vector_cosine_ops",
+    "l2": "vector_l2_ops",
+    "inner_product": "vector_ip_ops"
+}
+# bedrock knowledge bases query the table with cosine distance
+DEFAULT_VECTOR_INDEX_CONFIG = {
+    "IndexType": "hnsw",
+    "DistanceMetric": "cosine",
+    "M": 16,
+    "EfConstruction": 64,
+    "Lists": 100
+}
+
+
+# pylint: disable=too-many-instance-attributes
 class AuroraConnection():
     """Methods for connecting to Aurora
     """
@@ -29,27 +54,87 @@ class AuroraConnection():
         self.database = RAG_DATABASE
         self.dbhost = RAG_HOST
         self.dbport = RAG_PORT
-        service_user_secret_value = json.loads(commonUtil.get_secret_value(secrets_manager_client, service_user_secret_arn))
-        self.dbuser = service_user_secret_value['username']
-        self.dbpass = service_user_secret_value['password']
+        self.service_user_secret_arn = service_user_secret_arn
+        self.secrets_manager_client = secrets_manager_client
+        self.dbuser = None
+        self.dbpass = None
+        self.load_credentials()
 
         # Added to avoid pylint issue - attribute-defined-outside-init
         self.connection = None
         self.cursor = None
 
+    def load_credentials(self):
+        """Load the database credentials from the (cached) service user secret
+        """
+        service_user_secret_value = json.loads(commonUtil.get_cached_secret_value(self.secrets_manager_client, self.service_user_secret_arn))
+        self.dbuser = service_user_secret_value['username']
+        self.dbpass = service_user_secret_value['password']
+
+    def get_pool(self):
+        """Return the module connection pool, it is recreated if the credentials have changed
+        """
+        global CONNECTION_POOL, CONNECTION_POOL_USER # pylint: disable=global-statement
+        pool_user = f"{self.dbuser}:{self.dbpass}"
+        if CONNECTION_POOL is None or CONNECTION_POOL.closed or CONNECTION_POOL_USER != pool_user:
+            if CONNECTION_POOL is not None and not CONNECTION_POOL.closed:
+                CONNECTION_POOL.closeall()
+            CONNECTION_LAST_USED_TIME.clear()
+            CONNECTION_POOL = psycopg2.pool.SimpleConnectionPool(
+                0, CONNECTION_POOL_MAX_SIZE,
+                database = self.database,
+                host=self.dbhost,
+                user=self.dbuser,
+                password=self.dbpass,
+                port=self.dbport,
+                connect_timeout=10,
+            )
+            CONNECTION_POOL_USER = pool_user
+        return CONNECTION_POOL
+
+    def discard_connection(self, connection):
+        """Close a connection and remove it from the pool
+        """
+        CONNECTION_LAST_USED_TIME.pop(id(connection), None)
+        self.get_pool().putconn(connection, close=True)
+
+    def get_connection(self):
+        """Get a healthy connection from the pool, connections that are closed or fail the health check are replaced
+        """
+        pool = self.get_pool()
+        connection = pool.getconn()
+        if id(connection) not in CONNECTION_LAST_USED_TIME:
+            # new connection, register the types once
+            psycopg2.extras.register_uuid()
+            register_vector(connection)
+        elif connection.closed or time.time() - CONNECTION_LAST_USED_TIME[id(connection)] > CONNECTION_HEALTH_CHECK_IDLE_SECONDS:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                if not connection.autocommit:
+                    connection.rollback()
+            except psycopg2.Error as ex:
+                LOGGER.info("In auroraUtil.AuroraConnection, pooled connection failed health check with error - %s", str(ex))
+                self.discard_connection(connection)
+                connection = pool.getconn()
+                psycopg2.extras.register_uuid()
+                register_vector(connection)
+        CONNECTION_LAST_USED_TIME[id(connection)] = time.time()
+        return connection
+
     def __enter__(self):
-        connection = psycopg2.connect(
-            database = self.database,
-            host=self.dbhost,
-            user=self.dbuser,
-            password=self.dbpass,
-            port=self.dbport,
-            connect_timeout=10,
-        )
+        try:
+            connection = self.get_connection()
+        except psycopg2.OperationalError as ex:
+            if "authentication failed" not in str(ex):
+                raise
+            # the cached secret may be stale after a rotation, reload it and retry once
+            LOGGER.info("In auroraUtil.AuroraConnection, authentication failed, refreshing the service user secret")
+            commonUtil.refresh_cached_parameter(f"secret:{self.service_user_secret_arn}")
+            self.load_credentials()
+            connection = self.get_connection()
 
         connection.set_session(autocommit=self.autocommit)
-        psycopg2.extras.register_uuid()
-        register_vector(connection)
         cursor = connection.cursor()
         self.connection = connection
         self.cursor = cursor
@@ -58,16 +143,77 @@ class AuroraConnection():
 
     def __exit__(self, *args):
         self.cursor.close()
-        self.connection.close()
+        try:
+            # return the connection to the pool without an open transaction
+            if not self.connection.autocommit:
+                self.connection.rollback()
+            CONNECTION_LAST_USED_TIME[id(self.connection)] = time.time()
+            self.get_pool().putconn(self.connection)
+        except psycopg2.Error:
+            self.discard_connection(self.connection)
 
-def create_workspace_table(workspace_item, service_user_secret_arn, secrets_manager_client, embeddings_model_dimensions = 1536):
-    """Create a workspace table
+def get_workspace_table_name(workspace_id):
+    """Return the identifier of the table of a workspace
+    """
+    return sql.Identifier(f"table_{workspace_id.replace('-', '')}")
+
+def get_vector_index_config(vector_index_config):
+    """Return the vector index config merged with the defaults, raises ValueError if the config is invalid
+    :param vector_index_config: dict with IndexType (hnsw/ivfflat/none), DistanceMetric (cosine/l2/inner_product),
+        M and EfConstruction for hnsw and Lists for ivfflat
+    """
+    if vector_index_config is not None and not isinstance(vector_index_config, dict):
+        raise ValueError("VectorIndexConfig must be an object")
+    unknown_keys = set(vector_index_config or {}) - set(DEFAULT_VECTOR_INDEX_CONFIG)
+    if unknown_keys:
+        raise ValueError(f"Invalid keys in VectorIndexConfig - {sorted(unknown_keys)}")
+    index_config = dict(DEFAULT_VECTOR_INDEX_CONFIG)
+    index_config.update(vector_index_config or {})
+    index_config["IndexType"] = str(index_config["IndexType"]).lower()
+    if index_config["IndexType"] not in ["hnsw", "ivfflat", "none"]:
+        raise ValueError("Invalid IndexType in VectorIndexConfig, allowed values are hnsw, ivfflat and none")
+    if index_config["DistanceMetric"] not in VECTOR_INDEX_OPERATOR_CLASSES:
+        raise ValueError(f"Invalid DistanceMetric in VectorIndexConfig, allowed values are {list(VECTOR_INDEX_OPERATOR_CLASSES)}")
+    for key in ["M", "EfConstruction", "Lists"]:
+        if isinstance(index_config[key], bool) or not isinstance(index_config[key], int) or index_config[key] < 1:
+            raise ValueError(f"Invalid {key} in VectorIndexConfig, value must be a positive integer")
+    return index_config
+
+def create_vector_index(cursor, table_name, index_config):
+    """Create a HNSW or IVFFlat index on the embeddings of a workspace table
+    :param cursor: cursor of an open connection
+    :param table_name: sql identifier of the table
+    :param index_config: vector index config as returned by get_vector_index_config
+    """
+    index_type = index_config["IndexType"]
+    if index_type == "none":
+        LOGGER.info("In auroraUtil.create_vector_index, vector index is disabled, skipping index creation")
+        return
+    operator_class = sql.SQL(VECTOR_INDEX_OPERATOR_CLASSES[index_config["DistanceMetric"]])
+    LOGGER.info("In auroraUtil.create_vector_index, creating %s index with config - %s", index_type, index_config)
+    if index_type == "hnsw":
+        cursor.execute(
+            sql.SQL("CREATE INDEX ON {table} USING hnsw (embeddings {operator_class}) WITH (m = %s, ef_construction = %s);").format(
+                table=table_name, operator_class=operator_class),
+            [index_config["M"], index_config["EfConstruction"]]
+        )
+    else:
+        cursor.execute(
+            sql.SQL("CREATE INDEX ON {table} USING ivfflat (embeddings {operator_class}) WITH (lists = %s);").format(
+                table=table_name, operator_class=operator_class),
+            [index_config["Lists"]]
+        )
+
+def create_workspace_table(workspace_item, service_user_secret_arn, secrets_manager_client, embeddings_model_dimensions = 1536, vector_index_config = None):
+    """Create a workspace table along with a vector index on the embeddings, both are created in a single transaction so
+    that a failed index creation doesn't leave the table behind
     """
     LOGGER.info("In auroraUtil.create_workspace_table, creating a table in aurora for workspace with id - %s", workspace_item["WorkspaceId"])
     workspace_id = workspace_item["WorkspaceId"]
+    index_config = get_vector_index_config(vector_index_config)
 
-    table_name = sql.Identifier(f"table_{workspace_id.replace('-', '')}")
-    with AuroraConnection(service_user_secret_arn, secrets_manager_client) as cursor:
+    table_name = get_workspace_table_name(workspace_id)
+    with AuroraConnection(service_user_secret_arn, secrets_manager_client, autocommit=False) as cursor:
         cursor.execute(
             sql.SQL(
                 """CREATE TABLE {table} (
@@ -79,6 +225,8 @@ def create_workspace_table(workspace_item, service_user_secret_arn, secrets_mana
             ).format(table=table_name),
             [embeddings_model_dimensions],
         )
+        create_vector_index(cursor, table_name, index_config)
+        cursor.connection.commit()
     LOGGER.info("In auroraUtil.create_workspace_table, successfully created the table")
 
 def delete_workspace_table(workspace_id, service_user_secret_arn, secrets_manager_client):
@@ -3,14 +3,19 @@ This file has all the common functions that are used for bedrock and langchain.
 """
 import os
 import re
-import ast
 import json
+import asyncio
 import time
+import hashlib
 import logging
+import unicodedata
 import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from typing import List
 from datetime import datetime
+from boto3.dynamodb.conditions import Key
 import commonUtil
 import dynamodbUtil
 
@@ -19,14 +24,14 @@ from langchain.chains.combine_documents import create_stuff_documents_chain
 from langchain.chains import create_retrieval_chain, create_history_aware_retriever
 
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables import RunnableWithMessageHistory
+from langchain_core.runnables import RunnableWithMessageHistory, ConfigurableFieldSpec
 from langchain_core.chat_history import InMemoryChatMessageHistory
 from langchain_core.callbacks.base import BaseCallbackHandler
 from langchain_core.retrievers import BaseRetriever
 from langchain_core.documents import Document
 from langchain_core.messages import messages_from_dict
 from langchain_core.callbacks.manager import CallbackManagerForRetrieverRun
-from langchain_core.tools import Tool
+from langchain_core.tools import Tool, render_text_description_and_args
 
 from langchain_aws.llms import BedrockLLM
 from langchain_aws.chat_models import ChatBedrock
@@ -36,6 +41,7 @@ from langchain_community.document_loaders.csv_loader import CSVLoader
 
 from langchain_openai import ChatOpenAI
 from pypdf import PdfReader
+import pandas as pd
 
 # to prevent printing warning messages from langchain
 warnings.filterwarnings("ignore", category=UserWarning)
@@ -49,6 +55,7 @@ FILE_TOO_BIG_MESSAGE = "The size of the file exceeds the acceptable limit. Kindl
 INVALID_API_KEY_MESSAGE = "The OPEN AI API key you're using is invalid. Please setup a valid API key and try again."
 MODEL_ACCESS_ERROR_MESSAGE = "You do not have access to the model: {}. Please request access for it from Amazon Bedrock console "
 UNSUPPORTED_FILE_TYPE_MESSAGE = "Apologies, I wasn't able to process your request because of {} "
+PROMPT_TOO_LONG_MESSAGE = "The message is too long for the selected model. Kindly shorten the message or choose a model that supports a larger context."
 DEFAULT_MODEL_KWARGS = {
     "temperature": 0.5,
     "topP": 1,
@@ -65,7 +72,160 @@ DATASET_FILES_LAMBDA = None
 CHAT_HISTORY_TABLE = None
 WORKSPACES_DOCUMENTS_TABLE = None
 CHATBOTS_TABLE = None
-CHAT_HISTORY_STORE = {}
+WS_DELIVERY_SESSION = None
+SESSION_MEMORY_BACKEND_IN_MEMORY = "memory"
+SESSION_MEMORY_BACKEND_DYNAMODB = "dynamodb"
+SESSION_MEMORY_BACKEND = os.environ.get("sessionMemoryBackend", SESSION_MEMORY_BACKEND_IN_MEMORY)
+SESSION_MEMORY_MAX_SESSIONS = 1000
+SESSION_MEMORY_TTL_IN_SECONDS = 900
+SESSION_MEMORY_MAX_SIZE = 32 * 1024 * 1024
+
+# parsed session files are cached in memory and in /tmp, keyed by bucket, object key and ETag of the file
+SESSION_FILE_CACHE = OrderedDict()
+SESSION_FILE_CACHE_DIRECTORY = "/tmp/session-file-cache"
+SESSION_FILE_MEMORY_CACHE_MAX_SIZE = 128 * 1024 * 1024
+SESSION_FILE_DISK_CACHE_MAX_SIZE = 256 * 1024 * 1024
+# prompt token budget: share of the context window kept for the response at most, tokens kept free to absorb estimation
+# errors, share of the remaining budget given to the chat history and smallest document worth truncating into the context
+PROMPT_RESPONSE_MAX_SHARE = 0.5
+PROMPT_TOKEN_SAFETY_MARGIN = 256
+PROMPT_HISTORY_SHARE = 0.25
+PROMPT_MIN_TRUNCATED_DOCUMENT_TOKENS = 100
+# answers of workspace questions are cached per workspace version, model, prompt and access scope. Entries of TBAC scopes
+# expire along with the file access decisions they were filtered with. Only questions with the same normalized text share
+# an answer, similar questions can differ by a single year or negation that changes the answer
+ANSWER_CACHE_PROMPT_VERSION = "1"
+ANSWER_CACHE_TTL_IN_SECONDS = 900
+ANSWER_CACHE_MAX_SCOPES = 256
+ANSWER_CACHE_MAX_ENTRIES_PER_SCOPE = 64
+# trivial turns (greetings, thanks, messages without any text, repeated submissions) are answered from templates without
+# retrieval or generation. Messages are compared after normalization, see normalize_trivial_message
+TRIVIAL_GREETING_MESSAGES = [
+    "hi", "hello", "hey", "hi there", "hello there", "hey there", "yo", "hiya", "howdy", "greetings", "salutations", "welcome",
+    "good morning", "good afternoon", "good evening", "hi, how are you?", "how are you?", "what's up?", "how's it going?",
+    "hi, how's your day?", "hi, how can I help you today?", "hi, what's new?", "hi, long time no see!", "hi, nice to meet you!",
+    "hola", "buenos días", "buenos dias", "buenas tardes", "buenas noches", "bonjour", "bonsoir", "salut", "hallo", "guten tag",
+    "guten morgen", "guten abend", "servus", "moin", "ciao", "buongiorno", "buonasera", "salve", "olá", "ola", "oi", "bom dia",
+    "boa tarde", "boa noite", "hej", "hei", "hoi", "goedemorgen", "cześć", "dzień dobry", "ahoj", "merhaba", "selam",
+    "привет", "здравствуйте", "γεια", "γεια σας", "namaste", "namaskar", "नमस्ते", "shalom", "שלום", "مرحبا",
+    "السلام عليكم", "salam", "こんにちは", "おはよう", "おはようございます", "こんばんは", "你好", "您好", "안녕", "안녕하세요",
+    "xin chào", "sawasdee", "สวัสดี", "halo", "selamat pagi", "kumusta"
+]
+TRIVIAL_THANKS_MESSAGES = [
+    "thanks", "thank you", "thanks!", "thank you!", "thank you so much", "thanks a lot", "many thanks", "thank u", "thx", "ty",
+    "cheers", "great, thanks", "ok thanks", "ok, thank you", "gracias", "muchas gracias", "merci", "merci beaucoup", "danke",
+    "danke schön", "danke schon", "vielen dank", "grazie", "grazie mille", "obrigado", "obrigada", "muito obrigado",
+    "muito obrigada", "dank je", "dankjewel", "bedankt", "tack", "takk", "kiitos", "dziękuję", "děkuji", "teşekkürler",
+    "teşekkür ederim", "спасибо", "большое спасибо", "ευχαριστώ", "shukriya", "dhanyavaad", "dhanyavad", "धन्यवाद",
+    "toda", "תודה", "شكرا", "ありがとう", "ありがとうございます", "谢谢", "多谢", "감사합니다", "고맙습니다", "cảm ơn",
+    "terima kasih", "ขอบคุณ", "salamat"
+]
+TRIVIAL_TURN_RESPONSES = {
+    "greeting": "Hello! How can I assist you today?",
+    "thanks": "You're welcome! If you have any more questions or if there's anything else I can help you with, feel free to ask.",
+    "empty": "It looks like your message does not contain a question. Please type your question and I will be happy to help."
+}
+# a message identical to the previous question is answered with the previous answer if it is re-submitted within this window
+REPEATED_SUBMISSION_WINDOW_IN_SECONDS = 300
+# csv session files are loaded into dataframes which are kept in memory, keyed like the parsed session files
+CSV_TABLE_CACHE = OrderedDict()
+CSV_TABLE_CACHE_MAX_SIZE = 512 * 1024 * 1024
+# limits of the context returned by the csv retriever
+CSV_QUERY_MAX_ROWS = 50
+CSV_SCHEMA_SAMPLE_VALUES = 3
+CSV_FILTER_MAX_DISTINCT_VALUES = 1000
+CSV_QUERY_MIN_TOKEN_LENGTH = 3
+CSV_QUERY_INSTRUCTION = " Use the data which is already loaded for answering the questions. DONOT SEARCH FOR EXTERNAL DATA"
+CSV_QUERY_STOP_WORDS = {"the", "and", "for", "are", "was", "were", "what", "which", "who", "whom", "how", "many", "much", "with", "from", "that", "this",
+                        "these", "those", "have", "has", "had", "all", "any", "each", "per", "give", "show", "list", "tell", "find", "get", "about", "there",
+                        "their", "than", "then", "into", "does", "did", "can", "could", "would", "should", "please", "file", "data", "row", "rows", "column", "columns"}
+CSV_AGGREGATION_KEYWORDS = {
+    "sum": ["sum", "total"],
+    "mean": ["average", "avg", "mean"],
+    "max": ["max", "maximum", "highest", "largest", "most"],
+    "min": ["min", "minimum", "lowest", "smallest", "least"],
+    "count": ["count", "how many", "number of"]
+}
+CSV_GROUP_BY_PATTERN = re.compile(r"\b(by|per|each|every|breakdown)\b")
+# llm clients and chains are built once per container and reused across invocations, per request state
+# (callbacks, session, connection) is passed with the invocation config instead of being bound to them
+CONVERSATION_PIPELINES = OrderedDict()
+CONVERSATION_PIPELINES_MAX_SIZE = 32
+
+AGENT_TOOL_DEFINITIONS = [
+    {
+        "Name": "getConversationResponse",
+        "Description": "useful for when you need to converse with the chatbot. This is the default tool. Do not modify the user input. Pass the entire agent input as the action input to this tool"
+    },
+    {
+        "Name": "getTextSummarization",
+        "Description": """
+                    Useful for when user needs to summarize a text. User will need to specify a valid file name (.txt or .pdf) in the prompt. Only pass the name of the file as input message into the function.
+                    The prompt should contain keywords like summarize or summary.
+                    """
+    },
+    {
+        "Name": "getAIVisuals",
+        "Description": "Tool to plot user data. User will to specify the file name and the type of graph in the prompt. The prompt should contain keywords like plot or graph or subplot."
+    }
+]
+AGENT_SYSTEM_PROMPT = """ Respond the following questions as best you can to the human. Do no respond on your own. Use any one of the tools always. Do not give coded answers unless specified.
+                If you don't know which tool to use, use the getConversationResponse(used to converse with the chatbot. this is the default tool to be used. Answer questions about specific data from the file the user provides which requires analyzing data from a file. This should NOT BE CALLED WHEN SUMMARY IS REQUESTED) tool. 
+                Use getTextSummarization(Use this only if the input contains keywords 'summary' or 'summarize') when asked specifically to summarize.
+                Use getAIVisuals(Use this only if the input contains keywords 'plot' or 'draw' or 'graph' or 'visualize') when asked specifically to get visual or graphs on the data.
+                If you are not sure about the tool to use, use the getConversationResponse tool. If you are not sure about the input to the tool, use the getConversationResponse tool.
+
+        {tools}
+
+        Use a json blob to specify a tool by providing an action key (tool name) and an action_input key (tool input).
+        Valid "action" values: "Final Answer" or {tool_names}
+        "action_input" should only be of type string. Do not include the data type.
+        Provide only ONE action per $JSON_BLOB, as shown:
+
+        ```
+        {{
+        "action": $TOOL_NAME,
+        "action_input": $INPUT
+        }}
+        ```
+
+        Follow this format:
+
+        Question: input question to answer
+        Thought: consider previous and subsequent steps
+        Action:
+        ```
+        $JSON_BLOB
+        ```
+        Observation: action result
+        ... (repeat Thought/Action/Observation N times)
+        Thought: I know what to respond
+        Action:
+        ```
+        {{
+        "action": "Final Answer",
+        "action_input": "Final response to human"
+        }}
+
+        Begin! Reminder to ALWAYS respond with a valid json blob of a single action. Use tools if necessary. Respond directly if appropriate. Format is Action:```$JSON_BLOB```then Observation'''
+        """
+AGENT_HUMAN_PROMPT = """
+        Question: {input}
+        Thought:{agent_scratchpad}
+        (reminder to respond in a JSON blob no matter what)
+        """
+# compiled once per container by get_agent_tool_registry
+AGENT_TOOL_REGISTRY = {}
+AGENT_EVENT_LOOP = None
+# side effects of a chat turn (sources message and chat history write) which are run off the critical path
+BACKGROUND_TASKS_EXECUTOR = None
+BACKGROUND_TASKS_MAX_WORKERS = 2
+BACKGROUND_TASKS = []
+# website urls of scraped website documents, keyed by workspace id and document id
+WEBSITE_URL_CACHE = OrderedDict()
+WEBSITE_URL_CACHE_MAX_SIZE = 4096
+# interval at which progress messages are sent to the user while a tool lambda is running
+TOOL_PROGRESS_INTERVAL_IN_SECONDS = 5
 
 CHAIN_TYPE = {
     "general-response": "stuff",
@@ -143,34 +303,133 @@ def retrieve_user_accessible_files(user_id, files, workspace_datasets):
             # Add files to user accessible list if not TBAC dataset
             user_accessible_files.extend(dataset_name_files_map.get(dataset_domain_and_name, []))
 
-    for dataset_id, ds_files in dataset_id_files_map.items():
-        if ds_files:
-            ds_files = commonUtil.check_user_files_access(user_id, dataset_id, ds_files, LAMBDA_CLIENT, DATASET_FILES_LAMBDA)
-            for file in ds_files:
-                user_accessible_files.extend([filename for filename,file_access in file.items() if file_access])
+    dataset_id_files_map = {dataset_id: ds_files for dataset_id, ds_files in dataset_id_files_map.items() if ds_files}
+    if dataset_id_files_map:
+        datasets_files_access = commonUtil.check_user_datasets_files_access(user_id, dataset_id_files_map, LAMBDA_CLIENT, DATASET_FILES_LAMBDA)
+        for files_access in datasets_files_access.values():
+            user_accessible_files.extend([filename for filename, file_access in files_access.items() if file_access])
     LOGGER.info("In bedrockUtil.retrieve_user_accessible_files, user_accessible_files - %s", user_accessible_files)
     return user_accessible_files
 
+def submit_background_task(task_fn, *args):
+    """
+    Runs a task off the critical path of the chat turn, pending tasks are awaited before the turn completes
+    :param task_fn: function to be run
+    :param args: arguments of the function
+    """
+    # pylint: disable=global-statement
+    global BACKGROUND_TASKS_EXECUTOR
+    if BACKGROUND_TASKS_EXECUTOR is None:
+        BACKGROUND_TASKS_EXECUTOR = ThreadPoolExecutor(max_workers=BACKGROUND_TASKS_MAX_WORKERS)
+    BACKGROUND_TASKS.append(BACKGROUND_TASKS_EXECUTOR.submit(task_fn, *args))
+
+def has_pending_background_tasks():
+    """
+    Returns whether any background task of the chat turn is still running, without waiting for it
+    """
+    return any(not background_task.done() for background_task in BACKGROUND_TASKS)
+
+def wait_for_background_tasks():
+    """
+    Waits for the pending background tasks of the chat turn, failures are logged as the tasks are not part of the response
+    """
+    while BACKGROUND_TASKS:
+        background_task = BACKGROUND_TASKS.pop(0)
+        try:
+            background_task.result()
+        except Exception as ex:
+            LOGGER.error("In bedrockUtil.wait_for_background_tasks, background task failed with error - %s", str(ex))
+
+def get_website_urls(workspace_id, document_ids):
+    """
+    This method returns the website urls of the scraped website documents of a workspace. Documents are read
+    with a single batch request and memoized, documents which are not website documents are cached as None
+    :param workspace_id: The workspace id
+    :param document_ids: The document ids
+    :return: dict of document id to website url
+    """
+    uncached_document_ids = [document_id for document_id in dict.fromkeys(document_ids) if (workspace_id, document_id) not in WEBSITE_URL_CACHE]
+    LOGGER.info("In bedrockUtil.get_website_urls, %s of %s documents are not cached", len(uncached_document_ids), len(document_ids))
+    if uncached_document_ids:
+        document_items = dynamodbUtil.batch_get_items(
+            DYNAMODB_RESOURCE,
+            WORKSPACES_DOCUMENTS_TABLE,
+            [{'WorkspaceId': workspace_id, 'DocumentId': document_id} for document_id in uncached_document_ids],
+            projection_expression="DocumentId, DocumentDetails",
+            consistent_read=False
+        )
+        website_urls = {document_item["DocumentId"]: document_item["DocumentDetails"].get("WebsiteURL") for document_item in document_items if document_item["DocumentDetails"].get("FileName")}
+        for document_id in uncached_document_ids:
+            WEBSITE_URL_CACHE[(workspace_id, document_id)] = website_urls.get(document_id)
+        while len(WEBSITE_URL_CACHE) > WEBSITE_URL_CACHE_MAX_SIZE:
+            WEBSITE_URL_CACHE.popitem(last=False)
+    return {document_id: WEBSITE_URL_CACHE.get((workspace_id, document_id)) for document_id in document_ids}
+
+def send_retrieved_sources(user_id, user_accessible_files, workspace_details, request_context, sources_message_time):
+    """
+    This method formats the sources of the retrieved documents, sends them to the user and writes them to the chat history
+    :param user_id: The user id
+    :param user_accessible_files: The files the user has access to
+    :param workspace_details: The workspace details
+    :param request_context: The request context of the chat turn
+    :param sources_message_time: The time at which the sources were retrieved
+    """
+    formatted_sources = []
+    website_document_ids = {}
+    for file in user_accessible_files:
+        filepath_split = file.split('/')
+        filename = filepath_split[-1]
+        formatted_sources.append({
+            'FileName': filename,
+            'Dataset': filepath_split[1],
+            'Domain' : filepath_split[0],
+            'Workspace': workspace_details["WorkspaceName"]
+        })
+        # if the document file is scraped from a website, add the website url to the source details
+        # website file name will end with website_{uuid}.txt
+        match = re.search(r'_([^_]+)\.txt$', filename)
+        if match and commonUtil.is_valid_uuid(match.group(1)):
+            website_document_ids[len(formatted_sources) - 1] = match.group(1)
+    if website_document_ids:
+        website_urls = get_website_urls(workspace_details['WorkspaceId'], list(website_document_ids.values()))
+        for source_index, document_id in website_document_ids.items():
+            if website_urls.get(document_id):
+                formatted_sources[source_index]["WebsiteURL"] = website_urls[document_id]
+
+    sources_response_time = str((datetime.strptime(sources_message_time, commonUtil.DATETIME_ISO_FORMAT) - datetime.strptime(request_context["QueryStartTime"], commonUtil.DATETIME_ISO_FORMAT)).total_seconds() * 1000)
+    WS_DELIVERY_SESSION.send_message(
+        {"AIMessage": f"We found {len(user_accessible_files)} resources with relevant information, formatting your response", "Metadata": {"IsComplete": False, "Sources": formatted_sources, "MessageId": request_context["MessageId"], "ResponseTime": sources_response_time}})
+    # write sources to dynamodb
+    ai_message_object = {
+        "Type": "ai",
+        "Data": f"We found {len(user_accessible_files)} resources with relevant information, formatting your response",
+        "MessageId": request_context["MessageId"],
+        "ClientId": user_id,
+        "SessionId": request_context["SessionId"],
+        "MessageTime": sources_message_time,
+        "ResponseTime": sources_response_time,
+        "Sources": formatted_sources,
+        "ReviewRequired": False
+    }
+    dynamodbUtil.put_item(DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE), ai_message_object)
+
 # pylint: disable=too-few-public-methods
 class WorkspaceRetriever(BaseRetriever):
-    """This class is used as the retriever from RAG for Workspaces"""
+    """This class is used as the retriever from RAG for Workspaces, request details are read from the run metadata"""
     retriever: AmazonKnowledgeBasesRetriever
-    workspace_details: dict
-    user_id: str
-    connection_id: str
-    session_id: str
-    message_id: str
-    query_start_time: str
 
     def _get_relevant_documents(
         self, query: str, *, run_manager: CallbackManagerForRetrieverRun
     ) -> List[Document]:
+        request_context = get_request_context(run_manager)
+        workspace_details = request_context["WorkspaceDetails"]
+        user_id = request_context["UserId"]
         # Use knowledge base retriever to get the documents
         documents = self.retriever.invoke(query, callbacks=run_manager.get_child())
         LOGGER.info("In bedrockUtil.WorkspaceRetriever._get_relevant_documents, retrieved  %s relevant results", len(documents))
         filtered_documents = []
         # for chatbot requests, we do not need to do any access based filtering. for chatbot requests, user id will be None
-        if commonUtil.is_valid_uuid(self.user_id):
+        if commonUtil.is_valid_uuid(user_id):
             filtered_documents = documents
         else:
             files = []
@@ -181,88 +440,434 @@ class WorkspaceRetriever(BaseRetriever):
                 filepath = '/'.join(split_s3_path[3:])
                 document.metadata['location']['s3Location']['filepath'] = filepath
                 files.append(filepath)
-            user_accessible_files = retrieve_user_accessible_files(self.user_id, files, self.workspace_details["AttachedDatasets"])
+            user_accessible_files = retrieve_user_accessible_files(user_id, files, workspace_details["AttachedDatasets"])
             LOGGER.info("In bedrockUtil.WorkspaceRetriever._get_relevant_documents, user_accessible_files - %s", user_accessible_files)
             filtered_documents = [document for document in documents if document.metadata['location']['s3Location']['filepath'] in user_accessible_files]
-            # send message to user if any matching documents are found
-            if self.connection_id and filtered_documents:
-                kwargs = {"ApiManagementClient": API_MANAGEMENT_CLIENT, "DynamoDBResource": DYNAMODB_RESOURCE, "SessionsTable": SESSIONS_TABLE}
-                formatted_sources = []
-                for file in user_accessible_files:
-                    filepath_split = file.split('/')
-                    filename = filepath_split[-1]
-                    source_details = {
-                        'FileName': filename,
-                        'Dataset': filepath_split[1],
-                        'Domain' : filepath_split[0],
-                        'Workspace': self.workspace_details["WorkspaceName"]
-                    }
-                    # if the document file is scraped from a website, add the website url to the source details
-                    # website file name will end with website_{uuid}.txt
-                    match = re.search(r'_([^_]+)\.txt$', filename)
-                    if match:
-                        document_id = match.group(1)
-                        if commonUtil.is_valid_uuid(document_id):
-                            document_item = dynamodbUtil.get_item_with_key(DYNAMODB_RESOURCE.Table(WORKSPACES_DOCUMENTS_TABLE), {'WorkspaceId': self.workspace_details['WorkspaceId'], 'DocumentId': document_id})
-                            if document_item and document_item["DocumentDetails"].get("FileName"):
-                                source_details["WebsiteURL"] = document_item["DocumentDetails"]["WebsiteURL"]
-                    formatted_sources.append(source_details)
-                sources_message_time = commonUtil.get_current_time()
-                sources_response_time = str((datetime.strptime(sources_message_time, commonUtil.DATETIME_ISO_FORMAT) - datetime.strptime(self.query_start_time, commonUtil.DATETIME_ISO_FORMAT)).total_seconds() * 1000)
-                commonUtil.send_message_to_ws_connection(
-                    self.user_id,
-                    self.session_id,
-                    {"AIMessage": f"We found {len(user_accessible_files)} resources with relevant information, formatting your response", "Metadata": {"IsComplete": False, "Sources": formatted_sources, "MessageId": self.message_id, "ResponseTime": sources_response_time}},
-                    kwargs)
-                # write sources to dynamodb
-                ai_message_object = {
-                    "Type": "ai",
-                    "Data": f"We found {len(user_accessible_files)} resources with relevant information, formatting your response",
-                    "MessageId": self.message_id,
-                    "ClientId": self.user_id,
-                    "SessionId": self.session_id,
-                    "MessageTime": sources_message_time,
-                    "ResponseTime": sources_response_time,
-                    "Sources": formatted_sources,
-                    "ReviewRequired": False
-                }
-                dynamodbUtil.put_item(DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE), ai_message_object)
+            # send message to user if any matching documents are found, the sources are formatted and delivered in the
+            # background so that they do not delay the response generation
+            if request_context["ConnectionId"] and filtered_documents:
+                submit_background_task(send_retrieved_sources, user_id, user_accessible_files, workspace_details, request_context, commonUtil.get_current_time())
 
-        return filtered_documents
+        return fit_documents_to_budget(filtered_documents, request_context.get("ContextTokenBudget"), request_context.get("ModelProvider"))
+
+def get_session_file_cache_prefix(bucket, s3_file_path):
+    """
+    This method returns the prefix of the cache keys of a session file, all parsed versions of the file share it
+    :param bucket: The session files bucket
+    :param s3_file_path: The object key of the file
+    :return: The cache key prefix
+    """
+    return hashlib.sha256(f"{bucket}/{s3_file_path}".encode("utf-8")).hexdigest()
+
+def evict_session_file_disk_cache():
+    """
+    This method removes the least recently used files of the /tmp cache until it is within its size limit
+    """
+    cache_files = [os.path.join(SESSION_FILE_CACHE_DIRECTORY, file_name) for file_name in os.listdir(SESSION_FILE_CACHE_DIRECTORY)]
+    cache_files = sorted(cache_files, key=os.path.getmtime)
+    cache_size = sum(os.path.getsize(cache_file) for cache_file in cache_files)
+    while cache_files and cache_size > SESSION_FILE_DISK_CACHE_MAX_SIZE:
+        cache_file = cache_files.pop(0)
+        cache_size -= os.path.getsize(cache_file)
+        os.remove(cache_file)
+
+def put_session_file_in_cache(cache_key, parsed_content):
+    """
+    This method stores the parsed content of a session file in the memory and /tmp caches
+    :param cache_key: The cache key of the file
+    :param parsed_content: The parsed text (str) or documents (list of dict) of the file
+    """
+    serialized_content = json.dumps(parsed_content)
+    content_size = len(serialized_content)
+    if content_size <= SESSION_FILE_MEMORY_CACHE_MAX_SIZE:
+        SESSION_FILE_CACHE[cache_key] = (content_size, parsed_content)
+        while sum(entry[0] for entry in SESSION_FILE_CACHE.values()) > SESSION_FILE_MEMORY_CACHE_MAX_SIZE:
+            SESSION_FILE_CACHE.popitem(last=False)
+    if content_size <= SESSION_FILE_DISK_CACHE_MAX_SIZE:
+        try:
+            os.makedirs(SESSION_FILE_CACHE_DIRECTORY, exist_ok=True)
+            with open(os.path.join(SESSION_FILE_CACHE_DIRECTORY, f"{cache_key}.json"), "w", encoding="UTF-8") as cache_file:
+                cache_file.write(serialized_content)
+            evict_session_file_disk_cache()
+        except OSError as ex:
+            # a full /tmp should not fail the query, the in-memory cache is still populated
+            LOGGER.error("In bedrockUtil.put_session_file_in_cache, failed to write cache file with error - %s", str(ex))
+
+def get_session_file_from_cache(cache_key):
+    """
+    This method returns the parsed content of a session file from the memory cache or /tmp cache
+    :param cache_key: The cache key of the file
+    :return: The parsed content or None if the file is not cached
+    """
+    if cache_key in SESSION_FILE_CACHE:
+        SESSION_FILE_CACHE.move_to_end(cache_key)
+        return SESSION_FILE_CACHE[cache_key][1]
+    cache_file_path = os.path.join(SESSION_FILE_CACHE_DIRECTORY, f"{cache_key}.json")
+    if os.path.exists(cache_file_path):
+        with open(cache_file_path, "r", encoding="UTF-8") as cache_file:
+            serialized_content = cache_file.read()
+        # update the modified time so that the file is treated as recently used
+        os.utime(cache_file_path)
+        parsed_content = json.loads(serialized_content)
+        if len(serialized_content) <= SESSION_FILE_MEMORY_CACHE_MAX_SIZE:
+            SESSION_FILE_CACHE[cache_key] = (len(serialized_content), parsed_content)
+            while sum(entry[0] for entry in SESSION_FILE_CACHE.values()) > SESSION_FILE_MEMORY_CACHE_MAX_SIZE:
+                SESSION_FILE_CACHE.popitem(last=False)
+        return parsed_content
+    return None
+
+def invalidate_session_file_cache(bucket, s3_file_path):
+    """
+    This method removes all the cached versions of a session file
+    :param bucket: The session files bucket
+    :param s3_file_path: The object key of the file
+    """
+    LOGGER.info("In bedrockUtil.invalidate_session_file_cache, invalidating cache for file - %s", s3_file_path)
+    cache_prefix = get_session_file_cache_prefix(bucket, s3_file_path)
+    for cache_key in [cache_key for cache_key in SESSION_FILE_CACHE if cache_key.startswith(cache_prefix)]:
+        SESSION_FILE_CACHE.pop(cache_key, None)
+    for cache_key in [cache_key for cache_key in CSV_TABLE_CACHE if cache_key.startswith(cache_prefix)]:
+        CSV_TABLE_CACHE.pop(cache_key, None)
+    if os.path.isdir(SESSION_FILE_CACHE_DIRECTORY):
+        for file_name in os.listdir(SESSION_FILE_CACHE_DIRECTORY):
+            if file_name.startswith(cache_prefix):
+                os.remove(os.path.join(SESSION_FILE_CACHE_DIRECTORY, file_name))
+
+def get_session_file_cache_key(session_details, filename, parse_type):
+    """
+    This method returns the location, current version (ETag) and cache key of a parsed version of a session file
+    :param session_details: The session details
+    :param filename: The filename
+    :param parse_type: The type of parsing done on the file
+    :return: Tuple of bucket, object key, etag and cache key
+    """
+    s3_file_path = f"chat-sessions/{session_details['UserId']}/{session_details['SessionId']}/{filename}"
+    bucket = os.environ['sessionFilesBucketName']
+    etag = commonUtil.get_s3_object_metadata(S3_CLIENT, bucket, s3_file_path).get("ETag", "").strip('"')
+    cache_key = f"{get_session_file_cache_prefix(bucket, s3_file_path)}-{hashlib.sha256(f'{parse_type}/{etag}'.encode('utf-8')).hexdigest()}"
+    return bucket, s3_file_path, etag, cache_key
+
+def get_parsed_session_file(session_details, filename, parse_type, parse_function):
+    """
+    This method returns the parsed content of a file attached to the session, the file is downloaded and parsed
+    only if the current version of the file (ETag) is not cached
+    :param session_details: The session details
+    :param filename: The filename
+    :param parse_type: The type of parsing done by the parse function, part of the cache key
+    :param parse_function: The function which parses the downloaded file, the result must be json serializable
+    :return: The parsed content
+    """
+    bucket, s3_file_path, etag, cache_key = get_session_file_cache_key(session_details, filename, parse_type)
+    parsed_content = get_session_file_from_cache(cache_key) if etag else None
+    if parsed_content is not None:
+        LOGGER.info("In bedrockUtil.get_parsed_session_file, cache hit for file - %s", s3_file_path)
+        return parsed_content
+
+    LOGGER.info("In bedrockUtil.get_parsed_session_file, cache miss for file - %s", s3_file_path)
+    input_file = f'/tmp/{filename}'
+    commonUtil.download_file_from_s3(S3_CLIENT, bucket, s3_file_path, input_file)
+    try:
+        parsed_content = parse_function(input_file)
+    finally:
+        # the parsed content is cached so the downloaded file is not required anymore
+        os.remove(input_file)
+    if etag:
+        put_session_file_in_cache(cache_key, parsed_content)
+    return parsed_content
+
+def load_csv_table(input_file_path):
+    """
+    This method loads a csv file into a dataframe along with the details used to query it: the lowercase text of every
+    row for lexical ranking, the distinct values of the low cardinality text columns for filtering and a compact schema
+    :param input_file_path: The path of the csv file
+    :return: The csv table dict
+    """
+    found_delimiter = commonUtil.find_delimiter(input_file_path)
+    try:
+        data_frame = pd.read_csv(input_file_path, sep=found_delimiter, skipinitialspace=True)
+    except pd.errors.ParserError as ex:
+        # ragged rows are skipped by the slower python parser instead of failing the whole file
+        LOGGER.info("In bedrockUtil.load_csv_table, failed to parse the file with error - %s, retrying and skipping the bad lines", str(ex))
+        data_frame = pd.read_csv(input_file_path, sep=found_delimiter, skipinitialspace=True, engine="python", on_bad_lines="warn")
+    data_frame.columns = [str(column).strip() for column in data_frame.columns]
+
+    row_text = None
+    distinct_values = {}
+    schema_lines = [f"The file has {len(data_frame)} rows and {len(data_frame.columns)} columns:"]
+    for column in data_frame.columns:
+        column_text = data_frame[column].astype(str).str.lower()
+        row_text = column_text if row_text is None else row_text + " | " + column_text
+        sample_values = ", ".join(str(value) for value in data_frame[column].dropna().head(100).unique()[:CSV_SCHEMA_SAMPLE_VALUES])
+        schema_line = f"- {column} ({data_frame[column].dtype}), for example: {sample_values}"
+        if not pd.api.types.is_numeric_dtype(data_frame[column]):
+            column_values = data_frame[column].dropna().astype(str).str.strip().unique()
+            if len(column_values) <= CSV_FILTER_MAX_DISTINCT_VALUES:
+                distinct_values[column] = {value.lower(): value for value in column_values if len(value) >= CSV_QUERY_MIN_TOKEN_LENGTH}
+                schema_line += f", {len(column_values)} distinct values"
+        schema_lines.append(schema_line)
+
+    return {
+        "DataFrame": data_frame,
+        "RowText": row_text if row_text is not None else pd.Series(dtype=str),
+        "DistinctValues": distinct_values,
+        "Schema": "\n".join(schema_lines),
+        "Size": int(data_frame.memory_usage(deep=True).sum()) + (int(row_text.memory_usage(deep=True)) if row_text is not None else 0)
+    }
+
+def get_session_csv_table(session_details, filename):
+    """
+    This method returns the csv table of a file attached to the session, the file is loaded only once per version (ETag)
+    and kept in memory for the following queries
+    :param session_details: The session details
+    :param filename: The filename
+    :return: The csv table dict
+    """
+    bucket, s3_file_path, etag, cache_key = get_session_file_cache_key(session_details, filename, "csv-table")
+    if etag and cache_key in CSV_TABLE_CACHE:
+        LOGGER.info("In bedrockUtil.get_session_csv_table, cache hit for file - %s", s3_file_path)
+        CSV_TABLE_CACHE.move_to_end(cache_key)
+        return CSV_TABLE_CACHE[cache_key]
+
+    LOGGER.info("In bedrockUtil.get_session_csv_table, cache miss for file - %s", s3_file_path)
+    start_time = time.time()
+    input_file = f'/tmp/{filename}'
+    commonUtil.download_file_from_s3(S3_CLIENT, bucket, s3_file_path, input_file)
+    try:
+        csv_table = load_csv_table(input_file)
+    finally:
+        os.remove(input_file)
+    LOGGER.info("In bedrockUtil.get_session_csv_table, loaded %s rows (%s bytes) in %s seconds", len(csv_table["DataFrame"]), csv_table["Size"], time.time() - start_time)
+    if etag and csv_table["Size"] <= CSV_TABLE_CACHE_MAX_SIZE:
+        CSV_TABLE_CACHE[cache_key] = csv_table
+        while sum(entry["Size"] for entry in CSV_TABLE_CACHE.values()) > CSV_TABLE_CACHE_MAX_SIZE:
+            CSV_TABLE_CACHE.popitem(last=False)
+    return csv_table
+
+def is_mentioned_in_query(lower_text, query_text):
+    """
+    This method checks if a text is mentioned in the query as whole words, "age" is not mentioned in "average"
+    :param lower_text: The lowercase text
+    :param query_text: The lowercase query
+    :return: True if the text is mentioned
+    """
+    return re.search(rf"(?<!\w){re.escape(lower_text)}(?!\w)", query_text) is not None
+
+def get_csv_filter_mask(csv_table, query_text):
+    """
+    This method returns the rows whose text column values are mentioned in the query, values of the same column are
+    combined with OR and the columns with AND
+    :param csv_table: The csv table dict
+    :param query_text: The lowercase query
+    :return: The boolean mask of the rows or None if no value is mentioned
+    """
+    filter_mask = None
+    for column, column_values in csv_table["DistinctValues"].items():
+        matched_values = [value for lower_value, value in column_values.items() if is_mentioned_in_query(lower_value, query_text)]
+        if matched_values:
+            LOGGER.info("In bedrockUtil.get_csv_filter_mask, filtering column %s on values - %s", column, matched_values)
+            column_mask = csv_table["DataFrame"][column].astype(str).str.strip().isin(matched_values)
+            filter_mask = column_mask if filter_mask is None else filter_mask & column_mask
+    return filter_mask
+
+def get_csv_aggregates(csv_table, data_frame, query_text):
+    """
+    This method computes the aggregations asked for in the query on the numeric columns mentioned in it,
+    grouped by the mentioned text columns when the query asks for a breakdown
+    :param csv_table: The csv table dict
+    :param data_frame: The rows to aggregate
+    :param query_text: The lowercase query
+    :return: The aggregates as text, empty if the query does not ask for an aggregation
+    """
+    aggregations = [aggregation for aggregation, keywords in CSV_AGGREGATION_KEYWORDS.items() if any(re.search(rf"\b{keyword}\b", query_text) for keyword in keywords)]
+    if not aggregations:
+        return ""
+    mentioned_columns = [column for column in data_frame.columns
+                         if is_mentioned_in_query(column.lower(), query_text) or is_mentioned_in_query(column.lower().replace("_", " "), query_text)]
+    numeric_columns = [column for column in mentioned_columns if pd.api.types.is_numeric_dtype(data_frame[column])]
+    group_columns = [column for column in mentioned_columns if column in csv_table["DistinctValues"]] if CSV_GROUP_BY_PATTERN.search(query_text) else []
+    LOGGER.info("In bedrockUtil.get_csv_aggregates, aggregations - %s, columns - %s, group by - %s", aggregations, numeric_columns, group_columns)
+    if group_columns:
+        grouped_data_frame = data_frame.groupby(group_columns)
+        aggregates = grouped_data_frame[numeric_columns].agg(aggregations) if numeric_columns else grouped_data_frame.size().to_frame("count")
+    elif numeric_columns:
+        aggregates = data_frame[numeric_columns].agg(aggregations)
+    else:
+        aggregates = pd.DataFrame({"count": [len(data_frame)]})
+    return aggregates.head(CSV_QUERY_MAX_ROWS).to_string()
+
+def rank_csv_rows(row_text, query_text):
+    """
+    This method ranks the rows by the number of distinct query terms found in them
+    :param row_text: The lowercase text of the rows
+    :param query_text: The lowercase query
+    :return: The index of the top ranked rows, the first rows if no row matches the query
+    """
+    query_tokens = [token for token in dict.fromkeys(re.findall(r"[\w.-]+", query_text)) if len(token) >= CSV_QUERY_MIN_TOKEN_LENGTH and token not in CSV_QUERY_STOP_WORDS]
+    if query_tokens and len(row_text):
+        row_scores = sum(row_text.str.contains(token, regex=False).astype(int) for token in query_tokens)
+        row_scores = row_scores[row_scores > 0]
+        if len(row_scores):
+            return row_scores.nlargest(CSV_QUERY_MAX_ROWS, keep="first").index
+    return row_text.index[:CSV_QUERY_MAX_ROWS]
+
+def query_csv_table(csv_table, query, filename):
+    """
+    This method answers a query on a csv table with a compact context: the schema of the table, the aggregates asked for
+    in the query and a slice of the rows, filtered on the values mentioned in the query or ranked lexically otherwise
+    :param csv_table: The csv table dict
+    :param query: The query
+    :param filename: The filename, used as the source of the documents
+    :return: The list of documents
+    """
+    start_time = time.time()
+    query_text = query.replace(CSV_QUERY_INSTRUCTION, "").lower()
+    data_frame = csv_table["DataFrame"]
+    row_text = csv_table["RowText"]
+    filter_mask = get_csv_filter_mask(csv_table, query_text)
+    if filter_mask is not None:
+        data_frame = data_frame[filter_mask]
+        row_text = row_text[filter_mask]
+
+    documents = [Document(page_content=f"Schema of {filename}:\n{csv_table['Schema']}", metadata={"source": filename, "type": "schema"})]
+    if filter_mask is not None:
+        documents.append(Document(page_content=f"{len(data_frame)} rows of {filename} match the values mentioned in the question", metadata={"source": filename, "type": "filter"}))
+    aggregates = get_csv_aggregates(csv_table, data_frame, query_text)
+    if aggregates:
+        documents.append(Document(page_content=f"Aggregates computed on the matching rows of {filename}:\n{aggregates}", metadata={"source": filename, "type": "aggregates"}))
+    for row_index in rank_csv_rows(row_text, query_text):
+        row = data_frame.loc[row_index]
+        documents.append(Document(page_content="\n".join(f"{column}: {value}" for column, value in row.items()), metadata={"source": filename, "row": int(row_index)}))
+
+    prompt_size = sum(len(document.page_content) for document in documents)
+    LOGGER.info("In bedrockUtil.query_csv_table, returning %s documents with %s characters (~%s tokens) in %s seconds",
+                len(documents), prompt_size, commonUtil.estimate_token_count("".join(document.page_content for document in documents)), time.time() - start_time)
+    return documents
 
 class CSVRetriever(BaseRetriever):
-    """This class is used as the retriever from CSVLoader"""
-    filename: str
-    session_details: dict
+    """This class is used as the retriever for csv files, the session file is read from the run metadata"""
 
     #pylint: disable=unused-argument
     def _get_relevant_documents(
         self, query: str, *, run_manager: CallbackManagerForRetrieverRun
     ) -> List[Document]:
-        LOGGER.info('In bedrockUtil.CSVRetriever._get_relevant_documents, Processing file - %s', self.filename)
-        s3_file_path = f"chat-sessions/{self.session_details['UserId']}/{self.session_details['SessionId']}/{self.filename}"
-        bucket = os.environ['sessionFilesBucketName']
-        input_file_path = f'/tmp/{self.filename}'
-        commonUtil.download_file_from_s3(S3_CLIENT, bucket, s3_file_path, input_file_path)
-        found_delimiter = commonUtil.find_delimiter(input_file_path)
-        loader = CSVLoader(file_path=input_file_path, csv_args = {
-            'delimiter': found_delimiter
-        })
-        documents = loader.load()
+        request_context = get_request_context(run_manager)
+        LOGGER.info('In bedrockUtil.CSVRetriever._get_relevant_documents, Processing file - %s', request_context["FileName"])
+        csv_table = get_session_csv_table(request_context["SessionDetails"], request_context["FileName"])
+        documents = query_csv_table(csv_table, query, request_context["FileName"])
+        return fit_documents_to_budget(documents, request_context.get("ContextTokenBudget"), request_context.get("ModelProvider"))
+
+def get_model_provider_key(model_item):
+    """
+    This method returns the provider key (as in commonUtil.MODEL_PROVIDER_MAP values) of a model
+    :param model_item: The model details
+    :return: The provider key
+    """
+    return commonUtil.MODEL_PROVIDER_MAP.get(model_item["ModelProvider"].lower(), model_item["ModelName"].split('.')[0])
+
+def get_prompt_layout(prompt_template, model_provider):
+    """
+    This method returns the token count of the fixed text of a prompt and the number of times the question,
+    context and chat history are rendered in it
+    :param prompt_template: The chat prompt template
+    :param model_provider: The provider key of the model
+    :return: The prompt layout
+    """
+    templates = []
+    history_placeholders = 0
+    for message in prompt_template.messages:
+        if isinstance(message, MessagesPlaceholder):
+            history_placeholders += message.variable_name == "chat_history"
+        elif hasattr(getattr(message, "prompt", None), "template"):
+            templates.append(message.prompt.template)
+    # escaped braces are rendered as literal text
+    prompt_text = re.sub(r"\{\{|\}\}", "", "".join(templates))
+    return {
+        "FixedTokens": commonUtil.estimate_token_count(re.sub(r"\{(input|context|chat_history)\}", "", prompt_text), model_provider),
+        "InputSlots": prompt_text.count("{input}"),
+        "ContextSlots": prompt_text.count("{context}"),
+        "HistorySlots": prompt_text.count("{chat_history}") + history_placeholders
+    }
+
+def allocate_prompt_token_budget(model_provider, prompt_layout, question):
+    """
+    This method splits the prompt budget of a model between the chat history and the context. The budget is the context
+    window less the response tokens (commonUtil.MODEL_PROVIDER_MAX_TOKENS_MAP), the fixed prompt text and the question
+    :param model_provider: The provider key of the model
+    :param prompt_layout: The prompt layout returned by get_prompt_layout
+    :param question: The question of the user
+    :return: The token budget of a single rendering of the history and of the context
+    """
+    context_window = commonUtil.MODEL_PROVIDER_CONTEXT_WINDOW_MAP.get(model_provider, commonUtil.DEFAULT_MODEL_CONTEXT_WINDOW)
+    response_tokens = min(commonUtil.MODEL_PROVIDER_MAX_TOKENS_MAP.get(model_provider, DEFAULT_MODEL_KWARGS["maxTokens"]), int(context_window * PROMPT_RESPONSE_MAX_SHARE))
+    question_tokens = commonUtil.estimate_token_count(question, model_provider) * max(prompt_layout["InputSlots"], 1)
+    available_tokens = context_window - response_tokens - prompt_layout["FixedTokens"] - question_tokens - PROMPT_TOKEN_SAFETY_MARGIN
+    if available_tokens <= 0:
+        LOGGER.error("In bedrockUtil.allocate_prompt_token_budget, prompt exceeds the budget by %s tokens", -available_tokens)
+        raise Exception(PROMPT_TOO_LONG_MESSAGE)
+    history_tokens = min(commonUtil.CHAT_HISTORY_TOKEN_BUDGET, int(available_tokens * PROMPT_HISTORY_SHARE) // prompt_layout["HistorySlots"]) if prompt_layout["HistorySlots"] else 0
+    context_tokens = (available_tokens - history_tokens * prompt_layout["HistorySlots"]) // max(prompt_layout["ContextSlots"], 1)
+    LOGGER.info("In bedrockUtil.allocate_prompt_token_budget, provider - %s, window - %s, response - %s, fixed - %s, question - %s, history - %s, context - %s",
+                model_provider, context_window, response_tokens, prompt_layout["FixedTokens"], question_tokens, history_tokens, context_tokens)
+    return {"HistoryTokens": history_tokens, "ContextTokens": context_tokens}
+
+def truncate_text_to_budget(text, token_budget, model_provider):
+    """
+    This method truncates a text to the number of characters estimated to fit in the token budget
+    :param text: The text
+    :param token_budget: The token budget
+    :param model_provider: The provider key of the model
+    :return: The truncated text
+    """
+    if commonUtil.estimate_token_count(text, model_provider) <= token_budget:
+        return text
+    return text[:int(max(token_budget - 1, 0) * commonUtil.MODEL_PROVIDER_CHARACTERS_PER_TOKEN_MAP.get(model_provider, commonUtil.CHARACTERS_PER_TOKEN))]
+
+def fit_documents_to_budget(documents, token_budget, model_provider):
+    """
+    This method keeps the highest ranked documents that fit in the token budget. Documents are taken in rank order, the first
+    one that does not fit is truncated if enough budget is left and every lower ranked document is dropped
+    :param documents: The documents in rank order
+    :param token_budget: The token budget of the context, the documents are not limited if it is not set
+    :param model_provider: The provider key of the model
+    :return: The documents that fit in the budget
+    """
+    if not token_budget:
         return documents
+    remaining_tokens = token_budget
+    fitted_documents = []
+    for document in documents:
+        document_tokens = commonUtil.estimate_token_count(document.page_content, model_provider)
+        if document_tokens <= remaining_tokens:
+            fitted_documents.append(document)
+            remaining_tokens -= document_tokens
+            continue
+        if remaining_tokens >= PROMPT_MIN_TRUNCATED_DOCUMENT_TOKENS:
+            fitted_documents.append(Document(page_content=truncate_text_to_budget(document.page_content, remaining_tokens, model_provider), metadata=document.metadata))
+        LOGGER.info("In bedrockUtil.fit_documents_to_budget, kept %s of %s documents within %s tokens", len(fitted_documents), len(documents), token_budget)
+        break
+    return fitted_documents
+
+def get_request_context(run_manager):
+    """
+    This method returns the per request details passed in the metadata of the chain invocation
+    :param run_manager: The callback manager of the retriever run
+    :return: The request context
+    """
+    return run_manager.metadata.get("RequestContext", {})
 
-def get_workspace_retriever(workspace_details, user_id, connection_id, session_id, message_id, query_start_time):
+def get_workspace_retriever(knowledge_base_id, max_results):
     """
     This method returns the required workspace retriever depending on the version
-    :param workspace_details: The workspace details
+    :param knowledge_base_id: The knowledge base linked to the workspace
+    :param max_results: The number of results to retrieve
     :return: The workspace retriever
     """
     retriever = AmazonKnowledgeBasesRetriever(
-        knowledge_base_id=workspace_details.get("KnowledgeBaseId"),
-        retrieval_config={"vectorSearchConfiguration": {"numberOfResults": int(commonUtil.get_decrypted_value(commonUtil.WORKSPACE_RETRIEVAL_MAXRESULTS_SSM_KEY))}},
+        knowledge_base_id=knowledge_base_id,
+        retrieval_config={"vectorSearchConfiguration": {"numberOfResults": max_results}},
     )
     # we create a custom retriever on top of the KnowledgeBaseRetriever so that we can filter retrieved documents based on access
-    return WorkspaceRetriever(retriever=retriever, workspace_details=workspace_details, user_id=user_id, connection_id=connection_id, session_id=session_id, message_id=message_id, query_start_time=query_start_time)
+    return WorkspaceRetriever(retriever=retriever)
 
 def get_condense_question_prompt():
     """
@@ -280,18 +885,29 @@ def get_condense_question_prompt():
     ])
     return prompt_template
 
-def get_qa_prompt(client_id):
+def get_qa_prompt_config(client_id):
+    """
+    This method returns the chatbot settings the question answering prompt depends on
+    :param client_id: The user id or chatbot id of the request
+    :return: Tuple of instructions and redaction flag for chatbots, None for playground requests
+    """
+    if commonUtil.is_valid_uuid(client_id):
+        chatbot_details = dynamodbUtil.get_item_by_key_with_projection(DYNAMODB_RESOURCE.Table(CHATBOTS_TABLE), {"ChatbotId": client_id}, "Instructions, EnableRedaction") or {}
+        return (chatbot_details.get("Instructions", ""), bool(chatbot_details.get("EnableRedaction", False)))
+    return None
+
+def get_qa_prompt(client_id, qa_prompt_config=None):
     """
     This method returns the prompt to use to ask a question to the chatbot
+    :param client_id: The user id or chatbot id of the request
+    :param qa_prompt_config: The chatbot settings returned by get_qa_prompt_config, fetched when not passed
     :return: The prompt
     """
     LOGGER.info("In bedrockUtil.get_qa_prompt, with client id - %s", client_id)
     # If chatbot get chatbot details to retrieve Instructions and Redaction settings
     if commonUtil.is_valid_uuid(client_id):
         LOGGER.info("In bedrockUtil.get_qa_prompt, the request is to a chatbot")
-        chatbot_details = dynamodbUtil.get_item_with_key(DYNAMODB_RESOURCE.Table(CHATBOTS_TABLE), {"ChatbotId": client_id})
-        instructions = chatbot_details.get("Instructions", "")
-        enable_redaction = chatbot_details.get("EnableRedaction", False)
+        instructions, enable_redaction = qa_prompt_config or get_qa_prompt_config(client_id)
         if enable_redaction:
             LOGGER.info("In bedrockUtil.get_qa_prompt, redaction is enabled for chatbot")
             redact_prompt = """
@@ -376,13 +992,15 @@ class StreamingHandler(BaseCallbackHandler):
     user_id: str
     session_id: str
     message_id: str
+    delivery_session: commonUtil.WebSocketDeliverySession
     message: list
     question_pass: bool
 
-    def __init__(self, user_id, session_id, message_id):
+    def __init__(self, user_id, session_id, message_id, delivery_session):
         self.user_id = user_id
         self.session_id = session_id
         self.message_id = message_id
+        self.delivery_session = delivery_session
         self.message = []
         self.question_pass = True
 
@@ -405,9 +1023,11 @@ class StreamingHandler(BaseCallbackHandler):
         # don't need to send the response to user during the question rephrase step
         if not self.question_pass:
             self.message.append(token)
-            if len(self.message) > 40:
-                ws_kwargs = {"ApiManagementClient": API_MANAGEMENT_CLIENT, "DynamoDBResource": DYNAMODB_RESOURCE, "SessionsTable": SESSIONS_TABLE}
-                commonUtil.send_message_to_ws_connection(self.user_id, self.session_id, {"AIMessage": ''.join(self.message), "Metadata": {"IsComplete": False, "MessageId": self.message_id}}, ws_kwargs)
+            # the sources message of the turn has to reach the user before the response, the tokens are buffered
+            # until it is sent instead of blocking the generation, the final message waits for it in on_llm_end
+            if len(self.message) > 40 and not has_pending_background_tasks():
+                wait_for_background_tasks()
+                self.delivery_session.send_message({"AIMessage": ''.join(self.message), "Metadata": {"IsComplete": False, "MessageId": self.message_id}})
                 self.message = []
 
     def on_llm_end(self, response, **kwargs):
@@ -416,8 +1036,8 @@ class StreamingHandler(BaseCallbackHandler):
         """
         # don't need to send the response to user during the question rephrase step
         if not self.question_pass:
-            ws_kwargs = {"ApiManagementClient": API_MANAGEMENT_CLIENT, "DynamoDBResource": DYNAMODB_RESOURCE, "SessionsTable": SESSIONS_TABLE}
-            commonUtil.send_message_to_ws_connection(self.user_id, self.session_id, {"AIMessage": ''.join(self.message), "Metadata": {"IsComplete": True, "MessageId": self.message_id}}, ws_kwargs)
+            wait_for_background_tasks()
+            self.delivery_session.send_message({"AIMessage": ''.join(self.message), "Metadata": {"IsComplete": True, "MessageId": self.message_id}})
             self.message = []
 
 def get_callback_handler():
@@ -428,14 +1048,134 @@ def get_callback_handler():
     # we return a default template for now, we can modify it if needed
     return BaseCallbackHandler()
 
-def get_memory_from_chat_history(session_id):
+def trim_chat_history(chat_history, token_budget=None):
+    """
+    This method returns the newest messages of the chat history whose estimated token count fits in the budget
+    :param chat_history: The messages of the session in chronological order
+    :param token_budget: The token budget, commonUtil.CHAT_HISTORY_TOKEN_BUDGET if not passed
+    :return: The trimmed chat history in chronological order
+    """
+    remaining_tokens = token_budget or commonUtil.CHAT_HISTORY_TOKEN_BUDGET
+    trimmed_history = []
+    for message in reversed(chat_history):
+        remaining_tokens -= commonUtil.estimate_token_count(str(message.get("Data", "")))
+        if remaining_tokens < 0:
+            break
+        trimmed_history.append(message)
+    trimmed_history.reverse()
+    return trimmed_history
+
+class InMemorySessionMemoryStore():
+    """
+    This store keeps the chat history of the sessions served by the container. Entries expire after a TTL and
+    the least recently used sessions are evicted when the number of sessions or the total size exceeds the limits
+    """
+    def __init__(self, max_sessions=SESSION_MEMORY_MAX_SESSIONS, ttl_in_seconds=SESSION_MEMORY_TTL_IN_SECONDS, max_size=SESSION_MEMORY_MAX_SIZE):
+        self.max_sessions = max_sessions
+        self.ttl_in_seconds = ttl_in_seconds
+        self.max_size = max_size
+        self.sessions = OrderedDict()
+        self.size = 0
+
+    def remove(self, session_id):
+        """
+        This method removes the history of a session from the store
+        :param session_id: The session ID
+        """
+        session_entry = self.sessions.pop(session_id, None)
+        if session_entry:
+            self.size -= session_entry["Size"]
+
+    def evict(self):
+        """
+        This method removes the expired sessions and the least recently used ones above the limits
+        """
+        current_time = time.time()
+        for session_id in [session_id for session_id, session_entry in self.sessions.items() if session_entry["ExpiryTime"] <= current_time]:
+            self.remove(session_id)
+        while self.sessions and (len(self.sessions) > self.max_sessions or self.size > self.max_size):
+            self.remove(next(iter(self.sessions)))
+
+    def put(self, session_id, chat_history):
+        """
+        This method stores the chat history of a session, trimmed to the token budget
+        :param session_id: The session ID
+        :param chat_history: The messages of the session in chronological order
+        """
+        self.remove(session_id)
+        trimmed_history = trim_chat_history(chat_history)
+        self.sessions[session_id] = {
+            "History": trimmed_history,
+            "Size": len(json.dumps(trimmed_history, default=str)),
+            "ExpiryTime": time.time() + self.ttl_in_seconds
+        }
+        self.size += self.sessions[session_id]["Size"]
+        self.evict()
+
+    # pylint: disable=unused-argument
+    def get(self, session_id, history_end_time=None):
+        """
+        This method returns the chat history of a session, the history is loaded by the caller before the turn starts
+        :param session_id: The session ID
+        :param history_end_time: Not used, the stored history never contains the current turn
+        :return: The messages of the session in chronological order
+        """
+        session_entry = self.sessions.get(session_id)
+        if not session_entry or session_entry["ExpiryTime"] <= time.time():
+            self.remove(session_id)
+            return []
+        self.sessions.move_to_end(session_id)
+        return session_entry["History"]
+
+class DynamoDBSessionMemoryStore():
+    """
+    This store reads the chat history of a session from the chat history table on every turn, so that nothing is held in the container
+    """
+    # pylint: disable=unused-argument
+    def put(self, session_id, chat_history):
+        """
+        The history is persisted by the chat lambdas, so nothing is stored here
+        """
+        return None
+
+    def get(self, session_id, history_end_time=None):
+        """
+        This method returns the latest messages of a session that were written before the current turn
+        :param session_id: The session ID
+        :param history_end_time: MessageTime at which the current turn started
+        :return: The messages of the session in chronological order
+        """
+        key_condition_expression = Key("SessionId").eq(session_id)
+        if history_end_time:
+            key_condition_expression = key_condition_expression & Key("MessageTime").lt(history_end_time)
+        query_response = dynamodbUtil.get_items_by_query_index(
+            DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE),
+            None,
+            key_condition_expression,
+            projection_expression="#type, #data, MessageTime",
+            expression_attributes_names={"#type": "Type", "#data": "Data"},
+            scan_index_forward=False,
+            limit=commonUtil.CHAT_HISTORY_WINDOW_SIZE,
+            is_batch_query_required=True
+        )
+        chat_history = query_response.get("Items", [])
+        chat_history.reverse()
+        return trim_chat_history(chat_history)
+
+SESSION_MEMORY_STORE = DynamoDBSessionMemoryStore() if SESSION_MEMORY_BACKEND == SESSION_MEMORY_BACKEND_DYNAMODB else InMemorySessionMemoryStore()
+
+def get_memory_from_chat_history(session_id, history_end_time=None, history_token_budget=None):
     """
     This method returns the memory object generated from the chat history of the session
     :param session_id: The session ID for which to fetch history
+    :param history_end_time: MessageTime at which the current turn started
+    :param history_token_budget: Token budget of the history in the prompt, the store budget is used if not passed
     :return: The chat memory object to be used by retrieval chain
     """
     LOGGER.info("In bedrockUtil.get_memory_from_chat_history method with session ID: %s", session_id)
-    chat_history_from_ddb = CHAT_HISTORY_STORE.get(session_id, [])[-10:]
+    chat_history_from_ddb = SESSION_MEMORY_STORE.get(session_id, history_end_time)
+    if history_token_budget:
+        chat_history_from_ddb = trim_chat_history(chat_history_from_ddb, history_token_budget)
     chat_history_for_memory = []
     for message in chat_history_from_ddb:
         chat_history_for_memory.append({
@@ -450,19 +1190,24 @@ def get_memory_from_chat_history(session_id):
     LOGGER.info("In bedrockUtil.get_memory_from_chat_history method, exiting with memory object - %s", chat_memory_object)
     return chat_memory_object
 
-def get_contextful_prompt_using_file(session_details, filename):
+def get_memory_factory_config():
     """
-    This method returns the prompt to use to ask a question to the chatbot
-    :param session_details: The session details
-    :param filename: The filename
-    :return: The prompt
+    This method returns the configurable fields passed to get_memory_from_chat_history by the runnables with message history
+    :return: The field specs
     """
-    s3_file_path = f"chat-sessions/{session_details['UserId']}/{session_details['SessionId']}/{filename}"
-    bucket = os.environ['sessionFilesBucketName']
-    input_file = f'/tmp/{filename}'
-    commonUtil.download_file_from_s3(S3_CLIENT, bucket, s3_file_path, input_file)
+    return [
+        ConfigurableFieldSpec(id="session_id", annotation=str, name="Session ID", description="Unique identifier of the session", default="", is_shared=True),
+        ConfigurableFieldSpec(id="history_end_time", annotation=str, name="History end time", description="Start time of the current turn", default="", is_shared=True),
+        ConfigurableFieldSpec(id="history_token_budget", annotation=int, name="History token budget", description="Token budget of the history in the prompt", default=0, is_shared=True)
+    ]
 
-    file_type = filename.split('.')[-1]
+def read_file_text(input_file):
+    """
+    This method extracts the text of a csv, txt or pdf file
+    :param input_file: The path of the file
+    :return: The text of the file
+    """
+    file_type = input_file.split('.')[-1]
     if file_type == 'csv':
         loader = CSVLoader(file_path=input_file)
         document_text = ""
@@ -470,18 +1215,50 @@ def get_contextful_prompt_using_file(session_details, filename):
         for document in documents:
             document_text += document.page_content
     elif file_type == 'txt':
-        file_object = open(input_file, "r", encoding='UTF-8')
-        document_text = file_object.read()
-    elif file_type == 'pdf':
-        reader = PdfReader(open(input_file, "rb"))
-        document_text = ""
-        for page in reader.pages:
-            document_text += page.extract_text()
+        with open(input_file, "r", encoding='UTF-8') as file_object:
+            document_text = file_object.read()
     else:
+        with open(input_file, "rb") as file_object:
+            reader = PdfReader(file_object)
+            document_text = ""
+            for page in reader.pages:
+                document_text += page.extract_text()
+    return document_text
+
+def get_contextful_prompt_using_file(session_details, filename, model_provider, question):
+    """
+    This method returns the prompt to use to ask a question to the chatbot, the file content is truncated to the
+    context budget of the model
+    :param session_details: The session details
+    :param filename: The filename
+    :param model_provider: The provider key of the model
+    :param question: The question of the user
+    :return: The prompt and the token budget of the chat history
+    """
+    file_type = filename.split('.')[-1]
+    if file_type not in ['csv', 'txt', 'pdf']:
         LOGGER.error("In bedrockUtil.get_contextful_prompt_using_file, file type not supported - %s", file_type)
         raise Exception("unsupported file type - {} attached to the session".format(file_type))
+    document_text = get_parsed_session_file(session_details, filename, "text", read_file_text)
 
     LOGGER.info("In bedrockUtil.get_contextful_prompt_using_file, context length - %s", len(document_text))
+    prompt_budget = allocate_prompt_token_budget(model_provider, get_prompt_layout(build_contextful_prompt(""), model_provider), question)
+    document_text = truncate_text_to_budget(document_text, prompt_budget["ContextTokens"], model_provider)
+    # the text is embedded json encoded, escaped characters take more room than the raw text
+    encoded_tokens = commonUtil.estimate_token_count(json.dumps(document_text), model_provider)
+    if encoded_tokens > prompt_budget["ContextTokens"]:
+        document_text = document_text[:int(len(document_text) * prompt_budget["ContextTokens"] / encoded_tokens)]
+    LOGGER.info("In bedrockUtil.get_contextful_prompt_using_file, context length within budget - %s", len(document_text))
+    prompt_template = build_contextful_prompt(document_text)
+    LOGGER.info("In bedrockUtil.get_contextful_prompt_using_file, prompt_template : %s", prompt_template)
+    return prompt_template, prompt_budget["HistoryTokens"]
+
+def build_contextful_prompt(document_text):
+    """
+    This method builds the prompt which embeds the text of a file as the context
+    :param document_text: The text of the file
+    :return: The prompt
+    """
     # so that format call doesn't break anything
     document_text = document_text.replace('{', '{{')
     document_text = document_text.replace('}', '}}')
@@ -503,45 +1280,91 @@ def get_contextful_prompt_using_file(session_details, filename):
         MessagesPlaceholder("chat_history"),
         ("human", "content = {input}"),
     ])
-    LOGGER.info("In bedrockUtil.get_contextful_prompt_using_file, prompt_template : %s", prompt_template)
     return prompt_template
 
-def is_greeting(user_question, model_name, workspace_id):
+def normalize_trivial_message(message):
+    """
+    This method normalizes a message for trivial turn matching, the message is case folded and punctuation, symbols
+    (including emojis) and repeated whitespaces are removed
+    :param message: user message
+    :return: normalized message
+    """
+    message = unicodedata.normalize("NFKC", message or "").casefold()
+    message = "".join(character for character in message if unicodedata.category(character)[0] not in ("P", "S"))
+    return " ".join(message.split())
+
+TRIVIAL_TURN_TYPES = {
+    **{normalize_trivial_message(message): "greeting" for message in TRIVIAL_GREETING_MESSAGES},
+    **{normalize_trivial_message(message): "thanks" for message in TRIVIAL_THANKS_MESSAGES}
+}
+
+def get_last_turn(chat_history):
+    """
+    This method returns the last completed turn of the chat history. The sources of RAG turns are stored as a separate ai
+    message of the turn with Sources and without Metadata, they are skipped
+    :param chat_history: messages of the session in chronological order
+    :return: tuple of last human message and its ai answer, (None, None) if the last turn is not complete
     """
-    This method returns the response of user greetings or thank you messages without going through RAG or other data sources
+    turn_messages = [message for message in chat_history or []
+                     if not (message.get("Type") == "ai" and "Sources" in message and "Metadata" not in message)]
+    if len(turn_messages) < 2:
+        return None, None
+    human_message, ai_message = turn_messages[-2], turn_messages[-1]
+    if human_message.get("Type") != "human" or ai_message.get("Type") != "ai" or human_message.get("MessageId") != ai_message.get("MessageId"):
+        return None, None
+    return human_message, ai_message
+
+def classify_trivial_turn(message, chat_history=None):
+    """
+    This method classifies a message as a trivial turn which can be answered without retrieval or generation
+    :param message: user message
+    :param chat_history: messages of the session in chronological order, used to identify repeated submissions
+    :return: tuple of turn type (greeting, thanks, empty or repeat) and the response, (None, None) for other messages
+    """
+    normalized_message = normalize_trivial_message(message)
+    if not normalized_message:
+        return "empty", TRIVIAL_TURN_RESPONSES["empty"]
+    if normalized_message in TRIVIAL_TURN_TYPES:
+        turn_type = TRIVIAL_TURN_TYPES[normalized_message]
+        return turn_type, TRIVIAL_TURN_RESPONSES[turn_type]
+    human_message, ai_message = get_last_turn(chat_history)
+    # failed turns are stored with N/A metadata, they are retried instead of being repeated
+    if not human_message or ai_message.get("Metadata", "N/A") == "N/A" or not ai_message.get("Data") or not human_message.get("MessageTime"):
+        return None, None
+    if normalize_trivial_message(human_message.get("Data")) != normalized_message:
+        return None, None
+    seconds_since_last_turn = (datetime.strptime(commonUtil.get_current_time(), commonUtil.DATETIME_ISO_FORMAT) - datetime.strptime(human_message["MessageTime"], commonUtil.DATETIME_ISO_FORMAT)).total_seconds()
+    if seconds_since_last_turn > REPEATED_SUBMISSION_WINDOW_IN_SECONDS:
+        return None, None
+    return "repeat", ai_message["Data"]
+
+def is_greeting(user_question, model_name, workspace_id, chat_history=None):
+    """
+    This method returns the response of trivial turns (greetings, thank you messages, messages without any text and repeated
+    submissions) without going through RAG or other data sources
     :param user_question: The message to be sent to the chatbot
-    :return: The response of the conversation chain
+    :param chat_history: messages of the session in chronological order, repeated submissions are identified only if passed
+    :return: The response of the conversation chain, empty dict if the message is not a trivial turn
     """
     # This is to avoid an open issue : https://github.com/langchain-ai/langchain/issues/7606
-    # This is a temporary fix suggested in langchain forums, a more permanent solution is
-    # (1) we should use NLP to determine greetings or not.
-    # (2) we should update the prompt "CONDENSE_QUESTION_PROMPT" to ignore memory on greeting messages
-    greetings = ["hi there!", "hello!", "good morning!", "good afternoon!", "good evening!", "hey!", "greetings!", "howdy!",
-                 "hi, how are you?", "what's up?", "yo!", "hiya!", "salutations!", "hi, nice to meet you!", "welcome!",
-                 "how's it going?", "hi, how's your day?", "hi, how can I help you today?", "hi, what's new?",
-                 "hi, long time no see!", "hi", "hello", "hey", "hey there", "good morning", "good evening", "hi there", "howdy"]
-    thanks = ["thanks", "thank you"]
+    # Trivial turns are answered from templates so that they neither reach the model nor the condense question prompt
     LOGGER.info("In bedrockUtil.is_greeting method with questions - %s", user_question)
+    turn_type, content = classify_trivial_turn(user_question, chat_history)
+    if not turn_type:
+        LOGGER.info("In bedrockUtil.is_greeting method, user query is not a trivial turn")
+        return {}
     chatbot_response = {
-        "content": "N/A",
+        "content": content,
         "metadata": {
             "modelId": model_name,
             "mode": "N/A",
             "modelKwargs": "N/A",
-            "workspaceId": workspace_id
+            "workspaceId": workspace_id,
+            "turnType": turn_type
             }
         }
-    if user_question.lower() in greetings:
-        chatbot_response["content"] = "Hello! How can I assist you today?"
-        LOGGER.info("In bedrockUtil.is_greeting method, returning response - %s", chatbot_response)
-        return chatbot_response
-    elif user_question.lower() in thanks:
-        chatbot_response["content"] = "You're welcome! If you have any more questions or if there's anything else I can help you with, feel free to ask."
-        LOGGER.info("In bedrockUtil.is_greeting method, returning response - %s", chatbot_response)
-        return chatbot_response
-    else:
-        LOGGER.info("In bedrockUtil.is_greeting method, user query is not a greeting")
-        return {}
+    LOGGER.info("In bedrockUtil.is_greeting method, returning response - %s", chatbot_response)
+    return chatbot_response
 
 def get_model_params(model_name, model_params):
     """
@@ -593,6 +1416,198 @@ def get_model_params(model_name, model_params):
                 params[model_params_dict[model_provider][key]] = model_params.get(key, value)
     return params
 
+def get_cached_conversation_pipeline(pipeline_key, build_pipeline):
+    """
+    This method returns the pipeline object registered for the key, building and registering it on the first use
+    :param pipeline_key: Tuple identifying the pipeline, the first element is the pipeline type
+    :param build_pipeline: Function which builds the pipeline
+    :return: The pipeline object
+    """
+    if pipeline_key in CONVERSATION_PIPELINES:
+        CONVERSATION_PIPELINES.move_to_end(pipeline_key)
+        return CONVERSATION_PIPELINES[pipeline_key]
+    start_time = time.time()
+    pipeline = build_pipeline()
+    LOGGER.info("In bedrockUtil.get_cached_conversation_pipeline, built %s pipeline in %s seconds", pipeline_key[0], time.time() - start_time)
+    CONVERSATION_PIPELINES[pipeline_key] = pipeline
+    while len(CONVERSATION_PIPELINES) > CONVERSATION_PIPELINES_MAX_SIZE:
+        CONVERSATION_PIPELINES.popitem(last=False)
+    return pipeline
+
+def get_conversation_llm_key(model_item, model_params, is_streaming):
+    """
+    This method returns the registry key of the llm client of a model
+    :param model_item: The model details
+    :param model_params: The model kwargs
+    :param is_streaming: Whether the response is streamed to the user
+    :return: The llm key
+    """
+    llm_key = ("llm", model_item["ModelName"], model_item["ModelProvider"], json.dumps(model_params, sort_keys=True, default=str), is_streaming)
+    if model_item["ModelProvider"] == commonUtil.OPENAI_MODEL_PROVIDER:
+        # the openai client reads the api key when it is built, so a rotated key needs a new client
+        llm_key += (hashlib.sha256(os.environ.get("OPENAI_API_KEY", "").encode()).hexdigest(),)
+    return llm_key
+
+def get_conversation_llm(model_item, model_params, is_streaming):
+    """
+    This method returns the llm client of a model, callbacks are passed with each invocation instead of being bound to it
+    :param model_item: The model details
+    :param model_params: The model kwargs
+    :param is_streaming: Whether the response is streamed to the user
+    :return: The llm client
+    """
+    def build_llm():
+        model_name = model_item["ModelName"]
+        model_provider = model_item["ModelProvider"]
+        llm_args = {"streaming": True} if is_streaming else {}
+        if model_provider == commonUtil.OPENAI_MODEL_PROVIDER:
+            llm_args.update({'model_name': model_name})
+            return ChatOpenAI(**llm_args)
+        llm_args.update({
+            'model_id': model_name,
+            'model_kwargs': model_params,
+            'client': BEDROCK_RUNTIME_CLIENT,
+            'provider': get_model_provider_key(model_item)
+        })
+        if model_provider.lower() in ["anthropic"]:
+            return ChatBedrock(**llm_args)
+        return BedrockLLM(**llm_args)
+    return get_cached_conversation_pipeline(get_conversation_llm_key(model_item, model_params, is_streaming), build_llm)
+
+def get_retrieval_pipeline(llm_key, llm, retriever_key, build_retriever, client_id, qa_prompt_config=None):
+    """
+    This method returns the history aware retrieval chain of a retriever, with the question answering prompt of the client
+    :param llm_key: The registry key of the llm client
+    :param llm: The llm client
+    :param retriever_key: Tuple identifying the retriever
+    :param build_retriever: Function which builds the retriever
+    :param client_id: The user id or chatbot id of the request
+    :param qa_prompt_config: The chatbot settings returned by get_qa_prompt_config, fetched when not passed
+    :return: The retrieval chain
+    """
+    qa_prompt_config = qa_prompt_config or get_qa_prompt_config(client_id)
+    def build_retrieval_chain():
+        history_aware_retriever = create_history_aware_retriever(llm, build_retriever(), get_condense_question_prompt())
+        combine_docs_chain = create_stuff_documents_chain(llm, get_qa_prompt(client_id, qa_prompt_config))
+        return create_retrieval_chain(history_aware_retriever, combine_docs_chain)
+    return get_cached_conversation_pipeline(("retrieval",) + llm_key + retriever_key + (json.dumps(qa_prompt_config),), build_retrieval_chain)
+
+def get_retrieval_context_token_budget(client_id, qa_prompt_config, model_provider, question):
+    """
+    This method returns the token budget of the retrieved context in the question answering prompt of the client
+    :param client_id: The user id or chatbot id of the request
+    :param qa_prompt_config: The chatbot settings returned by get_qa_prompt_config
+    :param model_provider: The provider key of the model
+    :param question: The question of the user
+    :return: The context token budget
+    """
+    prompt_layout = get_prompt_layout(get_qa_prompt(client_id, qa_prompt_config), model_provider)
+    return allocate_prompt_token_budget(model_provider, prompt_layout, question)["ContextTokens"]
+
+def get_contextless_pipeline(llm_key, llm):
+    """
+    This method returns the general conversation chain with the session history, the session id is passed with each invocation
+    :param llm_key: The registry key of the llm client
+    :param llm: The llm client
+    :return: The conversation chain
+    """
+    def build_contextless_chain():
+        return RunnableWithMessageHistory(get_contextless_prompt() | llm, get_memory_from_chat_history,
+                                          input_messages_key = "input",
+                                          history_messages_key = "chat_history",
+                                          history_factory_config = get_memory_factory_config())
+    return get_cached_conversation_pipeline(("contextless",) + llm_key, build_contextless_chain)
+
+def normalize_question(question):
+    """
+    This method normalizes a question for the answer cache: lowercase, without punctuation and repeated whitespace
+    :param question: The question
+    :return: The normalized question
+    """
+    return " ".join(re.findall(r"\w+", question.lower()))
+
+def get_answer_cache_scope(client_id, workspace_details, llm_key, qa_prompt_config, max_results):
+    """
+    This method returns the scope of the cached answers of a workspace question. Answers are shared by the users of a workspace
+    unless one of its datasets is TBAC enabled, in which case the retrieved documents depend on the user and so does the scope
+    :param client_id: The user id or chatbot id of the request
+    :param workspace_details: The workspace details
+    :param llm_key: The registry key of the llm client
+    :param qa_prompt_config: The chatbot settings returned by get_qa_prompt_config
+    :param max_results: The number of documents retrieved from the knowledge base
+    :return: Tuple of the scope key and whether the scope is access controlled
+    """
+    attached_datasets = workspace_details.get("AttachedDatasets", [])
+    is_tbac_scope = any(dataset.get("IsTBACEnabled", False) for dataset in attached_datasets)
+    # chatbot requests are not filtered on access so they share the answers of the chatbot
+    access_scope = client_id if commonUtil.is_valid_uuid(client_id) or is_tbac_scope else "workspace"
+    datasets_signature = sorted((dataset["DatasetId"], bool(dataset.get("IsTBACEnabled", False))) for dataset in attached_datasets)
+    scope_key = hashlib.sha256(json.dumps([
+        workspace_details["WorkspaceId"],
+        workspace_details.get("LastIngestionCompletedTime", ""),
+        datasets_signature,
+        list(llm_key),
+        ANSWER_CACHE_PROMPT_VERSION,
+        qa_prompt_config,
+        max_results,
+        access_scope
+    ], default=str).encode("utf-8")).hexdigest()
+    return scope_key, is_tbac_scope
+
+class AnswerCache():
+    """
+    This cache keeps the answers of the workspace questions served by the container. A question is answered from the cache
+    when its normalized text matches a cached question of the same scope
+    """
+    def __init__(self, max_scopes=ANSWER_CACHE_MAX_SCOPES, max_entries_per_scope=ANSWER_CACHE_MAX_ENTRIES_PER_SCOPE):
+        self.max_scopes = max_scopes
+        self.max_entries_per_scope = max_entries_per_scope
+        self.scopes = OrderedDict()
+        self.stats = {"Hits": 0, "Misses": 0}
+
+    def get(self, scope_key, question):
+        """
+        This method returns the cached answer of a question
+        :param scope_key: The scope returned by get_answer_cache_scope
+        :param question: The question
+        :return: The cached response or None
+        """
+        scope_entries = self.scopes.get(scope_key)
+        entry = scope_entries.get(normalize_question(question)) if scope_entries else None
+        if not entry or entry["ExpiryTime"] <= time.time():
+            self.stats["Misses"] += 1
+            return None
+        self.scopes.move_to_end(scope_key)
+        self.stats["Hits"] += 1
+        return entry["Response"]
+
+    def put(self, scope_key, question, response, ttl_in_seconds=ANSWER_CACHE_TTL_IN_SECONDS):
+        """
+        This method stores the answer of a question, the expired entries and then the oldest entries of the scope are evicted
+        once the scope is full
+        :param scope_key: The scope returned by get_answer_cache_scope
+        :param question: The question
+        :param response: The chatbot response
+        :param ttl_in_seconds: The time for which the answer is served
+        """
+        current_time = time.time()
+        scope_entries = OrderedDict(
+            (normalized_question, entry) for normalized_question, entry in self.scopes.pop(scope_key, {}).items() if entry["ExpiryTime"] > current_time
+        )
+        normalized_question = normalize_question(question)
+        scope_entries.pop(normalized_question, None)
+        scope_entries[normalized_question] = {
+            "Response": response,
+            "ExpiryTime": current_time + ttl_in_seconds
+        }
+        while len(scope_entries) > self.max_entries_per_scope:
+            scope_entries.popitem(last=False)
+        self.scopes[scope_key] = scope_entries
+        while len(self.scopes) > self.max_scopes:
+            self.scopes.popitem(last=False)
+
+ANSWER_CACHE = AnswerCache()
+
 # pylint: disable=too-few-public-methods
 # pylint: disable=too-many-instance-attributes
 class ConversationObject():
@@ -618,38 +1633,36 @@ class ConversationObject():
         """
         LOGGER.info("In bedrockUtil.get_conversation_response method")
         model_name = self.model_item["ModelName"]
-        model_provider = self.model_item["ModelProvider"]
         session_id = self.session_details["SessionId"]
-        llm_args = {}
-        # Adding the chat history to the global store (Useful for runnables later)
-        CHAT_HISTORY_STORE[session_id] = self.session_details.get('History',[])
-        # these params are needed in order for streaming and sending response to user
-        if self.model_item["IsStreamingEnabled"] == "yes":
-            llm_args.update({
-                "streaming": True,
-                "callbacks": [StreamingHandler(user_id=self.user_id, session_id=self.session_details["SessionId"], message_id=self.message_id)]
-            })
-        if model_provider == commonUtil.OPENAI_MODEL_PROVIDER:
-            llm_args.update({'model_name': model_name})
-            llm = ChatOpenAI(**llm_args)
-        else:
-            llm_args.update({
-                'model_id': model_name,
-                'model_kwargs': self.model_params,
-                'client': BEDROCK_RUNTIME_CLIENT,
-                'provider': commonUtil.MODEL_PROVIDER_MAP.get(model_provider.lower(), model_name.split('.')[0])
-            })
-            if model_provider.lower() in ["anthropic"]:
-                llm = ChatBedrock(**llm_args)
-            else:
-                llm = BedrockLLM(**llm_args)
+        # Adding the chat history to the session memory store (Useful for runnables later)
+        SESSION_MEMORY_STORE.put(session_id, self.session_details.get('History',[]))
+        is_streaming = self.model_item["IsStreamingEnabled"] == "yes"
+        llm_key = get_conversation_llm_key(self.model_item, self.model_params, is_streaming)
+        llm = get_conversation_llm(self.model_item, self.model_params, is_streaming)
+        model_provider = get_model_provider_key(self.model_item)
+        # the pipelines are shared across invocations, so the request details are passed with the invocation
+        invoke_config = {
+            "callbacks": [StreamingHandler(user_id=self.user_id, session_id=session_id, message_id=self.message_id, delivery_session=WS_DELIVERY_SESSION)] if is_streaming else [],
+            "metadata": {
+                "RequestContext": {
+                    "UserId": self.user_id,
+                    "ConnectionId": self.connection_id,
+                    "SessionId": session_id,
+                    "MessageId": self.message_id,
+                    "QueryStartTime": self.query_start_time,
+                    "WorkspaceDetails": self.workspace_details,
+                    "SessionDetails": self.session_details,
+                    "FileName": self.file_config["FileName"],
+                    "ModelProvider": model_provider
+                }
+            }
+        }
         LOGGER.info("In bedrockUtil.get_conversation_response, with message - %s", message)
         start_time = time.time()
         # Handling greeting messages
         chatbot_response = is_greeting(message, model_name, self.workspace_details["WorkspaceId"] if self.workspace_details else "N/A")
         if chatbot_response:
-            ws_kwargs = {"ApiManagementClient": API_MANAGEMENT_CLIENT, "DynamoDBResource": DYNAMODB_RESOURCE, "SessionsTable": SESSIONS_TABLE}
-            commonUtil.send_message_to_ws_connection(self.user_id, self.session_details["SessionId"], {"AIMessage": chatbot_response["content"], "Metadata": {"IsComplete": True, "MessageId": self.message_id}}, ws_kwargs)
+            WS_DELIVERY_SESSION.send_message({"AIMessage": chatbot_response["content"], "Metadata": {"IsComplete": True, "MessageId": self.message_id}})
             LOGGER.info("In bedrockUtil.get_conversation_response, identified a greeting message skipped LLM, LLM response time: 0, returning with response %s", chatbot_response["content"])
             return chatbot_response
         if self.file_config["UseOriginalFile"]:
@@ -658,15 +1671,12 @@ class ConversationObject():
                 filetype = self.file_config["FileName"].split('.')[-1]
                 if filetype == 'csv':
                     # Use CSV Loader
-                    history_aware_retriever = create_history_aware_retriever(
-                        llm,
-                        CSVRetriever(filename=self.file_config["FileName"], session_details=self.session_details),
-                        get_condense_question_prompt()
-                    )
-                    combine_docs_chain = create_stuff_documents_chain(llm, get_qa_prompt(self.user_id))
-                    conversation = create_retrieval_chain(history_aware_retriever, combine_docs_chain)
+                    qa_prompt_config = get_qa_prompt_config(self.user_id)
+                    csv_question = f"{message}{CSV_QUERY_INSTRUCTION}"
+                    invoke_config["metadata"]["RequestContext"]["ContextTokenBudget"] = get_retrieval_context_token_budget(self.user_id, qa_prompt_config, model_provider, csv_question)
+                    conversation = get_retrieval_pipeline(llm_key, llm, ("csv",), CSVRetriever, self.user_id, qa_prompt_config)
 
-                    result = conversation.invoke({"input": f"{message} Use the data which is already loaded for answering the questions. DONOT SEARCH FOR EXTERNAL DATA"})
+                    result = conversation.invoke({"input": csv_question}, config=invoke_config)
                     documents = [
                         {
                             "metadata": doc.metadata,
@@ -686,14 +1696,17 @@ class ConversationObject():
                 else:
                     # Using a Runnable with chat history for other file types
                     # Use of LCEL to create a prompt context chain for invoking via a history aware runnable.
+                    # The prompt embeds the file content, so only the llm client is reused here
                     LOGGER.info("In bedrockUtil.get_conversation_response, for non CSV files the session details - %s and file - %s",self.session_details, self.file_config["FileName"])
-                    context_chain = get_contextful_prompt_using_file(self.session_details, self.file_config["FileName"]) | llm
+                    context_prompt, history_token_budget = get_contextful_prompt_using_file(self.session_details, self.file_config["FileName"], model_provider, message)
+                    context_chain = context_prompt | llm
                     conversation = RunnableWithMessageHistory(context_chain, get_memory_from_chat_history,
                         input_messages_key = "input",
-                        history_messages_key = "chat_history")
+                        history_messages_key = "chat_history",
+                        history_factory_config = get_memory_factory_config())
                     answer = conversation.invoke(
                         {"input" : message},
-                        config = {"configurable": {"session_id":session_id}},
+                        config = dict(invoke_config, configurable={"session_id": session_id, "history_end_time": self.query_start_time, "history_token_budget": history_token_budget}),
                     )
                     chatbot_response = {
                         "content": answer.content,
@@ -712,15 +1725,21 @@ class ConversationObject():
         elif self.workspace_details:
             # For Workspaces, use of history aware retrievers (ConversationalRetrievalChain deprecated)
             LOGGER.info("In bedrockUtil.get_conversation_response, getting response with RAG engine")
-            history_aware_retriever = create_history_aware_retriever(
-                        llm,
-                        get_workspace_retriever(workspace_details=self.workspace_details, user_id=self.user_id, connection_id=self.connection_id, session_id=self.session_details["SessionId"], message_id=self.message_id, query_start_time=self.query_start_time),
-                        get_condense_question_prompt()
-                    )
-            combine_docs_chain = create_stuff_documents_chain(llm, get_qa_prompt(self.user_id))
-            conversation = create_retrieval_chain(history_aware_retriever, combine_docs_chain)
-
-            result = conversation.invoke({"input": message})
+            knowledge_base_id = self.workspace_details.get("KnowledgeBaseId")
+            max_results = int(commonUtil.get_decrypted_value(commonUtil.WORKSPACE_RETRIEVAL_MAXRESULTS_SSM_KEY))
+            qa_prompt_config = get_qa_prompt_config(self.user_id)
+            answer_cache_scope, is_tbac_scope = get_answer_cache_scope(self.user_id, self.workspace_details, llm_key, qa_prompt_config, max_results)
+            cached_response = ANSWER_CACHE.get(answer_cache_scope, message)
+            LOGGER.info("In bedrockUtil.get_conversation_response, answer cache stats - %s", ANSWER_CACHE.stats)
+            if cached_response:
+                WS_DELIVERY_SESSION.send_message({"AIMessage": cached_response["content"], "Metadata": {"IsComplete": True, "MessageId": self.message_id}})
+                LOGGER.info("In bedrockUtil.get_conversation_response, answered from the answer cache, LLM response time: 0")
+                return dict(cached_response)
+            invoke_config["metadata"]["RequestContext"]["ContextTokenBudget"] = get_retrieval_context_token_budget(self.user_id, qa_prompt_config, model_provider, message)
+            conversation = get_retrieval_pipeline(llm_key, llm, ("workspace", self.workspace_details["WorkspaceId"], knowledge_base_id, max_results),
+                                                  lambda: get_workspace_retriever(knowledge_base_id, max_results), self.user_id, qa_prompt_config)
+
+            result = conversation.invoke({"input": message}, config=invoke_config)
             documents = [
                 {
                     "metadata": doc.metadata,
@@ -738,16 +1757,16 @@ class ConversationObject():
                     "documents": documents
                 }
             }
+            ANSWER_CACHE.put(answer_cache_scope, message, chatbot_response,
+                             min(ANSWER_CACHE_TTL_IN_SECONDS, commonUtil.FILE_ACCESS_CACHE_TTL_IN_SECONDS) if is_tbac_scope else ANSWER_CACHE_TTL_IN_SECONDS)
         else:
             LOGGER.info("In bedrockUtil.get_conversation_response, getting normal conversation response")
             # For general conversations, using contextless prompt
-            context_chain = get_contextless_prompt() | llm
-            conversation = RunnableWithMessageHistory(context_chain, get_memory_from_chat_history,
-                input_messages_key = "input",
-                history_messages_key = "chat_history")
+            conversation = get_contextless_pipeline(llm_key, llm)
+            history_token_budget = allocate_prompt_token_budget(model_provider, get_prompt_layout(get_contextless_prompt(), model_provider), message)["HistoryTokens"]
             answer = conversation.invoke(
                 {"input" : message},
-                config = {"configurable": {"session_id":session_id}}
+                config = dict(invoke_config, configurable={"session_id": session_id, "history_end_time": self.query_start_time, "history_token_budget": history_token_budget})
             )
 
             chatbot_response = {
@@ -763,22 +1782,105 @@ class ConversationObject():
         LOGGER.info("In bedrockUtil.get_conversation_response, returning with response - %s", chatbot_response["content"])
         return chatbot_response
 
+def parse_tool_lambda_response(lambda_response, tool_name):
+    """
+    Parses the response of a tool lambda, the payload is expected to be an api response with a json encoded body
+    :param lambda_response: response of the lambda invoke
+    :param tool_name: name of the tool, used for logging
+    :return: decoded body of the lambda response
+    """
+    lambda_response_payload = lambda_response['Payload'].read().decode()
+    LOGGER.info("In bedrockUtil.parse_tool_lambda_response, %s lambda response - %s, payload is - %s", tool_name, lambda_response, lambda_response_payload)
+    if lambda_response.get("FunctionError"):
+        LOGGER.error("In bedrockUtil.parse_tool_lambda_response, %s lambda failed with error - %s", tool_name, lambda_response_payload)
+        raise Exception(f"Failed to run the {tool_name} tool, please retry")
+    try:
+        api_response = json.loads(lambda_response_payload)
+        lambda_response_body = json.loads(api_response["body"])
+    except (ValueError, TypeError, KeyError) as ex:
+        LOGGER.error("In bedrockUtil.parse_tool_lambda_response, invalid %s lambda response - %s", tool_name, str(ex))
+        raise Exception(f"Invalid response received from the {tool_name} tool") from ex
+    if not isinstance(lambda_response_body, dict):
+        LOGGER.error("In bedrockUtil.parse_tool_lambda_response, %s lambda response body is not an object - %s", tool_name, lambda_response_body)
+        raise Exception(f"Invalid response received from the {tool_name} tool")
+    if api_response.get("statusCode") != 200:
+        LOGGER.error("In bedrockUtil.parse_tool_lambda_response, %s lambda returned status code %s with body - %s", tool_name, api_response.get("statusCode"), lambda_response_body)
+    return lambda_response_body
+
+def get_agent_event_loop():
+    """
+    Returns the event loop used to run the agent, the loop is kept for the lifetime of the container
+    so that the async clients of the cached llms stay bound to an open loop
+    """
+    # pylint: disable=global-statement
+    global AGENT_EVENT_LOOP
+    if AGENT_EVENT_LOOP is None or AGENT_EVENT_LOOP.is_closed():
+        AGENT_EVENT_LOOP = asyncio.new_event_loop()
+    return AGENT_EVENT_LOOP
+
+async def ainvoke_tool_lambda(lambda_client, function_name, payload, tool_name, progress_message, message_id, query_start_time):
+    """
+    Invokes a tool lambda without blocking the event loop and sends progress messages to the websocket
+    connection until the lambda responds
+    :param lambda_client: boto3 lambda client
+    :param function_name: arn of the tool lambda
+    :param payload: json encoded payload of the lambda
+    :param tool_name: name of the tool, used for logging
+    :param progress_message: message sent to the user while the tool is running
+    :param message_id: id of the ai message of the chat turn
+    :param query_start_time: start time of the chat turn
+    :return: decoded body of the lambda response
+    """
+    LOGGER.info("In bedrockUtil.ainvoke_tool_lambda, dispatching %s lambda - %s", tool_name, function_name)
+    invoke_task = asyncio.ensure_future(asyncio.to_thread(
+        commonUtil.invoke_lambda_function,
+        lambda_client=lambda_client,
+        function_name=function_name,
+        payload=payload,
+        invocation_type='RequestResponse'
+    ))
+    try:
+        while True:
+            progress_time = commonUtil.get_current_time()
+            progress_response_time = str((datetime.strptime(progress_time, commonUtil.DATETIME_ISO_FORMAT) - datetime.strptime(query_start_time, commonUtil.DATETIME_ISO_FORMAT)).total_seconds() * 1000)
+            if WS_DELIVERY_SESSION:
+                # progress messages are flagged so that the clients show them as a status instead of joining them to the answer
+                try:
+                    await asyncio.to_thread(
+                        WS_DELIVERY_SESSION.send_message,
+                        {"AIMessage": progress_message, "Metadata": {"IsComplete": False, "Progress": True, "MessageId": message_id, "ResponseTime": progress_response_time}}
+                    )
+                except Exception as ex:
+                    # progress messages are informational, the tool result is still delivered with the final message
+                    LOGGER.error("In bedrockUtil.ainvoke_tool_lambda, failed to send progress message of %s with error - %s", tool_name, str(ex))
+            done, _ = await asyncio.wait({invoke_task}, timeout=TOOL_PROGRESS_INTERVAL_IN_SECONDS)
+            if done:
+                break
+            LOGGER.info("In bedrockUtil.ainvoke_tool_lambda, %s lambda is still running after %s ms", tool_name, progress_response_time)
+    finally:
+        if not invoke_task.done():
+            # the turn was cancelled or failed while the tool was running, the lambda response is discarded
+            LOGGER.info("In bedrockUtil.ainvoke_tool_lambda, abandoning the running %s lambda", tool_name)
+            invoke_task.cancel()
+            await asyncio.gather(invoke_task, return_exceptions=True)
+    return parse_tool_lambda_response(invoke_task.result(), tool_name)
+
 class SummarizationObject():
     """This object is used to perform all the summarization chain related actions"""
-    def __init__(self, model_name, model_provider, model_params, file_config, summarization_metadata_dict, workspace_details):
+    def __init__(self, model_name, model_provider, model_params, file_config, summarization_metadata_dict, workspace_details, message_id=None, query_start_time=None):
         self.model_name = model_name
         self.model_provider = model_provider
         self.model_params = model_params
         self.file_config = file_config
         self.summarization_metadata_dict = summarization_metadata_dict
         self.workspace_details = workspace_details
+        self.message_id = message_id
+        self.query_start_time = query_start_time
 
-    def get_text_summarization(self, message):
+    def get_invoke_payload(self, message):
         """
-        Wrapper function that invokes text summarization API
+        Builds the payload of the text summarization lambda
         """
-        LOGGER.info("In bedrockUtil.get_text_summarization, input message is - %s", message)
-
         if self.workspace_details is None:
             LOGGER.info("In bedrockUtil.get_text_summarization, no workspace details are passed so defaulting")
             workspace_id = ""
@@ -795,22 +1897,16 @@ class SummarizationObject():
             'WorkspaceId': workspace_id,
             'AgentInput': message
         }
-
         LOGGER.info("In bedrockUtil.get_text_summarization, lambda payload -%s", invoke_payload)
+        return json.dumps(invoke_payload)
 
-        lambda_response = commonUtil.invoke_lambda_function(lambda_client=self.summarization_metadata_dict["lambdaClient"],
-                                                     function_name=self.summarization_metadata_dict["summarizationLambdaArn"],
-                                                     payload=json.dumps(invoke_payload),
-                                                     invocation_type='RequestResponse'
-                                                     )
-        lambda_response_body = lambda_response['Payload'].read().decode()
-        LOGGER.info("In bedrockUtil.get_text_summarization, lambda response - %s, body is - %s", lambda_response, lambda_response_body)
-
-        lambda_response_body = ast.literal_eval(ast.literal_eval(lambda_response_body)['body'])
-
+    def get_tool_response(self, lambda_response_body):
+        """
+        Formulates the chat response from the text summarization lambda response
+        """
         LOGGER.info("In bedrockUtil.get_text_summarization, formulating response for chat response")
         response = {
-            "content": lambda_response_body['Message'],
+            "content": lambda_response_body.get('Message', "Unable to summarize the file, please retry"),
             "metadata": {
                 "modelId": self.model_name,
                 "mode": CHAIN_TYPE["text-summarization"],
@@ -818,15 +1914,41 @@ class SummarizationObject():
                 "workspaceId": "N/A"
             }
         }
-
         LOGGER.info("In bedrockUtil.get_text_summarization, method completed with response -%s", response)
-
         return response
 
+    def get_text_summarization(self, message):
+        """
+        Wrapper function that invokes text summarization API
+        """
+        LOGGER.info("In bedrockUtil.get_text_summarization, input message is - %s", message)
+        lambda_response = commonUtil.invoke_lambda_function(lambda_client=self.summarization_metadata_dict["lambdaClient"],
+                                                     function_name=self.summarization_metadata_dict["summarizationLambdaArn"],
+                                                     payload=self.get_invoke_payload(message),
+                                                     invocation_type='RequestResponse'
+                                                     )
+        return self.get_tool_response(parse_tool_lambda_response(lambda_response, "getTextSummarization"))
+
+    async def aget_text_summarization(self, message):
+        """
+        Async wrapper function that invokes text summarization API and reports progress while it runs
+        """
+        LOGGER.info("In bedrockUtil.aget_text_summarization, input message is - %s", message)
+        lambda_response_body = await ainvoke_tool_lambda(
+            self.summarization_metadata_dict["lambdaClient"],
+            self.summarization_metadata_dict["summarizationLambdaArn"],
+            self.get_invoke_payload(message),
+            "getTextSummarization",
+            f"Summarizing {message}, this may take a moment",
+            self.message_id,
+            self.query_start_time
+        )
+        return self.get_tool_response(lambda_response_body)
+
 class VisualizationObject():
     """This class facilitates AI-powered data visualizations"""
 
-    def __init__(self, model_item, model_params, file_config, session_details, auth_token, workspace_details, visualization_metadata_dict):
+    def __init__(self, model_item, model_params, file_config, session_details, auth_token, workspace_details, visualization_metadata_dict, message_id=None, query_start_time=None):
         LOGGER.info("In bedrockUtil.generate_visualizations, init method called")
         self.model_item = model_item
         self.model_params = model_params
@@ -835,41 +1957,36 @@ class VisualizationObject():
         self.auth_token = auth_token
         self.workspace_details = workspace_details
         self.visualization_metadata_dict = visualization_metadata_dict
+        self.message_id = message_id
+        self.query_start_time = query_start_time
 
-    def generate_visualizations(self, message):
+    def get_invoke_payload(self, message):
         """
-        Function to invoke underlying model and generate the visualizations. This function will generate the code for plotting the data
-        and returns a S3 URL for UI to present it to the user
+        Validates the model and builds the payload of the visualizations lambda
         """
-        LOGGER.info("In bedrockUtil.generate_visualizations, input message is - %s", message)
         if self.model_item['IsStreamingEnabled'] != 'yes':
             LOGGER.error("In bedrockUtil.generate_visualizations, streaming is not enabled for the model. Please try another model.")
             raise Exception("Streaming is not enabled for the model. Please try another model.")
 
-        model_name = self.model_item['ModelName']
         invoke_payload={
-            'modelName': model_name,
+            'modelName': self.model_item['ModelName'],
             'fileConfig': self.file_config,
             'sessionDetails': self.session_details,
             'workspaceDetails': self.workspace_details,
             'agentInput': message
             }
-        response = commonUtil.invoke_lambda_function(lambda_client=self.visualization_metadata_dict["lambdaClient"],
-                                                     function_name=self.visualization_metadata_dict["visualizationsLambdaArn"],
-                                                     payload=json.dumps(invoke_payload, default = commonUtil.DecimalEncoder),
-                                                     invocation_type='RequestResponse'
-                                                     )
-        lambda_response_body = response['Payload'].read().decode()
-        LOGGER.info("In bedrockUtil.generate_visualizations, lambda response - %s, body is - %s - %s", response, lambda_response_body, type(lambda_response_body))
-        if response["ResponseMetadata"]["HTTPStatusCode"] != 200:
-            LOGGER.error("In bedrockUtil.generate_visualizations, error: %s", lambda_response_body)
-        lambda_response_body = ast.literal_eval(ast.literal_eval(lambda_response_body)['body'])
-        LOGGER.info("In bedrockUtil.generate_visualizations, lambda response extracted - %s, - %s", lambda_response_body, type(lambda_response_body))
+        return json.dumps(invoke_payload, default = commonUtil.DecimalEncoder)
+
+    def get_tool_response(self, lambda_response_body):
+        """
+        Formulates the chat response from the visualizations lambda response
+        """
+        LOGGER.info("In bedrockUtil.generate_visualizations, lambda response extracted - %s", lambda_response_body)
         tool_response = {
             "content": "<p>Please find the visualization below: <a href='{0}'>click here to download</a> </p><br/><img src='{0}' alt='Image' height= '1600' width= '720'>".format(lambda_response_body["presignedUrl"]) \
                         if "success" in lambda_response_body.get("message", "failed") else lambda_response_body.get("message", "Unable to generate the plot, please retry"),
             "metadata": {
-                "modelId": model_name,
+                "modelId": self.model_item['ModelName'],
                 "mode": "N/A",
                 "modelKwargs": json.dumps(self.model_params),
                 "workspaceId": "N/A"
@@ -877,119 +1994,109 @@ class VisualizationObject():
         }
         return tool_response
 
+    def generate_visualizations(self, message):
+        """
+        Function to invoke underlying model and generate the visualizations. This function will generate the code for plotting the data
+        and returns a S3 URL for UI to present it to the user
+        """
+        LOGGER.info("In bedrockUtil.generate_visualizations, input message is - %s", message)
+        response = commonUtil.invoke_lambda_function(lambda_client=self.visualization_metadata_dict["lambdaClient"],
+                                                     function_name=self.visualization_metadata_dict["visualizationsLambdaArn"],
+                                                     payload=self.get_invoke_payload(message),
+                                                     invocation_type='RequestResponse'
+                                                     )
+        return self.get_tool_response(parse_tool_lambda_response(response, "getAIVisuals"))
+
+    async def agenerate_visualizations(self, message):
+        """
+        Async version of generate_visualizations that reports progress while the visualization is generated
+        """
+        LOGGER.info("In bedrockUtil.agenerate_visualizations, input message is - %s", message)
+        lambda_response_body = await ainvoke_tool_lambda(
+            self.visualization_metadata_dict["lambdaClient"],
+            self.visualization_metadata_dict["visualizationsLambdaArn"],
+            self.get_invoke_payload(message),
+            "getAIVisuals",
+            "Generating the visualization, this may take a moment",
+            self.message_id,
+            self.query_start_time
+        )
+        return self.get_tool_response(lambda_response_body)
+
 # pylint: disable=too-many-arguments
 def define_tools(model_item, model_params, session_details, file_config, user_id, summarization_metadata_dict, visualization_metadata_dict, workspace_details, connection_id, message_id, query_start_time, retrieve_llm_trace):
     """
-    Utility function to define the tools
+    Utility function to define the tools, the tools share the names and descriptions compiled in the agent tool registry
+    and are bound to the objects of the current request
     """
     LOGGER.info("In bedrockUtil.define_tools")
     conversational_object = ConversationObject(model_item, workspace_details, session_details, model_params, file_config, user_id, connection_id, message_id, query_start_time, retrieve_llm_trace)
-    summarization_object = SummarizationObject(model_item["ModelName"], model_item["ModelProvider"], model_params, file_config, summarization_metadata_dict, workspace_details)
-    visualization_object = VisualizationObject(model_item, model_params, file_config, session_details, visualization_metadata_dict["authToken"], workspace_details, visualization_metadata_dict)
+    summarization_object = SummarizationObject(model_item["ModelName"], model_item["ModelProvider"], model_params, file_config, summarization_metadata_dict, workspace_details, message_id, query_start_time)
+    visualization_object = VisualizationObject(model_item, model_params, file_config, session_details, visualization_metadata_dict["authToken"], workspace_details, visualization_metadata_dict, message_id, query_start_time)
+    # the agent is run asynchronously, tools with a coroutine are awaited on the agent event loop and the
+    # others are run in the default executor of the loop
+    tool_functions = {
+        "getConversationResponse": (conversational_object.get_conversation_response, None),
+        "getTextSummarization": (summarization_object.get_text_summarization, summarization_object.aget_text_summarization),
+        "getAIVisuals": (visualization_object.generate_visualizations, visualization_object.agenerate_visualizations)
+    }
 
     tools = [
-                Tool.from_function(
-                    func=conversational_object.get_conversation_response,
-                    name="getConversationResponse",
-                    description="useful for when you need to converse with the chatbot. This is the default tool. Do not modify the user input. Pass the entire agent input as the action input to this tool",
-                    return_direct=True
-                ),
-                Tool.from_function(
-                    func=summarization_object.get_text_summarization,
-                    name="getTextSummarization",
-                    description="""
-                    Useful for when user needs to summarize a text. User will need to specify a valid file name (.txt or .pdf) in the prompt. Only pass the name of the file as input message into the function.
-                    The prompt should contain keywords like summarize or summary.
-                    """,
-                    return_direct=True
-                ),
-                Tool.from_function(
-                    func=visualization_object.generate_visualizations,
-                    name="getAIVisuals",
-                    description="Tool to plot user data. User will to specify the file name and the type of graph in the prompt. The prompt should contain keywords like plot or graph or subplot.",
-                    return_direct=True
-                )
+        Tool.from_function(
+            func=tool_functions[tool_definition["Name"]][0],
+            coroutine=tool_functions[tool_definition["Name"]][1],
+            name=tool_definition["Name"],
+            description=tool_definition["Description"],
+            return_direct=True
+        )
+        for tool_definition in AGENT_TOOL_DEFINITIONS
     ]
 
     LOGGER.info("In bedrockUtil.define_tools, exiting with tools: %s", tools)
     return tools
 
-def initialize_langchain_agent(bedrock_runtime_client, model_item, model_params, tools, session_details, workspace_details):
+def get_agent_tool_registry():
     """
-    Utility function to initialize langchain agent
+    Utility function to compile the agent prompt and tool schemas once per container, the tools of the registry
+    are only used to render the prompt and are never invoked
     """
-    LOGGER.info("In bedrockUtil.initialize_langchain_agent, session id - %s", session_details["SessionId"])
+    if not AGENT_TOOL_REGISTRY:
+        LOGGER.info("In bedrockUtil.get_agent_tool_registry, compiling the agent prompt and tools")
+        schema_tools = [
+            Tool.from_function(func=lambda tool_input: tool_input, name=tool_definition["Name"], description=tool_definition["Description"], return_direct=True)
+            for tool_definition in AGENT_TOOL_DEFINITIONS
+        ]
+        prompt = ChatPromptTemplate([
+            ("system", AGENT_SYSTEM_PROMPT),
+            MessagesPlaceholder(variable_name="chat_history", optional=True),
+            ("human", AGENT_HUMAN_PROMPT),]
+        )
+        tool_prompt_token_costs = {tool.name: commonUtil.estimate_token_count(render_text_description_and_args([tool])) for tool in schema_tools}
+        AGENT_TOOL_REGISTRY.update({
+            "Tools": schema_tools,
+            "Prompt": prompt,
+            "ToolPromptTokenCosts": tool_prompt_token_costs,
+            "PromptTokenCost": commonUtil.estimate_token_count(AGENT_SYSTEM_PROMPT + AGENT_HUMAN_PROMPT) + sum(tool_prompt_token_costs.values())
+        })
+        LOGGER.info("In bedrockUtil.get_agent_tool_registry, prompt token cost - %s, tool prompt token costs - %s", AGENT_TOOL_REGISTRY["PromptTokenCost"], tool_prompt_token_costs)
+    return AGENT_TOOL_REGISTRY
 
+def initialize_langchain_agent(model_item, model_params):
+    """
+    Utility function to initialize langchain agent, the agent is built once per model and reused across invocations
+    """
     model_name = model_item["ModelName"]
     LOGGER.info("In bedrockUtil.initialize_langchain_agent, model name - %s", model_name)
-    model_provider = model_item["ModelProvider"] if model_item["ModelProvider"] == commonUtil.OPENAI_MODEL_PROVIDER else commonUtil.MODEL_PROVIDER_MAP.get(model_item["ModelProvider"].lower(), model_name.split('.')[0])
-
-    if model_provider == commonUtil.OPENAI_MODEL_PROVIDER:
-        llm = ChatOpenAI(model_name=model_name)
-    elif model_provider.lower() == "anthropic":
-        llm = ChatBedrock(model_id=model_name, model_kwargs=model_params, client=bedrock_runtime_client, provider=model_provider.lower())
-    else:
-        llm = BedrockLLM(model_id=model_name, model_kwargs=model_params, client=bedrock_runtime_client, provider=model_provider.lower())
+    llm_key = get_conversation_llm_key(model_item, model_params, False)
+    llm = get_conversation_llm(model_item, model_params, False)
 
-    LOGGER.info("In bedrockUtil.initialize_langchain_agent, initializing the agents")
+    def build_agent():
+        LOGGER.info("In bedrockUtil.initialize_langchain_agent, initializing the agents")
+        agent_tool_registry = get_agent_tool_registry()
+        # Using Structured agents with support for tools with multiple inputs.
+        return create_structured_chat_agent(llm, agent_tool_registry["Tools"], agent_tool_registry["Prompt"])
 
-    system = """ Respond the following questions as best you can to the human. Do no respond on your own. Use any one of the tools always. Do not give coded answers unless specified.
-                If you don't know which tool to use, use the getConversationResponse(used to converse with the chatbot. this is the default tool to be used. Answer questions about specific data from the file the user provides which requires analyzing data from a file. This should NOT BE CALLED WHEN SUMMARY IS REQUESTED) tool. 
-                Use getTextSummarization(Use this only if the input contains keywords 'summary' or 'summarize') when asked specifically to summarize.
-                Use getAIVisuals(Use this only if the input contains keywords 'plot' or 'draw' or 'graph' or 'visualize') when asked specifically to get visual or graphs on the data.
-                If you are not sure about the tool to use, use the getConversationResponse tool. If you are not sure about the input to the tool, use the getConversationResponse tool.
-
-        {tools}
-
-        Use a json blob to specify a tool by providing an action key (tool name) and an action_input key (tool input).
-        Valid "action" values: "Final Answer" or {tool_names}
-        "action_input" should only be of type string. Do not include the data type.
-        Provide only ONE action per $JSON_BLOB, as shown:
-
-        ```
-        {{
-        "action": $TOOL_NAME,
-        "action_input": $INPUT
-        }}
-        ```
-
-        Follow this format:
-
-        Question: input question to answer
-        Thought: consider previous and subsequent steps
-        Action:
-        ```
-        $JSON_BLOB
-        ```
-        Observation: action result
-        ... (repeat Thought/Action/Observation N times)
-        Thought: I know what to respond
-        Action:
-        ```
-        {{
-        "action": "Final Answer",
-        "action_input": "Final response to human"
-        }}
-
-        Begin! Reminder to ALWAYS respond with a valid json blob of a single action. Use tools if necessary. Respond directly if appropriate. Format is Action:```$JSON_BLOB```then Observation'''
-        """
-    human = """
-        Question: {input}
-        Thought:{agent_scratchpad}
-        (reminder to respond in a JSON blob no matter what)
-        """
-
-    prompt = ChatPromptTemplate([
-    ("system", system),
-    MessagesPlaceholder(variable_name="chat_history", optional=True),
-    ("human", human),]
-    )
-
-    # Using Structured agents with support for tools with multiple inputs.
-    agent = create_structured_chat_agent(llm, tools, prompt)
-    LOGGER.info("In bedrockUtil.initialize_langchain_agent, initializing complete with workspace details - %s", workspace_details)
-
-    return agent
+    return get_cached_conversation_pipeline(("agent",) + llm_key, build_agent)
 
 def get_chatbot_response(user_id, connection_id, message_id, model_item, workspace_details, session_details, message, summarization_metadata_dict, visualization_metadata_dict, **kwargs):
     """
@@ -1002,7 +2109,7 @@ def get_chatbot_response(user_id, connection_id, message_id, model_item, workspa
     """
     LOGGER.info("In bedrockUtil.get_chatbot_response method with kwargs: %s", kwargs)
     # pylint: disable=global-statement
-    global BEDROCK_RUNTIME_CLIENT, S3_CLIENT, DATASET_FILES_LAMBDA, LAMBDA_CLIENT, API_MANAGEMENT_CLIENT, DYNAMODB_RESOURCE, SESSIONS_TABLE, CHAT_HISTORY_TABLE, WORKSPACES_DOCUMENTS_TABLE, CHATBOTS_TABLE
+    global BEDROCK_RUNTIME_CLIENT, S3_CLIENT, DATASET_FILES_LAMBDA, LAMBDA_CLIENT, API_MANAGEMENT_CLIENT, DYNAMODB_RESOURCE, SESSIONS_TABLE, CHAT_HISTORY_TABLE, WORKSPACES_DOCUMENTS_TABLE, CHATBOTS_TABLE, WS_DELIVERY_SESSION
     BEDROCK_RUNTIME_CLIENT = kwargs["Boto3Clients"]["BedrockRuntimeClient"]
     S3_CLIENT = kwargs["Boto3Clients"]["S3Client"]
     LAMBDA_CLIENT = kwargs["Boto3Clients"]["LambdaClient"]
@@ -1012,6 +2119,12 @@ def get_chatbot_response(user_id, connection_id, message_id, model_item, workspa
     CHAT_HISTORY_TABLE = kwargs["ChatHistoryTable"]
     DATASET_FILES_LAMBDA = kwargs["DatasetFilesLambda"]
     WORKSPACES_DOCUMENTS_TABLE = kwargs["WorkspacesDocumentsTable"]
+    # reuse the delivery session of the caller so that the connection id is resolved only once per turn
+    WS_DELIVERY_SESSION = kwargs.get("DeliverySession") or commonUtil.WebSocketDeliverySession(
+        user_id, session_details["SessionId"],
+        {"ApiManagementClient": API_MANAGEMENT_CLIENT, "DynamoDBResource": DYNAMODB_RESOURCE, "SessionsTable": SESSIONS_TABLE},
+        connection_id
+    )
 
     if kwargs.get("IsExternalChatbot", False):
         CHATBOTS_TABLE = kwargs["ChatbotsTable"]
@@ -1027,30 +2140,32 @@ def get_chatbot_response(user_id, connection_id, message_id, model_item, workspa
     retrieve_llm_trace = bool(kwargs.get("RetrieveLLMTrace", False))
     LOGGER.info("In bedrockUtil.get_chatbot_response method, with debugging - %s ", retrieve_llm_trace)
 
-    # Only using langchain agent with Anthropic and OpenAI models as other model performance is bad
-    if kwargs.get("IsExternalChatbot", False) or commonUtil.MODEL_PROVIDER_MAP[model_provider.lower()] not in ["anthropic", "openai"]:
-        conversational_object = ConversationObject(model_item, workspace_details, session_details, model_params, file_config, user_id, connection_id, message_id, query_start_time, retrieve_llm_trace)
-        response = conversational_object.get_conversation_response(message)
-    else:
-        tools = define_tools(model_item, model_params, session_details, file_config, user_id, summarization_metadata_dict, visualization_metadata_dict, workspace_details, connection_id, message_id, query_start_time, retrieve_llm_trace)
-        agent = initialize_langchain_agent(BEDROCK_RUNTIME_CLIENT, model_item, model_params, tools, session_details, workspace_details)
-        agent_executor = AgentExecutor(agent=agent, tools=tools,max_iterations=3, early_stopping_method='force',
-                                       handle_parsing_errors=True, return_intermediate_steps=True, verbose=retrieve_llm_trace)
-
-        chatbot_response = agent_executor.invoke({'input': message})
-        LOGGER.info("In bedrockUtil.get_chatbot_response method, chatbot response - %s", chatbot_response)
-        # if summarization tool was used send response to user
-        if "tool='getTextSummarization'" in str(chatbot_response["intermediate_steps"]) or "tool='getAIVisuals'" in str(chatbot_response["intermediate_steps"]):
-            ts_message_time = commonUtil.get_current_time()
-            ts_response_time = str((datetime.strptime(ts_message_time, commonUtil.DATETIME_ISO_FORMAT) - datetime.strptime(query_start_time, commonUtil.DATETIME_ISO_FORMAT)).total_seconds() * 1000)
-            commonUtil.send_message_to_ws_connection(
-                        user_id,
-                        session_details["SessionId"],
-                        {"AIMessage": chatbot_response.get("output").get("content"),
-                         "Metadata": {"IsComplete": True, "MessageId": message_id, "ResponseTime": ts_response_time}},
-                        {"ApiManagementClient": API_MANAGEMENT_CLIENT, "DynamoDBResource": DYNAMODB_RESOURCE, "SessionsTable": SESSIONS_TABLE}
-            )
-        response = chatbot_response["output"]
+    try:
+        # Only using langchain agent with Anthropic and OpenAI models as other model performance is bad
+        if kwargs.get("IsExternalChatbot", False) or commonUtil.MODEL_PROVIDER_MAP[model_provider.lower()] not in ["anthropic", "openai"]:
+            conversational_object = ConversationObject(model_item, workspace_details, session_details, model_params, file_config, user_id, connection_id, message_id, query_start_time, retrieve_llm_trace)
+            response = conversational_object.get_conversation_response(message)
+        else:
+            tools = define_tools(model_item, model_params, session_details, file_config, user_id, summarization_metadata_dict, visualization_metadata_dict, workspace_details, connection_id, message_id, query_start_time, retrieve_llm_trace)
+            agent = initialize_langchain_agent(model_item, model_params)
+            agent_executor = AgentExecutor(agent=agent, tools=tools,max_iterations=3, early_stopping_method='force',
+                                           handle_parsing_errors=True, return_intermediate_steps=True, verbose=retrieve_llm_trace)
+
+            # the agent runs on the container event loop so that progress messages are sent while a tool lambda is running
+            chatbot_response = get_agent_event_loop().run_until_complete(agent_executor.ainvoke({'input': message}))
+            LOGGER.info("In bedrockUtil.get_chatbot_response method, chatbot response - %s", chatbot_response)
+            # if summarization tool was used send response to user
+            if "tool='getTextSummarization'" in str(chatbot_response["intermediate_steps"]) or "tool='getAIVisuals'" in str(chatbot_response["intermediate_steps"]):
+                ts_message_time = commonUtil.get_current_time()
+                ts_response_time = str((datetime.strptime(ts_message_time, commonUtil.DATETIME_ISO_FORMAT) - datetime.strptime(query_start_time, commonUtil.DATETIME_ISO_FORMAT)).total_seconds() * 1000)
+                WS_DELIVERY_SESSION.send_message(
+                    {"AIMessage": chatbot_response.get("output").get("content"),
+                     "Metadata": {"IsComplete": True, "MessageId": message_id, "ResponseTime": ts_response_time}}
+                )
+            response = chatbot_response["output"]
+    finally:
+        # the sources of the turn are delivered in the background and must be complete before the turn ends
+        wait_for_background_tasks()
 
     LOGGER.info("In bedrockUtil.get_chatbot_response method, exiting")
     return response
@@ -15,6 +15,7 @@ from uuid import UUID
 from io import BytesIO
 import gzip
 import base64
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
 from botocore.exceptions import ClientError
@@ -55,6 +56,15 @@ RUN_STATUS_STARTING = "STARTING"
 RUN_STATUS_IN_PROGRESS = "IN_PROGRESS"
 RUN_STATUS_COMPLETE = "COMPLETE"
 RUN_STATUS_FAILED = "FAILED"
+RUN_STATUS_STOPPING = "STOPPING"
+RUN_ACTIVE_STATUSES = [RUN_STATUS_STARTING, RUN_STATUS_IN_PROGRESS, RUN_STATUS_STOPPING]
+
+# file-based ingestion scheduling variables, changes are coalesced until no new change arrives for the
+# debounce window (or the pending changes are older than the max delay) and no run is in progress
+INGESTION_DEBOUNCE_WINDOW_IN_SECONDS = 60
+INGESTION_MAX_DELAY_IN_SECONDS = 600
+INGESTION_RUN_POLL_INTERVAL_IN_SECONDS = 60
+INGESTION_SCHEDULER_STALE_AFTER_IN_SECONDS = 1800
 
 # file synchronization variables
 FILE_SYNC_STATUS_PENDING = "pending"
@@ -120,10 +130,28 @@ EVENT_INFO = errorUtil.EVENT_INFO
 OPENAI_KEY_SSM_KEY = 'AMORPHIC.AI.CONFIG.OPENAIKEY'
 WORKSPACE_RETRIEVAL_MAXRESULTS_SSM_KEY = 'AMORPHIC.AI.CONFIG.WORKSPACE_RETRIEVAL_MAXRESULTS'
 
+# SSM parameter and secret cache, entries are keyed by parameter name (secrets are prefixed with secret:)
+PARAMETER_CACHE_DEFAULT_TTL_IN_SECONDS = 300
+PARAMETER_CACHE_NEGATIVE_TTL_IN_SECONDS = 60
+PARAMETER_CACHE_TTL_IN_SECONDS = {
+    OPENAI_KEY_SSM_KEY: 300,
+    WORKSPACE_RETRIEVAL_MAXRESULTS_SSM_KEY: 900
+}
+PARAMETER_CACHE = {}
+PARAMETER_CACHE_STATS = {"Hits": 0, "Misses": 0}
+
 CHAT_MESSAGE_DELIVERY_DELIVERED = 'DELIVERED'
 CHAT_MESSAGE_DELIVERY_PENDING = 'PENDING'
+CHAT_MESSAGE_DELIVERY_STREAMING = 'STREAMING'
 CHAT_MESSAGE_DELIVERY_FAILED = 'FAILED'
 
+# number of latest messages of a session that are loaded as conversation memory for a new turn
+CHAT_HISTORY_WINDOW_SIZE = 10
+# the loaded messages are trimmed further to fit in this budget before they are added to the prompt
+CHAT_HISTORY_TOKEN_BUDGET = 2000
+# rough number of characters per token, used to estimate token counts without a model specific tokenizer
+CHARACTERS_PER_TOKEN = 4
+
 CHAT_SESSION_VALIDITY_IN_DAYS = 365
 CHATBOT_SESSION_VALIDITY_IN_DAYS = 7
 AGENT_IDLE_SESSION_TIMEOUT_IN_SECONDS = 3600
@@ -153,6 +181,45 @@ MODEL_PROVIDER_MAX_TOKENS_MAP = {
     'mistral': 4096
 }
 
+# context window (prompt and response tokens) of each provider, the smallest window among the supported models of the provider
+MODEL_PROVIDER_CONTEXT_WINDOW_MAP = {
+    'amazon': 8000,
+    'anthropic': 100000,
+    'ai21': 8191,
+    'cohere': 4096,
+    'meta': 8192,
+    'mistral': 32000,
+    'openai': 16385
+}
+DEFAULT_MODEL_CONTEXT_WINDOW = 4096
+# average number of characters per token of the tokenizers of each provider, kept on the low side so that estimates err on the safe side
+MODEL_PROVIDER_CHARACTERS_PER_TOKEN_MAP = {
+    'amazon': 4,
+    'anthropic': 3.5,
+    'ai21': 4,
+    'cohere': 4,
+    'meta': 3.5,
+    'mistral': 3.5,
+    'openai': 4
+}
+
+# Cognito user validation cache, entries are keyed by UserId and hold the allowed apps of the user or None for users who are
+# not active in cognito. The cache is local to each lambda container and users are disabled or deleted outside of the application,
+# so entries are invalidated only by their TTL, the short TTL of the negative entries bounds how long a re-enabled user stays rejected
+USER_VALIDATION_CACHE_TTL_IN_SECONDS = 300
+USER_VALIDATION_NEGATIVE_CACHE_TTL_IN_SECONDS = 30
+USER_VALIDATION_CACHE_MAX_ENTRIES = 5000
+USER_VALIDATION_CACHE = {}
+COGNITO_UTIL = None
+
+# TBAC file access cache, entries are keyed by (UserId, DatasetId) and hold the access decision of each checked file
+FILE_ACCESS_CACHE_TTL_IN_SECONDS = 60
+FILE_ACCESS_CACHE_MAX_ENTRIES = 1000
+FILE_ACCESS_CACHE = {}
+# number of files sent in a single file-access check and number of checks run concurrently
+FILE_ACCESS_CHECK_BATCH_SIZE = 100
+FILE_ACCESS_CHECK_MAX_WORKERS = 10
+
 class ExtendedEnum:
     """
     Extend Enum.
@@ -822,18 +889,104 @@ def validate_s3_path(s3_full_path):
 
     LOGGER.info("In commonUtil.validate_s3_path, S3 path - %s, is valid", s3_full_path)
 
+def cache_parameter_value(cache_key, value, ttl=None):
+    """
+    This function stores a parameter or secret value in the cache, None is stored as a negative entry
+    :param cache_key: parameter name or secret:<secret id>
+    :param value: value of the parameter, None if it does not exist
+    :param ttl: time to live of the entry in seconds
+    """
+    if value is None:
+        ttl = PARAMETER_CACHE_NEGATIVE_TTL_IN_SECONDS
+    elif ttl is None:
+        ttl = PARAMETER_CACHE_TTL_IN_SECONDS.get(cache_key, PARAMETER_CACHE_DEFAULT_TTL_IN_SECONDS)
+    PARAMETER_CACHE[cache_key] = {"Value": value, "ExpiryTime": time.time() + ttl}
+
+def get_parameter_from_cache(cache_key):
+    """
+    This function returns the cache entry of a parameter or secret if it is not expired and updates the hit/miss counters
+    :param cache_key: parameter name or secret:<secret id>
+    :return: cache entry dict with Value or None
+    """
+    cache_entry = PARAMETER_CACHE.get(cache_key)
+    if cache_entry and cache_entry["ExpiryTime"] > time.time():
+        PARAMETER_CACHE_STATS["Hits"] += 1
+        return cache_entry
+    PARAMETER_CACHE_STATS["Misses"] += 1
+    PARAMETER_CACHE.pop(cache_key, None)
+    return None
+
+def get_cached_parameter(parameter_name, ssm_client=None, ttl=None):
+    """
+    This function returns the decrypted value of a ssm parameter from the cache, the parameter is retrieved
+    from ssm only if it is not cached or the cached value is expired
+    :param parameter_name: name of the parameter
+    :param ssm_client: ssm service boto3 client, default client of the module is used if not passed
+    :param ttl: time to live of the value in seconds, overrides the default ttl of the parameter
+    :return: value of the parameter or None if the parameter does not exist
+    """
+    cache_entry = get_parameter_from_cache(parameter_name)
+    if cache_entry:
+        return cache_entry["Value"]
+    ssm_client = ssm_client if ssm_client else SSM_CLIENT
+    LOGGER.info("In commonUtil.get_cached_parameter, retrieving value of param %s from ssm", parameter_name)
+    try:
+        value = ssm_client.get_parameter(Name=parameter_name, WithDecryption=True)['Parameter']['Value']
+    except ssm_client.exceptions.ParameterNotFound:
+        LOGGER.info("In commonUtil.get_cached_parameter, ParameterNotFound - %s", parameter_name)
+        value = None
+    cache_parameter_value(parameter_name, value, ttl)
+    return value
+
+def prefetch_parameters(parameter_names, ssm_client=None):
+    """
+    This function retrieves the parameters with batched get_parameters calls and stores them in the cache,
+    it is meant to be called at cold start so failures are only logged
+    :param parameter_names: list of parameter names
+    :param ssm_client: ssm service boto3 client, default client of the module is used if not passed
+    """
+    LOGGER.info("In commonUtil.prefetch_parameters, prefetching parameters - %s", parameter_names)
+    ssm_client = ssm_client if ssm_client else SSM_CLIENT
+    try:
+        # get_parameters accepts at most 10 names per call
+        for index in range(0, len(parameter_names), 10):
+            response = ssm_client.get_parameters(Names=parameter_names[index:index + 10], WithDecryption=True)
+            for parameter in response.get("Parameters", []):
+                cache_parameter_value(parameter["Name"], parameter["Value"])
+            for parameter_name in response.get("InvalidParameters", []):
+                cache_parameter_value(parameter_name, None)
+    except Exception as ex:
+        LOGGER.error("In commonUtil.prefetch_parameters, failed to prefetch parameters with error - %s", str(ex))
+
+def refresh_cached_parameter(parameter_name=None):
+    """
+    This function removes a parameter or secret from the cache so that it is retrieved again on next use,
+    clears the whole cache if no parameter name is passed
+    :param parameter_name: parameter name or secret:<secret id>
+    """
+    LOGGER.info("In commonUtil.refresh_cached_parameter, refreshing cache for - %s", parameter_name)
+    if parameter_name:
+        PARAMETER_CACHE.pop(parameter_name, None)
+    else:
+        PARAMETER_CACHE.clear()
+
+def get_parameter_cache_stats():
+    """
+    This function returns the hit/miss counters and the number of entries of the parameter cache
+    """
+    return {"Hits": PARAMETER_CACHE_STATS["Hits"], "Misses": PARAMETER_CACHE_STATS["Misses"], "Entries": len(PARAMETER_CACHE)}
+
 def get_decrypted_value(parameter):
     """
     This function will decrypt the value that is stored in ssm parameter store
     :param parameter:
     :return:
     """
-    client = boto3.client('ssm')
-    param_details = client.get_parameter(
-        Name=parameter,
-        WithDecryption=True
-    )
-    return param_details['Parameter']['Value']
+    value = get_cached_parameter(parameter)
+    if value is None:
+        raise SSM_CLIENT.exceptions.ParameterNotFound(
+            {"Error": {"Code": "ParameterNotFound", "Message": f"Parameter {parameter} not found"}}, "GetParameter")
+    return value
 
 def get_secret_value(secrets_manager_client, secret_id, version_stage=None, version_id=None):
     """
@@ -862,6 +1015,23 @@ def get_secret_value(secrets_manager_client, secret_id, version_stage=None, vers
         raise errorUtil.InvalidInputException(EVENT_INFO, ec_ge_1114) from cer
     return secrets_response["SecretString"]
 
+def get_cached_secret_value(secrets_manager_client, secret_id, ttl=None):
+    """
+    Return secret string of the current version of the secret from the parameter cache, the secret is
+    retrieved from secrets manager only if it is not cached or the cached value is expired
+    :param secrets_manager_client: BOTO3 Secrets Manager Client
+    :param secret_id: SecretId
+    :param ttl: time to live of the value in seconds
+    :return: String
+    """
+    cache_key = f"secret:{secret_id}"
+    cache_entry = get_parameter_from_cache(cache_key)
+    if cache_entry:
+        return cache_entry["Value"]
+    secret_value = get_secret_value(secrets_manager_client, secret_id)
+    cache_parameter_value(cache_key, secret_value, ttl)
+    return secret_value
+
 def get_presigned_url_get_object(s3_client, bucket_name, object_key, output_file_key, disposition_type='attachment', expiration_in_seconds=3600, **kwargs):
     """
     Generate a presigned URL for download files from s3
@@ -958,6 +1128,32 @@ def sort_page_in_code(**kwargs):
 
     return new_items_dict
 
+def encode_pagination_token(last_evaluated_key):
+    """
+    This function encodes the LastEvaluatedKey of a dynamodb query into an opaque token for the next page
+    :param last_evaluated_key: LastEvaluatedKey of the query, None if there are no more pages
+    :return: url safe token or None
+    """
+    if not last_evaluated_key:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key, cls=DecimalEncoder, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+def decode_pagination_token(token):
+    """
+    This function decodes a token created by encode_pagination_token into the ExclusiveStartKey of a dynamodb query
+    :param token: token returned with the previous page
+    :return: ExclusiveStartKey, None if the token is not valid
+    """
+    try:
+        exclusive_start_key = json.loads(base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8"))
+    except (ValueError, UnicodeError) as ex:
+        LOGGER.error("In commonUtil.decode_pagination_token, invalid token - %s", str(ex))
+        return None
+    if not isinstance(exclusive_start_key, dict):
+        LOGGER.error("In commonUtil.decode_pagination_token, token does not contain a valid key")
+        return None
+    return exclusive_start_key
+
 def get_ssm_parameter(ssm_client, parameter_name):
     """
     This function returns a parameter's value from ssm given its name
@@ -1006,6 +1202,14 @@ def create_ssm_parameter(ssm_client, input_body):
     response = ssm_client.put_parameter(**input_body)
     LOGGER.info("In commonUtil.create_ssm_parameter, response - %s", response)
 
+def estimate_token_count(text, model_provider=None):
+    """
+    Returns an estimate of the number of tokens of the text
+    :param text: input text
+    :param model_provider: provider key (as in MODEL_PROVIDER_MAP values) whose tokenizer ratio is used, the generic ratio if not passed
+    """
+    return int(len(text) // MODEL_PROVIDER_CHARACTERS_PER_TOKEN_MAP.get(model_provider, CHARACTERS_PER_TOKEN)) + 1
+
 def get_current_time():
     """
     Retrieves current datetime in ISO format
@@ -1479,6 +1683,124 @@ def get_user_resource_permission(user_id, resource_id, user_table, groups_table,
         return 'owner'
     return 'read-only'
 
+def get_cognito_util():
+    """
+    Returns the CognitoUtil object of the user pool, the object is created once per execution environment
+    """
+    global COGNITO_UTIL # pylint: disable=global-statement
+    if not COGNITO_UTIL:
+        COGNITO_UTIL = cognitoUtil.CognitoUtil(USER_POOL_ID, AWS_REGION)
+    return COGNITO_UTIL
+
+def invalidate_user_validation_cache(user_id=None):
+    """
+    Removes the cached validation result of a user, clears the whole cache if no user is specified
+    :param user_id: UserId of the user to be removed from the cache
+    """
+    LOGGER.info("In commonUtil.invalidate_user_validation_cache, invalidating cache for UserId: %s", user_id)
+    if user_id:
+        USER_VALIDATION_CACHE.pop(user_id, None)
+    else:
+        USER_VALIDATION_CACHE.clear()
+
+def get_cognito_user_name(cognito_user, attributes_key='Attributes'):
+    """
+    Returns the name by which the user is identified in the application, custom:username takes precedence over the Username
+    :param cognito_user: user object as returned by cognito
+    :param attributes_key: key which holds the attributes in the user object
+    """
+    user_name = cognito_user['Username']
+    for each_attr in cognito_user.get(attributes_key, []):
+        if each_attr["Name"] == "custom:username":
+            user_name = each_attr["Value"]
+    return user_name
+
+def get_cognito_user_allowed_apps(cognito_user, attributes_key='Attributes'):
+    """
+    Returns the list of apps the user has access to
+    :param cognito_user: user object as returned by cognito
+    :param attributes_key: key which holds the attributes in the user object
+    """
+    allowed_apps = ["amorphic"]
+    for each_attr in cognito_user.get(attributes_key, []):
+        if str(each_attr["Name"]) == "custom:attr3":
+            # Value will be in format of "allowed_apps=amorphic,idp"
+            allowed_apps = each_attr["Value"].split("=")[1].split(",")
+    return list(set(allowed_apps))
+
+def is_active_cognito_user(cognito_user):
+    """
+    Checks if the user is enabled and has the status expected for the idp configuration
+    :param cognito_user: user object as returned by cognito
+    """
+    expected_status = "CONFIRMED" if ENABLE_IDP == "no" else "EXTERNAL_PROVIDER"
+    return cognito_user.get('Enabled', True) and cognito_user.get('UserStatus') == expected_status
+
+def cache_user_allowed_apps(user_id, allowed_apps):
+    """
+    Stores the allowed apps of the user in the validation cache, the expired entries and then the oldest entries are evicted
+    once the cache is full
+    :param user_id: UserId of the user
+    :param allowed_apps: list of apps the user has access to, None for a user who is not an active cognito user
+    """
+    if user_id not in USER_VALIDATION_CACHE and len(USER_VALIDATION_CACHE) >= USER_VALIDATION_CACHE_MAX_ENTRIES:
+        current_time = time.time()
+        for cache_key in [cache_key for cache_key, entry in USER_VALIDATION_CACHE.items() if entry["ExpiryTime"] <= current_time]:
+            USER_VALIDATION_CACHE.pop(cache_key)
+        if len(USER_VALIDATION_CACHE) >= USER_VALIDATION_CACHE_MAX_ENTRIES:
+            USER_VALIDATION_CACHE.pop(next(iter(USER_VALIDATION_CACHE)))
+    cache_ttl = USER_VALIDATION_CACHE_TTL_IN_SECONDS if allowed_apps is not None else USER_VALIDATION_NEGATIVE_CACHE_TTL_IN_SECONDS
+    USER_VALIDATION_CACHE[user_id] = {
+        "AllowedApps": allowed_apps,
+        "ExpiryTime": time.time() + cache_ttl
+    }
+
+def get_user_allowed_apps(user_id, email_id=None):
+    """
+    Retrieves the list of apps the user has access to, returns None if the user is not an active cognito user.
+    Lookup order is the validation cache, a point lookup on the username, a filtered lookup on the email of the user
+    and finally a listing of all the active users of the pool, which also warms the cache for the other users.
+    Users who are not found or not active are cached with a short TTL so that unknown users can't force repeated pool listings
+    :param user_id: UserId of the user
+    :param email_id: email of the user as stored in the users table
+    """
+    cache_entry = USER_VALIDATION_CACHE.get(user_id)
+    if cache_entry and cache_entry["ExpiryTime"] > time.time():
+        LOGGER.info("In commonUtil.get_user_allowed_apps, validation cache hit for UserId: %s", user_id)
+        return cache_entry["AllowedApps"]
+    invalidate_user_validation_cache(user_id)
+
+    cognito_util = get_cognito_util()
+    cognito_user = cognito_util.get_user(user_id)
+    if cognito_user and get_cognito_user_name(cognito_user, 'UserAttributes') == user_id:
+        LOGGER.info("In commonUtil.get_user_allowed_apps, user %s found with point lookup", user_id)
+        if not is_active_cognito_user(cognito_user):
+            cache_user_allowed_apps(user_id, None)
+            return None
+        allowed_apps = get_cognito_user_allowed_apps(cognito_user, 'UserAttributes')
+        cache_user_allowed_apps(user_id, allowed_apps)
+        return allowed_apps
+
+    # Federated users are identified by custom:username which can't be used in list_users filters
+    cognito_users = cognito_util.get_users_list(filter_condition=f'email = "{email_id}"') if email_id else []
+    if not any(get_cognito_user_name(each_user) == user_id for each_user in cognito_users):
+        LOGGER.info("In commonUtil.get_user_allowed_apps, listing all the active users of the pool")
+        filter_cond = 'cognito:user_status = "CONFIRMED"' if ENABLE_IDP == "no" else 'cognito:user_status = "EXTERNAL_PROVIDER"'
+        cognito_users = cognito_util.get_users_list(filter_condition=filter_cond)
+
+    allowed_apps = None
+    for each_user in cognito_users:
+        if not is_active_cognito_user(each_user):
+            continue
+        user_name = get_cognito_user_name(each_user)
+        user_allowed_apps = get_cognito_user_allowed_apps(each_user)
+        cache_user_allowed_apps(user_name, user_allowed_apps)
+        if user_name == user_id:
+            allowed_apps = user_allowed_apps
+    if allowed_apps is None:
+        cache_user_allowed_apps(user_id, None)
+    return allowed_apps
+
 def is_valid_user(user_id, skip_user_check=False):
     """
     This method will check if user have permission to do specific operations
@@ -1489,34 +1811,19 @@ def is_valid_user(user_id, skip_user_check=False):
         ec_ipv_1002 = errorUtil.get_error_object("IPV-1002")
         ec_ipv_1002['Message'] = ec_ipv_1002['Message'].format("UserId", user_id)
         raise errorUtil.InvalidInputException(EVENT_INFO, ec_ipv_1002)
+    if not user_item:
+        # user was removed from the application, don't trust a validation cached while the user still existed
+        invalidate_user_validation_cache(user_id)
 
-    cognito_util = cognitoUtil.CognitoUtil(USER_POOL_ID, AWS_REGION)
-    filter_cond = 'cognito:user_status = "CONFIRMED"' if ENABLE_IDP == "no" else 'cognito:user_status = "EXTERNAL_PROVIDER"'
-    cognito_user_response = cognito_util.get_users_list(filter_condition=filter_cond)
     # Check if user have access to the vertical
-    user_allowed_apps = []
-    invalid_user = True
-    for each_user in cognito_user_response:
-        allowed_apps = ["amorphic"]
-        user_name = each_user['Username'] if each_user['Username'] == user_id else None
-        for each_attr in each_user.get('Attributes', []):
-            if each_attr["Name"] == "custom:username":
-                user_name = each_user['Username'] if user_id == each_attr["Value"] else None
-            if str(each_attr["Name"]) == "custom:attr3":
-                # Value will be in format of "allowed_apps=amorphic,idp"
-                allowed_apps = (each_attr["Value"].split("=")[1].split(","))
-        # If a user is found then no need to continue the iteration, break the loop
-        if user_name:
-            invalid_user = False
-            break
-    user_allowed_apps = list(set(allowed_apps))
+    user_allowed_apps = get_user_allowed_apps(user_id, user_item.get("EmailId") if user_item else None)
 
     LOGGER.info("In commonUtil.is_valid_user, checking if user have access to the vertical or invalid user")
-    if not invalid_user and VERTICAL_NAME.lower() not in user_allowed_apps:
+    if user_allowed_apps is not None and VERTICAL_NAME.lower() not in user_allowed_apps:
         LOGGER.error("In commonUtil.is_valid_user, user doesn't have access to the vertical")
         errorUtil.raise_exception(EVENT_INFO, "GF", "GE-1034", "User doesn't have access to the vertical")
 
-    if invalid_user:
+    if user_allowed_apps is None:
         LOGGER.error("In commonUtil.is_valid_user, user doesn't have access to the vertical")
         errorUtil.raise_exception(EVENT_INFO, "GF", "GE-1034", "User does not exist")
 
@@ -1853,10 +2160,8 @@ def find_delimiter(file_path):
 def get_openai_key(ssm_client):
     """Get OpenAIKey value from ssm if exists
     """
-    if ssm_parameter_exists(ssm_client, OPENAI_KEY_SSM_KEY):
-        return get_decrypted_value(OPENAI_KEY_SSM_KEY)
-    else:
-        return ""
+    openai_key = get_cached_parameter(OPENAI_KEY_SSM_KEY, ssm_client)
+    return openai_key if openai_key else ""
 
 def is_valid_jsonl(file_path):
     """
@@ -1948,58 +2253,113 @@ def update_message_delivery_status(user_id, session_id, delivery_status, kwargs)
         expression_attributes
     )
 
+class WebSocketDeliverySession():
+    """
+    Delivers the messages of a single chat turn to the websocket connection of a session.
+    The connection id is resolved once and the delivery status is only written to the sessions table
+    when it changes (pending -> streaming -> delivered/failed)
+    """
+
+    def __init__(self, user_id, session_id, kwargs, connection_id=None):
+        """
+        :param user_id: UserId (or ChatbotId) of the sessions table item
+        :param session_id: SessionId of the sessions table item
+        :param kwargs: dict with ApiManagementClient, DynamoDBResource and SessionsTable
+        :param connection_id: websocket connection id, retrieved from the sessions table if not passed
+        """
+        self.user_id = user_id
+        self.session_id = session_id
+        self.kwargs = kwargs
+        self.api_management_client = kwargs["ApiManagementClient"]
+        self.connection_id = connection_id
+        self.delivery_status = None
+
+    def get_connection_id(self, refresh=False):
+        """
+        Returns the websocket connection id of the session
+        :param refresh: retrieve the connection id from the sessions table even if it is already resolved
+        """
+        if not self.connection_id or refresh:
+            session_item = dynamodbUtil.get_item_with_key(
+                self.kwargs["DynamoDBResource"].Table(self.kwargs["SessionsTable"]),
+                {
+                    "UserId": self.user_id,
+                    "SessionId": self.session_id
+                }
+            )
+            self.connection_id = session_item["ConnectionId"]
+        return self.connection_id
+
+    def update_delivery_status(self, delivery_status, latest_message_id=None):
+        """
+        Writes the message delivery status to the sessions table if it changed
+        :param delivery_status: one of the CHAT_MESSAGE_DELIVERY_* statuses
+        :param latest_message_id: id of the message that was delivered last
+        """
+        if delivery_status == self.delivery_status and not latest_message_id:
+            return
+        status_kwargs = dict(self.kwargs)
+        status_kwargs.pop("LatestMessageId", None)
+        if latest_message_id:
+            status_kwargs["LatestMessageId"] = latest_message_id
+        update_message_delivery_status(self.user_id, self.session_id, delivery_status, status_kwargs)
+        self.delivery_status = delivery_status
+
+    def send_message(self, message, is_final=False, latest_message_id=None):
+        """
+        Sends a message to the websocket connection of the session
+        :param message: message dict to be sent
+        :param is_final: whether this is the last message of the chat turn
+        :param latest_message_id: id of the message to be recorded with the final delivery status
+        """
+        # retry mechanism for sending message back to user
+        max_retries = 3
+        retry = 0
+        resp = None
+        while retry < max_retries:
+            try:
+                resp = self.api_management_client.post_to_connection(
+                    Data=json.dumps(message),
+                    ConnectionId=str(self.get_connection_id(refresh=retry > 0))
+                )
+                break
+            except Exception as ex:
+                LOGGER.error("In commonUtil.WebSocketDeliverySession.send_message, failed to send message to connection due to error - %s", str(ex))
+                time.sleep(3**retry)
+                retry += 1
+
+        if retry == max_retries:
+            self.update_delivery_status(CHAT_MESSAGE_DELIVERY_FAILED)
+        elif is_final:
+            self.update_delivery_status(CHAT_MESSAGE_DELIVERY_DELIVERED, latest_message_id)
+        else:
+            self.update_delivery_status(CHAT_MESSAGE_DELIVERY_STREAMING)
+        LOGGER.info("In commonUtil.WebSocketDeliverySession.send_message, response from client - %s", resp)
+
 def send_message_to_ws_connection(user_id, session_id, message, kwargs):
     """
     This method will send a message to websocket connection
-    :param apimanagement_client:
-    :param api_url:
-    :param connection_id:
+    :param user_id:
+    :param session_id:
     :param message:
+    :param kwargs: dict with ApiManagementClient, DynamoDBResource, SessionsTable and optionally LatestMessageId
     :return:
     """
     LOGGER.info("In commonUtil.send_message_to_ws_connection, starting method with user id: %s, session id: %s", user_id, session_id)
-    api_management_client = kwargs["ApiManagementClient"]
-    dynamodb_res = kwargs["DynamoDBResource"]
-    sessions_table = kwargs["SessionsTable"]
-    # retry mechanism for sending message back to user
-    max_retries = 3
-    retry = 0
-    while retry < max_retries:
-        try:
-            # get connection id from sessions table item
-            session_item =  dynamodbUtil.get_item_with_key(
-                dynamodb_res.Table(sessions_table),
-                {
-                    "UserId": user_id,
-                    "SessionId": session_id
-                }
-            )
-            connection_id = session_item["ConnectionId"]
-            resp = api_management_client.post_to_connection(
-                Data=json.dumps(message),
-                ConnectionId=str(connection_id)
-            )
-            update_message_delivery_status(user_id, session_id, CHAT_MESSAGE_DELIVERY_DELIVERED, kwargs)
-            break
-        except Exception as ex:
-            LOGGER.error("In commonUtil.lambda_handler, failed to send message to connection due to error - %s", str(ex))
-            time.sleep(3**retry)
-            retry += 1
+    delivery_session = WebSocketDeliverySession(user_id, session_id, kwargs)
+    delivery_session.send_message(message, is_final=True, latest_message_id=kwargs.get("LatestMessageId"))
 
-    if retry == max_retries:
-        update_message_delivery_status(user_id, session_id, CHAT_MESSAGE_DELIVERY_FAILED, kwargs)
-    LOGGER.info("In commonUtil.send_message_to_ws_connection, response from client - %s", resp)
-
-def check_user_files_access(user_id, dataset_id, files, lambda_client, dataset_files_lambda):
+def check_user_files_access(user_id, dataset_id, files, lambda_client, dataset_files_lambda, auth_resources=None):
     """
     This method will return the file access for the user
     :param user_id: user id
     :param dataset_id: dataset id
     :param files: list of file names
+    :param auth_resources: tuple of auth token and role id of the user, retrieved if not passed
     :return:
     """
     LOGGER.info("In commonUtil.check_user_file_access, starting method with user id: %s, dataset id: %s and files: %s", user_id, dataset_id, files)
-    auth_token, role_id = get_user_auth_resources(user_id, USERS_TABLE)
+    auth_token, role_id = auth_resources or get_user_auth_resources(user_id, USERS_TABLE)
 
     check_dataset_file_access_payload = {
         "headers": {
@@ -2030,6 +2390,90 @@ def check_user_files_access(user_id, dataset_id, files, lambda_client, dataset_f
     LOGGER.info("In commonUtil.check_user_file_access, response - %s", check_file_access_response)
     return check_file_access_response['Files']
 
+def get_cached_files_access(user_id, dataset_id, files):
+    """
+    Returns the cached access decisions of the files and the files which are not cached
+    :param user_id: user id
+    :param dataset_id: dataset id
+    :param files: list of file names
+    :return: dict of file name to access and list of files to be checked
+    """
+    cache_entry = FILE_ACCESS_CACHE.get((user_id, dataset_id))
+    if not cache_entry or cache_entry["ExpiryTime"] <= time.time():
+        FILE_ACCESS_CACHE.pop((user_id, dataset_id), None)
+        return {}, files
+    files_access = {file_name: cache_entry["Files"][file_name] for file_name in files if file_name in cache_entry["Files"]}
+    return files_access, [file_name for file_name in files if file_name not in files_access]
+
+def cache_files_access(user_id, dataset_id, files_access):
+    """
+    Stores the access decisions of the files in the file access cache, decisions added to an existing entry
+    expire along with it
+    :param user_id: user id
+    :param dataset_id: dataset id
+    :param files_access: dict of file name to access
+    """
+    cache_entry = FILE_ACCESS_CACHE.get((user_id, dataset_id))
+    if cache_entry and cache_entry["ExpiryTime"] > time.time():
+        cache_entry["Files"].update(files_access)
+        return
+    if len(FILE_ACCESS_CACHE) >= FILE_ACCESS_CACHE_MAX_ENTRIES:
+        current_time = time.time()
+        for cache_key in [cache_key for cache_key, entry in FILE_ACCESS_CACHE.items() if entry["ExpiryTime"] <= current_time]:
+            FILE_ACCESS_CACHE.pop(cache_key)
+        if len(FILE_ACCESS_CACHE) >= FILE_ACCESS_CACHE_MAX_ENTRIES:
+            FILE_ACCESS_CACHE.pop(next(iter(FILE_ACCESS_CACHE)))
+    FILE_ACCESS_CACHE[(user_id, dataset_id)] = {
+        "Files": dict(files_access),
+        "ExpiryTime": time.time() + FILE_ACCESS_CACHE_TTL_IN_SECONDS
+    }
+
+def invalidate_files_access_cache(user_id=None, dataset_id=None):
+    """
+    Removes the cached file access decisions of a user and/or dataset, clears the whole cache if neither is specified
+    :param user_id: user id
+    :param dataset_id: dataset id
+    """
+    LOGGER.info("In commonUtil.invalidate_files_access_cache, invalidating cache for user id: %s, dataset id: %s", user_id, dataset_id)
+    for cache_key in list(FILE_ACCESS_CACHE):
+        if (user_id is None or cache_key[0] == user_id) and (dataset_id is None or cache_key[1] == dataset_id):
+            FILE_ACCESS_CACHE.pop(cache_key)
+
+def check_user_datasets_files_access(user_id, dataset_files_map, lambda_client, dataset_files_lambda):
+    """
+    Resolves the access of the user to the files of multiple datasets. Cached decisions are reused, the remaining
+    files are checked in batches and the checks of all the datasets are run concurrently
+    :param user_id: user id
+    :param dataset_files_map: dict of dataset id to list of file names
+    :param lambda_client: boto3 lambda client
+    :param dataset_files_lambda: arn of the dataset files lambda
+    :return: dict of dataset id to dict of file name to access
+    """
+    LOGGER.info("In commonUtil.check_user_datasets_files_access, starting method with user id: %s and %s datasets", user_id, len(dataset_files_map))
+    datasets_files_access = {}
+    pending_checks = []
+    for dataset_id, files in dataset_files_map.items():
+        files_access, uncached_files = get_cached_files_access(user_id, dataset_id, list(dict.fromkeys(files)))
+        datasets_files_access[dataset_id] = files_access
+        pending_checks.extend(
+            (dataset_id, uncached_files[index:index + FILE_ACCESS_CHECK_BATCH_SIZE])
+            for index in range(0, len(uncached_files), FILE_ACCESS_CHECK_BATCH_SIZE)
+        )
+    LOGGER.info("In commonUtil.check_user_datasets_files_access, %s file access checks are required", len(pending_checks))
+    if pending_checks:
+        # auth resources are shared by all the checks of the user
+        auth_resources = get_user_auth_resources(user_id, USERS_TABLE)
+        with ThreadPoolExecutor(max_workers=min(FILE_ACCESS_CHECK_MAX_WORKERS, len(pending_checks))) as executor:
+            check_results = executor.map(
+                lambda pending_check: (pending_check[0], check_user_files_access(user_id, pending_check[0], pending_check[1], lambda_client, dataset_files_lambda, auth_resources)),
+                pending_checks
+            )
+            for dataset_id, files_access_list in check_results:
+                files_access = {file_name: file_access for file_item in files_access_list for file_name, file_access in file_item.items()}
+                cache_files_access(user_id, dataset_id, files_access)
+                datasets_files_access[dataset_id].update(files_access)
+    return datasets_files_access
+
 def disconnect_websocket(connection_id, kwargs):
     """
     This method will update the sessions table with connection end time
@@ -10,6 +10,8 @@ import sys
 import os
 import re
 import time
+import random
+from concurrent.futures import ThreadPoolExecutor
 
 from botocore.exceptions import ClientError
 import boto3
@@ -20,6 +22,13 @@ LOGGER.setLevel(logging.INFO)
 
 EVENT_INFO = errorUtil.EVENT_INFO
 DELETION_PROTECTION_KEY = "AMORPHIC.CONFIG.DELETIONPROTECTIONENABLE"
+BATCH_GET_ITEMS_BATCH_SIZE = 100
+BATCH_GET_ITEMS_MAX_WORKERS = 8
+BATCH_GET_ITEMS_MAX_RETRIES = 8
+BATCH_GET_ITEMS_BASE_BACKOFF_IN_SECONDS = 0.05
+BATCH_GET_ITEMS_MAX_BACKOFF_IN_SECONDS = 2
+BATCH_WRITE_ITEMS_BATCH_SIZE = 25
+BATCH_WRITE_ITEMS_MAX_WORKERS = 8
 
 
 try:
@@ -302,44 +311,127 @@ def batch_delete_items(dynamodb_table, key_list):
             batch.delete_item(Key=key)
     LOGGER.info("In dynamodbUtil.batch_delete_items, exiting")
 
-def batch_get_items(dynamodb_resource, table_name, key_list, projection_expression=None, expression_attribute_names=None):
+def batch_delete_items_chunk(dynamodb_client, table_name, keys):
+    """
+    Deletes a single chunk of at most 25 keys from a table and retries the
+    UnprocessedItems returned by dynamodb until all of them are deleted
+    :param dynamodb_client: boto3 dynamodb client
+    :param table_name: table name in dynamodb
+    :param keys: list of keys in the chunk
+    """
+    pending_requests = [{"DeleteRequest": {"Key": key}} for key in keys]
+    attempt = 0
+    while pending_requests:
+        response_write_items = dynamodb_client.batch_write_item(RequestItems={table_name: pending_requests})
+        pending_requests = response_write_items.get("UnprocessedItems", {}).get(table_name, [])
+        if not pending_requests:
+            break
+        if attempt >= BATCH_GET_ITEMS_MAX_RETRIES:
+            LOGGER.error("In dynamodbUtil.batch_delete_items_chunk, %s keys are still unprocessed in table %s after %s retries", len(pending_requests), table_name, attempt)
+            ec_db_1013 = errorUtil.get_error_object("DB-1013")
+            ec_db_1013['Message'] = ec_db_1013['Message'].format(len(pending_requests), table_name)
+            raise errorUtil.GenericFailureException(EVENT_INFO, ec_db_1013)
+        backoff_time = get_batch_get_items_backoff_time(attempt)
+        LOGGER.info("In dynamodbUtil.batch_delete_items_chunk, retrying %s unprocessed keys of table %s after %s seconds", len(pending_requests), table_name, backoff_time)
+        time.sleep(backoff_time)
+        attempt += 1
+
+def parallel_batch_delete_items(dynamodb_resource, table_name, key_list):
+    """
+    Removes the items from a dynamoDB table, keys are split into chunks of 25 (the dynamodb limit)
+    which are deleted concurrently, and UnprocessedItems of each chunk are retried with jittered backoff
+    :param dynamodb_resource: boto3.resource("dynamodb")
+    :param table_name: table name in dynamodb
+    :param key_list: list of keys, {"KeyName": "KeyValue"}
+    """
+    LOGGER.info("In dynamodbUtil.parallel_batch_delete_items, deleting %s items from table %s", len(key_list), table_name)
+    if not key_list:
+        return
+    # boto3 clients are thread safe, unlike resources, so the chunks share the underlying client
+    dynamodb_client = dynamodb_resource.meta.client
+    key_chunks = [key_list[i:i + BATCH_WRITE_ITEMS_BATCH_SIZE] for i in range(0, len(key_list), BATCH_WRITE_ITEMS_BATCH_SIZE)]
+    if len(key_chunks) == 1:
+        batch_delete_items_chunk(dynamodb_client, table_name, key_chunks[0])
+    else:
+        with ThreadPoolExecutor(max_workers=min(BATCH_WRITE_ITEMS_MAX_WORKERS, len(key_chunks))) as executor:
+            # consume the results so that failures of any chunk are raised
+            list(executor.map(lambda keys: batch_delete_items_chunk(dynamodb_client, table_name, keys), key_chunks))
+    LOGGER.info("In dynamodbUtil.parallel_batch_delete_items, exiting")
+
+def get_batch_get_items_backoff_time(attempt):
+    """
+    Returns a full jitter backoff time for retrying unprocessed keys of a batch_get_item call
+    :param attempt: retry attempt number, starting from 0
+    """
+    return random.uniform(0, min(BATCH_GET_ITEMS_MAX_BACKOFF_IN_SECONDS, BATCH_GET_ITEMS_BASE_BACKOFF_IN_SECONDS * (2 ** attempt)))
+
+def batch_get_items_chunk(dynamodb_client, table_name, keys, request_options):
+    """
+    Retrieves a single chunk of at most 100 keys from a table and retries the
+    UnprocessedKeys returned by dynamodb until all of them are read
+    :param dynamodb_client: boto3 dynamodb client
+    :param table_name: table name in dynamodb
+    :param keys: list of keys in the chunk
+    :param request_options: ConsistentRead, ProjectionExpression and ExpressionAttributeNames for the request
+    """
+    chunk_items = []
+    pending_keys = keys
+    attempt = 0
+    while pending_keys:
+        request_item = {table_name: dict(request_options, Keys=pending_keys)}
+        response_get_items = dynamodb_client.batch_get_item(
+            RequestItems=request_item,
+            ReturnConsumedCapacity="TOTAL"
+        )
+        chunk_items.extend(response_get_items.get("Responses", {}).get(table_name, []))
+        pending_keys = response_get_items.get("UnprocessedKeys", {}).get(table_name, {}).get("Keys", [])
+        if not pending_keys:
+            break
+        if attempt >= BATCH_GET_ITEMS_MAX_RETRIES:
+            LOGGER.error("In dynamodbUtil.batch_get_items_chunk, %s keys are still unprocessed in table %s after %s retries", len(pending_keys), table_name, attempt)
+            ec_db_1012 = errorUtil.get_error_object("DB-1012")
+            ec_db_1012['Message'] = ec_db_1012['Message'].format(len(pending_keys), table_name)
+            raise errorUtil.GenericFailureException(EVENT_INFO, ec_db_1012)
+        backoff_time = get_batch_get_items_backoff_time(attempt)
+        LOGGER.info("In dynamodbUtil.batch_get_items_chunk, retrying %s unprocessed keys of table %s after %s seconds", len(pending_keys), table_name, backoff_time)
+        time.sleep(backoff_time)
+        attempt += 1
+    return chunk_items
+
+def batch_get_items(dynamodb_resource, table_name, key_list, projection_expression=None, expression_attribute_names=None, consistent_read=True):
     """
     This method takes a list of keys to retrieve respective values
-    API can be used for multiple tables, but method is designed to handle one table
-    and Unprocessed keys is not being used to retireve values that were not processed in
-    previous calls(Not enough info and couldn't produce a scenario). So using breaking list
-    into batch at program level
+    API can be used for multiple tables, but method is designed to handle one table.
+    Keys are de-duplicated and split into chunks of 100 (the dynamodb limit) which are
+    read concurrently, and UnprocessedKeys of each chunk are retried with jittered backoff
     :param dynamodb_resource: boto3.resource("dynamodb")
     :param table_name: table name in dynamodb
     :param key_list: {"KeyName": "KeyValue"}
     :param projection_expression:
     :param expression_attribute_names:
+    :param consistent_read: False for eventually consistent reads which consume half the read capacity
     """
     LOGGER.info("In dynamodbUtil.batch_get_items method, length of key_list is %s", len(key_list))
-    return_items = []
-    unprocessed_keys = []
-    batch_size = 50
-    for i in range(0, len(key_list), batch_size):
-        request_item = {
-            table_name: {
-                "Keys": key_list[i:i + batch_size],
-                "ConsistentRead": True
-            }
-        }
+    unique_keys = list({json.dumps(key, sort_keys=True, default=str): key for key in key_list}.values())
+    if not unique_keys:
+        return []
 
-        if projection_expression:
-            request_item[table_name]["ProjectionExpression"] = projection_expression
-        if expression_attribute_names:
-            request_item[table_name]["ExpressionAttributeNames"] = expression_attribute_names
+    request_options = {"ConsistentRead": consistent_read}
+    if projection_expression:
+        request_options["ProjectionExpression"] = projection_expression
+    if expression_attribute_names:
+        request_options["ExpressionAttributeNames"] = expression_attribute_names
 
-        response_get_items = dynamodb_resource.meta.client.batch_get_item(
-            RequestItems=request_item,
-            ReturnConsumedCapacity="TOTAL"
-        )
-        unprocessed_keys.append(response_get_items["UnprocessedKeys"] if "UnprocessedKeys" in response_get_items and response_get_items["UnprocessedKeys"] else {})
-        return_items.extend(response_get_items["Responses"][table_name] if response_get_items\
-            and "Responses" in response_get_items\
-                and table_name in response_get_items["Responses"] else [])
+    # boto3 clients are thread safe, unlike resources, so the chunks share the underlying client
+    dynamodb_client = dynamodb_resource.meta.client
+    key_chunks = [unique_keys[i:i + BATCH_GET_ITEMS_BATCH_SIZE] for i in range(0, len(unique_keys), BATCH_GET_ITEMS_BATCH_SIZE)]
+    return_items = []
+    if len(key_chunks) == 1:
+        return_items = batch_get_items_chunk(dynamodb_client, table_name, key_chunks[0], request_options)
+    else:
+        with ThreadPoolExecutor(max_workers=min(BATCH_GET_ITEMS_MAX_WORKERS, len(key_chunks))) as executor:
+            for chunk_items in executor.map(lambda keys: batch_get_items_chunk(dynamodb_client, table_name, keys, request_options), key_chunks):
+                return_items.extend(chunk_items)
     LOGGER.info("In dynamodbUtil.batch_get_items method, number of items returned are %s", str(len(return_items)))
     LOGGER.info("In dynamodbUtil.batch_get_items method, exiting method")
     return return_items
@@ -542,6 +634,28 @@ def update_item_by_key(dynamodb_table, key, update_expression, expression_attrib
     LOGGER.info("In dynamodbUtil.update_item_by_key, exiting..")
     return response_message
 
+def transact_write_items(dynamodb_resource, transact_items):
+    """
+    Writes the items to one or more tables in a single all-or-nothing transaction
+    :param dynamodb_resource: boto3.resource("dynamodb")
+    :param transact_items: list of Put/Update/Delete/ConditionCheck operations, same as the TransactItems of the client
+                           api with python values, the client of the resource serializes them like the table api does
+    :returns: string - success, condition-error
+    """
+    LOGGER.info("In dynamodbUtil.transact_write_items, writing %s items in a transaction", len(transact_items))
+    try:
+        dynamodb_resource.meta.client.transact_write_items(TransactItems=transact_items)
+    except ClientError as c_e:
+        cancellation_reasons = [reason.get("Code") for reason in c_e.response.get("CancellationReasons", [])]
+        if c_e.response["Error"]["Code"] == "TransactionCanceledException" and "ConditionalCheckFailed" in cancellation_reasons:
+            LOGGER.error("In dynamodbUtil.transact_write_items, transaction cancelled because condition is not satisfied - %s", cancellation_reasons)
+            return "condition-error"
+        LOGGER.error("In dynamodbUtil.transact_write_items, transaction failed with code %s and message %s",\
+            c_e.response["Error"]["Code"], c_e.response["Error"]["Message"])
+        raise
+    LOGGER.info("In dynamodbUtil.transact_write_items, exiting")
+    return "success"
+
 def delete_item_by_key(dynamodb_table, key):
     """
     deletes single item with the unique key passed
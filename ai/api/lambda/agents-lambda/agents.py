@@ -897,9 +897,10 @@ def trigger_agent_action_groups_update(user_id, agent_id, event, context):
         raise errorUtil.InvalidInputException(EVENT_INFO, ec_ge_1020)
     return commonUtil.build_put_response(200, {"Message": "Agent action groups update process triggered"})
 
-def invoke_agent(agent_id, user_id, event):
+def invoke_agent(agent_id, user_id, event, delivery_session):
     """
     This function is to invoke agent
+    :param delivery_session: WebSocketDeliverySession used to stream the agent response to the user
     """
     LOGGER.info("In agents.invoke_agent, invoking agent with id - %s", agent_id)
     event_body = json.loads(event["body"])
@@ -982,7 +983,7 @@ def invoke_agent(agent_id, user_id, event):
     for stream_event in agent_response_stream:
         if "chunk" in stream_event:
             stream_message = stream_event["chunk"]["bytes"].decode("utf-8")
-            commonUtil.send_message_to_ws_connection(user_id, session_id, {"AIMessage": stream_message, "Metadata": {"MessageId": message_id, "IsComplete": True}}, WS_KWARGS)
+            delivery_session.send_message({"AIMessage": stream_message, "Metadata": {"MessageId": message_id, "IsComplete": True}})
             agent_message += stream_message
             for citation in stream_event["chunk"].get("attribution",{}).get("citations",[]):
                 agent_metadata["Documents"].append(citation["retrievedReferences"])
@@ -1072,20 +1073,21 @@ def lambda_handler(event, context):
                             Key("SessionId").eq(session_id)
                         )
                         user_id = session_item[0]["UserId"]
+                        # all messages of this turn are delivered through a single delivery session
+                        delivery_session = commonUtil.WebSocketDeliverySession(user_id, session_id, WS_KWARGS, connection_id)
                         # update message delivery status to pending in sessions table
-                        commonUtil.update_message_delivery_status(user_id, session_id, commonUtil.CHAT_MESSAGE_DELIVERY_PENDING, WS_KWARGS)
+                        delivery_session.update_delivery_status(commonUtil.CHAT_MESSAGE_DELIVERY_PENDING)
                         # invoke agent
                         try:
-                            chat_response_metadata = invoke_agent(agent_id, user_id, event)
-                            WS_KWARGS.update({"LatestMessageId": chat_response_metadata["MessageId"]})
+                            chat_response_metadata = invoke_agent(agent_id, user_id, event, delivery_session)
                             # send message back to client
-                            commonUtil.send_message_to_ws_connection(user_id, session_id, {"Metadata": chat_response_metadata}, WS_KWARGS)
+                            delivery_session.send_message({"Metadata": chat_response_metadata}, is_final=True, latest_message_id=chat_response_metadata["MessageId"])
                         except Exception as ex:
                             LOGGER.error("In agents.lambda_handler, agent invocation failed due to error - %s", str(ex))
                             ai_message = str(ex)
                             if "dependencyFailedException" in str(ex):
                                 ai_message = "Sorry I was unable to process your request. It seems like your Lambda has unhandled errors. Check the Lambda function logs for error details, then try your request again after fixing the error."
-                            commonUtil.send_message_to_ws_connection(user_id, session_id, {"AIMessage": ai_message, "Metadata": {"IsComplete": True }}, WS_KWARGS)
+                            delivery_session.send_message({"AIMessage": ai_message, "Metadata": {"IsComplete": True }}, is_final=True)
                         response = {
                             'statusCode': 200,
                             'body': json.dumps({"Message": "Message delivered"})
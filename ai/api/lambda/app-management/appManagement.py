@@ -260,6 +260,7 @@ def update_openai_key(input_body):
             "Overwrite": True
         }
         commonUtil.create_ssm_parameter(SSM_CLIENT, ssm_input)
+        commonUtil.refresh_cached_parameter(commonUtil.OPENAI_KEY_SSM_KEY)
 
         LOGGER.info("In appManagement.update_openai_key, successfully updated the OpenAI key")
 
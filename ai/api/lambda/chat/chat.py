@@ -5,7 +5,6 @@ Lambda for all operations related to Chat
 import os
 import sys
 import json
-import copy
 import signal
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal
@@ -13,10 +12,13 @@ from urllib.parse import unquote_plus
 import time
 import uuid
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
 from botocore.exceptions import ClientError
 
@@ -44,6 +46,8 @@ try:
 
     DYNAMODB_RESOURCE = boto3.resource('dynamodb', AWS_REGION)
     S3_RESOURCE = boto3.resource('s3', AWS_REGION, config=Config(signature_version='s3v4', s3 ={"addressing_style":"virtual"}))
+    # dataset uploads copy several files at a time, each of them in several parts
+    S3_TRANSFER_CLIENT = boto3.client('s3', AWS_REGION, config=Config(signature_version='s3v4', s3 ={"addressing_style":"virtual"}, max_pool_connections=32))
     LAMBDA_CLIENT = boto3.client('lambda', AWS_REGION, config=Config(read_timeout=900))
     BEDROCK_RUNTIME_CLIENT = boto3.client('bedrock-runtime', AWS_REGION, config=Config(read_timeout=900))
     SES_CLIENT = boto3.client('ses', AWS_REGION)
@@ -55,11 +59,13 @@ try:
     SESSIONS_TABLE = dynamodbUtil.SESSIONS_TABLE
     SESSIONS_TABLE_SESSIONID_INDEX = dynamodbUtil.SESSIONS_TABLE_SESSIONID_INDEX
     SESSIONS_TABLE_CONNECTIONID_INDEX = dynamodbUtil.SESSIONS_TABLE_CONNECTIONID_INDEX
+    SESSIONS_TABLE_USERCLIENTID_INDEX = dynamodbUtil.SESSIONS_TABLE_USERCLIENTID_INDEX
     WORKSPACES_TABLE = dynamodbUtil.WORKSPACES_TABLE
     WORKSPACES_DOCUMENTS_TABLE = dynamodbUtil.WORKSPACES_DOCUMENTS_TABLE
     CHAT_HISTORY_TABLE = dynamodbUtil.CHAT_HISTORY_TABLE
     CHAT_HISTORY_TABLE_SESSIONID_MESSAGEID_INDEX = dynamodbUtil.CHAT_HISTORY_TABLE_SESSIONID_MESSAGEID_INDEX
     MODELS_TABLE = dynamodbUtil.MODELS_TABLE
+    CHAT_DATASET_UPLOADS_TABLE = dynamodbUtil.CHAT_DATASET_UPLOADS_TABLE
 
     DATASET_OPERATIONS_LAMBDA = os.environ["amorphicDatasetOperationsLambdaArn"]
     DATASET_FILES_LAMBDA = os.environ["amorphicDatasetFilesLambdaArn"]
@@ -76,6 +82,137 @@ except Exception as ex:
     LOGGER.error("In chat.py, Failed to load environment variables. error: %s", str(ex))
     sys.exit()
 
+# warm the parameter cache with the parameters read on every chat turn
+commonUtil.prefetch_parameters([commonUtil.OPENAI_KEY_SSM_KEY, commonUtil.WORKSPACE_RETRIEVAL_MAXRESULTS_SSM_KEY], SSM_CLIENT)
+
+# the question of a running turn is kept as a pending marker on the session until the turn is committed, markers older
+# than the maximum lambda timeout belong to turns that were interrupted
+PENDING_TURN_TIMEOUT_IN_SECONDS = 900
+PENDING_TURN_FAILED_MESSAGE = "Apologies, failed to process query. Please try again."
+# sessions are listed from the UserClientId (UserId#ClientId) index sorted by LastModifiedTime, sessions created before
+# the index was added are backfilled once per user
+SESSIONS_INDEX_SORT_KEY = "LastModifiedTime"
+SESSIONS_LIST_PROJECTION = "UserId,SessionId,ClientId,Title,StartTime,LastModifiedTime"
+SESSIONS_INDEX_BACKFILLED_USERS = set()
+# page size limits accepted by the list sessions and session history apis
+PAGE_LIMIT_MIN = 1
+PAGE_LIMIT_MAX = 1000
+# session history is deleted one page of keys at a time, histories longer than a page are purged asynchronously by the
+# same lambda so that deleting a session takes the same time regardless of its length
+SESSION_HISTORY_DELETE_PAGE_SIZE = 1000
+SESSION_HISTORY_PURGE_OPERATION = "purge_session_history"
+SESSION_HISTORY_PURGE_MIN_REMAINING_TIME_IN_MILLIS = 60000
+# session files are copied to datasets by an asynchronous invocation of the same lambda so that the api returns the
+# UploadId before any file is copied. Files are copied concurrently, files above the multipart threshold are copied in
+# parts and the status of every file is kept in an item of the dataset uploads table, which expires after a week.
+# Copies are not started once the lambda is about to time out, the files that are left are copied by a new invocation
+DATASET_UPLOAD_OPERATION = "copy_session_files_to_dataset"
+DATASET_UPLOAD_MAX_FILES = 1000
+DATASET_UPLOAD_MAX_CONCURRENT_FILES = 8
+DATASET_UPLOAD_MIN_REMAINING_TIME_IN_MILLIS = 120000
+DATASET_UPLOAD_TRANSFER_CONFIG = TransferConfig(multipart_threshold=64 * 1024 * 1024, multipart_chunksize=64 * 1024 * 1024, max_concurrency=4)
+DATASET_UPLOAD_PROGRESS_STEP = 25
+DATASET_UPLOAD_PROGRESS_INTERVAL_IN_SECONDS = 5
+DATASET_UPLOAD_VALIDITY_IN_DAYS = 7
+# file names of a session are added and removed with conditional update expressions, updates are retried if the files of
+# the session change concurrently
+SESSION_FILES_UPDATE_MAX_ATTEMPTS = 5
+
+class DatasetUploadProgress:
+    """
+    Keeps the status of the files of a dataset upload. The s3 transfer manager reports the bytes copied by each part from
+    its threads and the changed statuses are saved to the item of the upload in the dataset uploads table
+    """
+
+    def __init__(self, session_id, upload_id):
+        self.upload_key = {"SessionId": session_id, "UploadId": upload_id}
+        self.files_status = {}
+        self.changed_files = set()
+        self.lock = threading.Lock()
+
+    def set_file_status(self, file, status, **details):
+        """
+        Sets the status of a file, the file is saved with the next save
+        """
+        with self.lock:
+            self.files_status[file] = dict(details, Status=status)
+            self.changed_files.add(file)
+
+    def get_copy_callback(self, file, size):
+        """
+        Returns the progress callback of a file copy, the percentage is reported in steps of DATASET_UPLOAD_PROGRESS_STEP
+        """
+        self.set_file_status(file, "copying", Size=size, CopiedBytes=0, Percentage=0)
+
+        def add_copied_bytes(bytes_amount):
+            with self.lock:
+                file_status = self.files_status[file]
+                file_status["CopiedBytes"] += bytes_amount
+                percentage = int(file_status["CopiedBytes"] * 100 / size) if size else 100
+                if percentage - file_status["Percentage"] >= DATASET_UPLOAD_PROGRESS_STEP or percentage == 100 and file_status["Percentage"] < 100:
+                    file_status["Percentage"] = percentage
+                    self.changed_files.add(file)
+        return add_copied_bytes
+
+    def start(self, user_id, dataset_id):
+        """
+        Saves the upload with the status of its files, an upload resumed with the same UploadId replaces the earlier one
+        """
+        with self.lock:
+            upload_item = dict(
+                self.upload_key,
+                UserId=user_id,
+                DatasetId=dataset_id,
+                Status="running",
+                StartTime=commonUtil.get_current_time(),
+                LastModifiedTime=commonUtil.get_current_time(),
+                ExpirationTime=int((datetime.now(timezone.utc) + timedelta(days=DATASET_UPLOAD_VALIDITY_IN_DAYS)).timestamp()),
+                Files={file: dict(file_status) for file, file_status in self.files_status.items()}
+            )
+            self.changed_files.clear()
+        if dynamodbUtil.put_item(DYNAMODB_RESOURCE.Table(CHAT_DATASET_UPLOADS_TABLE), upload_item) != "success":
+            raise Exception(f"Failed to save dataset upload {self.upload_key['UploadId']}")
+
+    def save(self):
+        """
+        Saves the status of the files that changed since the last save
+        """
+        with self.lock:
+            changed_files_status = {file: dict(self.files_status[file]) for file in self.changed_files}
+            self.changed_files.clear()
+        if not changed_files_status:
+            return
+        LOGGER.info("In chat.DatasetUploadProgress.save, status of the files of upload %s - %s", self.upload_key["UploadId"], changed_files_status)
+        expression_attribute_names = {}
+        expression_attribute_values = {":last_modified_time": commonUtil.get_current_time()}
+        set_expressions = ["LastModifiedTime = :last_modified_time"]
+        for position, (file, file_status) in enumerate(changed_files_status.items()):
+            expression_attribute_names[f"#file_{position}"] = file
+            expression_attribute_values[f":file_status_{position}"] = file_status
+            set_expressions.append(f"Files.#file_{position} = :file_status_{position}")
+        update_status = dynamodbUtil.update_item_by_key(
+            DYNAMODB_RESOURCE.Table(CHAT_DATASET_UPLOADS_TABLE), self.upload_key, "SET " + ", ".join(set_expressions),
+            expression_attribute_values, expression_attribute_names, condition_expression="attribute_exists(UploadId)"
+        )
+        # the progress of a file is reported again with the next save, the copies are not stopped
+        if update_status != "success":
+            LOGGER.error("In chat.DatasetUploadProgress.save, failed to save the status of the files of upload %s", self.upload_key["UploadId"])
+            with self.lock:
+                self.changed_files.update(changed_files_status)
+
+    def set_upload_status(self, status):
+        """
+        Sets the status of the upload
+        """
+        update_status = dynamodbUtil.update_item_by_key(
+            DYNAMODB_RESOURCE.Table(CHAT_DATASET_UPLOADS_TABLE), self.upload_key,
+            "SET #status = :status, LastModifiedTime = :last_modified_time",
+            {":status": status, ":last_modified_time": commonUtil.get_current_time()}, {"#status": "Status"},
+            condition_expression="attribute_exists(UploadId)"
+        )
+        if update_status != "success":
+            LOGGER.error("In chat.DatasetUploadProgress.set_upload_status, failed to set the status of upload %s to %s", self.upload_key["UploadId"], status)
+
 class LambdaTimer:
     """
     Calling a function in a specified time.
@@ -129,6 +266,12 @@ class LambdaTimer:
                     "ReviewRequired": False
                 }
 
+                # the question and the failure are committed together if the turn has started
+                pending_message = commonUtil.get_session_details(SESSIONS_TABLE, user_id, session_id).get("PendingMessage")
+                if pending_message and pending_message["MessageId"] == event_body["MessageId"]:
+                    commit_turn(user_id, session_id, pending_message, ai_message_object, commonUtil.CHAT_QUERY_FAILED, "Timed out")
+                    return
+
                 dynamodbUtil.put_item(DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE), ai_message_object)
 
                 # update sessions table with failure status
@@ -142,14 +285,68 @@ class LambdaTimer:
                     expression_attributes
                 )
 
+def get_session_user_client_id(user_id, client_id):
+    """
+    This function returns the partition key of a session in the user client index
+    :param user_id
+    :param client_id: user id for chat sessions, agent-<agent id> for agent sessions
+    """
+    return f"{user_id}#{client_id}"
+
+def backfill_sessions_index(user_id):
+    """
+    This function adds UserClientId to the sessions of a user that were created before the user client index was added,
+    the user item is flagged once all of them are updated
+    :param user_id
+    """
+    if user_id in SESSIONS_INDEX_BACKFILLED_USERS:
+        return
+    user_item = dynamodbUtil.get_item_by_key_with_projection(DYNAMODB_RESOURCE.Table(USERS_TABLE), {"UserId": user_id}, "UserId,SessionsIndexBackfilled")
+    if user_item and not user_item.get("SessionsIndexBackfilled"):
+        legacy_sessions = dynamodbUtil.get_item_details_query(DYNAMODB_RESOURCE.Table(SESSIONS_TABLE), \
+            Key('UserId').eq(user_id), Attr("UserClientId").not_exists(), 'UserId,SessionId,ClientId')
+        LOGGER.info("In chat.backfill_sessions_index, adding UserClientId to %s sessions of user %s", len(legacy_sessions), user_id)
+        for session in legacy_sessions:
+            dynamodbUtil.update_item_by_key(
+                DYNAMODB_RESOURCE.Table(SESSIONS_TABLE),
+                {"UserId": user_id, "SessionId": session["SessionId"]},
+                "SET UserClientId = :user_client_id",
+                {":user_client_id": get_session_user_client_id(user_id, session.get("ClientId", user_id))},
+                condition_expression="attribute_exists(SessionId)"
+            )
+        dynamodbUtil.update_item_by_key(
+            DYNAMODB_RESOURCE.Table(USERS_TABLE),
+            {"UserId": user_id},
+            "SET SessionsIndexBackfilled = :backfilled",
+            {":backfilled": True},
+            condition_expression="attribute_exists(UserId)"
+        )
+    SESSIONS_INDEX_BACKFILLED_USERS.add(user_id)
+
 def get_chat_sessions(user_id, client_id, **kwargs):
     """
-    This function is to get chat sessions
+    This function is to get chat sessions, sessions sorted by LastModifiedTime are read one page at a time from the
+    user client index
     :param user_id
     :param client_id
+    :param items_limit: number of sessions in the page
+    :param sort_order: asc or desc
+    :param sort_by: sessions are sorted in code if it is not LastModifiedTime
+    :param next_token: token returned with the previous page
     :return: list of chat sessions
     """
     LOGGER.info("In chat.get_chat_sessions, User %s requested to get chat sessions", user_id)
+    if not client_id.startswith('agent-'):
+        client_id = user_id
+    user_client_id = get_session_user_client_id(user_id, client_id)
+    exclusive_start_key = None
+    if kwargs.get("next_token"):
+        exclusive_start_key = commonUtil.decode_pagination_token(kwargs["next_token"])
+        if not exclusive_start_key or exclusive_start_key.get("UserClientId") != user_client_id or exclusive_start_key.get("UserId") != user_id:
+            LOGGER.error("In chat.get_chat_sessions, invalid next token - `%s`", kwargs["next_token"])
+            ec_ipv_1002 = errorUtil.get_error_object("IPV-1002")
+            ec_ipv_1002['Message'] = ec_ipv_1002['Message'].format("next-token", kwargs["next_token"])
+            raise errorUtil.InvalidInputException(EVENT_INFO, ec_ipv_1002)
     try:
         if client_id.startswith('agent-'):
             agent_id = client_id.split('-', 1)[1]
@@ -159,17 +356,48 @@ def get_chat_sessions(user_id, client_id, **kwargs):
                 ec_ipv_1002 = errorUtil.get_error_object("IPV-1002")
                 ec_ipv_1002['Message'] = ec_ipv_1002['Message'].format("AgentId", agent_id)
                 raise errorUtil.InvalidInputException(EVENT_INFO, ec_ipv_1002)
-            chat_sessions = dynamodbUtil.get_item_details_query(DYNAMODB_RESOURCE.Table(SESSIONS_TABLE), \
-                Key('UserId').eq(user_id), Attr("ClientId").eq(client_id), 'UserId,SessionId,ClientId,Title,StartTime,LastModifiedTime')
+        backfill_sessions_index(user_id)
+
+        if kwargs.get("sort_by", SESSIONS_INDEX_SORT_KEY) == SESSIONS_INDEX_SORT_KEY:
+            # one item more than the page is read to know if there is a next page
+            items_limit = kwargs["items_limit"]
+            query_response = dynamodbUtil.get_items_by_query_index(
+                DYNAMODB_RESOURCE.Table(SESSIONS_TABLE),
+                SESSIONS_TABLE_USERCLIENTID_INDEX,
+                Key('UserClientId').eq(user_client_id),
+                projection_expression=SESSIONS_LIST_PROJECTION,
+                scan_index_forward=kwargs.get("sort_order") != 'desc',
+                exclusive_start_key=exclusive_start_key,
+                limit=items_limit + 1,
+                is_batch_query_required=True
+            )
+            sessions = query_response.get("Items", [])
+            next_token = None
+            if len(sessions) > items_limit:
+                sessions = sessions[:items_limit]
+                next_token = commonUtil.encode_pagination_token({
+                    "UserId": user_id,
+                    "SessionId": sessions[-1]["SessionId"],
+                    "UserClientId": user_client_id,
+                    "LastModifiedTime": sessions[-1]["LastModifiedTime"]
+                })
+            chat_sessions = {
+                "Sessions": sessions,
+                "next_available": "yes" if next_token else "no",
+                "count": len(sessions),
+                "NextToken": next_token
+            }
         else:
-            chat_sessions = dynamodbUtil.get_item_details_query(DYNAMODB_RESOURCE.Table(SESSIONS_TABLE), \
-                Key('UserId').eq(user_id), Attr("ClientId").eq(user_id) | Attr("ClientId").not_exists(), 'UserId,SessionId,ClientId,Title,StartTime,LastModifiedTime')
-
-         # Sort & paginate results if applicable
-        LOGGER.info("In chat.get_chat_sessions, Sorting & Paginating the results based on the input given")
-        kwargs['dict_key'] = 'Sessions'
-        kwargs['input_items'] = {'Sessions': chat_sessions}
-        chat_sessions = commonUtil.sort_page_in_code(**kwargs)
+            # other sort keys are not part of the index, all sessions of the client are sorted & paginated in code
+            LOGGER.info("In chat.get_chat_sessions, Sorting & Paginating the results based on the input given")
+            sessions = dynamodbUtil.get_items_by_query_index(
+                DYNAMODB_RESOURCE.Table(SESSIONS_TABLE),
+                SESSIONS_TABLE_USERCLIENTID_INDEX,
+                Key('UserClientId').eq(user_client_id),
+                projection_expression=SESSIONS_LIST_PROJECTION
+            )
+            chat_sessions = commonUtil.sort_page_in_code(dict_key='Sessions', input_items={'Sessions': sessions}, offset=0,
+                items_limit=kwargs["items_limit"], sort_order=kwargs.get("sort_order"), sort_by=kwargs["sort_by"])
         LOGGER.info("In chat.get_chat_sessions, retrieved chat sessions - %s", chat_sessions)
         return commonUtil.build_get_response(200, chat_sessions)
     except Exception as ex:
@@ -207,7 +435,8 @@ def create_new_session(user_id, client_id):
         "History": [],
         "LastModifiedTime": commonUtil.get_current_time(),
         "ExpirationTime": int(expiration_time),
-        "ClientId": client_id
+        "ClientId": client_id,
+        "UserClientId": get_session_user_client_id(user_id, client_id)
     }
     put_status = dynamodbUtil.put_item(DYNAMODB_RESOURCE.Table(SESSIONS_TABLE), session_details)
     if put_status == "error":
@@ -217,21 +446,72 @@ def create_new_session(user_id, client_id):
     LOGGER.info("In chat.create_new_session, Successfully created new chat session with session id: %s", session_id)
     return session_id
 
-def delete_session_history(session_id):
+def delete_session_history_page(session_id):
     """
-    This function is to delete chat session history
+    This function deletes the oldest page of a session history, only the keys of the page are read
     :param session_id
+    :return: True if the session has more messages
+    """
+    query_response = dynamodbUtil.get_items_by_query_index(
+        DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE),
+        None,
+        Key("SessionId").eq(session_id),
+        projection_expression="SessionId,MessageTime",
+        limit=SESSION_HISTORY_DELETE_PAGE_SIZE,
+        is_batch_query_required=True
+    )
+    dynamodbUtil.parallel_batch_delete_items(DYNAMODB_RESOURCE, CHAT_HISTORY_TABLE, query_response.get("Items", []))
+    return bool(query_response.get("LastEvaluatedKey"))
+
+def delete_session_history(session_id, context=None):
+    """
+    This function is to delete chat session history page by page
+    :param session_id
+    :param context: lambda context, deletion stops before the lambda times out if passed
+    :return: True if the entire history is deleted
     """
     LOGGER.info("In chat.delete_session_history, User requested to delete session history for session id: %s", session_id)
-    chat_history = get_session_history(session_id, "SessionId,MessageTime")
-    dynamodbUtil.batch_delete_items(DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE), chat_history)
+    while delete_session_history_page(session_id):
+        if context and context.get_remaining_time_in_millis() < SESSION_HISTORY_PURGE_MIN_REMAINING_TIME_IN_MILLIS:
+            LOGGER.info("In chat.delete_session_history, lambda is about to time out, session history for session id: %s is partially deleted", session_id)
+            return False
     LOGGER.info("In chat.delete_session_history, Successfully deleted session history for session id: %s", session_id)
+    return True
+
+def trigger_session_history_purge(session_id, context):
+    """
+    This function triggers an asynchronous purge of the session history
+    :param session_id
+    :param context: lambda context
+    :return: True if the purge is triggered
+    """
+    LOGGER.info("In chat.trigger_session_history_purge, triggering purge of session history for session id: %s", session_id)
+    response = commonUtil.invoke_lambda_function(
+        lambda_client=LAMBDA_CLIENT,
+        function_name=context.function_name,
+        payload=json.dumps({"Operation": SESSION_HISTORY_PURGE_OPERATION, "SessionId": session_id}),
+        invocation_type='Event'
+    )
+    return bool(response)
+
+def purge_session_history(event, context):
+    """
+    This function purges the history of a deleted session, the purge is triggered again if the history could not be
+    deleted before the lambda times out
+    :param event: purge event with SessionId
+    :param context: lambda context
+    """
+    session_id = event["SessionId"]
+    LOGGER.info("In chat.purge_session_history, purging session history for session id: %s", session_id)
+    if not delete_session_history(session_id, context) and not trigger_session_history_purge(session_id, context):
+        raise Exception(f"Failed to trigger purge of session history for session id: {session_id}")
 
-def delete_session(user_id, session_id):
+def delete_session(user_id, session_id, context):
     """
     This function is to delete chat session
     :param user_id
     :param session_id
+    :param context: lambda context, used to purge long session histories asynchronously
     :return: status of deletion
     """
     LOGGER.info("In chat.delete_session, User %s requested to delete session id: %s", user_id, session_id)
@@ -240,7 +520,9 @@ def delete_session(user_id, session_id):
     if s3_delete_response != 'success':
         raise Exception('Failed to delete sessions files from S3')
 
-    delete_session_history(session_id)
+    # the first page of the history is deleted within the request, the rest of it is purged asynchronously
+    if delete_session_history_page(session_id) and not trigger_session_history_purge(session_id, context):
+        delete_session_history(session_id)
 
     response = dynamodbUtil.delete_item_by_key(
         DYNAMODB_RESOURCE.Table(SESSIONS_TABLE),
@@ -270,21 +552,155 @@ def delete_session_file(user_id, session_id, filename):
     if not s3_error:
         # Removing chat session file from DynamoDB table
         LOGGER.info("In chat.delete_session_file, Removing chat session file from DynamoDB table")
-        session_details["Files"].remove(filename)
-        session_details["LastModifiedTime"] = commonUtil.get_current_time()
-        dynamodbUtil.put_item(DYNAMODB_RESOURCE.Table(SESSIONS_TABLE), json.loads(json.dumps(session_details, cls=commonUtil.DecimalEncoder), parse_float=Decimal))
+        update_session_files(user_id, session_id, files_to_remove=[filename])
     else:
         raise Exception(s3_error)
 
-def upload_file_to_dataset(user_id, session_id, files, dataset_id):
+def copy_file_to_dataset(file, upload_event, upload_progress):
+    """
+    This function copies a session file to the dataset, files above the multipart threshold are copied in parts
+    :param file: file name
+    :param upload_event: dataset upload event with UserId, SessionId, TargetBucket and ObjectKeyPrefix
+    :param upload_progress: DatasetUploadProgress of the upload
+    """
+    copy_source = {
+        'Bucket': SESSION_FILES_BUCKET_NAME,
+        'Key': f'chat-sessions/{upload_event["UserId"]}/{upload_event["SessionId"]}/{file}'
+    }
+    target_bucket, object_key = upload_event["TargetBucket"], upload_event["ObjectKeyPrefix"] + file
+    size = S3_TRANSFER_CLIENT.head_object(**copy_source)["ContentLength"]
+    # the partition of an upload only holds the files copied by it, files copied by an earlier invocation are skipped
+    try:
+        if S3_TRANSFER_CLIENT.head_object(Bucket=target_bucket, Key=object_key)["ContentLength"] == size:
+            LOGGER.info("In chat.copy_file_to_dataset, file %s was already copied to %s", file, object_key)
+            upload_progress.set_file_status(file, "skipped", Size=size, CopiedBytes=size, Percentage=100)
+            return
+    except ClientError as ex:
+        if ex.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise
+    S3_TRANSFER_CLIENT.copy(
+        copy_source, target_bucket, object_key,
+        Callback=upload_progress.get_copy_callback(file, size), Config=DATASET_UPLOAD_TRANSFER_CONFIG
+    )
+    upload_progress.set_file_status(file, "copied", Size=size, CopiedBytes=size, Percentage=100)
+
+def trigger_dataset_upload(upload_event, context):
+    """
+    This function triggers an asynchronous copy of the files of a dataset upload
+    :param upload_event: dataset upload event with UserId, SessionId, DatasetId, DatasetName, UploadId, TargetBucket,
+    ObjectKeyPrefix and Files
+    :param context: lambda context
+    :return: True if the copy is triggered
     """
-    This function is to upload file to dataset
+    LOGGER.info("In chat.trigger_dataset_upload, triggering copy of %s files for upload %s", len(upload_event["Files"]), upload_event["UploadId"])
+    response = commonUtil.invoke_lambda_function(
+        lambda_client=LAMBDA_CLIENT,
+        function_name=context.function_name,
+        payload=json.dumps(dict(upload_event, Operation=DATASET_UPLOAD_OPERATION)),
+        invocation_type='Event'
+    )
+    return bool(response)
+
+def send_dataset_upload_report(user_id, dataset_id, dataset_name, success_files_list, failed_files_list):
+    """
+    This function sends the report of a completed dataset upload to the user
+    :param user_id
+    :param dataset_id
+    :param dataset_name
+    :param success_files_list: files copied to the dataset
+    :param failed_files_list: files which could not be copied
+    """
+    user_details = commonUtil.get_userdetails(user_id, USERS_TABLE, DYNAMODB_RESOURCE)
+    if user_details.get('EmailSubscription', None) == 'yes':
+        recipient = user_details['EmailId']
+        email_type = "info"
+        email_subject = f"{PROJECT_SHORT_NAME} | {ENVIRONMENT} | {email_type} | Dataset File Upload Report"
+        title = "Dataset File Upload Report"
+        event_type = "Dataset File Upload from Session"
+        resource_type = "Dataset"
+        resource_name = dataset_name
+        message = "Dataset file upload process completed. Please check the dataset to the view the upload status. Do not trigger the upload for the same files as this will generate duplicates"
+        kwargs = {
+            "success_files_list": ', '.join(success_files_list),
+            "failed_files_list": ', '.join(failed_files_list)
+        }
+        body_text = commonUtil.generate_email_body(title, event_type, resource_type, resource_name, dataset_id, message, email_type, **kwargs)
+        msg = MIMEMultipart()
+        # Add subject, from and to lines.
+        msg['Subject'] = email_subject
+        msg['From'] = f"{commonUtil.EMAIL_SENDER_NAME} <{SENDER}>"
+        msg['To'] = recipient
+        textpart = MIMEText(body_text, 'html')
+        msg.attach(textpart)
+        try:
+            response = commonUtil.send_email(recipient, body_text, email_subject, SENDER, SES_CLIENT)
+        except ClientError as ex:
+            LOGGER.error("In chat.send_dataset_upload_report, sending report failed with error: %s", ex.response['Error']['Message'])
+        else:
+            LOGGER.info("In chat.send_dataset_upload_report, Email sent! Message ID: %s",response['MessageId'])
+
+def copy_session_files_to_dataset(event, context):
+    """
+    This function copies the session files of a dataset upload and saves the progress of every file. The copy of the
+    files that are left is triggered again if the lambda is about to time out
+    :param event: dataset upload event with UserId, SessionId, DatasetId, DatasetName, UploadId, TargetBucket,
+    ObjectKeyPrefix and Files
+    :param context: lambda context
+    """
+    user_id, session_id, upload_id = event["UserId"], event["SessionId"], event["UploadId"]
+    LOGGER.info("In chat.copy_session_files_to_dataset, copying %s files of upload %s for session id: %s", len(event["Files"]), upload_id, session_id)
+    upload_progress = DatasetUploadProgress(session_id, upload_id)
+    pending_copies = list(event["Files"])
+    copy_futures = {}
+    with ThreadPoolExecutor(max_workers=DATASET_UPLOAD_MAX_CONCURRENT_FILES) as executor:
+        while pending_copies or copy_futures:
+            # copies are not started once the lambda is about to time out, the running ones are awaited
+            while pending_copies and len(copy_futures) < DATASET_UPLOAD_MAX_CONCURRENT_FILES and \
+                    context.get_remaining_time_in_millis() > DATASET_UPLOAD_MIN_REMAINING_TIME_IN_MILLIS:
+                file = pending_copies.pop(0)
+                copy_futures[executor.submit(copy_file_to_dataset, file, event, upload_progress)] = file
+            if not copy_futures:
+                break
+            done_futures, _ = wait(copy_futures, timeout=DATASET_UPLOAD_PROGRESS_INTERVAL_IN_SECONDS, return_when=FIRST_COMPLETED)
+            for future in done_futures:
+                file = copy_futures.pop(future)
+                try:
+                    future.result()
+                except Exception as ex:
+                    LOGGER.error("In chat.copy_session_files_to_dataset, Dataset upload failed for file - %s, due to error - %s", file, str(ex))
+                    upload_progress.set_file_status(file, "failed", FailureReason=str(ex))
+            upload_progress.save()
+
+    if pending_copies:
+        LOGGER.info("In chat.copy_session_files_to_dataset, lambda is about to time out, %s files of upload %s are left", len(pending_copies), upload_id)
+        if trigger_dataset_upload(dict(event, Files=pending_copies), context):
+            return
+        for file in pending_copies:
+            upload_progress.set_file_status(file, "failed", FailureReason="Failed to trigger the copy of the file")
+        upload_progress.save()
+
+    # the status of the files copied by earlier invocations is read from the upload
+    upload_item = dynamodbUtil.get_item_by_key_with_projection(DYNAMODB_RESOURCE.Table(CHAT_DATASET_UPLOADS_TABLE), upload_progress.upload_key, "Files")
+    files_status = upload_item.get("Files", {}) if upload_item else {}
+    success_files_list = [file for file, file_status in files_status.items() if file_status["Status"] in ("copied", "skipped")]
+    failed_files_list = [file for file, file_status in files_status.items() if file_status["Status"] == "failed"]
+    upload_progress.set_upload_status("completed" if success_files_list else "failed")
+    LOGGER.info("In chat.copy_session_files_to_dataset, upload %s completed, copied files - %s, failed files - %s", upload_id, success_files_list, failed_files_list)
+    send_dataset_upload_report(user_id, event["DatasetId"], event["DatasetName"], success_files_list, failed_files_list)
+
+def upload_file_to_dataset(user_id, session_id, files, dataset_id, context, upload_id=None):
+    """
+    This function is to upload file to dataset, the files are copied asynchronously and their progress is saved to the
+    dataset uploads table
     :param user_id
     :param session_id
     :param files
     :param dataset_id
+    :param context: lambda context, used to copy the files asynchronously
+    :param upload_id: UploadId of an earlier upload to copy the files to the same partition
     """
     LOGGER.info("In chat.upload_file_to_dataset, User %s requested to upload file to dataset id: %s", user_id, dataset_id)
+    upload_start_time = time.time()
     auth_token, role_id = commonUtil.get_user_auth_resources(user_id, USERS_TABLE)
     dataset_operations_lambda_obj = {
         "AuthorizationToken": auth_token,
@@ -308,66 +724,79 @@ def upload_file_to_dataset(user_id, session_id, files, dataset_id):
         ec_ge_1034["Message"] = "Only S3/S3athena target type datasets are supported"
         raise errorUtil.GenericFailureException(EVENT_INFO, ec_ge_1034)
 
+    # the upload id is the upload time of the partition, resumed uploads copy the files to the same objects
+    if upload_id and (not str(upload_id).isdigit() or int(upload_id) > int(upload_start_time)):
+        LOGGER.error("In chat.upload_file_to_dataset, invalid upload id - `%s`", upload_id)
+        ec_ipv_1002 = errorUtil.get_error_object("IPV-1002")
+        ec_ipv_1002['Message'] = ec_ipv_1002['Message'].format("UploadId", upload_id)
+        raise errorUtil.InvalidInputException(EVENT_INFO, ec_ipv_1002)
+    if not files or len(files) > DATASET_UPLOAD_MAX_FILES:
+        LOGGER.error("In chat.upload_file_to_dataset, %s files are requested, at most %s files can be uploaded at once", len(files), DATASET_UPLOAD_MAX_FILES)
+        ec_ipv_1012 = errorUtil.get_error_object("IPV-1012")
+        ec_ipv_1012['Message'] = ec_ipv_1012['Message'].format("Files", 1, DATASET_UPLOAD_MAX_FILES)
+        raise errorUtil.InvalidInputException(EVENT_INFO, ec_ipv_1012)
     session_details = commonUtil.get_session_details(SESSIONS_TABLE, user_id, session_id)
-    epoch_time = str(int(time.time()))
+    epoch_time = str(upload_id) if upload_id else str(int(upload_start_time))
     partition = f"upload_date={epoch_time}"
-    success_files_list = []
+    if amorphic_dataset_item.get("SkipLZProcess", False):
+        target_bucket = DLZ_BUCKET
+        object_key_prefix = "{}/{}/{}/{}_{}_{}_".format(amorphic_dataset_item['Domain'], amorphic_dataset_item['DatasetName'], partition, user_id, dataset_id, str(epoch_time))
+    else:
+        target_bucket = LZ_BUCKET
+        object_key_prefix = "{}/{}/{}/{}/{}/".format(amorphic_dataset_item['Domain'], amorphic_dataset_item['DatasetName'], partition, user_id, amorphic_dataset_item['FileType'])
+    upload_progress = DatasetUploadProgress(session_id, epoch_time)
+    files_to_copy = []
     failed_files = []
-    for file in files:
+    for file in dict.fromkeys(files):
         if file not in session_details.get("Files", []):
-            LOGGER.error("In chat.post_query_to_model, invalid file name - `%s`", file)
+            LOGGER.error("In chat.upload_file_to_dataset, invalid file name - `%s`", file)
             failed_files.append({"FileName": file, "FailurReason": "Invalid file. File doesn't exist in session"})
+            upload_progress.set_file_status(file, "failed", FailureReason="Invalid file. File doesn't exist in session")
             continue
-        if amorphic_dataset_item.get("SkipLZProcess", False):
-            target_bucket = DLZ_BUCKET
-            object_key = "{}/{}/{}/{}_{}_{}_{}".format(amorphic_dataset_item['Domain'], amorphic_dataset_item['DatasetName'], partition, user_id, dataset_id, str(epoch_time), file)
-        else:
-            target_bucket = LZ_BUCKET
-            object_key = "{}/{}/{}/{}/{}/{}".format(amorphic_dataset_item['Domain'], amorphic_dataset_item['DatasetName'], partition, user_id, amorphic_dataset_item['FileType'], file)
-        copy_source = {
-            'Bucket': SESSION_FILES_BUCKET_NAME,
-            'Key': f'chat-sessions/{user_id}/{session_id}/{file}'
-         }
-        try:
-            S3_RESOURCE.meta.client.copy(copy_source, target_bucket, object_key)
-            success_files_list.append(file)
-        except Exception as ex:
-            LOGGER.info("In chat.upload_file_to_dataset, Dataset upload failed for file - %s, due to error - %s", file, str(ex))
-            failed_files.append({"FileName": file, "FailureReason": str(ex)})
+        files_to_copy.append(file)
+        upload_progress.set_file_status(file, "pending")
 
-    if not success_files_list:
+    if not files_to_copy:
         return commonUtil.build_put_response(500, {"Message": "Dataset file upload failed. Please try again later.", "FailedFiles": failed_files})
 
-    user_details = commonUtil.get_userdetails(user_id, USERS_TABLE, DYNAMODB_RESOURCE)
-    if user_details.get('EmailSubscription', None) == 'yes':
-        recipient = user_details['EmailId']
-        email_type = "info"
-        email_subject = f"{PROJECT_SHORT_NAME} | {ENVIRONMENT} | {email_type} | Dataset File Upload Report"
-        title = "Dataset File Upload Report"
-        event_type = "Dataset File Upload from Session"
-        resource_type = "Dataset"
-        resource_name = amorphic_dataset_item["DatasetName"]
-        message = "Dataset file upload process triggered. Please check the dataset to the view the upload status. Do not trigger the upload for the same files as this will generate duplicates"
-        kwargs = {
-            "success_files_list": ', '.join(success_files_list),
-            "failed_files_list": ', '.join([file["FileName"] for file in failed_files])
-        }
-        body_text = commonUtil.generate_email_body(title, event_type, resource_type, resource_name, dataset_id, message, email_type, **kwargs)
-        msg = MIMEMultipart()
-        # Add subject, from and to lines.
-        msg['Subject'] = email_subject
-        msg['From'] = f"{commonUtil.EMAIL_SENDER_NAME} <{SENDER}>"
-        msg['To'] = recipient
-        textpart = MIMEText(body_text, 'html')
-        msg.attach(textpart)
-        try:
-            response = commonUtil.send_email(recipient, body_text, email_subject, SENDER, SES_CLIENT)
-        except ClientError as ex:
-            LOGGER.error("In chat.upload_file_to_dataset, sending report failed with error: %s", ex.response['Error']['Message'])
-        else:
-            LOGGER.info("In chat.upload_file_to_dataset, Email sent! Message ID: %s",response['MessageId'])
-
-    return commonUtil.build_put_response(200, {"Message": "Dataset file upload process started"})
+    upload_progress.start(user_id, dataset_id)
+    upload_event = {
+        "UserId": user_id,
+        "SessionId": session_id,
+        "DatasetId": dataset_id,
+        "DatasetName": amorphic_dataset_item["DatasetName"],
+        "UploadId": epoch_time,
+        "TargetBucket": target_bucket,
+        "ObjectKeyPrefix": object_key_prefix,
+        "Files": files_to_copy
+    }
+    if not trigger_dataset_upload(upload_event, context):
+        upload_progress.set_upload_status("failed")
+        raise Exception("Failed to trigger the dataset file upload")
+
+    return commonUtil.build_put_response(200, {
+        "Message": "Dataset file upload process started. The progress of the files is returned by the dataset upload api with the UploadId",
+        "UploadId": epoch_time,
+        "Files": [{"FileName": file, "Status": "pending"} for file in files_to_copy],
+        "FailedFiles": failed_files
+    })
+
+def get_dataset_upload(user_id, session_id, upload_id):
+    """
+    This function returns the status of a dataset upload and of its files
+    :param user_id
+    :param session_id
+    :param upload_id
+    """
+    LOGGER.info("In chat.get_dataset_upload, User %s requested status of upload %s for session id: %s", user_id, upload_id, session_id)
+    upload_item = dynamodbUtil.get_item_with_key(DYNAMODB_RESOURCE.Table(CHAT_DATASET_UPLOADS_TABLE), {"SessionId": session_id, "UploadId": upload_id})
+    if not upload_item or upload_item.get("UserId") != user_id:
+        LOGGER.error("In chat.get_dataset_upload, upload %s of session %s not found", upload_id, session_id)
+        ec_ipv_1002 = errorUtil.get_error_object("IPV-1002")
+        ec_ipv_1002['Message'] = ec_ipv_1002['Message'].format("UploadId", upload_id)
+        raise errorUtil.InvalidInputException(EVENT_INFO, ec_ipv_1002)
+    upload_item.pop("ExpirationTime", None)
+    return upload_item
 
 def format_ai_message(message):
     """
@@ -389,13 +818,142 @@ def raise_model_access_exception():
     raise errorUtil.InvalidInputException(EVENT_INFO, ec_ge_1034)
 
 # pylint: disable=too-many-locals
-def post_query_to_model(event, session_id, user_id, connection_id, auth_token):
+def get_ai_message_time(question_time, answer_time):
+    """
+    This function returns the MessageTime of an answer, MessageTime is the sort key of the chat history with second
+    precision so answers given within the second of their question are stored a second later
+    :param question_time: MessageTime of the question
+    :param answer_time: time at which the answer was completed
+    """
+    if answer_time > question_time:
+        return answer_time
+    return (datetime.strptime(question_time, commonUtil.DATETIME_ISO_FORMAT) + timedelta(seconds=1)).strftime(commonUtil.DATETIME_ISO_FORMAT)
+
+def commit_turn(user_id, session_id, human_message_object, ai_message_object, query_status, query_failure_reason=None):
+    """
+    This function commits a turn, the question and the answer are stored and the pending marker of the turn is removed
+    from the session in a single transaction. If a newer turn has replaced the pending marker only the messages are stored
+    :param user_id
+    :param session_id
+    :param human_message_object: pending marker of the turn
+    :param ai_message_object
+    :param query_status: completed or failed
+    :param query_failure_reason
+    """
+    LOGGER.info("In chat.commit_turn, committing turn %s of session %s with status %s", human_message_object["MessageId"], session_id, query_status)
+    ai_message_object["MessageTime"] = get_ai_message_time(human_message_object["MessageTime"], ai_message_object["MessageTime"])
+    update_expression = "REMOVE PendingMessage SET QueryStatus = :query_status, LastModifiedTime = :last_modified_time"
+    expression_attributes = {":query_status": query_status, ":last_modified_time": ai_message_object["MessageTime"], ":message_id": human_message_object["MessageId"]}
+    if query_failure_reason:
+        update_expression += ", QueryFailureReason = :query_failure_reason"
+        expression_attributes[":query_failure_reason"] = query_failure_reason
+
+    # single round trip to convert floats of the metadata to decimals
+    message_objects = json.loads(json.dumps([human_message_object, ai_message_object], cls=commonUtil.DecimalEncoder), parse_float=Decimal)
+    transaction_status = dynamodbUtil.transact_write_items(DYNAMODB_RESOURCE, [
+        {"Put": {"TableName": CHAT_HISTORY_TABLE, "Item": message_objects[0]}},
+        {"Put": {"TableName": CHAT_HISTORY_TABLE, "Item": message_objects[1]}},
+        {"Update": {
+            "TableName": SESSIONS_TABLE,
+            "Key": {"UserId": user_id, "SessionId": session_id},
+            "UpdateExpression": update_expression,
+            "ExpressionAttributeValues": expression_attributes,
+            "ConditionExpression": "PendingMessage.MessageId = :message_id"
+        }}
+    ])
+    if transaction_status == "condition-error":
+        LOGGER.info("In chat.commit_turn, session %s is owned by a newer turn, storing messages only", session_id)
+        dynamodbUtil.batch_write_items(DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE), message_objects)
+
+def recover_pending_turn(user_id, session_id, session_details):
+    """
+    This function commits the pending turn of a session as failed if it was interrupted without being committed,
+    e.g. if the lambda was killed mid-turn
+    :param user_id
+    :param session_id
+    :param session_details: session item
+    :return: True if an interrupted turn was recovered
+    """
+    pending_message = session_details.get("PendingMessage")
+    if not pending_message:
+        return False
+    pending_time = (datetime.now(timezone.utc).replace(tzinfo=None) - datetime.strptime(pending_message["MessageTime"], commonUtil.DATETIME_ISO_FORMAT)).total_seconds()
+    if pending_time <= PENDING_TURN_TIMEOUT_IN_SECONDS:
+        return False
+    LOGGER.info("In chat.recover_pending_turn, turn %s of session %s was interrupted, committing it as failed", pending_message["MessageId"], session_id)
+    ai_message_object = {
+        "Type": "ai",
+        "Data": PENDING_TURN_FAILED_MESSAGE,
+        "MessageId": pending_message["MessageId"],
+        "Metadata": "N/A",
+        # stored right after its question, the current time is the MessageTime of the question of the turn being started
+        "MessageTime": pending_message["MessageTime"],
+        "ClientId": user_id,
+        "SessionId": session_id,
+        "ReviewRequired": False
+    }
+    commit_turn(user_id, session_id, pending_message, ai_message_object, commonUtil.CHAT_QUERY_FAILED, "Interrupted")
+    return True
+
+def post_trivial_turn(session_id, user_id, message_id, message, trivial_response, query_start_time, delivery_session):
+    """
+    This function records a trivial turn answered from a template, both messages are stored in a single batch write and
+    the session is not updated
+    :param session_id
+    :param user_id
+    :param message_id
+    :param message: user message
+    :param trivial_response: response returned by bedrockUtil.is_greeting
+    :param query_start_time
+    :param delivery_session: WebSocketDeliverySession used to send messages of this turn to the user
+    """
+    LOGGER.info("In chat.post_trivial_turn, answering %s turn of session %s", trivial_response["metadata"]["turnType"], session_id)
+    query_end_time = get_ai_message_time(query_start_time, commonUtil.get_current_time())
+    response_time = "0.0"
+    message_objects = [
+        {
+            "Type": "human",
+            "MessageId": message_id,
+            "Data": message,
+            "MessageTime": query_start_time,
+            "ClientId": user_id,
+            "SessionId": session_id,
+            "ReviewRequired": False
+        },
+        {
+            "Type": "ai",
+            "Data": trivial_response["content"],
+            "MessageId": message_id,
+            "Metadata": trivial_response["metadata"],
+            "MessageTime": query_end_time,
+            "ResponseTime": response_time,
+            "ClientId": user_id,
+            "SessionId": session_id,
+            "ReviewRequired": False
+        }
+    ]
+    message_objects = json.loads(json.dumps(message_objects, cls=commonUtil.DecimalEncoder), parse_float=Decimal)
+    dynamodbUtil.batch_write_items(DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE), message_objects)
+    delivery_session.send_message({"AIMessage": trivial_response["content"], "Metadata": {"IsComplete": True, "MessageId": message_id, "ResponseTime": response_time}})
+
+    # return metadata
+    trivial_response["metadata"].update({
+        "MessageId": message_id,
+        "IsComplete": True,
+        "ResponseTime": response_time
+    })
+    return trivial_response["metadata"]
+
+def post_query_to_model(event, session_id, user_id, connection_id, auth_token, delivery_session=None):
     """
     This function is to post query to model
     :param event
     :param user_id
+    :param delivery_session: WebSocketDeliverySession used to send messages of this turn to the user
     """
     LOGGER.info("In chat.post_query_to_model with event - %s", event)
+    if not delivery_session:
+        delivery_session = commonUtil.WebSocketDeliverySession(user_id, session_id, WS_KWARGS, connection_id)
     event_body = json.loads(event['body'])
 
     commonUtil.validate_event_body(event_body, CHAT_SEND_MESSAGE_REQUIRED_KEYS)
@@ -478,7 +1036,19 @@ def post_query_to_model(event, session_id, user_id, connection_id, auth_token):
             raise errorUtil.InvalidInputException(EVENT_INFO, ec_ipv_1002)
 
     query_start_time = commonUtil.get_current_time()
-    chat_history = get_session_history(session_id)
+    # trivial turns are answered from templates, they are not taken while another query of the session is running or
+    # after a failed query so that the query status of the session stays consistent
+    is_trivial_turn_allowed = session_details.get("QueryStatus", commonUtil.CHAT_QUERY_COMPLETED) == commonUtil.CHAT_QUERY_COMPLETED
+    workspace_key = workspace_id if workspace_id else "N/A"
+    trivial_response = bedrockUtil.is_greeting(message, model_item["ModelName"], workspace_key) if is_trivial_turn_allowed else {}
+    if trivial_response:
+        return post_trivial_turn(session_id, user_id, message_id, message, trivial_response, query_start_time, delivery_session)
+
+    chat_history = get_session_history(session_id, window_size=commonUtil.CHAT_HISTORY_WINDOW_SIZE)
+    # repeated submissions of the last question are answered with the last answer
+    trivial_response = bedrockUtil.is_greeting(message, model_item["ModelName"], workspace_key, chat_history) if is_trivial_turn_allowed else {}
+    if trivial_response:
+        return post_trivial_turn(session_id, user_id, message_id, message, trivial_response, query_start_time, delivery_session)
     human_message_object = {
         "Type": "human",
         "MessageId": message_id,
@@ -488,20 +1058,18 @@ def post_query_to_model(event, session_id, user_id, connection_id, auth_token):
         "SessionId": session_id,
         "ReviewRequired": False
     }
-    chat_history = json.loads(json.dumps(chat_history, cls=commonUtil.DecimalEncoder), parse_float=Decimal)
 
-    # set query status to running
-    update_expression = "REMOVE QueryFailureReason SET QueryStatus = :query_status, LastModifiedTime = :last_modified_time"
-    expression_attributes = {":query_status": commonUtil.CHAT_QUERY_PROCESSING, ":last_modified_time": query_start_time}
+    # set query status to running, the question is kept as the pending marker of the turn and is stored along with the
+    # answer when the turn is committed
+    recover_pending_turn(user_id, session_id, session_details)
+    update_expression = "REMOVE QueryFailureReason SET QueryStatus = :query_status, LastModifiedTime = :last_modified_time, PendingMessage = :pending_message"
+    expression_attributes = {":query_status": commonUtil.CHAT_QUERY_PROCESSING, ":last_modified_time": query_start_time, ":pending_message": human_message_object}
 
     # write title if not present
     if session_details["Title"] == "New Session":
         update_expression += ", Title = :title"
         expression_attributes[":title"] = message[:128]
 
-    human_message_object = json.loads(json.dumps(human_message_object, cls=commonUtil.DecimalEncoder), parse_float=Decimal)
-    dynamodbUtil.put_item(DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE), human_message_object)
-
     dynamodbUtil.update_item_by_key(
         DYNAMODB_RESOURCE.Table(SESSIONS_TABLE),
         {"UserId": user_id, "SessionId": session_id},
@@ -526,20 +1094,16 @@ def post_query_to_model(event, session_id, user_id, connection_id, auth_token):
             "SessionsTable": SESSIONS_TABLE,
             "ChatHistoryTable": CHAT_HISTORY_TABLE,
             "WorkspacesDocumentsTable": WORKSPACES_DOCUMENTS_TABLE,
-            "QueryStartTime": query_start_time
+            "QueryStartTime": query_start_time,
+            "DeliverySession": delivery_session
         })
         result = bedrockUtil.get_chatbot_response(user_id, connection_id, message_id, model_item, workspace_item, session_details, message, summarization_metadata_dict, visualization_metadata_dict, **advanced_config)
         query_end_time = commonUtil.get_current_time()
         response_time = str((datetime.strptime(query_end_time, commonUtil.DATETIME_ISO_FORMAT) - datetime.strptime(query_start_time, commonUtil.DATETIME_ISO_FORMAT)).total_seconds() * 1000)
-        # remove page content from metadata when storing to ddb
-        updated_documents = []
-        for document in result["metadata"].get("documents", []):
-            document_copy = copy.deepcopy(document)
-            document_copy.pop("page_content", None)
-            updated_documents.append(document_copy)
-        updated_metadata = copy.deepcopy(result["metadata"])
-        if updated_documents:
-            updated_metadata["documents"] = updated_documents
+        # remove page content from metadata when storing to ddb, the metadata is copied when it is serialized
+        updated_metadata = dict(result["metadata"])
+        if updated_metadata.get("documents"):
+            updated_metadata["documents"] = [{key: value for key, value in document.items() if key != "page_content"} for document in updated_metadata["documents"]]
         ai_message_object = {
             "Type": "ai",
             "Data": format_ai_message(result["content"]),
@@ -551,24 +1115,12 @@ def post_query_to_model(event, session_id, user_id, connection_id, auth_token):
             "SessionId": session_id,
             "ReviewRequired": False
         }
-        # store response to dynamodb
-        update_expression = "SET QueryStatus = :query_status, LastModifiedTime = :last_modified_time"
-        expression_attributes = {":query_status": commonUtil.CHAT_QUERY_COMPLETED, ":last_modified_time": query_end_time}
-
-        ai_message_object = json.loads(json.dumps(ai_message_object, cls=commonUtil.DecimalEncoder), parse_float=Decimal)
-        dynamodbUtil.put_item(DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE), ai_message_object)
-
-        dynamodbUtil.update_item_by_key(
-            DYNAMODB_RESOURCE.Table(SESSIONS_TABLE),
-            {"UserId": user_id, "SessionId": session_id},
-            update_expression,
-            expression_attributes
-        )
+        # store the turn to dynamodb
+        commit_turn(user_id, session_id, human_message_object, ai_message_object, commonUtil.CHAT_QUERY_COMPLETED)
 
         # send final response to user if model is not streamable
         if model_item["IsStreamingEnabled"] == "no":
-            WS_KWARGS.update({"LatestMessageId": message_id})
-            commonUtil.send_message_to_ws_connection(user_id, session_id, {"AIMessage": format_ai_message(result["content"]), "Metadata": {"IsComplete": True, "MessageId": message_id, "ResponseTime": response_time}}, WS_KWARGS)
+            delivery_session.send_message({"AIMessage": format_ai_message(result["content"]), "Metadata": {"IsComplete": True, "MessageId": message_id, "ResponseTime": response_time}})
 
         # return metadata
         result["metadata"].update({
@@ -606,20 +1158,8 @@ def post_query_to_model(event, session_id, user_id, connection_id, auth_token):
             "ReviewRequired": False
         }
 
-        update_expression = "SET QueryStatus = :query_status, QueryFailureReason = :query_failure_reason, LastModifiedTime = :last_modified_time"
-        expression_attributes = {":query_status": commonUtil.CHAT_QUERY_FAILED, ":query_failure_reason": str(ex), ":last_modified_time": query_end_time}
-
-        ai_message_object = json.loads(json.dumps(ai_message_object, cls=commonUtil.DecimalEncoder), parse_float=Decimal)
-        dynamodbUtil.put_item(DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE), ai_message_object)
-
-        dynamodbUtil.update_item_by_key(
-            DYNAMODB_RESOURCE.Table(SESSIONS_TABLE),
-            {"UserId": user_id, "SessionId": session_id},
-            update_expression,
-            expression_attributes
-        )
-        WS_KWARGS.update({"LatestMessageId": message_id})
-        commonUtil.send_message_to_ws_connection(user_id, session_id, {"AIMessage": ai_message, "Metadata": {"IsComplete": True, "MessageId": message_id, "ResponseTime": response_time}}, WS_KWARGS)
+        commit_turn(user_id, session_id, human_message_object, ai_message_object, commonUtil.CHAT_QUERY_FAILED, str(ex))
+        delivery_session.send_message({"AIMessage": ai_message, "Metadata": {"IsComplete": True, "MessageId": message_id, "ResponseTime": response_time}})
 
         # return metadata
         return {"IsComplete": True, "MessageId": message_id, "ResponseTime": response_time}
@@ -632,7 +1172,7 @@ def get_model_query_response(user_id, session_id, message_id):
     :param message_id
     """
     session_details = commonUtil.get_session_details(SESSIONS_TABLE, user_id, session_id)
-    if session_details.get("QueryStatus", None) == commonUtil.CHAT_QUERY_PROCESSING:
+    if session_details.get("QueryStatus", None) == commonUtil.CHAT_QUERY_PROCESSING and not recover_pending_turn(user_id, session_id, session_details):
         return commonUtil.build_get_response(200, {"Message": "Query is still running"})
     else:
         if message_id:
@@ -643,8 +1183,7 @@ def get_model_query_response(user_id, session_id, message_id):
                 ec_ipv_1002['Message'] = ec_ipv_1002['Message'].format("message-id", message_id)
                 raise errorUtil.InvalidInputException(EVENT_INFO, ec_ipv_1002)
         else:
-            history = get_session_history(session_id)
-            messages = history[-2:]
+            messages = get_session_history(session_id, window_size=2)
             message_id = messages[-1]["MessageId"]
 
         message_response = {}
@@ -655,52 +1194,156 @@ def get_model_query_response(user_id, session_id, message_id):
         return commonUtil.build_get_response(200,
             {"Message": message_response, "SessionId": session_id, "MessageId": message_id})
 
+def update_session_files(user_id, session_id, files_to_add=(), files_to_remove=()):
+    """
+    This function adds and removes file names of a session with update expressions conditioned on the files that were
+    read, so concurrent updates of the same session do not overwrite each other
+    :param user_id
+    :param session_id
+    :param files_to_add: file names to be appended to the session files
+    :param files_to_remove: file names to be removed from the session files
+    :return: False if the session does not exist
+    """
+    session_key = {"UserId": user_id, "SessionId": session_id}
+    for attempt in range(SESSION_FILES_UPDATE_MAX_ATTEMPTS):
+        session_item = dynamodbUtil.get_item_by_key_with_projection(DYNAMODB_RESOURCE.Table(SESSIONS_TABLE), session_key, "SessionId,Files")
+        if not session_item:
+            return False
+        files_list = session_item.get("Files", [])
+        remove_indexes = [index for index, file in enumerate(files_list) if file in files_to_remove]
+        new_files = [file for file in dict.fromkeys(files_to_add) if file not in files_list]
+        update_status = "success"
+        # list elements are removed by index, the update fails if an element was moved by a concurrent update
+        if remove_indexes:
+            expression_attributes = {":last_modified_time": commonUtil.get_current_time()}
+            expression_attributes.update({f":file_{position}": files_list[index] for position, index in enumerate(remove_indexes)})
+            update_status = dynamodbUtil.update_item_by_key(
+                DYNAMODB_RESOURCE.Table(SESSIONS_TABLE),
+                session_key,
+                "REMOVE " + ", ".join(f"Files[{index}]" for index in remove_indexes) + " SET LastModifiedTime = :last_modified_time",
+                expression_attributes,
+                condition_expression=" AND ".join(f"Files[{index}] = :file_{position}" for position, index in enumerate(remove_indexes))
+            )
+        # files are appended only if they are not part of the list yet
+        if new_files and update_status == "success":
+            expression_attributes = {":last_modified_time": commonUtil.get_current_time(), ":empty_list": [], ":new_files": new_files}
+            expression_attributes.update({f":new_file_{position}": file for position, file in enumerate(new_files)})
+            update_status = dynamodbUtil.update_item_by_key(
+                DYNAMODB_RESOURCE.Table(SESSIONS_TABLE),
+                session_key,
+                "SET Files = list_append(if_not_exists(Files, :empty_list), :new_files), LastModifiedTime = :last_modified_time",
+                expression_attributes,
+                condition_expression="attribute_exists(SessionId) AND " + " AND ".join(f"NOT contains(Files, :new_file_{position})" for position in range(len(new_files)))
+            )
+        if update_status == "success":
+            return True
+        if update_status == "error":
+            raise Exception(f"Failed to update files of session {session_id}")
+        LOGGER.info("In chat.update_session_files, files of session %s changed concurrently, retrying (attempt %s)", session_id, attempt + 1)
+    raise Exception(f"Failed to update files of session {session_id} after {SESSION_FILES_UPDATE_MAX_ATTEMPTS} attempts")
+
 def update_file_metadata(event):
     """
-    This function updates file metadata in sessions table
+    This function updates file metadata in sessions table, events of the same session are applied together
     :param event
     """
-    add_file = 'ObjectCreated' in event['Records'][0]['eventName']
-    key = unquote_plus(str(event['Records'][0]['s3']['object']['key']))
-    user_id = key.split("/")[-3]
-    session_id = key.split("/")[-2]
-    filename = key.split("/")[-1]
-    try:
-        session_details = commonUtil.get_session_details(SESSIONS_TABLE, user_id, session_id)
-    except Exception as ex:
+    # only the latest event of each object is applied, S3 orders the events of an object with the sequencer.
+    # Sequencers of different lengths are compared as strings after right-padding the shorter one with zeros
+    latest_records = {}
+    for record in event['Records']:
+        key = unquote_plus(str(record['s3']['object']['key']))
+        sequencer = record['s3']['object'].get('sequencer', '0')
+        if key in latest_records:
+            sequencer_length = max(len(sequencer), len(latest_records[key][0]))
+            if sequencer.ljust(sequencer_length, "0") < latest_records[key][0].ljust(sequencer_length, "0"):
+                continue
+        latest_records[key] = (sequencer, 'ObjectCreated' in record['eventName'])
+
+    session_files = {}
+    for key, (_, add_file) in latest_records.items():
+        user_id, session_id, filename = key.split("/")[-3:]
+        # drop the parsed copies of the file cached by this execution environment
+        bedrockUtil.invalidate_session_file_cache(SESSION_FILES_BUCKET_NAME, key)
+        files_to_add, files_to_remove = session_files.setdefault((user_id, session_id), ([], []))
+        if add_file:
+            LOGGER.info("In chat.update_file_metadata, user %s has added file %s to session %s", user_id, filename, session_id)
+            files_to_add.append(filename)
+        else:
+            LOGGER.info("In chat.update_file_metadata, user %s has removed file %s from session %s", user_id, filename, session_id)
+            files_to_remove.append(filename)
+
+    for (user_id, session_id), (files_to_add, files_to_remove) in session_files.items():
+        if update_session_files(user_id, session_id, files_to_add, files_to_remove):
+            continue
         # case where a session's ddb entry got deleted due to TTL expiry
-        if not add_file and "IPV-1002" in str(ex):
+        if not files_to_add:
             LOGGER.info("In chat.update_file_metadata, session already deleted, so no need to update metadata")
-            return
-        else:
-            raise Exception(ex) from ex
-    files_list = session_details.get("Files", [])
-    if add_file:
-        LOGGER.info("In chat.update_file_metadata, user %s has added file %s to session %s", user_id, filename, session_id)
-        files_list.append(filename)
-    else:
-        LOGGER.info("In chat.update_file_metadata, user %s has removed file %s from session %s", user_id, filename, session_id)
-        files_list.remove(filename)
-    session_details["Files"] = list(set(files_list))
-    session_details["LastModifiedTime"] = commonUtil.get_current_time()
-    dynamodbUtil.put_item(DYNAMODB_RESOURCE.Table(SESSIONS_TABLE), json.loads(json.dumps(session_details, cls=commonUtil.DecimalEncoder), parse_float=Decimal))
+            continue
+        LOGGER.error("In chat.update_file_metadata, session %s of user %s does not exist", session_id, user_id)
+        ec_ipv_1002 = errorUtil.get_error_object("IPV-1002")
+        ec_ipv_1002['Message'] = ec_ipv_1002['Message'].format("SessionId", session_id)
+        raise errorUtil.InvalidInputException(EVENT_INFO, ec_ipv_1002)
 
-def get_session_history(session_id, projection_keys=None, expression_attribute_names=None):
+def get_session_history(session_id, projection_keys=None, expression_attribute_names=None, window_size=None):
     """
-    This function gets session history
+    This function gets session history in chronological order
     :param session_id
     :param projection_keys
+    :param expression_attribute_names
+    :param window_size: number of latest messages to be returned, entire history is returned if not passed
     """
-    LOGGER.info("In chat.get_session_history, getting session history for session %s", session_id)
-    chat_history = dynamodbUtil.get_items_by_query_index(
+    LOGGER.info("In chat.get_session_history, getting session history for session %s with window size %s", session_id, window_size)
+    chat_history, _ = get_session_history_page(session_id, projection_keys, expression_attribute_names, window_size)
+    return chat_history
+
+def get_page_limit(query_params, default_limit=None):
+    """
+    Returns the page size requested with the limit query parameter, raises GE-1028 if the limit is not an integer between
+    PAGE_LIMIT_MIN and PAGE_LIMIT_MAX
+    :param query_params: query string parameters of the request
+    :param default_limit: page size to be used if no limit is requested
+    """
+    if not query_params or "limit" not in query_params:
+        return default_limit
+    limit = str(query_params["limit"]).strip()
+    if not limit.isdigit() or not PAGE_LIMIT_MIN <= int(limit) <= PAGE_LIMIT_MAX:
+        LOGGER.error("In chat.get_page_limit, invalid limit - %s", query_params["limit"])
+        ec_ge_1028 = errorUtil.get_error_object("GE-1028")
+        raise errorUtil.InvalidInputException(EVENT_INFO, ec_ge_1028)
+    return int(limit)
+
+def get_session_history_page(session_id, projection_keys=None, expression_attribute_names=None, window_size=None, next_token=None):
+    """
+    This function gets a page of session history, newest messages are read first using the MessageTime sort key
+    :param session_id
+    :param projection_keys: projection expression, MessageTime has to be part of it for paging
+    :param expression_attribute_names
+    :param window_size: number of messages in the page, entire history is returned if not passed
+    :param next_token: MessageTime of the oldest message of the previous page, only messages older than it are returned
+    :return: messages of the page in chronological order and the token to retrieve older messages (None if there are none)
+    """
+    LOGGER.info("In chat.get_session_history_page, getting session history for session %s older than %s", session_id, next_token)
+    key_condition_expression = Key("SessionId").eq(session_id)
+    if next_token:
+        key_condition_expression = key_condition_expression & Key("MessageTime").lt(next_token)
+    query_response = dynamodbUtil.get_items_by_query_index(
         DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE),
-        CHAT_HISTORY_TABLE_SESSIONID_MESSAGEID_INDEX,
-        Key("SessionId").eq(session_id),
+        None,
+        key_condition_expression,
         projection_expression=projection_keys,
-        expression_attributes_names=expression_attribute_names
+        expression_attributes_names=expression_attribute_names,
+        scan_index_forward=False,
+        limit=window_size,
+        is_batch_query_required=bool(window_size)
     )
-    chat_history = sorted(chat_history, key=lambda x: x["MessageTime"], reverse=False)
-    return chat_history
+    if window_size:
+        chat_history = query_response.get("Items", [])
+        older_messages_token = chat_history[-1]["MessageTime"] if chat_history and query_response.get("LastEvaluatedKey") else None
+    else:
+        chat_history = query_response
+        older_messages_token = None
+    chat_history.reverse()
+    return chat_history, older_messages_token
 
 def get_messages_from_history(session_id, message_id):
     """
@@ -781,17 +1424,18 @@ def lambda_handler(event, context):
                             Key("SessionId").eq(session_id)
                         )
                         user_id = session_item[0]["UserId"]
+                        # all messages of this turn are delivered through a single delivery session
+                        delivery_session = commonUtil.WebSocketDeliverySession(user_id, session_id, WS_KWARGS, connection_id)
                         # update message delivery status to pending in sessions table
-                        commonUtil.update_message_delivery_status(user_id, session_id, commonUtil.CHAT_MESSAGE_DELIVERY_PENDING, WS_KWARGS)
+                        delivery_session.update_delivery_status(commonUtil.CHAT_MESSAGE_DELIVERY_PENDING)
                         # post query to model
                         try:
-                            chat_response_metadata = post_query_to_model(event, session_id, user_id, connection_id, None)
-                            WS_KWARGS.update({"LatestMessageId": chat_response_metadata["MessageId"]})
+                            chat_response_metadata = post_query_to_model(event, session_id, user_id, connection_id, None, delivery_session)
                             # send metadata to client
-                            commonUtil.send_message_to_ws_connection(user_id, session_id, {"Metadata": chat_response_metadata}, WS_KWARGS)
+                            delivery_session.send_message({"Metadata": chat_response_metadata}, is_final=True, latest_message_id=chat_response_metadata["MessageId"])
                         except Exception as ex:
                             LOGGER.error("In chat.lambda_handler, user query failed due to error - %s", str(ex))
-                            commonUtil.send_message_to_ws_connection(user_id, session_id, {"AIMessage": str(ex), "Metadata": {"IsComplete": True}}, WS_KWARGS)
+                            delivery_session.send_message({"AIMessage": str(ex), "Metadata": {"IsComplete": True}}, is_final=True)
                         response = {
                             'statusCode': 200,
                             'body': json.dumps({"Message": "Message delivered"})
@@ -817,10 +1461,10 @@ def lambda_handler(event, context):
                         query_params = event.get("queryStringParameters", {})
                         client_id = query_params.get("client-id") if query_params and "client-id" in query_params else user_id
                         kwargs = {
-                            "offset": 0,
-                            "items_limit": 20,
+                            "items_limit": get_page_limit(query_params, 20),
                             "sort_order": query_params.get('sortorder') if query_params and 'sortorder' in query_params else 'desc',
-                            "sort_by": query_params.get('sortby') if query_params and 'sortby' in query_params else 'LastModifiedTime'
+                            "sort_by": query_params.get('sortby') if query_params and 'sortby' in query_params else 'LastModifiedTime',
+                            "next_token": query_params.get('next-token') if query_params else None
                          }
                         response = get_chat_sessions(user_id, client_id, **kwargs)
                     elif api_resource == "/chat/sessions" and http_method == "POST":
@@ -831,11 +1475,23 @@ def lambda_handler(event, context):
                     elif api_resource == "/chat/sessions/{id}" and http_method == "GET":
                         session_id = event['pathParameters']['id']
                         session_details = commonUtil.get_session_details(SESSIONS_TABLE, user_id, session_id)
-                        session_details["History"] = get_session_history(session_id, "#type,#data,MessageTime,ResponseTime,MessageId,Sources", {"#type": "Type", "#data": "Data"})
+                        query_params = event["queryStringParameters"] if event.get("queryStringParameters", {}) else {}
+                        window_size = get_page_limit(query_params)
+                        session_details["History"], next_token = get_session_history_page(
+                            session_id, "#type,#data,MessageTime,ResponseTime,MessageId,Sources", {"#type": "Type", "#data": "Data"},
+                            window_size, query_params.get("next-token")
+                        )
+                        # the question of a running turn is stored only when the turn is committed
+                        pending_message = session_details.pop("PendingMessage", None)
+                        if pending_message and not query_params.get("next-token"):
+                            session_details["History"].append({key: pending_message[key] for key in ("Type", "Data", "MessageTime", "MessageId")})
+                            session_details["History"].sort(key=lambda message: message["MessageTime"])
+                        if window_size:
+                            session_details["NextToken"] = next_token
                         response = commonUtil.build_get_response(200, session_details, commonUtil.is_compression_requested(event))
                     elif api_resource == "/chat/sessions/{id}" and http_method == "DELETE":
                         session_id = event['pathParameters']['id']
-                        response = delete_session(user_id, session_id)
+                        response = delete_session(user_id, session_id, context)
                     elif api_resource == "/chat/sessions/{id}/files" and http_method == "GET":
                         session_id = event['pathParameters']['id']
                         session_details = commonUtil.get_session_details(SESSIONS_TABLE, user_id, session_id)
@@ -882,7 +1538,12 @@ def lambda_handler(event, context):
                             raise errorUtil.InvalidInputException(EVENT_INFO, ec_ipv_1008)
                         files = event_body["Files"]
                         dataset_id = event_body["DatasetId"]
-                        response = upload_file_to_dataset(user_id, session_id, files, dataset_id)
+                        response = upload_file_to_dataset(user_id, session_id, files, dataset_id, context, event_body.get("UploadId"))
+                    elif api_resource == "/chat/sessions/{id}/files/dataset-upload/{upload_id}" and http_method == "GET":
+                        session_id = event['pathParameters']['id']
+                        upload_id = event['pathParameters']['upload_id']
+                        upload_details = get_dataset_upload(user_id, session_id, upload_id)
+                        response = commonUtil.build_get_response(200, upload_details, commonUtil.is_compression_requested(event))
                     elif api_resource == "/chat/sessions/{id}/messages/{message_id}" and http_method == "GET":
                         session_id = event['pathParameters']['id']
                         message_id = event['pathParameters']['message_id']
@@ -906,6 +1567,12 @@ def lambda_handler(event, context):
                 LOGGER.error("In chat.lambda_handler, Exception occurred with error %s", exc)
                 response = commonUtil.build_generic_response(500, {"Message": str(exc)})
             return response
+    elif event.get("Operation") == SESSION_HISTORY_PURGE_OPERATION:
+        LOGGER.info("In chat.lambda_handler, request is to purge session history, event - %s", event)
+        purge_session_history(event, context)
+    elif event.get("Operation") == DATASET_UPLOAD_OPERATION:
+        LOGGER.info("In chat.lambda_handler, request is to copy session files to a dataset, event - %s", event)
+        copy_session_files_to_dataset(event, context)
     else:
         LOGGER.info("In chat.lambda_handler, request is from S3, event - %s", event)
         update_file_metadata(event)
@@ -57,6 +57,9 @@ except Exception as ex:
     LOGGER.error("In embeddedChatbots.py, Failed to load environment variables. error: %s", str(ex))
     sys.exit()
 
+# warm the parameter cache with the parameters read on every chatbot turn
+commonUtil.prefetch_parameters([commonUtil.OPENAI_KEY_SSM_KEY, commonUtil.WORKSPACE_RETRIEVAL_MAXRESULTS_SSM_KEY])
+
 class LambdaTimer:
     """
     Calling a function in a specified time.
@@ -184,15 +187,16 @@ def format_ai_message(message):
     return message
 
 
-def get_session_details(session_id, chatbot_id):
+def get_session_details(session_id, chatbot_id, window_size=None):
     """
     Method used to fetch session details from chat history table and compose object required for session
     :param session_id: session for which details are to be returned
     :param chatbot_id: chatbot for which session details are asked
+    :param window_size: number of latest messages to be loaded, entire history is loaded if not passed
     """
     LOGGER.info("In embeddedChatbots.get_session_details method")
     # Fetch chat history from table
-    chatbot_history = get_chat_history(session_id, chatbot_id)
+    chatbot_history = get_chat_history(session_id, chatbot_id, window_size)
     session_history = [
             {
                 "MessageId": a_message["MessageId"],
@@ -218,19 +222,78 @@ def raise_model_access_exception():
     raise errorUtil.InvalidInputException(EVENT_INFO, ec_ge_1034)
 
 # pylint: disable=too-many-locals
-def post_query_to_model(event_body, chatbot_id, session_id, connection_id):
+def post_trivial_turn(event_body, chatbot_id, session_id, message_id, message, trivial_response, query_start_time, delivery_session):
+    """
+    This function records a trivial turn answered from a template, both messages are stored in a single batch write
+    :param event_body
+    :param chatbot_id
+    :param session_id
+    :param message_id
+    :param message: user message
+    :param trivial_response: response returned by bedrockUtil.is_greeting
+    :param query_start_time
+    :param delivery_session: WebSocketDeliverySession used to send messages of this turn to the user
+    """
+    LOGGER.info("In embeddedChatbots.post_trivial_turn, answering %s turn of session %s", trivial_response["metadata"]["turnType"], session_id)
+    response_time = "0.0"
+    if event_body.get("SaveChatHistory"):
+        query_end_time = commonUtil.get_current_time()
+        # MessageTime is the sort key with second precision, the answer is stored after the question
+        if query_end_time <= query_start_time:
+            query_end_time = (datetime.strptime(query_start_time, commonUtil.DATETIME_ISO_FORMAT) + timedelta(seconds=1)).strftime(commonUtil.DATETIME_ISO_FORMAT)
+        expiration_time = int((datetime.now(timezone.utc) + timedelta(days=commonUtil.CHATBOT_SESSION_VALIDITY_IN_DAYS)).strftime('%s'))
+        message_objects = [
+            {
+                "Type": "human",
+                "MessageId": message_id,
+                "Data": message,
+                "MessageTime": query_start_time,
+                "ClientId": chatbot_id,
+                "SessionId": session_id,
+                "ReviewRequired": False,
+                "ExpirationTime": expiration_time
+            },
+            {
+                "Type": "ai",
+                "Data": trivial_response["content"],
+                "MessageId": message_id,
+                "Metadata": trivial_response["metadata"],
+                "MessageTime": query_end_time,
+                "ResponseTime": response_time,
+                "ClientId": chatbot_id,
+                "SessionId": session_id,
+                "ReviewRequired": False,
+                "ExpirationTime": expiration_time
+            }
+        ]
+        message_objects = json.loads(json.dumps(message_objects, cls=commonUtil.DecimalEncoder), parse_float=Decimal)
+        dynamodbUtil.batch_write_items(DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE), message_objects)
+    delivery_session.send_message({"AIMessage": trivial_response["content"], "Metadata": {"IsComplete": True, "MessageId": message_id, "ResponseTime": response_time}})
+
+    # return metadata
+    trivial_response["metadata"].update({
+        "MessageId": message_id,
+        "IsComplete": True,
+        "ResponseTime": response_time
+    })
+    return trivial_response["metadata"]
+
+def post_query_to_model(event_body, chatbot_id, session_id, connection_id, delivery_session=None):
     """
     This function is to post query to model
     :param event
+    :param delivery_session: WebSocketDeliverySession used to send messages of this turn to the user
     """
     LOGGER.info("In embeddedChatbots.post_query_to_model with event - %s", event_body)
+    if not delivery_session:
+        delivery_session = commonUtil.WebSocketDeliverySession(chatbot_id, session_id, WS_KWARGS, connection_id)
     bedrock_runtime_client = boto3.client("bedrock-runtime", AWS_REGION)
     s3_resource = boto3.resource('s3', AWS_REGION, config=Config(signature_version='s3v4', s3 ={"addressing_style":"virtual"}))
     ssm_client = boto3.client("ssm", AWS_REGION)
 
     commonUtil.validate_event_body(event_body, CHATBOT_SEND_MESSAGE_REQUIRED_KEYS)
 
-    session_details = get_session_details(session_id, chatbot_id)
+    session_details = get_session_details(session_id, chatbot_id, commonUtil.CHAT_HISTORY_WINDOW_SIZE)
     chatbot_details = get_chatbot_details_from_db(chatbot_id)
     model_id = chatbot_details.get("Model")
     message_id = event_body["MessageId"]
@@ -287,9 +350,15 @@ def post_query_to_model(event_body, chatbot_id, session_id, connection_id):
             raise errorUtil.GenericFailureException(EVENT_INFO, ec_ge_1034)
         os.environ["OPENAI_API_KEY"] = openai_key
 
+    query_start_time = commonUtil.get_current_time()
+    # trivial turns (greetings, thanks, repeated submissions) are answered from templates
+    history = session_details.get("History", event_body.get("History", [])) if event_body.get("SaveChatHistory") else event_body.get("History", [])
+    trivial_response = bedrockUtil.is_greeting(message, model_item["ModelName"], workspace_id if workspace_id else "N/A", history)
+    if trivial_response:
+        return post_trivial_turn(event_body, chatbot_id, session_id, message_id, message, trivial_response, query_start_time, delivery_session)
+
     workspace_item = dynamodbUtil.get_item_with_key(DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE), {"WorkspaceId": workspace_id})
 
-    query_start_time = commonUtil.get_current_time()
     if event_body.get("SaveChatHistory"):
         chat_history = session_details.get("History", event_body.get("History", []))
         human_message_object = {
@@ -327,7 +396,8 @@ def post_query_to_model(event_body, chatbot_id, session_id, connection_id):
             "ChatHistoryTable": CHAT_HISTORY_TABLE,
             "WorkspacesDocumentsTable": WORKSPACES_DOCUMENTS_TABLE,
             "ChatbotsTable": CHATBOTS_TABLE,
-            "QueryStartTime": query_start_time
+            "QueryStartTime": query_start_time,
+            "DeliverySession": delivery_session
         })
         result = bedrockUtil.get_chatbot_response(chatbot_id, connection_id, message_id, model_item, workspace_item, session_details, message, {}, **advanced_config)
         query_end_time = commonUtil.get_current_time()
@@ -351,8 +421,7 @@ def post_query_to_model(event_body, chatbot_id, session_id, connection_id):
 
         # send final response to user if model is not streamable
         if model_item["IsStreamingEnabled"] == "no":
-            WS_KWARGS.update({"LatestMessageId": message_id})
-            commonUtil.send_message_to_ws_connection(chatbot_id, session_id, {"AIMessage": format_ai_message(result["content"]), "Metadata": {"IsComplete": True, "MessageId": message_id, "ResponseTime": response_time}}, WS_KWARGS)
+            delivery_session.send_message({"AIMessage": format_ai_message(result["content"]), "Metadata": {"IsComplete": True, "MessageId": message_id, "ResponseTime": response_time}})
 
         # return metadata
         result["metadata"].update({
@@ -382,28 +451,31 @@ def post_query_to_model(event_body, chatbot_id, session_id, connection_id):
             ai_message_object = json.loads(json.dumps(ai_message_object, cls=commonUtil.DecimalEncoder), parse_float=Decimal)
             dynamodbUtil.put_item(DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE), ai_message_object)
 
-        WS_KWARGS.update({"LatestMessageId": message_id})
-        commonUtil.send_message_to_ws_connection(chatbot_id, session_id, {"AIMessage": ai_message, "Metadata": {"IsComplete": True, "MessageId": message_id, "ResponseTime": response_time}}, WS_KWARGS)
+        delivery_session.send_message({"AIMessage": ai_message, "Metadata": {"IsComplete": True, "MessageId": message_id, "ResponseTime": response_time}})
 
         # return metadata
         return {"IsComplete": True, "MessageId": message_id, "ResponseTime": response_time}
 
 
-def get_chat_history(session_id, chatbot_id):
+def get_chat_history(session_id, chatbot_id, window_size=None):
     """
     Method used to fetch session details give session id
     :param session_id: session id for which details are to be retrieved
+    :param chatbot_id: chatbot to which the session belongs
+    :param window_size: number of latest messages to be retrieved, entire history is retrieved if not passed
     """
     LOGGER.info("In embeddedChatbots.get_chat_history method, with session id %s and chatbot id %s", session_id, chatbot_id)
+    # newest messages are read first using the MessageTime sort key so only the required window is read
     chat_history_details = dynamodbUtil.get_items_by_query_index(
         DYNAMODB_RESOURCE.Table(CHAT_HISTORY_TABLE),
-        CHAT_HISTORY_CLIENTID_INDEX,
-        Key("ClientId").eq(chatbot_id), None,
-        Attr("SessionId").eq(session_id)
+        None,
+        Key("SessionId").eq(session_id), None,
+        Attr("ClientId").eq(chatbot_id),
+        scan_index_forward=False,
+        limit=window_size
     )
-    # sort the retrieved messages
-    if chat_history_details:
-        chat_history_details = sorted(chat_history_details, key=lambda x: x["MessageTime"], reverse=False)
+    # return the messages in chronological order
+    chat_history_details.reverse()
     LOGGER.info("In embeddedChatbots.get_chat_history method, exiting")
     return chat_history_details
 
@@ -530,17 +602,18 @@ def lambda_handler(event, context):
                     event_body = json.loads(event.get('body')) if event.get('body', None) else {}
                     chatbot_id = event_body["ChatbotId"]
                     session_id = event_body["SessionId"]
+                    # all messages of this turn are delivered through a single delivery session
+                    delivery_session = commonUtil.WebSocketDeliverySession(chatbot_id, session_id, WS_KWARGS, connection_id)
                     # update message delivery status to pending in sessions table
-                    commonUtil.update_message_delivery_status(chatbot_id, session_id, commonUtil.CHAT_MESSAGE_DELIVERY_PENDING, WS_KWARGS)
+                    delivery_session.update_delivery_status(commonUtil.CHAT_MESSAGE_DELIVERY_PENDING)
                     # post query to model
                     try:
-                        chat_response_metadata = post_query_to_model(event_body, chatbot_id, session_id, connection_id)
-                        WS_KWARGS.update({"LatestMessageId": chat_response_metadata["MessageId"]})
+                        chat_response_metadata = post_query_to_model(event_body, chatbot_id, session_id, connection_id, delivery_session)
                         # send metadata to client
-                        commonUtil.send_message_to_ws_connection(chatbot_id, session_id, {"Metadata": chat_response_metadata}, WS_KWARGS)
+                        delivery_session.send_message({"Metadata": chat_response_metadata}, is_final=True, latest_message_id=chat_response_metadata["MessageId"])
                     except Exception as ex:
                         LOGGER.error("In embeddedChatbots.lambda_handler, user query failed due to error - %s", str(ex))
-                        commonUtil.send_message_to_ws_connection(chatbot_id, session_id, {"AIMessage": str(ex), "Metadata": {"IsComplete": True}}, WS_KWARGS)
+                        delivery_session.send_message({"AIMessage": str(ex), "Metadata": {"IsComplete": True}}, is_final=True)
                     response = {
                         'statusCode': 200,
                         'body': json.dumps({"Message": "Message sent"})
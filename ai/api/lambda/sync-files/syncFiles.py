@@ -6,6 +6,7 @@ import os
 import re
 import logging
 import json
+import time
 import uuid
 import boto3
 from boto3.dynamodb.conditions import Key, Attr
@@ -26,6 +27,7 @@ try:
     PROJECT_SHORT_NAME = os.environ['projectShortName']
     AWS_PARTITION = os.environ["awsPartition"]
     ACCOUNT_ID = os.environ['accountId']
+    VERTICAL_NAME = os.environ['verticalName']
 
     # aws service clients
     DYNAMODB_RESOURCE = boto3.resource('dynamodb', AWS_REGION)
@@ -34,80 +36,173 @@ try:
 
     # dynamodb tables
     WORKSPACES_DOCUMENTS_TABLE_WORKSPACEID_INDEX = dynamodbUtil.WORKSPACES_DOCUMENTS_TABLE_WORKSPACEID_INDEX
+    WORKSPACES_DOCUMENTS_TABLE_WORKSPACEID_FILENAME_INDEX = dynamodbUtil.WORKSPACES_DOCUMENTS_TABLE_WORKSPACEID_FILENAME_INDEX
+    WORKSPACES_DATASETS_TABLE = dynamodbUtil.WORKSPACES_DATASETS_TABLE
     WORKSPACES_DOCUMENTS_TABLE = dynamodbUtil.WORKSPACES_DOCUMENTS_TABLE
     WORKSPACES_TABLE = dynamodbUtil.WORKSPACES_TABLE
-    WORKSPACES_EXECUTIONS_TABLE = dynamodbUtil.WORKSPACES_EXECUTIONS_TABLE
     USERS_TABLE = dynamodbUtil.USERS_TABLE
 
     STEP_FUNCTION_CLIENT = boto3.client('stepfunctions', AWS_REGION)
-    BEDROCK_AGENT_CLIENT = boto3.client('bedrock-agent', AWS_REGION)
 
     WORKSPACES_LAMBDA_ARN = os.environ['workspacesLambdaArn']
     EXECUTE_INPUT_LAMBDA_SM_ARN = os.environ['executeInputLambdaStateMachineArn']
     DATASET_OPERATIONS_LAMBDA = os.environ["amorphicDatasetOperationsLambdaArn"]
 
     EVENT_INFO ={}
+    # set once per container after workspaces created before the reverse index are backfilled
+    IS_SOURCE_INDEX_BACKFILLED = False
+    # written once the backfill completed, so that later cold starts skip the scan of the workspaces table
+    SOURCE_INDEX_BACKFILLED_SSM_KEY = f"/{VERTICAL_NAME}/{ENVIRONMENT}/workspaces/sourceIndexBackfilled"
 except Exception as ex:
     LOGGER.error("In syncFiles, failed to set environment variables with: %s", '{0}'.format(ex))
     sys.exit()
 
-def run_workspace(user_id: str, workspace_id: str) -> dict:
-    """Trigger ingestion job for the knowledge base linked to the workspace
+def request_workspace_ingestion(user_id: str, workspace_id: str) -> dict:
+    """Record pending file changes of a file-based workspace and make sure an ingestion scheduler is running for it
+
+    Changes are coalesced per workspace, the scheduler (run_pending_ingestion operation of the workspaces lambda)
+    starts a single ingestion job once the changes settle and no other job is running for the workspace
 
     Args:
-        user_id (str): Id of the user triggering the workspace run
+        user_id (str): Id of the user whose file change requested the run
         workspace_id (str): Workspace ID
     """
-    LOGGER.info("In syncFiles.run_workspace, Starting ingestion job for workspace id - %s", workspace_id)
-    workspace_item = dynamodbUtil.get_item_with_key(DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE), {'WorkspaceId': workspace_id})
-    knowledge_base_id = workspace_item['KnowledgeBaseId']
-    data_source_id = workspace_item['DataSourceId']
-    response = BEDROCK_AGENT_CLIENT.start_ingestion_job(
-        knowledgeBaseId=knowledge_base_id,
-        dataSourceId=data_source_id
-    )['ingestionJob']
-
-    workspace_run_db_item = {
-        "RunId": response['ingestionJobId'],
-        "WorkspaceId": workspace_id,
-        "RunStatus": commonUtil.RUN_STATUS_IN_PROGRESS,
-        "StartTime": commonUtil.get_current_time(),
-        "Message": "Run triggered",
-        "LastModifiedBy": user_id,
-        "LastModifiedTime": commonUtil.get_current_time(),
-        "TriggeredBy": user_id,
-        "TriggerType": 'file-based'
-    }
-    put_response = dynamodbUtil.put_item(DYNAMODB_RESOURCE.Table(WORKSPACES_EXECUTIONS_TABLE), workspace_run_db_item)
-    if put_response == "error":
-        LOGGER.info("In syncFiles.run_workspace, updating workspace execution table failed")
-        ec_ge_1020 = errorUtil.get_error_object("GE-1020")
-        ec_ge_1020['Message'] = ec_ge_1020['Message'].format("WORKSPACES EXECUTIONS")
-        raise errorUtil.InvalidInputException(EVENT_INFO, ec_ge_1020)
+    LOGGER.info("In syncFiles.request_workspace_ingestion, requesting ingestion for workspace id - %s", workspace_id)
+    current_epoch = int(time.time())
+    update_status = dynamodbUtil.update_item_by_key(
+        DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE),
+        {'WorkspaceId': workspace_id},
+        "SET IngestionPending = :pending, LastIngestionRequestTime = :now, IngestionPendingSince = if_not_exists(IngestionPendingSince, :now), IngestionRequestedBy = :user",
+        {":pending": True, ":now": current_epoch, ":user": user_id}
+    )
+    if update_status == "error":
+        LOGGER.error("In syncFiles.request_workspace_ingestion, failed to record pending ingestion for workspace %s", workspace_id)
+        ec_db_1002 = errorUtil.get_error_object("DB-1002")
+        raise errorUtil.GenericFailureException(EVENT_INFO, ec_db_1002)
+
+    # only the request which flips IngestionScheduled starts the scheduler, others are coalesced into its next run.
+    # A scheduler which stopped sending heartbeats is considered dead and replaced
+    update_status = dynamodbUtil.update_item_by_key(
+        DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE),
+        {'WorkspaceId': workspace_id},
+        "SET IngestionScheduled = :scheduled, IngestionScheduledTime = :now",
+        {":scheduled": True, ":not_scheduled": False, ":now": current_epoch, ":stale": current_epoch - commonUtil.INGESTION_SCHEDULER_STALE_AFTER_IN_SECONDS},
+        None,
+        "attribute_not_exists(IngestionScheduled) OR IngestionScheduled = :not_scheduled OR IngestionScheduledTime < :stale"
+    )
+    if update_status == "condition-error":
+        LOGGER.info("In syncFiles.request_workspace_ingestion, ingestion is already scheduled for workspace %s, coalescing the change", workspace_id)
+        return {'Message': 'Run queued'}
+    if update_status == "error":
+        LOGGER.error("In syncFiles.request_workspace_ingestion, failed to schedule ingestion for workspace %s", workspace_id)
+        ec_db_1002 = errorUtil.get_error_object("DB-1002")
+        raise errorUtil.GenericFailureException(EVENT_INFO, ec_db_1002)
 
     sf_payload = {
         "lambdaArn": WORKSPACES_LAMBDA_ARN,
-        "Operation": "check_ingestion_job_status",
+        "Operation": "run_pending_ingestion",
         "UserId": user_id,
         "WorkspaceId": workspace_id,
-        "RunStatus": commonUtil.RUN_STATUS_IN_PROGRESS,
-        "RunId": workspace_run_db_item['RunId'],
-        "KnowledgeBaseId": knowledge_base_id,
-        "DataSourceId": data_source_id
+        "WaitTimeInSec": commonUtil.INGESTION_DEBOUNCE_WINDOW_IN_SECONDS
     }
-    sm_resp = STEP_FUNCTION_CLIENT.start_execution(
-        stateMachineArn=EXECUTE_INPUT_LAMBDA_SM_ARN,
-        input=json.dumps(sf_payload),
-        name=str(uuid.uuid4())
-    )
-    LOGGER.info("In syncFiles.run_workspace, check ingestion job sf invoke response - %s", str(sm_resp))
-    if sm_resp["ResponseMetadata"]["HTTPStatusCode"] != 200:
-        LOGGER.error("In syncFiles.run_workspace, error: %s", sm_resp['Payload'].read().decode())
-        ec_ge_1034 = errorUtil.get_error_object("GE-1034")
-        ec_ge_1034["Message"] = f"Error- {sm_resp['Payload'].read().decode()}"
-        raise errorUtil.GenericFailureException(EVENT_INFO, ec_ge_1034)
+    try:
+        sm_resp = STEP_FUNCTION_CLIENT.start_execution(
+            stateMachineArn=EXECUTE_INPUT_LAMBDA_SM_ARN,
+            input=json.dumps(sf_payload),
+            name=str(uuid.uuid4())
+        )
+    except Exception as ex:
+        # release the flag this request set, otherwise the changes would wait for the stale timeout of a scheduler that never started
+        LOGGER.error("In syncFiles.request_workspace_ingestion, failed to start the ingestion scheduler for workspace %s with error - %s", workspace_id, str(ex))
+        update_status = dynamodbUtil.update_item_by_key(
+            DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE),
+            {'WorkspaceId': workspace_id},
+            "SET IngestionScheduled = :not_scheduled",
+            {":not_scheduled": False, ":scheduled_time": current_epoch},
+            None,
+            "IngestionScheduledTime = :scheduled_time"
+        )
+        LOGGER.info("In syncFiles.request_workspace_ingestion, reset of the ingestion schedule for workspace %s returned - %s", workspace_id, update_status)
+        raise
+    LOGGER.info("In syncFiles.request_workspace_ingestion, ingestion scheduler sf invoke response - %s", str(sm_resp))
+    return {'Message': 'Run scheduled'}
 
-    return {'Message': 'Run triggered', 'RunId': workspace_run_db_item['RunId']}
+
+def backfill_workspaces_source_index() -> None:
+    """Index workspaces created before the dataset to workspace reverse index existed
+
+    Adds the (DatasetId, WorkspaceId) entries of every attached dataset and copies the file name of
+    the workspace documents to the top-level FileName attribute used by the workspace id and file
+    name index, then marks the workspace as indexed so that it is skipped afterwards
+    """
+    LOGGER.info("In syncFiles.backfill_workspaces_source_index, starting method")
+    workspaces_to_index = dynamodbUtil.scan_with_pagination(DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE), Attr("IsSourceIndexed").not_exists(),
+                                                            "AttachedDatasets, WorkspaceId")
+    for workspace in workspaces_to_index:
+        workspace_id = workspace['WorkspaceId']
+        LOGGER.info("In syncFiles.backfill_workspaces_source_index, indexing workspace %s", workspace_id)
+        dynamodbUtil.batch_write_items(DYNAMODB_RESOURCE.Table(WORKSPACES_DATASETS_TABLE), [
+            {"DatasetId": dataset['DatasetId'], "WorkspaceId": workspace_id} for dataset in workspace.get('AttachedDatasets', [])
+        ])
+        document_items = dynamodbUtil.get_items_by_query_index(DYNAMODB_RESOURCE.Table(WORKSPACES_DOCUMENTS_TABLE), WORKSPACES_DOCUMENTS_TABLE_WORKSPACEID_INDEX,
+                                                               Key('WorkspaceId').eq(workspace_id), "DocumentId, WorkspaceId",
+                                                               Attr('DocumentDetails.FileName').exists() & Attr('FileName').not_exists())
+        for document_item in document_items:
+            dynamodbUtil.update_item_by_key(DYNAMODB_RESOURCE.Table(WORKSPACES_DOCUMENTS_TABLE), {'DocumentId': document_item['DocumentId'], 'WorkspaceId': workspace_id},
+                                            "SET FileName = DocumentDetails.FileName")
+        dynamodbUtil.update_item_by_key(DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE), {'WorkspaceId': workspace_id}, "SET IsSourceIndexed = :val", {":val": True})
+    LOGGER.info("In syncFiles.backfill_workspaces_source_index, indexed %s workspaces", len(workspaces_to_index))
+
+
+def backfill_workspaces_source_index_once() -> None:
+    """Run the source index backfill unless it already completed in this container or in an earlier deployment
+
+    Failures are only logged so that the files of the batch are still synced, the backfill is retried on the next batch
+    """
+    global IS_SOURCE_INDEX_BACKFILLED # pylint: disable=global-statement
+    if IS_SOURCE_INDEX_BACKFILLED:
+        return
+    try:
+        if commonUtil.ssm_parameter_exists(SSM_CLIENT, SOURCE_INDEX_BACKFILLED_SSM_KEY):
+            LOGGER.info("In syncFiles.backfill_workspaces_source_index_once, source index is already backfilled")
+        else:
+            backfill_workspaces_source_index()
+            commonUtil.create_ssm_parameter(SSM_CLIENT, {
+                "Name": SOURCE_INDEX_BACKFILLED_SSM_KEY,
+                "Description": "Workspaces created before the dataset to workspace reverse index are backfilled",
+                "Value": "true",
+                "Type": "String",
+                "Overwrite": True
+            })
+        IS_SOURCE_INDEX_BACKFILLED = True
+    except Exception as ex:
+        LOGGER.error("In syncFiles.backfill_workspaces_source_index_once, failed to backfill the workspaces source index with error - %s", str(ex))
+
+
+def get_dataset_workspaces(dataset_id: str) -> list:
+    """Returns the active workspaces to which the dataset is attached, using the dataset to workspace reverse index
+
+    Args:
+        dataset_id (str): Amorphic dataset ID
+    """
+    workspace_keys = [{'WorkspaceId': item['WorkspaceId']} for item in dynamodbUtil.get_items_by_query(
+        DYNAMODB_RESOURCE.Table(WORKSPACES_DATASETS_TABLE), Key('DatasetId').eq(dataset_id), "WorkspaceId")]
+    if not workspace_keys:
+        return []
+    workspace_items = dynamodbUtil.batch_get_items(DYNAMODB_RESOURCE, WORKSPACES_TABLE, workspace_keys, "WorkspaceId, WorkspaceStatus, TriggerType", None, consistent_read=False)
+    return [workspace for workspace in workspace_items if workspace.get('WorkspaceStatus') == commonUtil.WORKSPACES_CREATION_COMPLETED_STATUS]
+
+
+def get_workspace_document_by_file_name(workspace_id: str, file_name: str) -> dict:
+    """Returns the workspace document for a source dataset file, if it exists
+
+    Args:
+        workspace_id (str): Workspace ID
+        file_name (str): File name of the document in the source dataset
+    """
+    file_items = dynamodbUtil.get_items_by_query_index(DYNAMODB_RESOURCE.Table(WORKSPACES_DOCUMENTS_TABLE), WORKSPACES_DOCUMENTS_TABLE_WORKSPACEID_FILENAME_INDEX,
+                                                       Key('WorkspaceId').eq(workspace_id) & Key('FileName').eq(file_name), None, None)
+    return file_items[0] if file_items else {}
 
 
 def sync_workspace_source_files(event):
@@ -116,91 +211,93 @@ def sync_workspace_source_files(event):
     :param event: list of events from dynamodb streams
     """
     LOGGER.info("In syncFiles.sync_workspace_source_files, starting files sync")
-    workspaces_to_sync = dynamodbUtil.scan_with_pagination(DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE), Attr("WorkspaceStatus").eq(commonUtil.WORKSPACES_CREATION_COMPLETED_STATUS),
-                                                           "AttachedDatasets, WorkspaceId")
-    source_dataset_ids = []
-    workspace_dataset_ids = {}
-    for workspace in workspaces_to_sync:
-        datasets_linked_to_workspace = [dataset['DatasetId'] for dataset in workspace.get('AttachedDatasets', [])]
-        source_dataset_ids.extend(datasets_linked_to_workspace)
-        workspace_dataset_ids[workspace['WorkspaceId']] = datasets_linked_to_workspace
-    source_dataset_ids = list(set(source_dataset_ids))
-
-    for item in event:
-        event_name = item.get('eventName', "")
-        new_record = item.get('dynamodb').get('OldImage') if event_name == 'REMOVE' else item.get('dynamodb').get('NewImage')
-        file_name = new_record.get('FileName').get('S')
-        dataset_id = new_record.get('DatasetId').get('S')
-        load_status = new_record.get('LoadStatus').get('S')
-        if new_record.get('UserId'):
-            user_id = new_record.get('UserId', {}).get('S', "N/A")
-        else:
-            user_id = new_record.get('LastModifiedBy', {}).get('S', "N/A")
-        if dataset_id in source_dataset_ids:
-            source_dataset_id = dataset_id
-            LOGGER.info("In syncFiles.sync_workspace_source_files, syncing file for source dataset %s", dataset_id)
-
-            workspace_id_list = [workspace['WorkspaceId'] for workspace in workspaces_to_sync if source_dataset_id in workspace_dataset_ids[workspace['WorkspaceId']]]
-            LOGGER.info("In syncFiles.sync_workspace_source_files, workspaces who have source dataset %s are - %s", source_dataset_id, workspace_id_list)
-            workspace_file_items = []
-            for workspace_id in workspace_id_list:
-                workspace_item = dynamodbUtil.get_item_with_key(DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE), {'WorkspaceId': workspace_id})
-                document_id = str(uuid.uuid4())
-                file_item = {}
-                # Check if the file is scraped web page from the workspace
-                match = re.search(r'_([^_]+)\.txt$', file_name)
-                if match:
-                    website_document_id = match.group(1)
-                    file_item = dynamodbUtil.get_item_with_key(DYNAMODB_RESOURCE.Table(WORKSPACES_DOCUMENTS_TABLE), {'WorkspaceId': workspace_id, 'DocumentId': website_document_id})
-                # Check if file already exists
-                else:
-                    key_condition_expression = Key('WorkspaceId').eq(workspace_id)
-                    filter_expression = Attr('DocumentDetails.FileName').eq(file_name)
-                    file_items = dynamodbUtil.get_items_by_query_index(DYNAMODB_RESOURCE.Table(WORKSPACES_DOCUMENTS_TABLE), WORKSPACES_DOCUMENTS_TABLE_WORKSPACEID_INDEX, key_condition_expression,
-                                                                    None, filter_expression)
-                    if file_items:
-                        file_item = file_items[0]
-                if file_item:
-                    document_id = file_item['DocumentId']
-                workspace_file_item = {
-                    "DocumentId": document_id,
-                    "WorkspaceId": workspace_id
-                }
-                if event_name != "REMOVE":
-                    workspace_file_item.update({
-                        "DocumentType": file_item.get("DocumentType", "file"),
-                        "DocumentDetails": {
-                            "FileName": file_name,
-                            "DatasetId": source_dataset_id
-                        },
-                        "LastModifiedBy": user_id,
-                        "LastModifiedTime": commonUtil.get_current_time(),
-                        "TriggerType": workspace_item["TriggerType"]
-                    })
-                    if file_item.get('DocumentType') == 'website':
-                        workspace_file_item['DocumentDetails'].update({
-                            'WebsiteURL': file_item['DocumentDetails']['WebsiteURL']
-                        })
-                    if load_status == "completed":
-                        workspace_file_item.update({
-                            "Message": "File uploaded successfully"
-                        })
-                    elif load_status == "failed":
+    # workspaces are looked up once per source dataset in the batch
+    dataset_workspaces = {}
+    # file-based workspaces with completed file loads, ingestion is requested once per workspace for the batch
+    workspaces_to_ingest = {}
+
+    # ingestion is requested even if a later record fails, the files written for the workspaces before the failure
+    # would otherwise not be ingested until the next file load of the workspace
+    try:
+        for item in event:
+            event_name = item.get('eventName', "")
+            new_record = item.get('dynamodb').get('OldImage') if event_name == 'REMOVE' else item.get('dynamodb').get('NewImage')
+            file_name = new_record.get('FileName').get('S')
+            dataset_id = new_record.get('DatasetId').get('S')
+            load_status = new_record.get('LoadStatus').get('S')
+            if new_record.get('UserId'):
+                user_id = new_record.get('UserId', {}).get('S', "N/A")
+            else:
+                user_id = new_record.get('LastModifiedBy', {}).get('S', "N/A")
+            if dataset_id not in dataset_workspaces:
+                dataset_workspaces[dataset_id] = get_dataset_workspaces(dataset_id)
+            if dataset_workspaces[dataset_id]:
+                source_dataset_id = dataset_id
+                LOGGER.info("In syncFiles.sync_workspace_source_files, syncing file for source dataset %s", dataset_id)
+
+                workspace_id_list = [workspace['WorkspaceId'] for workspace in dataset_workspaces[dataset_id]]
+                LOGGER.info("In syncFiles.sync_workspace_source_files, workspaces who have source dataset %s are - %s", source_dataset_id, workspace_id_list)
+                workspace_file_items = []
+                for workspace_item in dataset_workspaces[dataset_id]:
+                    workspace_id = workspace_item['WorkspaceId']
+                    document_id = str(uuid.uuid4())
+                    file_item = {}
+                    # Check if the file is scraped web page from the workspace
+                    match = re.search(r'_([^_]+)\.txt$', file_name)
+                    if match:
+                        website_document_id = match.group(1)
+                        file_item = dynamodbUtil.get_item_with_key(DYNAMODB_RESOURCE.Table(WORKSPACES_DOCUMENTS_TABLE), {'WorkspaceId': workspace_id, 'DocumentId': website_document_id})
+                    # Check if file already exists
+                    else:
+                        file_item = get_workspace_document_by_file_name(workspace_id, file_name)
+                    if file_item:
+                        document_id = file_item['DocumentId']
+                    workspace_file_item = {
+                        "DocumentId": document_id,
+                        "WorkspaceId": workspace_id
+                    }
+                    if event_name != "REMOVE":
                         workspace_file_item.update({
-                            "Message": "File upload failed"
+                            "DocumentType": file_item.get("DocumentType", "file"),
+                            "DocumentDetails": {
+                                "FileName": file_name,
+                                "DatasetId": source_dataset_id
+                            },
+                            "FileName": file_name,
+                            "LastModifiedBy": user_id,
+                            "LastModifiedTime": commonUtil.get_current_time(),
+                            "TriggerType": workspace_item["TriggerType"]
                         })
-                workspace_file_items.append(workspace_file_item)
-            if event_name != "REMOVE" and load_status in ["failed", "completed"]:
-                LOGGER.info("In syncFiles.sync_workspace_source_files, adding file items to workspace files table - %s", workspace_file_items)
-                dynamodbUtil.batch_write_items(DYNAMODB_RESOURCE.Table(WORKSPACES_DOCUMENTS_TABLE), workspace_file_items)
-                for file_item in workspace_file_items:
-                    if file_item['TriggerType'] == 'file-based' and load_status=="completed":
-                        LOGGER.info("In syncFiles.sync_workspace_source_files, running filebased run for workspace %s", file_item["WorkspaceId"])
-                        response = run_workspace(user_id, file_item["WorkspaceId"])
-                        LOGGER.info("In syncFiles.sync_workspace_source_files, response from workspace job run - %s", response)
-            elif event_name == "REMOVE" or load_status == 'deleted':
-                LOGGER.info("In syncFiles.sync_workspace_source_files, workspace file items - %s", workspace_file_items)
-                dynamodbUtil.batch_delete_items(DYNAMODB_RESOURCE.Table(WORKSPACES_DOCUMENTS_TABLE), workspace_file_items)
+                        if file_item.get('DocumentType') == 'website':
+                            workspace_file_item['DocumentDetails'].update({
+                                'WebsiteURL': file_item['DocumentDetails']['WebsiteURL']
+                            })
+                        if load_status == "completed":
+                            workspace_file_item.update({
+                                "Message": "File uploaded successfully"
+                            })
+                        elif load_status == "failed":
+                            workspace_file_item.update({
+                                "Message": "File upload failed"
+                            })
+                    workspace_file_items.append(workspace_file_item)
+                if event_name != "REMOVE" and load_status in ["failed", "completed"]:
+                    LOGGER.info("In syncFiles.sync_workspace_source_files, adding file items to workspace files table - %s", workspace_file_items)
+                    dynamodbUtil.batch_write_items(DYNAMODB_RESOURCE.Table(WORKSPACES_DOCUMENTS_TABLE), workspace_file_items)
+                    for file_item in workspace_file_items:
+                        if file_item['TriggerType'] == 'file-based' and load_status=="completed":
+                            workspaces_to_ingest[file_item["WorkspaceId"]] = user_id
+                elif event_name == "REMOVE" or load_status == 'deleted':
+                    LOGGER.info("In syncFiles.sync_workspace_source_files, workspace file items - %s", workspace_file_items)
+                    dynamodbUtil.batch_delete_items(DYNAMODB_RESOURCE.Table(WORKSPACES_DOCUMENTS_TABLE), workspace_file_items)
+    finally:
+        for workspace_id, user_id in workspaces_to_ingest.items():
+            LOGGER.info("In syncFiles.sync_workspace_source_files, requesting file-based run for workspace %s", workspace_id)
+            try:
+                response = request_workspace_ingestion(user_id, workspace_id)
+                LOGGER.info("In syncFiles.sync_workspace_source_files, response from workspace ingestion request - %s", response)
+            except Exception as ex:
+                LOGGER.error("In syncFiles.sync_workspace_source_files, failed to request ingestion for workspace %s with error - %s", workspace_id, str(ex))
     LOGGER.info("In syncFiles.sync_workspace_source_files, exiting method")
 
 
@@ -222,6 +319,7 @@ def lambda_handler(event, context):
         # triggered from event-bridge pipes
         if isinstance(event,list) and event[0].get('eventSource') == 'aws:dynamodb' and 'dynamodb' in event[0]:
             LOGGER.info("In syncFiles.lambda_handler, syncing files from amorphic")
+            backfill_workspaces_source_index_once()
             sync_workspace_source_files(event)
     except Exception as err:
         LOGGER.error("In syncFiles.lambda_handler, Failed to sync files from amorphic with error %s:", str(err))
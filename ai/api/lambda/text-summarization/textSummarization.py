@@ -4,7 +4,10 @@ This lambda performs text summarization
 import sys
 import os
 import json
+import time
+import random
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from pypdf import PdfReader
 
@@ -14,7 +17,7 @@ import dynamodbUtil
 
 from boto3.dynamodb.conditions import Key
 
-from langchain.chains.summarize import load_summarize_chain
+from langchain.chains.summarize.map_reduce_prompt import PROMPT as SUMMARIZATION_PROMPT
 from langchain_text_splitters.character import RecursiveCharacterTextSplitter
 from langchain_aws.llms import BedrockLLM
 from langchain_aws.chat_models import ChatBedrock
@@ -50,6 +53,109 @@ except Exception as exc:
     LOGGER.error("Failed to set environment variables with: %s", "{0}".format(exc))
     sys.exit()
 
+SUMMARIZATION_CHUNK_SIZE = 4000
+SUMMARIZATION_CHUNK_OVERLAP = 100
+# documents above this size are rejected as they can't be summarized within the lambda timeout
+SUMMARIZATION_MAX_DOCUMENT_TOKENS = 10000
+# maximum size of the summaries combined in a single reduce call
+SUMMARIZATION_REDUCE_MAX_TOKENS = 3000
+SUMMARIZATION_MAX_REDUCE_LEVELS = 5
+SUMMARIZATION_MAX_CONCURRENCY = 5
+SUMMARIZATION_MAX_RETRIES = 5
+THROTTLING_ERRORS = ["ThrottlingException", "Too many requests", "TooManyRequestsException", "ServiceUnavailableException"]
+
+
+def invoke_llm_with_backoff(llm, prompt):
+    '''
+    This function invokes the llm, throttled requests are retried with exponential backoff and jitter
+    :param llm : langchain llm object
+    :param prompt : prompt to be sent to the model
+    '''
+    retry = 0
+    while True:
+        try:
+            response = llm.invoke(prompt)
+            return response.content if hasattr(response, "content") else response
+        except Exception as ex:
+            if retry >= SUMMARIZATION_MAX_RETRIES or not any(error in str(ex) for error in THROTTLING_ERRORS):
+                raise
+            sleep_time = min(2 ** retry, 20) + random.uniform(0, 1)
+            LOGGER.info("In textSummarization.invoke_llm_with_backoff, request throttled, retrying after %s seconds", sleep_time)
+            time.sleep(sleep_time)
+            retry += 1
+
+
+def summarize_texts(llm, texts):
+    '''
+    This function summarizes each of the texts with bounded concurrency, summaries are returned in the order of the texts
+    :param llm : langchain llm object
+    :param texts : list of texts to be summarized
+    '''
+    prompts = [SUMMARIZATION_PROMPT.format(text=text) for text in texts]
+    with ThreadPoolExecutor(max_workers=max(1, min(SUMMARIZATION_MAX_CONCURRENCY, len(prompts)))) as executor:
+        summaries = list(executor.map(lambda prompt: invoke_llm_with_backoff(llm, prompt).strip(), prompts))
+    return summaries
+
+
+def group_summaries(llm, summaries):
+    '''
+    This function groups the summaries so that each group fits within the reduce token budget
+    :param llm : langchain llm object
+    :param summaries : list of summaries
+    '''
+    groups = []
+    current_group = []
+    current_group_tokens = 0
+    for summary in summaries:
+        summary_tokens = llm.get_num_tokens(summary)
+        if current_group and current_group_tokens + summary_tokens > SUMMARIZATION_REDUCE_MAX_TOKENS:
+            groups.append(current_group)
+            current_group = []
+            current_group_tokens = 0
+        current_group.append(summary)
+        current_group_tokens += summary_tokens
+    if current_group:
+        groups.append(current_group)
+    return groups
+
+
+def reduce_summaries(llm, summaries):
+    '''
+    This function combines the summaries into a single summary. If the summaries don't fit within the reduce
+    token budget they are combined group by group, level by level, until they do. Summaries which still don't
+    fit after the last level are truncated to an equal share of the budget so that the final call stays within it
+    :param llm : langchain llm object
+    :param summaries : list of summaries
+    '''
+    level = 0
+    groups = group_summaries(llm, summaries)
+    while len(groups) > 1 and level < SUMMARIZATION_MAX_REDUCE_LEVELS:
+        LOGGER.info("In textSummarization.reduce_summaries, reducing %s summaries in %s groups at level %s", len(summaries), len(groups), level)
+        summaries = summarize_texts(llm, ["\n\n".join(group) for group in groups])
+        groups = group_summaries(llm, summaries)
+        level += 1
+    if len(groups) > 1:
+        LOGGER.error("In textSummarization.reduce_summaries, %s summaries don't fit the reduce budget after %s levels, truncating them", len(summaries), level)
+        summaries = truncate_summaries(llm, summaries)
+    return summarize_texts(llm, ["\n\n".join(summaries)])[0]
+
+
+def truncate_summaries(llm, summaries):
+    '''
+    This function truncates each of the summaries to an equal share of the reduce token budget, so that every part
+    of the document is still represented in the final summary
+    :param llm : langchain llm object
+    :param summaries : list of summaries
+    '''
+    summary_token_budget = SUMMARIZATION_REDUCE_MAX_TOKENS // len(summaries)
+    truncated_summaries = []
+    for summary in summaries:
+        summary_tokens = llm.get_num_tokens(summary)
+        if summary_tokens > summary_token_budget:
+            summary = summary[:len(summary) * summary_token_budget // summary_tokens]
+        truncated_summaries.append(summary)
+    return truncated_summaries
+
 
 def generate_doc_summary(model_name, model_params, doc_file_contents):
     '''
@@ -70,32 +176,29 @@ def generate_doc_summary(model_name, model_params, doc_file_contents):
 
     n_tokens = llm.get_num_tokens(doc_file_contents)
     LOGGER.info("In textSummarization.generate_doc_summary, number of tokens - %s, checking if its exceeding limit", n_tokens)
-    if n_tokens > 10000:
+    if n_tokens > SUMMARIZATION_MAX_DOCUMENT_TOKENS:
         LOGGER.info("In textSummarization.generate_doc_summary, file is exceeding max token limit")
         response = {
                 "Status": commonUtil.AGENT_FAILURE_STATE,
                 "Message": "Document is too large for summarization. Please select another file."
             }
+        return response
 
     LOGGER.info("In textSummarization.generate_doc_summary, initializing text splitter object")
     text_splitter = RecursiveCharacterTextSplitter(
         separators=["\n\n", "\n"],
-        chunk_size=4000,
-        chunk_overlap=100
+        chunk_size=SUMMARIZATION_CHUNK_SIZE,
+        chunk_overlap=SUMMARIZATION_CHUNK_OVERLAP
     )
 
     LOGGER.info("In textSummarization.generate_doc_summary, create smaller documents from the main file")
-    docs = text_splitter.create_documents([doc_file_contents])
+    docs = text_splitter.split_text(doc_file_contents)
     num_docs = len(docs)
     LOGGER.info("In textSummarization.generate_doc_summary, created %s docs", num_docs)
 
-    LOGGER.info("In textSummarization.generate_doc_summary, initializing summarize chain")
-    summary_chain = load_summarize_chain(llm=llm, chain_type="map_reduce", verbose=False)
-
     LOGGER.info("In textSummarization.generate_doc_summary, now summarizing each individual doc and combining the summaries")
-    output = ""
-    output = summary_chain.run(docs)
-    doc_summary = output.strip()
+    doc_summaries = summarize_texts(llm, docs)
+    doc_summary = reduce_summaries(llm, doc_summaries).strip()
 
     LOGGER.info("In textSummarization.generate_doc_summary, consolidated summary generated - %s", doc_summary)
 
@@ -229,27 +332,35 @@ def lambda_handler(event, context):
                 return commonUtil.build_post_response(400, response)
 
             # getting path of the first file with that name from docs table
-            doc_file_path=""
+            tbac_dataset_ids = {dataset["DatasetId"] for dataset in workspace_item["AttachedDatasets"] if dataset.get("IsTBACEnabled", False)}
+            matching_doc_items = []
             for doc_item in doc_items:
                 doc_file_name = doc_item["DocumentDetails"].get("FileName","").split('/')[-1]
                 if '_'.join(doc_file_name.split('_')[3:]) == agent_input_file_name:
-                    doc_dataset_id = doc_item["DocumentDetails"]["DatasetId"]
-                    is_dataset_tbac_enabled = False
-                    # check if dataset is tbac enabled
-                    for dataset in workspace_item["AttachedDatasets"]:
-                        if dataset["DatasetId"] == doc_dataset_id:
-                            is_dataset_tbac_enabled = dataset.get("IsTBACEnabled", False)
-                    if is_dataset_tbac_enabled:
-                        # check user access to file
-                        file_access_list = commonUtil.check_user_files_access(user_id, doc_dataset_id, [doc_item["DocumentDetails"]["FileName"]], LAMBDA_CLIENT, DATASET_FILES_LAMBDA)
-                        user_file_access = file_access_list[0][doc_item["DocumentDetails"]["FileName"]]
-                    else:
-                        user_file_access = True
-                    if user_file_access:
-                        doc_file_path = doc_item["DocumentDetails"]["FileName"]
-                        LOGGER.info("In textSummarization.lambda_handler, there may be multiple files with the same name so going for the first one")
+                    matching_doc_items.append(doc_item)
+                    # files after the first file of a non tbac dataset are never chosen so their access is not checked
+                    if doc_item["DocumentDetails"]["DatasetId"] not in tbac_dataset_ids:
                         break
 
+            # check user access to the files of tbac enabled datasets in a single batched call
+            dataset_files_map = {}
+            for doc_item in matching_doc_items:
+                if doc_item["DocumentDetails"]["DatasetId"] in tbac_dataset_ids:
+                    dataset_files_map.setdefault(doc_item["DocumentDetails"]["DatasetId"], []).append(doc_item["DocumentDetails"]["FileName"])
+            datasets_files_access = commonUtil.check_user_datasets_files_access(user_id, dataset_files_map, LAMBDA_CLIENT, DATASET_FILES_LAMBDA) if dataset_files_map else {}
+
+            doc_file_path=""
+            for doc_item in matching_doc_items:
+                doc_dataset_id = doc_item["DocumentDetails"]["DatasetId"]
+                if doc_dataset_id in tbac_dataset_ids:
+                    user_file_access = datasets_files_access[doc_dataset_id].get(doc_item["DocumentDetails"]["FileName"], False)
+                else:
+                    user_file_access = True
+                if user_file_access:
+                    doc_file_path = doc_item["DocumentDetails"]["FileName"]
+                    LOGGER.info("In textSummarization.lambda_handler, there may be multiple files with the same name so going for the first one")
+                    break
+
             if not doc_file_path:
                 LOGGER.info("In textSummarization.lambda_handler, file %s not found in workspace documents table", agent_input_file_name)
                 response = {
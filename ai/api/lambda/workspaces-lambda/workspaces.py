@@ -61,6 +61,7 @@ try:
     WORKSPACES_EXECUTIONS_TABLE_WORKSPACEID_INDEX = dynamodbUtil.WORKSPACES_EXECUTIONS_TABLE_WORKSPACEID_INDEX
     WORKSPACES_GROUPS_TABLE = dynamodbUtil.WORKSPACES_GROUPS_TABLE
     WORKSPACES_GROUPS_TABLE_WORKSPACEID_INDEX = dynamodbUtil.WORKSPACES_GROUPS_TABLE_WORKSPACEID_INDEX
+    WORKSPACES_DATASETS_TABLE = dynamodbUtil.WORKSPACES_DATASETS_TABLE
     MODELS_TABLE = dynamodbUtil.MODELS_TABLE
     CHATBOTS_TABLE = dynamodbUtil.CHATBOTS_TABLE
     AGENTS_TABLE = dynamodbUtil.AGENTS_TABLE
@@ -316,6 +317,11 @@ def validate_workspace_body(workspace_obj: dict, embedding_model_item: dict) ->
     if workspace_obj.get("ChunkingConfig", {}).get("OverlapPercentage") and (workspace_obj["ChunkingConfig"]["OverlapPercentage"] < 1 or workspace_obj["ChunkingConfig"]["OverlapPercentage"] > 100):
         LOGGER.error("In workspaces.validate_workspace_body, invalid chunk size specified - %s", workspace_obj["ChunkingConfig"]["OverlapPercentage"])
         errorUtil.raise_exception(EVENT_INFO, "GF", "GE-1034", "Invalid OverlapPercentage specified, value must be between 1 and 100")
+    try:
+        auroraUtil.get_vector_index_config(workspace_obj.get("VectorIndexConfig"))
+    except ValueError as ex:
+        LOGGER.error("In workspaces.validate_workspace_body, invalid vector index config specified - %s", workspace_obj.get("VectorIndexConfig"))
+        errorUtil.raise_exception(EVENT_INFO, "GF", "GE-1034", str(ex))
 
 def create_knowledge_base_data_source(workspace_id: str, knowledge_base_id: str, attached_datasets: list[dict], max_tokens: int, overlap_percentage: int) -> str:
     """Create a data source to be linked to the knowledge base
@@ -492,6 +498,8 @@ def create_workspace(workspace_obj: dict, user_id: str) -> dict:
             "OverlapPercentage": workspace_obj.get("ChunkingConfig", {}).get("OverlapPercentage", 1)
         },
         "RAGEngine": RAG_ENGINES,
+        # attached datasets are indexed in the workspaces datasets table and documents carry a top-level FileName
+        "IsSourceIndexed": True,
         "EmbeddingsModel": {
             "Name": embedding_model_item['ModelName'],
             "Id": workspace_obj["EmbeddingsModel"],
@@ -582,7 +590,7 @@ def create_workspace(workspace_obj: dict, user_id: str) -> dict:
         })
 
     try:
-        auroraUtil.create_workspace_table(workspace_db_put_item, RAG_SERVICE_USER_SECRET_ARN, SECRETS_MANAGER_CLIENT, EMBEDDING_MODEL_DIMENSIONS[embedding_model_item['ModelName']])
+        auroraUtil.create_workspace_table(workspace_db_put_item, RAG_SERVICE_USER_SECRET_ARN, SECRETS_MANAGER_CLIENT, EMBEDDING_MODEL_DIMENSIONS[embedding_model_item['ModelName']], workspace_obj.get("VectorIndexConfig"))
     except Exception as ex:
         LOGGER.error("In workspaces.create_workspace, failed to create aurora table for workspace due to error - %s", str(ex))
         errorUtil.raise_exception(EVENT_INFO, "GF", "GE-1034", f"Failed to create aurora table for workspace due to error - {str(ex)}")
@@ -604,6 +612,11 @@ def create_workspace(workspace_obj: dict, user_id: str) -> dict:
         ec_db_1001 = errorUtil.get_error_object("DB-1001")
         raise errorUtil.GenericFailureException(EVENT_INFO, ec_db_1001)
 
+    # add entries to the dataset to workspace reverse index used while syncing source dataset files
+    dynamodbUtil.batch_write_items(DYNAMODB_RESOURCE.Table(WORKSPACES_DATASETS_TABLE), [
+        {"DatasetId": dataset["DatasetId"], "WorkspaceId": workspace_db_put_item["WorkspaceId"]} for dataset in attached_datasets
+    ])
+
     if workspace_obj.get("AttachedDatasets", []):
         # trigger step function to sync source dataset metadata files metadata into workspaces table
         trigger_dataset_files_metadata_sync_sf(workspace_db_put_item["WorkspaceId"], user_id, attached_datasets, WORKSPACES_LAMBDA_ARN)
@@ -984,10 +997,127 @@ def check_and_update_ingestion_job_status(event):
         commonUtil.update_execution_status({'RunId': run_id}, response['status'], message)
 
     if response['status'] in ['COMPLETE', 'FAILED']:
+        # answers cached by the chat lambdas are keyed on this time, so they are invalidated once the knowledge base changes
+        update_response = dynamodbUtil.update_item_by_key(
+            DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE),
+            {'WorkspaceId': event['WorkspaceId']},
+            "SET LastIngestionCompletedTime = :completed_time",
+            {":completed_time": commonUtil.get_current_time()}
+        )
+        if update_response == "error":
+            LOGGER.error("In workspaces.check_ingestion_job_status, failed to update the ingestion completed time of workspace - %s", event['WorkspaceId'])
         event.update({'RunStatus': response['status'], 'Operation': 'Complete'})
 
     return event
 
+def is_workspace_run_active(workspace_item: dict) -> bool:
+    """Checks whether an ingestion job is running for the workspace
+
+    Runs still marked active in the executions table are confirmed with bedrock so that a run whose
+    status check was interrupted does not block the workspace forever
+
+    Args:
+        workspace_item (dict): Workspace DDB item
+    """
+    active_runs = dynamodbUtil.get_items_by_query_index(
+        DYNAMODB_RESOURCE.Table(WORKSPACES_EXECUTIONS_TABLE),
+        WORKSPACES_EXECUTIONS_TABLE_WORKSPACEID_INDEX,
+        Key('WorkspaceId').eq(workspace_item['WorkspaceId']),
+        "RunId, RunStatus",
+        Attr('RunStatus').is_in(commonUtil.RUN_ACTIVE_STATUSES)
+    )
+    for run_item in active_runs:
+        try:
+            ingestion_job = BEDROCK_AGENT_CLIENT.get_ingestion_job(
+                knowledgeBaseId=workspace_item['KnowledgeBaseId'],
+                dataSourceId=workspace_item['DataSourceId'],
+                ingestionJobId=run_item['RunId']
+            )['ingestionJob']
+        except Exception as ex:
+            LOGGER.error("In workspaces.is_workspace_run_active, failed to get ingestion job %s with error - %s", run_item['RunId'], str(ex))
+            continue
+        if ingestion_job['status'] in commonUtil.RUN_ACTIVE_STATUSES:
+            LOGGER.info("In workspaces.is_workspace_run_active, run %s is in progress for workspace %s", run_item['RunId'], workspace_item['WorkspaceId'])
+            return True
+    return False
+
+def wait_for_pending_ingestion(event: dict, wait_time: int) -> dict:
+    """Keeps the ingestion scheduler of the workspace alive for another poll after the given wait time
+
+    Args:
+        event (dict): Step function event containing the workspace id
+        wait_time (int): Seconds to wait before the next poll
+    """
+    # heartbeat lets syncFiles replace a scheduler whose step function execution died
+    dynamodbUtil.update_item_by_key(DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE), {'WorkspaceId': event['WorkspaceId']},
+                                    "SET IngestionScheduledTime = :now", {":now": int(time.time())})
+    event['WaitTimeInSec'] = wait_time
+    return event
+
+def run_pending_ingestion(event: dict, workspaces_lambda_arn: str) -> dict:
+    """Debounced ingestion scheduler of a file-based workspace, invoked in a loop by the execute input lambda state machine
+
+    Waits until no file change has been recorded for the debounce window (or the oldest pending change exceeds
+    the max delay) and no ingestion job is running, then starts a single run covering all the pending changes.
+    The scheduler keeps polling while the run is in progress, so changes arriving meanwhile get one follow-up run
+
+    Args:
+        event (dict): Step function event containing the workspace id
+        workspaces_lambda_arn (str): ARN of the workspaces lambda
+
+    Returns:
+        dict: Updated event for the step function
+    """
+    workspace_id = event['WorkspaceId']
+    LOGGER.info("In workspaces.run_pending_ingestion, checking pending ingestion for workspace id - %s", workspace_id)
+    workspace_item = dynamodbUtil.get_item_with_key(DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE), {'WorkspaceId': workspace_id})
+    if not workspace_item or workspace_item.get('WorkspaceStatus') != commonUtil.WORKSPACES_CREATION_COMPLETED_STATUS:
+        LOGGER.info("In workspaces.run_pending_ingestion, workspace %s is not active anymore, stopping the scheduler", workspace_id)
+        if workspace_item:
+            dynamodbUtil.update_item_by_key(DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE), {'WorkspaceId': workspace_id},
+                                            "SET IngestionScheduled = :scheduled", {":scheduled": False})
+        event.pop('WaitTimeInSec', None)
+        event['Operation'] = 'Complete'
+        return event
+
+    current_epoch = int(time.time())
+    if workspace_item.get('IngestionPending'):
+        settle_time = int(workspace_item['LastIngestionRequestTime']) + commonUtil.INGESTION_DEBOUNCE_WINDOW_IN_SECONDS - current_epoch
+        pending_time = current_epoch - int(workspace_item.get('IngestionPendingSince', current_epoch))
+        if settle_time > 0 and pending_time < commonUtil.INGESTION_MAX_DELAY_IN_SECONDS:
+            LOGGER.info("In workspaces.run_pending_ingestion, file changes are still arriving for workspace %s, waiting %s seconds", workspace_id, settle_time)
+            return wait_for_pending_ingestion(event, min(settle_time, commonUtil.INGESTION_MAX_DELAY_IN_SECONDS - pending_time))
+
+    if is_workspace_run_active(workspace_item):
+        return wait_for_pending_ingestion(event, commonUtil.INGESTION_RUN_POLL_INTERVAL_IN_SECONDS)
+
+    if workspace_item.get('IngestionPending'):
+        dynamodbUtil.update_item_by_key(DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE), {'WorkspaceId': workspace_id},
+                                        "SET IngestionPending = :pending REMOVE IngestionPendingSince", {":pending": False})
+        try:
+            response = run_workspace(workspace_item.get('IngestionRequestedBy', event['UserId']), workspace_id, workspace_item['KnowledgeBaseId'],
+                                     workspace_item['DataSourceId'], workspaces_lambda_arn, trigger_type="file-based")
+            LOGGER.info("In workspaces.run_pending_ingestion, response from workspace job run - %s", response)
+            event['RunId'] = response['RunId']
+        except Exception as ex:
+            # put the changes back so that they are picked up in the next poll
+            LOGGER.error("In workspaces.run_pending_ingestion, failed to run workspace %s with error - %s", workspace_id, str(ex))
+            dynamodbUtil.update_item_by_key(DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE), {'WorkspaceId': workspace_id},
+                                            "SET IngestionPending = :pending, IngestionPendingSince = if_not_exists(IngestionPendingSince, :now)",
+                                            {":pending": True, ":now": current_epoch})
+        return wait_for_pending_ingestion(event, commonUtil.INGESTION_RUN_POLL_INTERVAL_IN_SECONDS)
+
+    # nothing is pending and no run is in progress, release the scheduler unless a change came in meanwhile
+    update_status = dynamodbUtil.update_item_by_key(DYNAMODB_RESOURCE.Table(WORKSPACES_TABLE), {'WorkspaceId': workspace_id},
+                                                    "SET IngestionScheduled = :scheduled", {":scheduled": False, ":pending": False}, None,
+                                                    "attribute_not_exists(IngestionPending) OR IngestionPending = :pending")
+    if update_status == "condition-error":
+        return wait_for_pending_ingestion(event, commonUtil.INGESTION_DEBOUNCE_WINDOW_IN_SECONDS)
+    LOGGER.info("In workspaces.run_pending_ingestion, no pending changes for workspace %s, stopping the scheduler", workspace_id)
+    event.pop('WaitTimeInSec', None)
+    event['Operation'] = 'Complete'
+    return event
+
 def trigger_web_crawling_sf(event_body, workspace_id: str, user_id: str, workspaces_lambda_arn: str) -> dict:
     """Invoke step function for triggering web crawling files metadata sync
 
@@ -1246,6 +1376,7 @@ def delete_workspace(workspace_item: dict, user_id: str) -> dict:
     # 7, 8. delete workspace id from WorkspacesGroups table and GroupsTable
     # 9. Cleanup of run payloads and website content stored in the AI data bucket
     # 10. delete aurora table
+    # 11. delete workspace id from WorkspacesDatasets table
 
     ### 0. check if there are any dependent chatbots
     LOGGER.info("In workspaces.delete_workspace, checking for any chatbots dependent on the workspace - %s", workspace_id)
@@ -1384,6 +1515,11 @@ def delete_workspace(workspace_item: dict, user_id: str) -> dict:
     #### 10. Delete the table from aurora
     auroraUtil.delete_workspace_table(workspace_id, RAG_SERVICE_USER_SECRET_ARN, SECRETS_MANAGER_CLIENT)
 
+    #### 11. Delete the dataset to workspace reverse index entries
+    dynamodbUtil.batch_delete_items(DYNAMODB_RESOURCE.Table(WORKSPACES_DATASETS_TABLE), [
+        {"DatasetId": dataset["DatasetId"], "WorkspaceId": workspace_id} for dataset in workspace_item.get("AttachedDatasets", [])
+    ])
+
     LOGGER.info("In workspaces.delete_workspace, Workspace deletion completed successfully.")
     return {
         "Message": "Deletion completed successfully"
@@ -1520,6 +1656,7 @@ def upload_file_to_source_dataset(workspace_item: dict, event_body: dict, user_i
                 "FileName": file_name,
                 "DatasetId": dataset_id
             },
+            "FileName": file_name,
             "DocumentType": "file",
             "WorkspaceId": workspace_item["WorkspaceId"],
             "LastModifiedBy": user_id,
@@ -1901,6 +2038,7 @@ def sync_amorphic_dataset_files(attached_datasets: list[dict], workspace_id: str
                     "FileName": file_item["FileName"],
                     "DatasetId": file_item["DatasetId"]
                 },
+                "FileName": file_item["FileName"],
                 "WorkspaceId": workspace_id,
                 "LastModifiedTime": commonUtil.get_current_time(),
                 "LastModifiedBy": user_id
@@ -2006,6 +2144,9 @@ def lambda_handler(event, context):
                     LOGGER.info("In workspaces.lambda_handler, Request is to crawl website content and store it in dataset")
                     webcrawling.update_crawling_job_metadata(event)
 
+                elif event['Operation'] == 'run_pending_ingestion':
+                    LOGGER.info("In workspaces.lambda_handler, Request is to run the pending file-based ingestion for the workspace with id - %s", event['WorkspaceId'])
+                    event = run_pending_ingestion(event, context.invoked_function_arn)
                 elif event['Operation'] == 'check_ingestion_job_status':
                     LOGGER.info("In workspaces.lambda_handler, Request is to check the status of the ingestion job with id - %s for the workspace with id - %s", event['RunId'], event['WorkspaceId'])
                     event = check_and_update_ingestion_job_status(event)
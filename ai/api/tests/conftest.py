@@ -0,0 +1,70 @@
+"""
+Test configuration of the api lambdas and common modules.
+The modules are imported by name the way the lambda layer exposes them, the lambda environment is set to test values
+and the dynamodb table names are served from the cached parameter file so that importing the modules doesn't call SSM
+"""
+import os
+import sys
+import json
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMON_MODULES_DIR = os.path.join(API_DIR, "common-modules")
+LAMBDA_DIRS = ["chat", "sync-files", "workspaces-lambda", "text-summarization"]
+DYNAMODB_SSM_PARAM_FILE = "/tmp/dynamodb_ssm_params.json"
+
+TEST_ENVIRONMENT = {
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_EC2_METADATA_DISABLED": "true",
+    # parameters that are prefetched at import time fail fast instead of reaching SSM
+    "AWS_MAX_ATTEMPTS": "1",
+    "AWS_ENDPOINT_URL_SSM": "http://127.0.0.1:9",
+    "awsRegion": "us-east-1",
+    "awsPartition": "aws",
+    "accountId": "123456789012",
+    "projectShortName": "test",
+    "environment": "test",
+    "verticalName": "ai",
+    "userPoolId": "us-east-1_test",
+    "enableIDP": "no",
+    "sessionFilesBucketName": "test-session-files",
+    "DLZBucketName": "test-dlz",
+    "LZBucketName": "test-lz",
+    "sesEmailFrom": "test@example.com",
+    "amorphicDatasetOperationsLambdaArn": "arn:aws:lambda:us-east-1:123456789012:function:test-dataset-operations",
+    "amorphicDatasetFilesLambdaArn": "arn:aws:lambda:us-east-1:123456789012:function:test-dataset-files",
+    "summarizationLambdaArn": "arn:aws:lambda:us-east-1:123456789012:function:test-summarization",
+    "webSocketAPIEndpoint": "wss://test.execute-api.us-east-1.amazonaws.com",
+    "projectName": "test",
+    "aiDataBucket": "test-ai-data",
+    "AWS_USE_FIPS_ENDPOINT": "False",
+    "workspacesLambdaArn": "arn:aws:lambda:us-east-1:123456789012:function:test-workspaces",
+    "amorphicGetPresignedURLLambdaArn": "arn:aws:lambda:us-east-1:123456789012:function:test-presigned-url",
+    "executeInputLambdaStateMachineArn": "arn:aws:states:us-east-1:123456789012:stateMachine:test-execute-input-lambda",
+    "workspaceWebsiteContentScrapingStateMachineArn": "arn:aws:states:us-east-1:123456789012:stateMachine:test-website-content-scraping",
+    "ragEngines": "bedrock",
+    "RAGEngineClusterArn": "arn:aws:rds:us-east-1:123456789012:cluster:test-rag",
+    "RAGDatabase": "test",
+    "RAGHost": "127.0.0.1",
+    "RAGPort": "5432",
+    "auroraServiceUserAuthArn": "arn:aws:secretsmanager:us-east-1:123456789012:secret:test-aurora",
+    "DLZKMSKeyArn": "arn:aws:kms:us-east-1:123456789012:key/test-dlz",
+    "BedrockKMSKeyArn": "arn:aws:kms:us-east-1:123456789012:key/test-bedrock",
+    "summarizationModels": "[\"anthropic.claude-3-haiku-20240307-v1:0\"]"
+}
+
+for module_dir in sorted(os.listdir(COMMON_MODULES_DIR)):
+    if os.path.isdir(os.path.join(COMMON_MODULES_DIR, module_dir)):
+        sys.path.insert(0, os.path.join(COMMON_MODULES_DIR, module_dir))
+for lambda_dir in LAMBDA_DIRS:
+    sys.path.insert(0, os.path.join(API_DIR, "lambda", lambda_dir))
+
+for env_key, env_value in TEST_ENVIRONMENT.items():
+    os.environ.setdefault(env_key, env_value)
+
+# the table names of the tests are the names of their ssm parameters
+with open(os.path.join(COMMON_MODULES_DIR, "dynamodb-util", "dynamodb_table_keys.json"), "r", encoding="utf8") as table_keys_file:
+    TABLE_KEYS = json.load(table_keys_file)
+with open(DYNAMODB_SSM_PARAM_FILE, "w", encoding="utf8") as ssm_params_file:
+    json.dump({table_name: table_name for table_name in TABLE_KEYS.values()}, ssm_params_file)
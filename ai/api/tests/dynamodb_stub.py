@@ -0,0 +1,391 @@
+"""
+In-memory stand-in of the dynamodb resource used by the tests.
+Items are kept per table, every request is applied atomically under a lock shared by all the tables of the resource and
+the subset of the expression syntax used by the lambdas is evaluated: SET of attributes and nested map keys with
+list_append and if_not_exists, REMOVE of attributes and list elements, and conditions made of attribute_exists, attribute_not_exists, contains, NOT and
+comparisons joined with AND and OR. Batch reads can be throttled to return UnprocessedKeys. Queries evaluate the boto3 condition objects of the key and filter expressions on every item of the table
+"""
+import re
+import copy
+import time
+import operator
+import threading
+
+from botocore.exceptions import ClientError
+
+FUNCTION_PATTERN = re.compile(r"^(\w+)\((.*)\)$", re.DOTALL)
+PATH_ELEMENT_PATTERN = re.compile(r"([^.\[\]]+)|\[(\d+)\]")
+COMPARISON_PATTERN = re.compile(r"^(.+?)\s*(<>|<=|>=|=|<|>)\s*(.+)$")
+COMPARISON_OPERATORS = {"=": operator.eq, "<>": operator.ne, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+
+def split_arguments(text):
+    """
+    Splits the comma separated arguments of an expression, commas inside parentheses are kept
+    """
+    arguments, depth, current = [], 0, ""
+    for character in text:
+        if character == "," and depth == 0:
+            arguments.append(current.strip())
+            current = ""
+            continue
+        depth += character == "("
+        depth -= character == ")"
+        current += character
+    if current.strip():
+        arguments.append(current.strip())
+    return arguments
+
+
+def parse_path(path, names):
+    """
+    Returns the elements of an attribute path, attribute names are strings and list indexes are integers
+    """
+    elements = []
+    for name, index in PATH_ELEMENT_PATTERN.findall(path.strip()):
+        elements.append(int(index) if index else names.get(name, name))
+    return elements
+
+
+def resolve_path(item, path, names):
+    """
+    Returns whether the attribute exists and its value
+    """
+    value = item
+    for element in parse_path(path, names):
+        if isinstance(element, int):
+            if not isinstance(value, list) or element >= len(value):
+                return False, None
+            value = value[element]
+        else:
+            if not isinstance(value, dict) or element not in value:
+                return False, None
+            value = value[element]
+    return True, value
+
+
+def evaluate_operand(item, operand, names, values):
+    """
+    Returns the value of a value placeholder, a function or an attribute path, None if the attribute does not exist
+    """
+    operand = operand.strip()
+    if operand.startswith(":"):
+        return copy.deepcopy(values[operand])
+    function_match = FUNCTION_PATTERN.match(operand)
+    if function_match:
+        function_name, arguments = function_match.group(1), split_arguments(function_match.group(2))
+        if function_name == "list_append":
+            return evaluate_operand(item, arguments[0], names, values) + evaluate_operand(item, arguments[1], names, values)
+        if function_name == "if_not_exists":
+            exists, value = resolve_path(item, arguments[0], names)
+            return copy.deepcopy(value) if exists else evaluate_operand(item, arguments[1], names, values)
+        raise NotImplementedError(f"Function {function_name} is not supported by the stub")
+    return copy.deepcopy(resolve_path(item, operand, names)[1])
+
+
+def evaluate_condition(item, condition, names, values):
+    """
+    Evaluates a condition expression on an item, the item is None if it does not exist
+    """
+    item = item or {}
+    return any(evaluate_conjunction(item, conjunction, names, values) for conjunction in re.split(r"\s+OR\s+", condition.strip()))
+
+
+def evaluate_conjunction(item, condition, names, values):
+    """
+    Evaluates the terms of a condition joined with AND
+    """
+    for term in re.split(r"\s+AND\s+", condition.strip()):
+        term = term.strip()
+        negate = term.startswith("NOT ")
+        if negate:
+            term = term[4:].strip()
+        function_match = FUNCTION_PATTERN.match(term)
+        if function_match:
+            function_name, arguments = function_match.group(1), split_arguments(function_match.group(2))
+            exists, value = resolve_path(item, arguments[0], names)
+            if function_name == "attribute_exists":
+                result = exists
+            elif function_name == "attribute_not_exists":
+                result = not exists
+            elif function_name == "contains":
+                result = exists and evaluate_operand(item, arguments[1], names, values) in value
+            else:
+                raise NotImplementedError(f"Function {function_name} is not supported by the stub")
+        else:
+            operator_match = COMPARISON_PATTERN.match(term)
+            if not operator_match:
+                raise NotImplementedError(f"Condition {term} is not supported by the stub")
+            left_exists, left_value = resolve_path(item, operator_match.group(1), names)
+            right_value = evaluate_operand(item, operator_match.group(3), names, values)
+            result = left_exists and COMPARISON_OPERATORS[operator_match.group(2)](left_value, right_value)
+        if result == negate:
+            return False
+    return True
+
+
+def apply_update(item, update_expression, names, values):
+    """
+    Returns the item updated with an update expression
+    """
+    updated_item = copy.deepcopy(item)
+    clauses = re.split(r"\b(SET|REMOVE)\b", update_expression)
+    for action, clause in zip(clauses[1::2], clauses[2::2]):
+        if action == "SET":
+            for assignment in split_arguments(clause):
+                path, operand = assignment.split("=", 1)
+                set_path(updated_item, parse_path(path, names), evaluate_operand(item, operand, names, values))
+        else:
+            removed_elements = []
+            for path in split_arguments(clause):
+                elements = parse_path(path, names)
+                if len(elements) == 1:
+                    updated_item.pop(elements[0], None)
+                else:
+                    removed_elements.append(elements)
+            # list elements are removed from the end so that the indexes of the expression stay valid
+            for elements in sorted(removed_elements, key=lambda elements: elements[-1], reverse=True):
+                exists, parent = resolve_path(updated_item, ".".join(elements[:-1]), {})
+                if exists and elements[-1] < len(parent):
+                    parent.pop(elements[-1])
+    return updated_item
+
+
+def set_path(item, elements, value):
+    """
+    Sets the value of an attribute path, the parents of the path must exist like they must in dynamodb
+    """
+    parent = item
+    try:
+        for element in elements[:-1]:
+            parent = parent[element]
+        parent[elements[-1]] = value
+    except (KeyError, IndexError, TypeError) as ex:
+        raise ClientError({"Error": {"Code": "ValidationException", "Message": "The document path provided in the update expression is invalid for update"}}, "UpdateItem") from ex
+
+
+def evaluate_condition_object(item, condition):
+    """
+    Evaluates a boto3 Key or Attr condition object on an item
+    """
+    expression = condition.get_expression()
+    condition_operator, operands = expression["operator"], expression["values"]
+    if condition_operator == "AND":
+        return all(evaluate_condition_object(item, operand) for operand in operands)
+    if condition_operator == "OR":
+        return any(evaluate_condition_object(item, operand) for operand in operands)
+    if condition_operator == "NOT":
+        return not evaluate_condition_object(item, operands[0])
+    exists, value = resolve_path(item, operands[0].name, {})
+    if condition_operator == "attribute_exists":
+        return exists
+    if condition_operator == "attribute_not_exists":
+        return not exists
+    if condition_operator == "IN":
+        return exists and value in operands[1]
+    if condition_operator in COMPARISON_OPERATORS:
+        return exists and COMPARISON_OPERATORS[condition_operator](value, operands[1])
+    raise NotImplementedError(f"Condition operator {condition_operator} is not supported by the stub")
+
+
+def project_item(item, projection_expression, names):
+    """
+    Returns the top-level attributes of the item named in the projection expression
+    """
+    if not projection_expression:
+        return item
+    projected_names = [parse_path(path, names or {})[0] for path in split_arguments(projection_expression)]
+    return {name: value for name, value in item.items() if name in projected_names}
+
+
+def get_condition_error(operation_name):
+    return ClientError({"Error": {"Code": "ConditionalCheckFailedException", "Message": "The conditional request failed"}}, operation_name)
+
+
+class StubBatchWriter:
+    """
+    Batch writer of a stub table, the items are written when the context is exited
+    """
+    def __init__(self, table):
+        self.table = table
+        self.items = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        with self.table.resource.lock:
+            self.table.resource.write_requests += 1
+            for item in self.items:
+                self.table.items[self.table.get_key(item)] = copy.deepcopy(item)
+
+    def put_item(self, Item): # pylint: disable=invalid-name
+        self.items.append(Item)
+
+
+class StubTable:
+    """
+    Table of the stub resource, items are keyed by the values of the key attributes
+    """
+    def __init__(self, resource, name, key_names):
+        self.resource = resource
+        self.name = name
+        self.key_names = key_names
+        self.items = {}
+
+    def get_key(self, item):
+        return tuple(item[key_name] for key_name in self.key_names)
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs): # pylint: disable=invalid-name,unused-argument
+        self.resource.wait()
+        with self.resource.lock:
+            self.resource.read_requests += 1
+            item = copy.deepcopy(self.items.get(self.get_key(Key)))
+        response = {"ResponseMetadata": {"HTTPStatusCode": 200}}
+        if item is not None:
+            response["Item"] = project_item(item, ProjectionExpression, ExpressionAttributeNames)
+        return response
+
+    def query(self, KeyConditionExpression, FilterExpression=None, ProjectionExpression=None, ExpressionAttributeNames=None, # pylint: disable=invalid-name,unused-argument
+              ScanIndexForward=True, Limit=None, **kwargs):
+        """
+        Returns the matching items in a single page ordered by the sort key of the table, the index is not needed since all the
+        attributes of the items are kept
+        """
+        self.resource.wait()
+        with self.resource.lock:
+            self.resource.read_requests += 1
+            items = [copy.deepcopy(item) for item in self.items.values() if evaluate_condition_object(item, KeyConditionExpression)]
+        if len(self.key_names) > 1:
+            items.sort(key=lambda item: item[self.key_names[-1]], reverse=not ScanIndexForward)
+        items = [item for item in items[:Limit] if FilterExpression is None or evaluate_condition_object(item, FilterExpression)]
+        return {"Items": [project_item(item, ProjectionExpression, ExpressionAttributeNames) for item in items], "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None): # pylint: disable=invalid-name
+        self.resource.wait()
+        with self.resource.lock:
+            self.resource.write_requests += 1
+            self.check_condition(self.items.get(self.get_key(Item)), ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues, "PutItem")
+            self.items[self.get_key(Item)] = copy.deepcopy(Item)
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None, ExpressionAttributeNames=None, ConditionExpression=None, **kwargs): # pylint: disable=invalid-name,unused-argument
+        self.resource.wait()
+        with self.resource.lock:
+            self.resource.write_requests += 1
+            self.items[self.get_key(Key)] = self.get_updated_item(Key, UpdateExpression, ExpressionAttributeValues, ExpressionAttributeNames, ConditionExpression, "UpdateItem")
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def delete_item(self, Key, **kwargs): # pylint: disable=invalid-name,unused-argument
+        self.resource.wait()
+        with self.resource.lock:
+            self.resource.write_requests += 1
+            self.items.pop(self.get_key(Key), None)
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def batch_writer(self):
+        return StubBatchWriter(self)
+
+    def check_condition(self, item, condition_expression, names, values, operation_name):
+        if condition_expression and not evaluate_condition(item, condition_expression, names or {}, values or {}):
+            raise get_condition_error(operation_name)
+
+    def get_updated_item(self, key, update_expression, values, names, condition_expression, operation_name):
+        """
+        Returns the item updated with the expression, the caller must hold the lock of the resource
+        """
+        item = self.items.get(self.get_key(key))
+        self.check_condition(item, condition_expression, names, values, operation_name)
+        return apply_update(item if item is not None else dict(key), update_expression, names or {}, values or {})
+
+    def get_all_items(self):
+        with self.resource.lock:
+            return copy.deepcopy(list(self.items.values()))
+
+
+class StubClient:
+    """
+    Client of the stub resource, only transactions and batch reads are supported. The next throttled_batch_gets batch reads
+    only read throttled_batch_get_size keys of each table and return the others as UnprocessedKeys
+    """
+    def __init__(self, resource):
+        self.resource = resource
+        self.throttled_batch_gets = 0
+        self.throttled_batch_get_size = 0
+        self.batch_get_requests = []
+
+    def batch_get_item(self, RequestItems, **kwargs): # pylint: disable=invalid-name,unused-argument
+        self.resource.wait()
+        with self.resource.lock:
+            self.resource.read_requests += 1
+            self.batch_get_requests.append({table_name: len(request["Keys"]) for table_name, request in RequestItems.items()})
+            is_throttled = self.throttled_batch_gets > 0
+            self.throttled_batch_gets -= is_throttled
+            responses, unprocessed_keys = {}, {}
+            for table_name, request in RequestItems.items():
+                table = self.resource.Table(table_name)
+                processed_keys = request["Keys"][:self.throttled_batch_get_size] if is_throttled else request["Keys"]
+                responses[table_name] = [project_item(copy.deepcopy(table.items[table.get_key(key)]), request.get("ProjectionExpression"),
+                                                      request.get("ExpressionAttributeNames")) for key in processed_keys if table.get_key(key) in table.items]
+                if len(processed_keys) < len(request["Keys"]):
+                    unprocessed_keys[table_name] = dict(request, Keys=request["Keys"][len(processed_keys):])
+        return {"Responses": responses, "UnprocessedKeys": unprocessed_keys, "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def transact_write_items(self, TransactItems): # pylint: disable=invalid-name
+        self.resource.wait()
+        with self.resource.lock:
+            self.resource.write_requests += 1
+            writes, cancellation_reasons = [], []
+            for transact_item in TransactItems:
+                (operation, request), = transact_item.items()
+                table = self.resource.Table(request["TableName"])
+                try:
+                    if operation == "Put":
+                        table.check_condition(table.items.get(table.get_key(request["Item"])), request.get("ConditionExpression"),
+                                              request.get("ExpressionAttributeNames"), request.get("ExpressionAttributeValues"), "TransactWriteItems")
+                        writes.append((table, table.get_key(request["Item"]), copy.deepcopy(request["Item"])))
+                    elif operation == "Update":
+                        writes.append((table, table.get_key(request["Key"]), table.get_updated_item(
+                            request["Key"], request["UpdateExpression"], request.get("ExpressionAttributeValues"),
+                            request.get("ExpressionAttributeNames"), request.get("ConditionExpression"), "TransactWriteItems")))
+                    else:
+                        raise NotImplementedError(f"Transaction operation {operation} is not supported by the stub")
+                    cancellation_reasons.append({"Code": "None"})
+                except ClientError:
+                    cancellation_reasons.append({"Code": "ConditionalCheckFailed"})
+            if any(reason["Code"] != "None" for reason in cancellation_reasons):
+                raise ClientError({"Error": {"Code": "TransactionCanceledException", "Message": "Transaction cancelled"},
+                                   "CancellationReasons": cancellation_reasons}, "TransactWriteItems")
+            for table, key, item in writes:
+                table.items[key] = item
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+
+class StubMeta:
+    def __init__(self, client):
+        self.client = client
+
+
+class StubDynamoDBResource:
+    """
+    Stand-in of boto3.resource("dynamodb"), tables are created on first use with the key attributes of key_schemas.
+    Every request waits for the configured latency before it is applied so that concurrent requests interleave
+    """
+    def __init__(self, key_schemas, latency_in_seconds=0):
+        self.key_schemas = key_schemas
+        self.latency_in_seconds = latency_in_seconds
+        self.lock = threading.RLock()
+        self.tables = {}
+        self.read_requests = 0
+        self.write_requests = 0
+        self.meta = StubMeta(StubClient(self))
+
+    def Table(self, name): # pylint: disable=invalid-name
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = StubTable(self, name, self.key_schemas[name])
+            return self.tables[name]
+
+    def wait(self):
+        if self.latency_in_seconds:
+            time.sleep(self.latency_in_seconds)
@@ -0,0 +1,100 @@
+"""
+Tests of the answer cache of the workspace questions, answers must never be served across access scopes or to questions
+that only look like the cached one
+"""
+import uuid
+
+import pytest
+
+import bedrockUtil
+
+LLM_KEY = ("anthropic.claude-3-haiku-20240307-v1:0", "{}")
+QA_PROMPT_CONFIG = {"Instructions": "default"}
+MAX_RESULTS = 5
+
+
+def get_workspace_details(is_tbac_enabled):
+    return {
+        "WorkspaceId": "test-workspace",
+        "LastIngestionCompletedTime": "2026-10-01 00:00:00",
+        "AttachedDatasets": [
+            {"DatasetId": "public-dataset", "IsTBACEnabled": False},
+            {"DatasetId": "restricted-dataset", "IsTBACEnabled": is_tbac_enabled}
+        ]
+    }
+
+
+def get_scope(client_id, workspace_details):
+    return bedrockUtil.get_answer_cache_scope(client_id, workspace_details, LLM_KEY, QA_PROMPT_CONFIG, MAX_RESULTS)
+
+
+def get_response(content):
+    return {"content": content, "metadata": {"documents": [{"page_content": content, "metadata": {}}]}}
+
+
+@pytest.fixture
+def answer_cache():
+    return bedrockUtil.AnswerCache()
+
+
+def test_tbac_answers_are_not_served_to_other_users(answer_cache):
+    workspace_details = get_workspace_details(is_tbac_enabled=True)
+    first_user_scope, is_tbac_scope = get_scope("first-user", workspace_details)
+    second_user_scope, _ = get_scope("second-user", workspace_details)
+    answer_cache.put(first_user_scope, "What is the salary of the CEO?", get_response("restricted answer"))
+
+    assert is_tbac_scope
+    assert first_user_scope != second_user_scope
+    assert answer_cache.get(first_user_scope, "What is the salary of the CEO?")["content"] == "restricted answer"
+    assert answer_cache.get(second_user_scope, "What is the salary of the CEO?") is None
+    assert answer_cache.get(second_user_scope, "what is the salary of the ceo") is None
+
+
+def test_tbac_answers_expire_with_the_file_access_decisions(answer_cache, monkeypatch):
+    workspace_details = get_workspace_details(is_tbac_enabled=True)
+    scope_key, _ = get_scope("first-user", workspace_details)
+    current_time = 1000000.0
+    monkeypatch.setattr(bedrockUtil.time, "time", lambda: current_time)
+    answer_cache.put(scope_key, "Who approved the budget?", get_response("restricted answer"), ttl_in_seconds=60)
+
+    current_time += 61
+    assert answer_cache.get(scope_key, "Who approved the budget?") is None
+
+
+def test_answers_are_not_shared_when_tbac_is_enabled_on_a_dataset(answer_cache):
+    shared_scope, is_tbac_scope = get_scope("first-user", get_workspace_details(is_tbac_enabled=False))
+    tbac_scope, _ = get_scope("second-user", get_workspace_details(is_tbac_enabled=True))
+    answer_cache.put(shared_scope, "Who approved the budget?", get_response("answer without access control"))
+
+    assert not is_tbac_scope
+    assert get_scope("second-user", get_workspace_details(is_tbac_enabled=False))[0] == shared_scope
+    assert answer_cache.get(tbac_scope, "Who approved the budget?") is None
+
+
+def test_chatbot_answers_are_not_shared_with_users(answer_cache):
+    workspace_details = get_workspace_details(is_tbac_enabled=False)
+    chatbot_scope, _ = get_scope(str(uuid.uuid4()), workspace_details)
+    user_scope, _ = get_scope("first-user", workspace_details)
+    answer_cache.put(chatbot_scope, "Who approved the budget?", get_response("chatbot answer"))
+
+    assert answer_cache.get(user_scope, "Who approved the budget?") is None
+
+
+@pytest.mark.parametrize("cached_question, question", [
+    ("What was the revenue in 2023?", "What was the revenue in 2024?"),
+    ("Are contractors allowed to work remotely?", "Are contractors not allowed to work remotely?"),
+    ("Is the office open on Monday?", "Is the office open on Sunday?")
+])
+def test_similar_questions_are_not_answered_from_the_cache(answer_cache, cached_question, question):
+    scope_key, _ = get_scope("first-user", get_workspace_details(is_tbac_enabled=False))
+    answer_cache.put(scope_key, cached_question, get_response("cached answer"))
+
+    assert answer_cache.get(scope_key, question) is None
+
+
+def test_questions_differing_in_case_and_punctuation_share_the_answer(answer_cache):
+    scope_key, _ = get_scope("first-user", get_workspace_details(is_tbac_enabled=False))
+    answer_cache.put(scope_key, "What was the revenue in 2023?", get_response("cached answer"))
+
+    assert answer_cache.get(scope_key, "  what was the REVENUE in 2023 ")["content"] == "cached answer"
+    assert answer_cache.stats == {"Hits": 1, "Misses": 0}
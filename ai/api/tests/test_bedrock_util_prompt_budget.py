@@ -0,0 +1,113 @@
+"""
+Tests of the split of the prompt budget of each model provider between the chat history and the context, and of the
+documents kept from a fixed-size corpus within the context budget
+"""
+import pytest
+from langchain_core.documents import Document
+
+import bedrockUtil
+import commonUtil
+
+PROVIDERS = sorted(commonUtil.MODEL_PROVIDER_CONTEXT_WINDOW_MAP) + ["unknown"]
+RAG_PROMPT_LAYOUT = {"FixedTokens": 200, "InputSlots": 1, "ContextSlots": 1, "HistorySlots": 1}
+QUESTION = "What is the leave policy for the employees who joined this year?"
+CORPUS_DOCUMENTS = 200
+CORPUS_DOCUMENT_SIZE = 2000
+
+
+def get_corpus():
+    return [Document(page_content=f"{rank} ".ljust(CORPUS_DOCUMENT_SIZE, "x"), metadata={"Rank": rank}) for rank in range(CORPUS_DOCUMENTS)]
+
+
+def get_contents(documents):
+    return [(document.page_content, document.metadata) for document in documents]
+
+
+def get_context_window(model_provider):
+    return commonUtil.MODEL_PROVIDER_CONTEXT_WINDOW_MAP.get(model_provider, commonUtil.DEFAULT_MODEL_CONTEXT_WINDOW)
+
+
+def get_tokens(documents, model_provider):
+    return sum(commonUtil.estimate_token_count(document.page_content, model_provider) for document in documents)
+
+
+@pytest.mark.parametrize("model_provider", PROVIDERS)
+def test_history_and_context_fit_in_the_context_window(model_provider):
+    budget = bedrockUtil.allocate_prompt_token_budget(model_provider, RAG_PROMPT_LAYOUT, QUESTION)
+
+    response_tokens = min(commonUtil.MODEL_PROVIDER_MAX_TOKENS_MAP.get(model_provider, bedrockUtil.DEFAULT_MODEL_KWARGS["maxTokens"]),
+                          int(get_context_window(model_provider) * bedrockUtil.PROMPT_RESPONSE_MAX_SHARE))
+    prompt_tokens = RAG_PROMPT_LAYOUT["FixedTokens"] + commonUtil.estimate_token_count(QUESTION, model_provider) + budget["HistoryTokens"] + budget["ContextTokens"]
+    assert 0 < budget["HistoryTokens"] <= commonUtil.CHAT_HISTORY_TOKEN_BUDGET
+    assert budget["ContextTokens"] > 0
+    assert prompt_tokens + response_tokens + bedrockUtil.PROMPT_TOKEN_SAFETY_MARGIN <= get_context_window(model_provider)
+
+
+@pytest.mark.parametrize("model_provider", PROVIDERS)
+def test_repeated_slots_share_the_budget(model_provider):
+    layout = dict(RAG_PROMPT_LAYOUT, ContextSlots=2, HistorySlots=2)
+
+    single_budget = bedrockUtil.allocate_prompt_token_budget(model_provider, RAG_PROMPT_LAYOUT, QUESTION)
+    budget = bedrockUtil.allocate_prompt_token_budget(model_provider, layout, QUESTION)
+
+    assert budget["ContextTokens"] * 2 + budget["HistoryTokens"] * 2 <= single_budget["ContextTokens"] + single_budget["HistoryTokens"]
+
+
+def test_prompt_without_history_gives_the_history_budget_to_the_context():
+    layout = dict(RAG_PROMPT_LAYOUT, HistorySlots=0)
+
+    budget = bedrockUtil.allocate_prompt_token_budget("anthropic", layout, QUESTION)
+
+    assert budget["HistoryTokens"] == 0
+    assert budget["ContextTokens"] == sum(bedrockUtil.allocate_prompt_token_budget("anthropic", RAG_PROMPT_LAYOUT, QUESTION).values())
+
+
+@pytest.mark.parametrize("model_provider", PROVIDERS)
+def test_question_above_the_context_window_is_rejected(model_provider):
+    characters_per_token = commonUtil.MODEL_PROVIDER_CHARACTERS_PER_TOKEN_MAP.get(model_provider, commonUtil.CHARACTERS_PER_TOKEN)
+    question = "x" * int(get_context_window(model_provider) * characters_per_token)
+
+    with pytest.raises(Exception, match=bedrockUtil.PROMPT_TOO_LONG_MESSAGE):
+        bedrockUtil.allocate_prompt_token_budget(model_provider, RAG_PROMPT_LAYOUT, question)
+
+
+def test_contextless_prompt_layout_counts_the_history_and_question_slots():
+    layout = bedrockUtil.get_prompt_layout(bedrockUtil.get_contextless_prompt(), "anthropic")
+
+    assert layout["InputSlots"] >= 1 and layout["HistorySlots"] >= 1 and layout["ContextSlots"] == 0
+    assert layout["FixedTokens"] > 0
+
+
+@pytest.mark.parametrize("model_provider", PROVIDERS)
+def test_corpus_is_cut_to_the_highest_ranked_documents_within_the_budget(model_provider):
+    context_tokens = bedrockUtil.allocate_prompt_token_budget(model_provider, RAG_PROMPT_LAYOUT, QUESTION)["ContextTokens"]
+
+    documents = bedrockUtil.fit_documents_to_budget(get_corpus(), context_tokens, model_provider)
+
+    assert get_tokens(documents, model_provider) <= context_tokens
+    assert [document.metadata["Rank"] for document in documents] == list(range(len(documents)))
+    assert get_contents(documents) == get_contents(bedrockUtil.fit_documents_to_budget(get_corpus(), context_tokens, model_provider))
+    # the documents which were dropped would not have fit
+    kept_whole = [document for document in documents if len(document.page_content) == CORPUS_DOCUMENT_SIZE]
+    assert get_tokens(kept_whole + [get_corpus()[len(kept_whole)]], model_provider) > context_tokens
+
+
+def test_first_document_that_does_not_fit_is_truncated_when_enough_budget_is_left():
+    document_tokens = commonUtil.estimate_token_count("x" * CORPUS_DOCUMENT_SIZE, "anthropic")
+    token_budget = document_tokens * 2 + bedrockUtil.PROMPT_MIN_TRUNCATED_DOCUMENT_TOKENS
+
+    documents = bedrockUtil.fit_documents_to_budget(get_corpus(), token_budget, "anthropic")
+
+    assert [document.metadata["Rank"] for document in documents] == [0, 1, 2]
+    assert len(documents[2].page_content) < CORPUS_DOCUMENT_SIZE
+    assert get_tokens(documents, "anthropic") <= token_budget
+
+
+def test_first_document_that_does_not_fit_is_dropped_when_little_budget_is_left():
+    document_tokens = commonUtil.estimate_token_count("x" * CORPUS_DOCUMENT_SIZE, "anthropic")
+    token_budget = document_tokens * 2 + bedrockUtil.PROMPT_MIN_TRUNCATED_DOCUMENT_TOKENS - 1
+
+    documents = bedrockUtil.fit_documents_to_budget(get_corpus(), token_budget, "anthropic")
+
+    assert [document.metadata["Rank"] for document in documents] == [0, 1]
+    assert get_contents(bedrockUtil.fit_documents_to_budget(get_corpus(), None, "anthropic")) == get_contents(get_corpus())
@@ -0,0 +1,124 @@
+"""
+Tests of the session memory stores. The in-memory store evicts sessions by TTL, least recent use and total size, both stores
+keep only the newest messages of a session which fit in the token budget of the history
+"""
+import time
+
+import pytest
+
+import bedrockUtil
+import commonUtil
+from dynamodb_stub import StubDynamoDBResource
+
+CHAT_HISTORY_TABLE = "test-chat-history"
+# about 100 tokens per message with the generic characters per token ratio
+MESSAGE_SIZE = 400
+
+
+class SimulatedClock:
+    """
+    Replaces time.time, the time only moves when the test advances it
+    """
+    def __init__(self, start_time=1700000000):
+        self.now = start_time
+
+    def time(self):
+        return self.now
+
+
+def get_history(messages_count, prefix="message", start_time=0):
+    return [{"Type": "human" if index % 2 == 0 else "ai", "Data": f"{prefix} {index} ".ljust(MESSAGE_SIZE, "x"),
+             "MessageTime": f"2026-01-01 00:00:{start_time + index:02d}"} for index in range(messages_count)]
+
+
+def get_kept_budget_messages(token_budget):
+    return token_budget // commonUtil.estimate_token_count("x" * MESSAGE_SIZE)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    simulated_clock = SimulatedClock()
+    monkeypatch.setattr(time, "time", simulated_clock.time)
+    return simulated_clock
+
+
+def test_least_recently_used_session_is_evicted_above_the_session_limit(clock): # pylint: disable=unused-argument
+    store = bedrockUtil.InMemorySessionMemoryStore(max_sessions=3)
+    for session_id in ["first", "second", "third"]:
+        store.put(session_id, get_history(2, session_id))
+
+    store.get("first")
+    store.put("fourth", get_history(2, "fourth"))
+
+    assert list(store.sessions) == ["third", "first", "fourth"]
+    assert store.get("second") == []
+    assert store.get("first") == get_history(2, "first")
+
+
+def test_sessions_expire_after_the_ttl(clock): # pylint: disable=redefined-outer-name
+    store = bedrockUtil.InMemorySessionMemoryStore(ttl_in_seconds=60)
+    store.put("first", get_history(2, "first"))
+    clock.now += 30
+    store.put("second", get_history(2, "second"))
+
+    clock.now += 30
+    assert store.get("first") == []
+    assert store.get("second") == get_history(2, "second")
+
+    # expired sessions are dropped on the next put even if they are never read again
+    clock.now += 30
+    store.put("third", get_history(2, "third"))
+    assert list(store.sessions) == ["third"]
+    assert store.size == store.sessions["third"]["Size"]
+
+
+def test_least_recently_used_sessions_are_evicted_above_the_size_limit(clock): # pylint: disable=unused-argument
+    session_size = len(bedrockUtil.json.dumps(get_history(4), default=str))
+    store = bedrockUtil.InMemorySessionMemoryStore(max_size=session_size * 3)
+    for index in range(5):
+        store.put(f"session-{index}", get_history(4))
+
+    assert list(store.sessions) == ["session-2", "session-3", "session-4"]
+    assert store.size == sum(session_entry["Size"] for session_entry in store.sessions.values()) <= store.max_size
+
+    # a session above the limit by itself is not kept
+    store.put("large", get_history(4 * 4))
+    assert "large" not in store.sessions and store.size <= store.max_size
+
+
+def test_stored_history_is_trimmed_to_the_newest_messages_within_the_token_budget(clock): # pylint: disable=unused-argument
+    store = bedrockUtil.InMemorySessionMemoryStore()
+    chat_history = get_history(50)
+
+    store.put("session", chat_history)
+
+    kept_messages = get_kept_budget_messages(commonUtil.CHAT_HISTORY_TOKEN_BUDGET)
+    assert store.get("session") == chat_history[-kept_messages:]
+
+
+def test_prompt_history_budget_trims_the_stored_history(clock, monkeypatch): # pylint: disable=unused-argument
+    store = bedrockUtil.InMemorySessionMemoryStore()
+    store.put("session", get_history(50))
+    monkeypatch.setattr(bedrockUtil, "SESSION_MEMORY_STORE", store)
+
+    memory = bedrockUtil.get_memory_from_chat_history("session", history_token_budget=500)
+
+    assert [message.content for message in memory.messages] == [message["Data"] for message in get_history(50)[-get_kept_budget_messages(500):]]
+
+
+def test_dynamodb_store_reads_the_newest_messages_before_the_turn(monkeypatch):
+    resource = StubDynamoDBResource({CHAT_HISTORY_TABLE: ["SessionId", "MessageTime"]})
+    for message in get_history(30):
+        resource.Table(CHAT_HISTORY_TABLE).put_item(Item=dict(message, SessionId="session"))
+    for message in get_history(5, "other"):
+        resource.Table(CHAT_HISTORY_TABLE).put_item(Item=dict(message, SessionId="other-session"))
+    monkeypatch.setattr(bedrockUtil, "DYNAMODB_RESOURCE", resource)
+    monkeypatch.setattr(bedrockUtil, "CHAT_HISTORY_TABLE", CHAT_HISTORY_TABLE)
+    store = bedrockUtil.DynamoDBSessionMemoryStore()
+
+    # the last two messages belong to the turn being answered
+    chat_history = store.get("session", get_history(30)[28]["MessageTime"])
+
+    expected_history = get_history(28)[-min(commonUtil.CHAT_HISTORY_WINDOW_SIZE, get_kept_budget_messages(commonUtil.CHAT_HISTORY_TOKEN_BUDGET)):]
+    assert [message["Data"] for message in chat_history] == [message["Data"] for message in expected_history]
+    assert resource.read_requests == 1
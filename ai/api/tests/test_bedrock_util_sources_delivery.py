@@ -0,0 +1,100 @@
+"""
+Tests of the delivery of the sources of a chat turn. The website urls of the sources are read with deduplicated batch
+requests, and the streamed response is buffered instead of blocked until the sources message is sent
+"""
+import time
+import threading
+from collections import OrderedDict
+
+import pytest
+
+import bedrockUtil
+from dynamodb_stub import StubDynamoDBResource
+
+WORKSPACE_ID = "test-workspace"
+DOCUMENTS_TABLE = "test-workspaces-documents"
+WEBSITE_DOCUMENTS = 150
+
+
+class DeliverySessionStandIn:
+    """
+    Records the messages sent to the websocket connection of the session
+    """
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, message, is_final=False, latest_message_id=None): # pylint: disable=unused-argument
+        self.messages.append(message)
+
+
+@pytest.fixture
+def dynamodb_resource(monkeypatch):
+    resource = StubDynamoDBResource({DOCUMENTS_TABLE: ["WorkspaceId", "DocumentId"]})
+    for index in range(WEBSITE_DOCUMENTS):
+        resource.Table(DOCUMENTS_TABLE).put_item(Item={"WorkspaceId": WORKSPACE_ID, "DocumentId": f"website-{index}", "DocumentDetails": {
+            "FileName": f"page_website-{index}.txt", "WebsiteURL": f"https://example.com/{index}"}})
+    resource.Table(DOCUMENTS_TABLE).put_item(Item={"WorkspaceId": WORKSPACE_ID, "DocumentId": "file-0", "DocumentDetails": {"FileName": "handbook.pdf"}})
+    monkeypatch.setattr(bedrockUtil, "DYNAMODB_RESOURCE", resource)
+    monkeypatch.setattr(bedrockUtil, "WORKSPACES_DOCUMENTS_TABLE", DOCUMENTS_TABLE)
+    monkeypatch.setattr(bedrockUtil, "WEBSITE_URL_CACHE", OrderedDict())
+    return resource
+
+
+def test_website_urls_are_read_once_with_batched_requests(dynamodb_resource):
+    client = dynamodb_resource.meta.client
+    document_ids = [f"website-{index}" for index in range(WEBSITE_DOCUMENTS)] * 2 + ["file-0", "missing"]
+
+    website_urls = bedrockUtil.get_website_urls(WORKSPACE_ID, document_ids)
+
+    assert website_urls == dict({f"website-{index}": f"https://example.com/{index}" for index in range(WEBSITE_DOCUMENTS)}, **{"file-0": None, "missing": None})
+    # every unique document is requested once, in requests of at most the dynamodb batch size
+    assert sorted(request[DOCUMENTS_TABLE] for request in client.batch_get_requests) == [WEBSITE_DOCUMENTS + 2 - 100, 100]
+
+    website_urls = bedrockUtil.get_website_urls(WORKSPACE_ID, ["website-0", "file-0", "missing", "website-0"])
+
+    assert website_urls == {"website-0": "https://example.com/0", "file-0": None, "missing": None}
+    assert len(client.batch_get_requests) == 2
+
+
+def test_only_uncached_documents_are_requested(dynamodb_resource):
+    client = dynamodb_resource.meta.client
+    bedrockUtil.get_website_urls(WORKSPACE_ID, ["website-0", "website-1"])
+
+    bedrockUtil.get_website_urls(WORKSPACE_ID, ["website-1", "website-2", "website-2"])
+
+    assert [request[DOCUMENTS_TABLE] for request in client.batch_get_requests] == [2, 1]
+
+
+def test_response_is_buffered_until_the_sources_are_sent(monkeypatch):
+    monkeypatch.setattr(bedrockUtil, "BACKGROUND_TASKS", [])
+    delivery_session = DeliverySessionStandIn()
+    sources_released = threading.Event()
+
+    def send_sources():
+        sources_released.wait(5)
+        delivery_session.send_message({"AIMessage": "sources", "Metadata": {"IsComplete": False, "Sources": []}})
+    bedrockUtil.submit_background_task(send_sources)
+    handler = bedrockUtil.StreamingHandler("test-user", "test-session", "test-message", delivery_session)
+    handler.on_llm_start({}, ["Answer the question"])
+    tokens = [f"token{index} " for index in range(200)]
+
+    start_time = time.monotonic()
+    for token in tokens[:100]:
+        handler.on_llm_new_token(token)
+    # the generation is not blocked while the sources are pending
+    assert time.monotonic() - start_time < 1
+    assert not delivery_session.messages
+
+    sources_released.set()
+    while bedrockUtil.has_pending_background_tasks():
+        time.sleep(0.01)
+    for token in tokens[100:]:
+        handler.on_llm_new_token(token)
+    handler.on_llm_end(None)
+
+    messages = delivery_session.messages
+    assert messages[0]["AIMessage"] == "sources"
+    assert len(messages) > 3 and messages[-1]["Metadata"]["IsComplete"]
+    assert "".join(message["AIMessage"] for message in messages[1:]) == "".join(tokens)
+    # the buffered tokens are sent in the first chunk after the sources
+    assert messages[1]["AIMessage"].startswith("".join(tokens[:100]))
@@ -0,0 +1,126 @@
+"""
+Tests of the asynchronous tool lambda invocation of the agent, the lambda service is replaced by an in-process stand-in
+with a fixed latency
+"""
+import io
+import json
+import time
+import asyncio
+
+import pytest
+
+import bedrockUtil
+import commonUtil
+
+LAMBDA_LATENCY_IN_SECONDS = 0.3
+PROGRESS_INTERVAL_IN_SECONDS = 0.05
+# scheduling overhead allowed on top of the lambda latency
+LATENCY_TOLERANCE_IN_SECONDS = 0.15
+
+
+class LambdaStandIn:
+    """
+    In-process stand-in of the lambda client, every invoke takes the configured latency and returns an api response
+    """
+    def __init__(self, latency, body):
+        self.latency = latency
+        self.body = body
+        self.invocations = 0
+
+    def invoke(self, FunctionName, Payload, InvocationType): # pylint: disable=invalid-name,unused-argument
+        self.invocations += 1
+        time.sleep(self.latency)
+        return {
+            "ResponseMetadata": {"HTTPStatusCode": 200, "RequestId": "test-request"},
+            "Payload": io.BytesIO(json.dumps({"statusCode": 200, "body": json.dumps(self.body)}).encode())
+        }
+
+
+class DeliverySessionStandIn:
+    """
+    Records the messages sent to the websocket connection, fails every send if requested
+    """
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.messages = []
+
+    def send_message(self, message):
+        self.messages.append(message)
+        if self.fail:
+            raise Exception("GoneException")
+
+
+@pytest.fixture(autouse=True)
+def progress_interval(monkeypatch):
+    monkeypatch.setattr(bedrockUtil, "TOOL_PROGRESS_INTERVAL_IN_SECONDS", PROGRESS_INTERVAL_IN_SECONDS)
+
+
+def invoke_tool(lambda_client, tool_name="getTextSummarization"):
+    return bedrockUtil.ainvoke_tool_lambda(
+        lambda_client, "test-tool-lambda", json.dumps({}), tool_name, "Summarizing...", "test-message", commonUtil.get_current_time()
+    )
+
+
+def test_tool_lambda_adds_no_latency_and_sends_progress(monkeypatch):
+    delivery_session = DeliverySessionStandIn()
+    monkeypatch.setattr(bedrockUtil, "WS_DELIVERY_SESSION", delivery_session)
+    lambda_client = LambdaStandIn(LAMBDA_LATENCY_IN_SECONDS, {"Message": "summary"})
+
+    start_time = time.monotonic()
+    response = asyncio.run(invoke_tool(lambda_client))
+    elapsed_time = time.monotonic() - start_time
+
+    assert response == {"Message": "summary"}
+    assert lambda_client.invocations == 1
+    assert elapsed_time < LAMBDA_LATENCY_IN_SECONDS + LATENCY_TOLERANCE_IN_SECONDS
+    assert len(delivery_session.messages) >= 2
+    # progress is sent as a status, the clients must not join it to the answer of the tool
+    assert all(message["Metadata"]["Progress"] and not message["Metadata"]["IsComplete"] for message in delivery_session.messages)
+
+
+def test_tool_lambda_does_not_block_the_event_loop(monkeypatch):
+    monkeypatch.setattr(bedrockUtil, "WS_DELIVERY_SESSION", DeliverySessionStandIn())
+    lambda_client = LambdaStandIn(LAMBDA_LATENCY_IN_SECONDS, {"Message": "done"})
+
+    async def run_tools_with_ticker():
+        ticks = 0
+        tools_task = asyncio.gather(invoke_tool(lambda_client), invoke_tool(lambda_client, "getAIVisuals"))
+        while not tools_task.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        return await tools_task, ticks
+
+    start_time = time.monotonic()
+    responses, ticks = asyncio.run(run_tools_with_ticker())
+    elapsed_time = time.monotonic() - start_time
+
+    assert responses == [{"Message": "done"}, {"Message": "done"}]
+    # both lambdas were running at the same time and the loop kept scheduling other coroutines meanwhile
+    assert elapsed_time < LAMBDA_LATENCY_IN_SECONDS + LATENCY_TOLERANCE_IN_SECONDS
+    assert ticks >= 10
+
+
+def test_failing_progress_message_does_not_abandon_the_tool(monkeypatch):
+    delivery_session = DeliverySessionStandIn(fail=True)
+    monkeypatch.setattr(bedrockUtil, "WS_DELIVERY_SESSION", delivery_session)
+    lambda_client = LambdaStandIn(LAMBDA_LATENCY_IN_SECONDS, {"Message": "summary"})
+
+    response = asyncio.run(invoke_tool(lambda_client))
+
+    assert response == {"Message": "summary"}
+    assert len(delivery_session.messages) >= 2
+
+
+def test_cancelled_turn_leaves_no_pending_task(monkeypatch):
+    monkeypatch.setattr(bedrockUtil, "WS_DELIVERY_SESSION", DeliverySessionStandIn())
+    lambda_client = LambdaStandIn(LAMBDA_LATENCY_IN_SECONDS, {"Message": "summary"})
+
+    async def cancel_running_tool():
+        tool_task = asyncio.ensure_future(invoke_tool(lambda_client))
+        await asyncio.sleep(PROGRESS_INTERVAL_IN_SECONDS * 2)
+        tool_task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await tool_task
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert not asyncio.run(cancel_running_tool())
@@ -0,0 +1,42 @@
+"""
+Tests of the classification of the trivial turns which are answered without retrieval or generation
+"""
+import bedrockUtil
+import commonUtil
+
+
+def get_turn(message_id, question, answer, with_sources=False):
+    message_time = commonUtil.get_current_time()
+    turn = [{"Type": "human", "Data": question, "MessageId": message_id, "MessageTime": message_time}]
+    if with_sources:
+        turn.append({"Type": "ai", "Data": "We found 2 resources with relevant information, formatting your response", "MessageId": message_id,
+                     "MessageTime": message_time, "Sources": [{"FileName": "handbook.pdf"}]})
+    turn.append({"Type": "ai", "Data": answer, "MessageId": message_id, "MessageTime": message_time, "Metadata": {"modelId": "test-model"}})
+    return turn
+
+
+def test_greetings_and_empty_messages_are_trivial():
+    assert bedrockUtil.classify_trivial_turn("Hello!!")[0] == "greeting"
+    assert bedrockUtil.classify_trivial_turn("  Thank you.  ")[0] == "thanks"
+    assert bedrockUtil.classify_trivial_turn(" ?! ")[0] == "empty"
+    assert bedrockUtil.classify_trivial_turn("Hello, what is the leave policy?") == (None, None)
+
+
+def test_repeated_question_of_a_rag_turn_is_answered_with_the_last_answer():
+    chat_history = get_turn("first", "What is the leave policy?", "20 days") + get_turn("second", "Who approves leaves?", "Your manager", with_sources=True)
+
+    assert bedrockUtil.get_last_turn(chat_history)[1]["Data"] == "Your manager"
+    assert bedrockUtil.classify_trivial_turn("who approves leaves", chat_history) == ("repeat", "Your manager")
+
+
+def test_question_of_an_older_turn_is_not_a_repeat():
+    chat_history = get_turn("first", "What is the leave policy?", "20 days", with_sources=True) + get_turn("second", "Who approves leaves?", "Your manager")
+
+    assert bedrockUtil.classify_trivial_turn("What is the leave policy?", chat_history) == (None, None)
+
+
+def test_failed_turn_is_not_repeated():
+    chat_history = get_turn("first", "What is the leave policy?", "20 days", with_sources=True)
+    chat_history[-1]["Metadata"] = "N/A"
+
+    assert bedrockUtil.classify_trivial_turn("What is the leave policy?", chat_history) == (None, None)
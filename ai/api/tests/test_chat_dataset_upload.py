@@ -0,0 +1,236 @@
+"""
+Tests of the upload of session files to datasets. The api must return before any file is copied, the files are copied by
+an asynchronous invocation against an in-process s3 stand-in and the progress of every file is kept in the dataset uploads
+table
+"""
+import json
+import math
+import time
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+import chat
+import commonUtil
+from dynamodb_stub import StubDynamoDBResource
+
+USER_ID = "test-user"
+SESSION_ID = "test-session"
+DATASET_ID = "test-dataset"
+DATASET_ITEM = {"AccessType": "owner", "TargetLocation": "s3", "Domain": "sales", "DatasetName": "reports", "FileType": "csv"}
+FILE_SIZE = 1024
+# larger than the 5GB limit of a single CopyObject request
+LARGE_FILE_SIZE = 6 * 1024 * 1024 * 1024
+SINGLE_COPY_MAX_SIZE = 5 * 1024 * 1024 * 1024
+
+
+class S3StandIn:
+    """
+    In-process stand-in of the s3 client used by the dataset uploads, objects only have a size. Copies above the
+    multipart threshold of the transfer config are copied part by part and each part takes part_latency seconds
+    """
+    def __init__(self, part_latency=0):
+        self.part_latency = part_latency
+        self.objects = {}
+        self.copies = []
+        self.lock = threading.Lock()
+
+    def head_object(self, Bucket, Key): # pylint: disable=invalid-name
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+            return {"ContentLength": self.objects[(Bucket, Key)]}
+
+    def copy(self, CopySource, Bucket, Key, Callback=None, Config=None): # pylint: disable=invalid-name
+        size = self.head_object(**CopySource)["ContentLength"]
+        if size > Config.multipart_threshold:
+            part_sizes = [min(Config.multipart_chunksize, size - offset) for offset in range(0, size, Config.multipart_chunksize)]
+        else:
+            part_sizes = [size]
+        assert max(part_sizes) <= SINGLE_COPY_MAX_SIZE
+        for part_size in part_sizes:
+            time.sleep(self.part_latency)
+            Callback(part_size)
+        with self.lock:
+            self.objects[(Bucket, Key)] = size
+            self.copies.append({"Key": Key, "Parts": len(part_sizes)})
+
+
+class LambdaStandIn:
+    """
+    Records the asynchronous invocations of the chat lambda
+    """
+    def __init__(self):
+        self.payloads = []
+
+    def invoke(self, FunctionName, Payload, InvocationType): # pylint: disable=invalid-name,unused-argument
+        self.payloads.append(json.loads(Payload))
+        return {"ResponseMetadata": {"HTTPStatusCode": 202, "RequestId": "test-request"}}
+
+
+class ContextStandIn:
+    """
+    Lambda context which is about to time out after the given number of remaining time checks
+    """
+    function_name = "test-chat"
+
+    def __init__(self, checks_before_timeout=None):
+        self.checks_before_timeout = checks_before_timeout
+
+    def get_remaining_time_in_millis(self):
+        if self.checks_before_timeout is None:
+            return 900000
+        self.checks_before_timeout -= 1
+        return 900000 if self.checks_before_timeout >= 0 else 0
+
+
+@pytest.fixture
+def dynamodb_resource(monkeypatch):
+    resource = StubDynamoDBResource({chat.SESSIONS_TABLE: ["UserId", "SessionId"], chat.CHAT_DATASET_UPLOADS_TABLE: ["SessionId", "UploadId"]})
+    monkeypatch.setattr(chat, "DYNAMODB_RESOURCE", resource)
+    monkeypatch.setattr(commonUtil, "DYNAMODB_RES", resource)
+    return resource
+
+
+@pytest.fixture
+def upload_clients(monkeypatch, dynamodb_resource): # pylint: disable=unused-argument,redefined-outer-name
+    s3_client, lambda_client, reports = S3StandIn(), LambdaStandIn(), []
+    monkeypatch.setattr(chat, "S3_TRANSFER_CLIENT", s3_client)
+    monkeypatch.setattr(chat, "LAMBDA_CLIENT", lambda_client)
+    monkeypatch.setattr(chat, "DATASET_UPLOAD_PROGRESS_INTERVAL_IN_SECONDS", 0.01)
+    monkeypatch.setattr(commonUtil, "get_user_auth_resources", lambda user_id, users_table: ("test-token", "test-role"))
+    monkeypatch.setattr(commonUtil, "retrieve_amorphic_dataset", lambda user_id, dataset_id, lambda_obj: dict(DATASET_ITEM))
+    monkeypatch.setattr(chat, "send_dataset_upload_report", lambda *args: reports.append(args))
+    return s3_client, lambda_client, reports
+
+
+def add_session_files(resource, s3_client, sizes):
+    files = list(sizes)
+    resource.Table(chat.SESSIONS_TABLE).put_item(Item={"UserId": USER_ID, "SessionId": SESSION_ID, "Title": "New Session", "Files": files})
+    for file, size in sizes.items():
+        s3_client.objects[(chat.SESSION_FILES_BUCKET_NAME, f"chat-sessions/{USER_ID}/{SESSION_ID}/{file}")] = size
+    return files
+
+
+def start_upload(files, upload_id=None):
+    response = chat.upload_file_to_dataset(USER_ID, SESSION_ID, files, DATASET_ID, ContextStandIn(), upload_id)
+    return response["statusCode"], json.loads(response["body"])
+
+
+def get_upload(resource, upload_id):
+    return resource.Table(chat.CHAT_DATASET_UPLOADS_TABLE).get_item(Key={"SessionId": SESSION_ID, "UploadId": upload_id})["Item"]
+
+
+@pytest.mark.parametrize("files_count", [1, 100, 1000])
+def test_api_returns_before_the_files_are_copied(dynamodb_resource, upload_clients, files_count):
+    s3_client, lambda_client, reports = upload_clients
+    files = add_session_files(dynamodb_resource, s3_client, {f"file_{index}.csv": FILE_SIZE for index in range(files_count)})
+
+    status_code, body = start_upload(files)
+
+    assert status_code == 200
+    assert not s3_client.copies
+    assert [file["Status"] for file in body["Files"]] == ["pending"] * files_count
+    upload = get_upload(dynamodb_resource, body["UploadId"])
+    assert upload["Status"] == "running"
+    assert {file_status["Status"] for file_status in upload["Files"].values()} == {"pending"}
+
+    (upload_event,) = lambda_client.payloads
+    assert upload_event["Operation"] == chat.DATASET_UPLOAD_OPERATION
+    chat.copy_session_files_to_dataset(upload_event, ContextStandIn())
+
+    upload = get_upload(dynamodb_resource, body["UploadId"])
+    assert upload["Status"] == "completed"
+    assert all(file_status == {"Status": "copied", "Size": FILE_SIZE, "CopiedBytes": FILE_SIZE, "Percentage": 100} for file_status in upload["Files"].values())
+    assert len(upload["Files"]) == files_count
+    assert sorted(copy["Key"] for copy in s3_client.copies) == sorted(f"sales/reports/upload_date={body['UploadId']}/{USER_ID}/csv/{file}" for file in files)
+    assert len(reports) == 1 and len(reports[0][3]) == files_count
+
+
+def test_files_above_the_copy_limit_are_copied_in_parts_with_progress(dynamodb_resource, upload_clients, monkeypatch):
+    s3_client, lambda_client, _ = upload_clients
+    s3_client.part_latency = 0.002
+    files = add_session_files(dynamodb_resource, s3_client, {"large.csv": LARGE_FILE_SIZE})
+    saved_percentages = []
+    save = chat.DatasetUploadProgress.save
+
+    def record_save(upload_progress):
+        save(upload_progress)
+        saved_percentages.append(get_upload(dynamodb_resource, upload_progress.upload_key["UploadId"])["Files"]["large.csv"].get("Percentage"))
+    monkeypatch.setattr(chat.DatasetUploadProgress, "save", record_save)
+
+    _, body = start_upload(files)
+    chat.copy_session_files_to_dataset(lambda_client.payloads[0], ContextStandIn())
+
+    (large_copy,) = s3_client.copies
+    assert large_copy["Parts"] == math.ceil(LARGE_FILE_SIZE / chat.DATASET_UPLOAD_TRANSFER_CONFIG.multipart_chunksize)
+    file_status = get_upload(dynamodb_resource, body["UploadId"])["Files"]["large.csv"]
+    assert file_status["Status"] == "copied" and file_status["CopiedBytes"] == LARGE_FILE_SIZE
+    # the progress is saved in steps while the parts are copied
+    reported_percentages = [percentage for percentage in saved_percentages if percentage is not None]
+    assert reported_percentages == sorted(reported_percentages)
+    assert any(0 < percentage < 100 for percentage in reported_percentages)
+    assert all(percentage % chat.DATASET_UPLOAD_PROGRESS_STEP == 0 for percentage in reported_percentages)
+
+
+def test_files_left_at_timeout_are_copied_by_the_next_invocation(dynamodb_resource, upload_clients):
+    s3_client, lambda_client, reports = upload_clients
+    files = add_session_files(dynamodb_resource, s3_client, {f"file_{index}.csv": FILE_SIZE for index in range(5)})
+
+    _, body = start_upload(files)
+    chat.copy_session_files_to_dataset(lambda_client.payloads[0], ContextStandIn(checks_before_timeout=2))
+
+    assert len(s3_client.copies) == 2
+    assert not reports
+    assert get_upload(dynamodb_resource, body["UploadId"])["Status"] == "running"
+    resumed_event = lambda_client.payloads[-1]
+    assert resumed_event["Files"] == files[2:]
+
+    chat.copy_session_files_to_dataset(resumed_event, ContextStandIn())
+
+    upload = get_upload(dynamodb_resource, body["UploadId"])
+    assert upload["Status"] == "completed"
+    assert {file_status["Status"] for file_status in upload["Files"].values()} == {"copied"}
+    assert sorted(copy["Key"].rsplit("/", 1)[-1] for copy in s3_client.copies) == files
+    assert len(reports) == 1 and sorted(reports[0][3]) == files
+
+
+def test_resumed_upload_skips_copied_files_and_recopies_partial_ones(dynamodb_resource, upload_clients):
+    s3_client, lambda_client, _ = upload_clients
+    files = add_session_files(dynamodb_resource, s3_client, {"copied.csv": FILE_SIZE, "partial.csv": FILE_SIZE, "missing.csv": FILE_SIZE})
+    _, body = start_upload(files)
+    object_key_prefix = lambda_client.payloads[0]["ObjectKeyPrefix"]
+    s3_client.objects[(chat.LZ_BUCKET, object_key_prefix + "copied.csv")] = FILE_SIZE
+    s3_client.objects[(chat.LZ_BUCKET, object_key_prefix + "partial.csv")] = FILE_SIZE // 2
+
+    status_code, resumed_body = start_upload(files, body["UploadId"])
+    chat.copy_session_files_to_dataset(lambda_client.payloads[-1], ContextStandIn())
+
+    assert status_code == 200 and resumed_body["UploadId"] == body["UploadId"]
+    assert lambda_client.payloads[-1]["ObjectKeyPrefix"] == object_key_prefix
+    upload = get_upload(dynamodb_resource, body["UploadId"])
+    assert {file: file_status["Status"] for file, file_status in upload["Files"].items()} == {
+        "copied.csv": "skipped", "partial.csv": "copied", "missing.csv": "copied"
+    }
+    assert sorted(copy["Key"].rsplit("/", 1)[-1] for copy in s3_client.copies) == ["missing.csv", "partial.csv"]
+    assert s3_client.objects[(chat.LZ_BUCKET, object_key_prefix + "partial.csv")] == FILE_SIZE
+
+
+def test_upload_status_is_returned_only_to_its_user(dynamodb_resource, upload_clients):
+    s3_client, _, _ = upload_clients
+    files = add_session_files(dynamodb_resource, s3_client, {"report.csv": FILE_SIZE})
+    _, body = start_upload(files)
+
+    assert chat.get_dataset_upload(USER_ID, SESSION_ID, body["UploadId"])["Files"] == {"report.csv": {"Status": "pending"}}
+    with pytest.raises(chat.errorUtil.InvalidInputException):
+        chat.get_dataset_upload("other-user", SESSION_ID, body["UploadId"])
+
+
+def test_uploads_above_the_file_limit_are_rejected(dynamodb_resource, upload_clients):
+    s3_client, lambda_client, _ = upload_clients
+    files = add_session_files(dynamodb_resource, s3_client, {f"file_{index}.csv": FILE_SIZE for index in range(chat.DATASET_UPLOAD_MAX_FILES + 1)})
+
+    with pytest.raises(chat.errorUtil.InvalidInputException):
+        start_upload(files)
+    assert not lambda_client.payloads
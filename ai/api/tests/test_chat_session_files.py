@@ -0,0 +1,100 @@
+"""
+Tests of the session files updates, concurrent S3 events of the same session must not lose any file
+"""
+import threading
+
+import pytest
+
+import chat
+import commonUtil
+from dynamodb_stub import StubDynamoDBResource
+
+USER_ID = "test-user"
+SESSION_ID = "test-session"
+CONCURRENT_UPLOADS = 50
+# every request waits for the latency so that the reads and writes of the uploads interleave
+DYNAMODB_LATENCY_IN_SECONDS = 0.005
+
+
+@pytest.fixture
+def dynamodb_resource(monkeypatch):
+    resource = StubDynamoDBResource({chat.SESSIONS_TABLE: ["UserId", "SessionId"]}, DYNAMODB_LATENCY_IN_SECONDS)
+    resource.Table(chat.SESSIONS_TABLE).put_item(Item={
+        "UserId": USER_ID, "SessionId": SESSION_ID, "Title": "New Session", "StartTime": commonUtil.get_current_time(),
+        "Files": ["handbook.pdf"]
+    })
+    monkeypatch.setattr(chat, "DYNAMODB_RESOURCE", resource)
+    return resource
+
+
+def get_s3_event(filename, event_name="ObjectCreated:Put", sequencer="0055AED6DCD90281E5"):
+    return {"Records": [{
+        "eventName": event_name,
+        "s3": {"object": {"key": f"chat-sessions/{USER_ID}/{SESSION_ID}/{filename}", "sequencer": sequencer}}
+    }]}
+
+
+def get_session_files(resource):
+    return resource.Table(chat.SESSIONS_TABLE).get_item(Key={"UserId": USER_ID, "SessionId": SESSION_ID})["Item"]["Files"]
+
+
+def run_concurrently(events):
+    """
+    Applies every event in its own thread, the threads are released together
+    """
+    barrier = threading.Barrier(len(events))
+    errors = []
+
+    def apply_event(event):
+        barrier.wait()
+        try:
+            chat.update_file_metadata(event)
+        except Exception as ex: # pylint: disable=broad-except
+            errors.append(ex)
+
+    threads = [threading.Thread(target=apply_event, args=(event,)) for event in events]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_simultaneous_uploads_do_not_lose_files(dynamodb_resource):
+    filenames = [f"file_{index}.txt" for index in range(CONCURRENT_UPLOADS)]
+
+    errors = run_concurrently([get_s3_event(filename) for filename in filenames])
+
+    session_files = get_session_files(dynamodb_resource)
+    assert not errors
+    assert sorted(session_files) == sorted(filenames + ["handbook.pdf"])
+    assert len(session_files) == len(set(session_files))
+
+
+def test_simultaneous_uploads_and_delete_keep_every_other_file(dynamodb_resource):
+    filenames = [f"file_{index}.txt" for index in range(CONCURRENT_UPLOADS)]
+    events = [get_s3_event(filename) for filename in filenames] + [get_s3_event("handbook.pdf", "ObjectRemoved:Delete")]
+
+    errors = run_concurrently(events)
+
+    assert not errors
+    assert sorted(get_session_files(dynamodb_resource)) == sorted(filenames)
+
+
+def test_repeated_upload_event_adds_the_file_once(dynamodb_resource):
+    errors = run_concurrently([get_s3_event("notes.txt") for _ in range(CONCURRENT_UPLOADS)])
+
+    assert not errors
+    assert sorted(get_session_files(dynamodb_resource)) == ["handbook.pdf", "notes.txt"]
+
+
+def test_latest_event_of_an_object_is_found_with_padded_sequencers(dynamodb_resource):
+    # right-padded with zeros the shorter sequencer of the upload is the later one, as numbers it would be the earlier one
+    event = {"Records": get_s3_event("notes.txt", "ObjectRemoved:Delete", "0055AED6DCD90281E5")["Records"] +
+                        get_s3_event("notes.txt", sequencer="0055AED6DCD90281F")["Records"] +
+                        get_s3_event("handbook.pdf", sequencer="0055AED6DCD90281F")["Records"] +
+                        get_s3_event("handbook.pdf", "ObjectRemoved:Delete", "0055AED6DCD902820")["Records"]}
+
+    chat.update_file_metadata(event)
+
+    assert sorted(get_session_files(dynamodb_resource)) == ["notes.txt"]
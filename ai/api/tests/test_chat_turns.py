@@ -0,0 +1,169 @@
+"""
+Tests of the persistence of chat turns, the session and the chat history must stay consistent when the lambda is killed
+in the middle of a turn
+"""
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import bedrockUtil
+import chat
+import commonUtil
+from dynamodb_stub import StubDynamoDBResource
+
+USER_ID = "test-user"
+SESSION_ID = "test-session"
+MODEL_ID = "test-model"
+
+
+class LambdaKilled(BaseException):
+    """
+    Raised to stop a turn the way a killed lambda does, without running any of the exception handlers of the turn
+    """
+
+
+class DeliverySessionStandIn:
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, message, **kwargs): # pylint: disable=unused-argument
+        self.messages.append(message)
+
+
+@pytest.fixture
+def dynamodb_resource(monkeypatch):
+    resource = StubDynamoDBResource({
+        chat.SESSIONS_TABLE: ["UserId", "SessionId"],
+        chat.CHAT_HISTORY_TABLE: ["SessionId", "MessageTime"],
+        chat.MODELS_TABLE: ["ModelId"]
+    })
+    resource.Table(chat.SESSIONS_TABLE).put_item(Item={
+        "UserId": USER_ID, "SessionId": SESSION_ID, "ClientId": USER_ID, "Title": "New Session",
+        "StartTime": commonUtil.get_current_time(), "QueryStatus": commonUtil.CHAT_QUERY_COMPLETED
+    })
+    resource.Table(chat.MODELS_TABLE).put_item(Item={
+        "ModelId": MODEL_ID, "ModelName": "anthropic.claude-3-haiku-20240307-v1:0", "ModelProvider": "Amazon Bedrock",
+        "ModelType": "Base", "ModelStatusCode": commonUtil.MODEL_STATUS_GREEN, "InferenceTypesSupported": ["ON_DEMAND"],
+        "IsStreamingEnabled": "yes"
+    })
+    resource.write_requests = 0
+    monkeypatch.setattr(chat, "DYNAMODB_RESOURCE", resource)
+    monkeypatch.setattr(commonUtil, "DYNAMODB_RES", resource)
+    monkeypatch.setattr(commonUtil, "is_valid_user", lambda user_id, skip_user_check=False: {"UserId": user_id})
+    monkeypatch.setattr(chat, "get_session_history", lambda session_id, projection_keys=None, expression_attribute_names=None, window_size=None:
+                        get_history(resource)[-window_size:] if window_size else get_history(resource))
+    return resource
+
+
+def get_history(resource):
+    return sorted(resource.Table(chat.CHAT_HISTORY_TABLE).get_all_items(), key=lambda message: message["MessageTime"])
+
+
+def get_session(resource):
+    return resource.Table(chat.SESSIONS_TABLE).get_item(Key={"UserId": USER_ID, "SessionId": SESSION_ID})["Item"]
+
+
+def post_turn(message_id, message):
+    event = {"body": json.dumps({"ModelId": MODEL_ID, "UserMessage": message, "SessionId": SESSION_ID, "MessageId": message_id})}
+    return chat.post_query_to_model(event, SESSION_ID, USER_ID, "test-connection", "test-token", DeliverySessionStandIn())
+
+
+def answer(content):
+    def get_chatbot_response(*args, **kwargs): # pylint: disable=unused-argument
+        return {"content": content, "metadata": {"modelId": MODEL_ID}}
+    return get_chatbot_response
+
+
+def kill(*args, **kwargs):
+    raise LambdaKilled()
+
+
+def test_turn_is_committed_with_two_write_requests(dynamodb_resource, monkeypatch):
+    monkeypatch.setattr(bedrockUtil, "get_chatbot_response", answer("20 days a year"))
+
+    post_turn("first-turn", "What is the leave policy?")
+
+    history = get_history(dynamodb_resource)
+    session = get_session(dynamodb_resource)
+    assert [(message["Type"], message["MessageId"]) for message in history] == [("human", "first-turn"), ("ai", "first-turn")]
+    assert history[1]["Data"] == "20 days a year"
+    assert session["QueryStatus"] == commonUtil.CHAT_QUERY_COMPLETED
+    assert "PendingMessage" not in session
+    assert session["Title"] == "What is the leave policy?"
+    # the start of the turn and its commit
+    assert dynamodb_resource.write_requests == 2
+
+
+def test_turn_killed_mid_way_leaves_only_the_pending_marker(dynamodb_resource, monkeypatch):
+    monkeypatch.setattr(bedrockUtil, "get_chatbot_response", kill)
+
+    with pytest.raises(LambdaKilled):
+        post_turn("killed-turn", "What is the leave policy?")
+
+    session = get_session(dynamodb_resource)
+    assert not get_history(dynamodb_resource)
+    assert session["QueryStatus"] == commonUtil.CHAT_QUERY_PROCESSING
+    assert session["PendingMessage"]["MessageId"] == "killed-turn"
+    assert session["PendingMessage"]["Data"] == "What is the leave policy?"
+
+
+def test_killed_turn_is_recovered_by_the_next_turn(dynamodb_resource, monkeypatch):
+    monkeypatch.setattr(bedrockUtil, "get_chatbot_response", kill)
+    with pytest.raises(LambdaKilled):
+        post_turn("killed-turn", "What is the leave policy?")
+    # the next question is asked once the killed turn is older than the lambda timeout
+    sessions_table = dynamodb_resource.Table(chat.SESSIONS_TABLE)
+    pending_time = datetime.strptime(commonUtil.get_current_time(), commonUtil.DATETIME_ISO_FORMAT) - timedelta(seconds=chat.PENDING_TURN_TIMEOUT_IN_SECONDS + 60)
+    sessions_table.items[(USER_ID, SESSION_ID)]["PendingMessage"]["MessageTime"] = pending_time.strftime(commonUtil.DATETIME_ISO_FORMAT)
+
+    monkeypatch.setattr(bedrockUtil, "get_chatbot_response", answer("Your manager"))
+    post_turn("next-turn", "Who approves leaves?")
+
+    history = get_history(dynamodb_resource)
+    session = get_session(dynamodb_resource)
+    assert [(message["Type"], message["MessageId"]) for message in history] == [
+        ("human", "killed-turn"), ("ai", "killed-turn"), ("human", "next-turn"), ("ai", "next-turn")
+    ]
+    assert history[1]["Data"] == chat.PENDING_TURN_FAILED_MESSAGE
+    assert history[3]["Data"] == "Your manager"
+    assert session["QueryStatus"] == commonUtil.CHAT_QUERY_COMPLETED
+    assert "PendingMessage" not in session
+    assert "QueryFailureReason" not in session
+
+
+def test_killed_turn_is_recovered_when_its_response_is_requested(dynamodb_resource, monkeypatch):
+    monkeypatch.setattr(bedrockUtil, "get_chatbot_response", kill)
+    with pytest.raises(LambdaKilled):
+        post_turn("killed-turn", "What is the leave policy?")
+    session_details = commonUtil.get_session_details(chat.SESSIONS_TABLE, USER_ID, SESSION_ID)
+    pending_time = datetime.strptime(commonUtil.get_current_time(), commonUtil.DATETIME_ISO_FORMAT) - timedelta(seconds=chat.PENDING_TURN_TIMEOUT_IN_SECONDS + 60)
+    session_details["PendingMessage"]["MessageTime"] = pending_time.strftime(commonUtil.DATETIME_ISO_FORMAT)
+
+    assert chat.recover_pending_turn(USER_ID, SESSION_ID, session_details)
+
+    session = get_session(dynamodb_resource)
+    assert [message["Type"] for message in get_history(dynamodb_resource)] == ["human", "ai"]
+    assert session["QueryStatus"] == commonUtil.CHAT_QUERY_FAILED
+    assert session["QueryFailureReason"] == "Interrupted"
+    assert "PendingMessage" not in session
+
+
+def test_late_commit_does_not_overwrite_the_newer_turn(dynamodb_resource, monkeypatch):
+    monkeypatch.setattr(bedrockUtil, "get_chatbot_response", kill)
+    with pytest.raises(LambdaKilled):
+        post_turn("newer-turn", "Who approves leaves?")
+    older_question_time = datetime.strptime(commonUtil.get_current_time(), commonUtil.DATETIME_ISO_FORMAT) - timedelta(seconds=30)
+    older_question = {
+        "Type": "human", "MessageId": "older-turn", "Data": "What is the leave policy?", "ClientId": USER_ID,
+        "SessionId": SESSION_ID, "ReviewRequired": False, "MessageTime": older_question_time.strftime(commonUtil.DATETIME_ISO_FORMAT)
+    }
+    older_answer = dict(older_question, Type="ai", Data="20 days a year", Metadata={"modelId": MODEL_ID},
+                        MessageTime=(older_question_time + timedelta(seconds=10)).strftime(commonUtil.DATETIME_ISO_FORMAT))
+
+    chat.commit_turn(USER_ID, SESSION_ID, older_question, older_answer, commonUtil.CHAT_QUERY_COMPLETED)
+
+    session = get_session(dynamodb_resource)
+    assert [(message["Type"], message["MessageId"]) for message in get_history(dynamodb_resource)] == [("human", "older-turn"), ("ai", "older-turn")]
+    assert session["QueryStatus"] == commonUtil.CHAT_QUERY_PROCESSING
+    assert session["PendingMessage"]["MessageId"] == "newer-turn"
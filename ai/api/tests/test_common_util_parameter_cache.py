@@ -0,0 +1,150 @@
+"""
+Tests of the ssm parameter and secret cache against stand-ins of the ssm and secrets manager clients. A chat turn reads
+the openai key, the workspace retrieval max results and the aurora service user secret, which must reach the services once
+per TTL instead of once per turn
+"""
+import json
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+import auroraUtil
+import commonUtil
+
+TURNS = 10
+AURORA_SECRET_ARN = "arn:aws:secretsmanager:us-east-1:123456789012:secret:test-aurora"
+PARAMETERS = {commonUtil.OPENAI_KEY_SSM_KEY: "test-openai-key", commonUtil.WORKSPACE_RETRIEVAL_MAXRESULTS_SSM_KEY: "5"}
+# ssm and secrets manager calls made by a turn without the cache
+UNCACHED_CALLS_PER_TURN = 3
+
+
+class ParameterNotFound(ClientError):
+    """
+    Raised by the ssm stand-in for parameters which don't exist
+    """
+
+
+class SSMStandIn:
+    """
+    Stand-in of the ssm client which counts the get_parameter and get_parameters calls
+    """
+    class exceptions: # pylint: disable=invalid-name,too-few-public-methods
+        ParameterNotFound = ParameterNotFound
+
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.calls = []
+
+    def get_parameter(self, Name, WithDecryption): # pylint: disable=invalid-name,unused-argument
+        self.calls.append(("get_parameter", Name))
+        if Name not in self.parameters:
+            raise ParameterNotFound({"Error": {"Code": "ParameterNotFound", "Message": Name}}, "GetParameter")
+        return {"Parameter": {"Name": Name, "Value": self.parameters[Name]}}
+
+    def get_parameters(self, Names, WithDecryption): # pylint: disable=invalid-name,unused-argument
+        self.calls.append(("get_parameters", Names))
+        return {"Parameters": [{"Name": name, "Value": self.parameters[name]} for name in Names if name in self.parameters],
+                "InvalidParameters": [name for name in Names if name not in self.parameters]}
+
+
+class SecretsManagerStandIn:
+    """
+    Stand-in of the secrets manager client which counts the get_secret_value calls
+    """
+    def __init__(self):
+        self.password = "first-password"
+        self.calls = 0
+
+    def get_secret_value(self, SecretId): # pylint: disable=invalid-name,unused-argument
+        self.calls += 1
+        return {"SecretString": json.dumps({"username": "service-user", "password": self.password})}
+
+
+class SimulatedClock:
+    """
+    Replaces time.time, the time only moves when the test advances it
+    """
+    def __init__(self, start_time=1700000000):
+        self.now = start_time
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    ssm_client, secrets_manager_client = SSMStandIn(dict(PARAMETERS)), SecretsManagerStandIn()
+    monkeypatch.setattr(commonUtil, "SSM_CLIENT", ssm_client)
+    monkeypatch.setattr(commonUtil, "PARAMETER_CACHE", {})
+    monkeypatch.setattr(commonUtil, "PARAMETER_CACHE_STATS", {"Hits": 0, "Misses": 0})
+    return ssm_client, secrets_manager_client
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    simulated_clock = SimulatedClock()
+    monkeypatch.setattr(time, "time", simulated_clock.time)
+    return simulated_clock
+
+
+def run_turn(ssm_client, secrets_manager_client):
+    """
+    Reads the parameters and the secret the way a chat turn over a workspace does
+    """
+    openai_key = commonUtil.get_openai_key(ssm_client)
+    max_results = int(commonUtil.get_decrypted_value(commonUtil.WORKSPACE_RETRIEVAL_MAXRESULTS_SSM_KEY))
+    aurora_connection = auroraUtil.AuroraConnection(AURORA_SECRET_ARN, secrets_manager_client)
+    return openai_key, max_results, aurora_connection.dbuser
+
+
+def test_turns_after_the_cold_start_prefetch_make_no_ssm_calls(clients, clock): # pylint: disable=unused-argument,redefined-outer-name
+    ssm_client, secrets_manager_client = clients
+    commonUtil.prefetch_parameters(list(PARAMETERS), ssm_client)
+
+    results = [run_turn(ssm_client, secrets_manager_client) for _ in range(TURNS)]
+
+    assert set(results) == {("test-openai-key", 5, "service-user")}
+    assert ssm_client.calls == [("get_parameters", list(PARAMETERS))]
+    assert secrets_manager_client.calls == 1
+    stats = commonUtil.get_parameter_cache_stats()
+    assert stats == {"Hits": TURNS * UNCACHED_CALLS_PER_TURN - 1, "Misses": 1, "Entries": 3}
+    # the prefetch and the first secret read replace the calls of every turn
+    assert TURNS * UNCACHED_CALLS_PER_TURN - len(ssm_client.calls) - secrets_manager_client.calls == TURNS * UNCACHED_CALLS_PER_TURN - 2
+
+
+def test_expired_entries_are_read_again_by_their_own_ttl(clients, clock): # pylint: disable=redefined-outer-name
+    ssm_client, secrets_manager_client = clients
+    commonUtil.prefetch_parameters(list(PARAMETERS), ssm_client)
+    run_turn(ssm_client, secrets_manager_client)
+
+    clock.now += commonUtil.PARAMETER_CACHE_TTL_IN_SECONDS[commonUtil.OPENAI_KEY_SSM_KEY] + 1
+    run_turn(ssm_client, secrets_manager_client)
+
+    # the retrieval max results have a longer ttl than the openai key and the secret
+    assert ssm_client.calls[1:] == [("get_parameter", commonUtil.OPENAI_KEY_SSM_KEY)]
+    assert secrets_manager_client.calls == 2
+    assert commonUtil.get_parameter_cache_stats()["Misses"] == 3
+
+
+def test_missing_parameters_are_cached_for_the_negative_ttl(clients, clock): # pylint: disable=redefined-outer-name
+    ssm_client, _ = clients
+    del ssm_client.parameters[commonUtil.OPENAI_KEY_SSM_KEY]
+
+    assert [commonUtil.get_openai_key(ssm_client) for _ in range(TURNS)] == [""] * TURNS
+    clock.now += commonUtil.PARAMETER_CACHE_NEGATIVE_TTL_IN_SECONDS + 1
+    commonUtil.get_openai_key(ssm_client)
+
+    assert ssm_client.calls == [("get_parameter", commonUtil.OPENAI_KEY_SSM_KEY)] * 2
+
+
+def test_refreshed_secret_is_read_again(clients, clock): # pylint: disable=unused-argument,redefined-outer-name
+    _, secrets_manager_client = clients
+    assert auroraUtil.AuroraConnection(AURORA_SECRET_ARN, secrets_manager_client).dbpass == "first-password"
+
+    secrets_manager_client.password = "rotated-password"
+    assert auroraUtil.AuroraConnection(AURORA_SECRET_ARN, secrets_manager_client).dbpass == "first-password"
+    commonUtil.refresh_cached_parameter(f"secret:{AURORA_SECRET_ARN}")
+
+    assert auroraUtil.AuroraConnection(AURORA_SECRET_ARN, secrets_manager_client).dbpass == "rotated-password"
+    assert secrets_manager_client.calls == 2
@@ -0,0 +1,90 @@
+"""
+Tests of the websocket delivery of a streamed chat turn against a stand-in of the api gateway management api. The connection
+id must be read from the sessions table once per turn and the delivery status written only when it changes
+"""
+import json
+
+import pytest
+
+import commonUtil
+import dynamodbUtil
+from dynamodb_stub import StubDynamoDBResource
+
+USER_ID = "test-user"
+SESSION_ID = "test-session"
+CONNECTION_ID = "test-connection"
+STREAMED_CHUNKS = 50
+
+
+class ManagementApiStandIn:
+    """
+    Stand-in of the api gateway management api client, posts fail with GoneException while the connection is gone
+    """
+    def __init__(self, is_gone=False):
+        self.is_gone = is_gone
+        self.posts = []
+
+    def post_to_connection(self, Data, ConnectionId): # pylint: disable=invalid-name
+        if self.is_gone:
+            raise Exception("GoneException") # pylint: disable=broad-exception-raised
+        self.posts.append((ConnectionId, json.loads(Data)))
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+
+@pytest.fixture
+def dynamodb_resource():
+    resource = StubDynamoDBResource({dynamodbUtil.SESSIONS_TABLE: ["UserId", "SessionId"]})
+    resource.Table(dynamodbUtil.SESSIONS_TABLE).put_item(Item={"UserId": USER_ID, "SessionId": SESSION_ID, "ConnectionId": CONNECTION_ID})
+    return resource
+
+
+@pytest.fixture
+def status_writes(monkeypatch):
+    written_statuses = []
+    update_message_delivery_status = commonUtil.update_message_delivery_status
+
+    def record_status(user_id, session_id, delivery_status, kwargs):
+        written_statuses.append(delivery_status)
+        update_message_delivery_status(user_id, session_id, delivery_status, kwargs)
+    monkeypatch.setattr(commonUtil, "update_message_delivery_status", record_status)
+    return written_statuses
+
+
+def stream_answer(dynamodb_resource, management_api_client):
+    """
+    Delivers a streamed answer the way the chat lambdas do, the connection id is not known upfront
+    """
+    delivery_session = commonUtil.WebSocketDeliverySession(USER_ID, SESSION_ID, {
+        "ApiManagementClient": management_api_client, "DynamoDBResource": dynamodb_resource, "SessionsTable": dynamodbUtil.SESSIONS_TABLE
+    })
+    delivery_session.update_delivery_status(commonUtil.CHAT_MESSAGE_DELIVERY_PENDING)
+    for index in range(STREAMED_CHUNKS):
+        delivery_session.send_message({"AIMessage": f"chunk {index} ", "Metadata": {"IsComplete": False}})
+    delivery_session.send_message({"AIMessage": "", "Metadata": {"IsComplete": True}}, is_final=True, latest_message_id="test-message")
+
+
+def get_session(dynamodb_resource):
+    return dynamodb_resource.Table(dynamodbUtil.SESSIONS_TABLE).get_item(Key={"UserId": USER_ID, "SessionId": SESSION_ID})["Item"]
+
+
+def test_streamed_answer_reads_the_connection_once_and_writes_each_status_once(dynamodb_resource, status_writes): # pylint: disable=redefined-outer-name
+    management_api_client = ManagementApiStandIn()
+
+    stream_answer(dynamodb_resource, management_api_client)
+
+    assert len(management_api_client.posts) == STREAMED_CHUNKS + 1
+    assert {connection_id for connection_id, _ in management_api_client.posts} == {CONNECTION_ID}
+    assert dynamodb_resource.read_requests == 1
+    assert status_writes == [commonUtil.CHAT_MESSAGE_DELIVERY_PENDING, commonUtil.CHAT_MESSAGE_DELIVERY_STREAMING, commonUtil.CHAT_MESSAGE_DELIVERY_DELIVERED]
+    assert dynamodb_resource.write_requests == 1 + len(status_writes)
+    session = get_session(dynamodb_resource)
+    assert session["MessageDeliveryStatus"] == commonUtil.CHAT_MESSAGE_DELIVERY_DELIVERED and session["LatestMessageId"] == "test-message"
+
+
+def test_gone_connection_writes_the_failed_status_once(dynamodb_resource, status_writes, monkeypatch): # pylint: disable=redefined-outer-name
+    monkeypatch.setattr(commonUtil.time, "sleep", lambda seconds: None)
+
+    stream_answer(dynamodb_resource, ManagementApiStandIn(is_gone=True))
+
+    assert status_writes == [commonUtil.CHAT_MESSAGE_DELIVERY_PENDING, commonUtil.CHAT_MESSAGE_DELIVERY_FAILED]
+    assert get_session(dynamodb_resource)["MessageDeliveryStatus"] == commonUtil.CHAT_MESSAGE_DELIVERY_FAILED
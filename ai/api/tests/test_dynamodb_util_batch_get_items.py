@@ -0,0 +1,54 @@
+"""
+Tests of the batched reads of dynamodbUtil against the stub client, throttled requests return UnprocessedKeys which must be
+retried until every requested item is read once
+"""
+import pytest
+
+import dynamodbUtil
+import errorUtil
+from dynamodb_stub import StubDynamoDBResource
+
+TABLE_NAME = "test-items"
+ITEMS_COUNT = 250
+
+
+@pytest.fixture
+def dynamodb_resource(monkeypatch):
+    resource = StubDynamoDBResource({TABLE_NAME: ["ItemId"]})
+    for index in range(ITEMS_COUNT):
+        resource.Table(TABLE_NAME).put_item(Item={"ItemId": f"item-{index}", "Position": index, "Payload": "x" * 10})
+    # the retries are not delayed, the backoff itself is not under test
+    monkeypatch.setattr(dynamodbUtil, "get_batch_get_items_backoff_time", lambda attempt: 0)
+    return resource
+
+
+def test_unprocessed_keys_are_retried_until_every_item_is_read(dynamodb_resource):
+    client = dynamodb_resource.meta.client
+    client.throttled_batch_gets, client.throttled_batch_get_size = 6, 10
+    # every key is requested twice and some keys don't have an item
+    keys = [{"ItemId": f"item-{index}"} for index in range(ITEMS_COUNT + 20)] * 2
+
+    items = dynamodbUtil.batch_get_items(dynamodb_resource, TABLE_NAME, keys, "ItemId, Position")
+
+    assert sorted(item["Position"] for item in items) == list(range(ITEMS_COUNT))
+    assert all(set(item) == {"ItemId", "Position"} for item in items)
+    # 270 unique keys are read in 3 chunks and the 6 throttled requests are retried
+    assert len(client.batch_get_requests) == 3 + 6
+    assert all(request[TABLE_NAME] <= dynamodbUtil.BATCH_GET_ITEMS_BATCH_SIZE for request in client.batch_get_requests)
+
+
+def test_keys_left_unprocessed_after_the_retries_raise_db_1012(dynamodb_resource):
+    client = dynamodb_resource.meta.client
+    client.throttled_batch_gets, client.throttled_batch_get_size = 100, 0
+
+    with pytest.raises(errorUtil.GenericFailureException, match="DB-1012"):
+        dynamodbUtil.batch_get_items(dynamodb_resource, TABLE_NAME, [{"ItemId": f"item-{index}"} for index in range(10)])
+
+    assert len(client.batch_get_requests) == dynamodbUtil.BATCH_GET_ITEMS_MAX_RETRIES + 1
+
+
+def test_duplicate_keys_are_read_once(dynamodb_resource):
+    items = dynamodbUtil.batch_get_items(dynamodb_resource, TABLE_NAME, [{"ItemId": "item-1"}, {"ItemId": "item-2"}, {"ItemId": "item-1"}])
+
+    assert sorted(item["ItemId"] for item in items) == ["item-1", "item-2"]
+    assert dynamodb_resource.meta.client.batch_get_requests == [{TABLE_NAME: 2}]
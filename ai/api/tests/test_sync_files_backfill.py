@@ -0,0 +1,86 @@
+"""
+Tests of the one-time backfill of the workspaces source index run by syncFiles before a batch is synced. The backfill is
+skipped once its ssm flag is written and a failing backfill must not prevent the files of the batch from being synced
+"""
+import pytest
+from botocore.exceptions import ClientError
+
+import syncFiles
+
+STREAM_EVENT = [{"eventSource": "aws:dynamodb", "eventName": "INSERT", "dynamodb": {"NewImage": {}}}]
+
+
+class ParameterNotFound(ClientError):
+    """
+    Raised by the ssm stand-in for parameters which don't exist
+    """
+
+
+class SSMStandIn:
+    """
+    Stand-in of the ssm client keeping the parameters in memory
+    """
+    class exceptions: # pylint: disable=invalid-name,too-few-public-methods
+        ParameterNotFound = ParameterNotFound
+
+    def __init__(self):
+        self.parameters = {}
+
+    def get_parameter(self, Name): # pylint: disable=invalid-name
+        if Name not in self.parameters:
+            raise ParameterNotFound({"Error": {"Code": "ParameterNotFound", "Message": Name}}, "GetParameter")
+        return {"Parameter": {"Name": Name, "Value": self.parameters[Name]}}
+
+    def put_parameter(self, Name, Value, **kwargs): # pylint: disable=invalid-name,unused-argument
+        self.parameters[Name] = Value
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+
+class ContextStandIn: # pylint: disable=too-few-public-methods
+    aws_request_id = "test-request"
+
+
+@pytest.fixture
+def handler_calls(monkeypatch):
+    calls = {"Backfills": 0, "SyncedBatches": [], "BackfillError": None}
+
+    def backfill():
+        calls["Backfills"] += 1
+        if calls["BackfillError"]:
+            raise calls["BackfillError"]
+    monkeypatch.setattr(syncFiles, "SSM_CLIENT", SSMStandIn())
+    monkeypatch.setattr(syncFiles, "IS_SOURCE_INDEX_BACKFILLED", False)
+    monkeypatch.setattr(syncFiles, "backfill_workspaces_source_index", backfill)
+    monkeypatch.setattr(syncFiles, "sync_workspace_source_files", calls["SyncedBatches"].append)
+    return calls
+
+
+def start_container(monkeypatch):
+    monkeypatch.setattr(syncFiles, "IS_SOURCE_INDEX_BACKFILLED", False)
+
+
+def test_backfill_runs_once_across_cold_starts(handler_calls, monkeypatch): # pylint: disable=redefined-outer-name
+    syncFiles.lambda_handler(STREAM_EVENT, ContextStandIn())
+    syncFiles.lambda_handler(STREAM_EVENT, ContextStandIn())
+    start_container(monkeypatch)
+    syncFiles.lambda_handler(STREAM_EVENT, ContextStandIn())
+
+    assert handler_calls["Backfills"] == 1
+    assert syncFiles.SSM_CLIENT.parameters == {syncFiles.SOURCE_INDEX_BACKFILLED_SSM_KEY: "true"}
+    assert handler_calls["SyncedBatches"] == [STREAM_EVENT] * 3
+
+
+def test_failed_backfill_still_syncs_the_batch_and_is_retried(handler_calls): # pylint: disable=redefined-outer-name
+    handler_calls["BackfillError"] = RuntimeError("ProvisionedThroughputExceededException")
+
+    syncFiles.lambda_handler(STREAM_EVENT, ContextStandIn())
+
+    assert handler_calls["SyncedBatches"] == [STREAM_EVENT]
+    assert not syncFiles.SSM_CLIENT.parameters
+
+    handler_calls["BackfillError"] = None
+    syncFiles.lambda_handler(STREAM_EVENT, ContextStandIn())
+
+    assert handler_calls["Backfills"] == 2
+    assert handler_calls["SyncedBatches"] == [STREAM_EVENT] * 2
+    assert syncFiles.SOURCE_INDEX_BACKFILLED_SSM_KEY in syncFiles.SSM_CLIENT.parameters
@@ -0,0 +1,202 @@
+"""
+Tests of the debounced file-based ingestion. File loads request ingestion through syncFiles, the scheduler executions of
+the workspaces lambda are driven on a simulated clock and the ingestion jobs are started on a stand-in of the bedrock
+agent client, so that the number of jobs started for bursts of uploads can be counted
+"""
+import time
+
+import pytest
+
+import commonUtil
+import syncFiles
+import workspaces
+from dynamodb_stub import StubDynamoDBResource
+
+USER_ID = "test-user"
+WORKSPACE_ID = "test-workspace"
+WORKSPACE_ITEM = {
+    "WorkspaceId": WORKSPACE_ID, "WorkspaceStatus": commonUtil.WORKSPACES_CREATION_COMPLETED_STATUS, "TriggerType": "file-based",
+    "KnowledgeBaseId": "test-knowledge-base", "DataSourceId": "test-data-source"
+}
+# duration of an ingestion job on the simulated clock
+INGESTION_JOB_DURATION_IN_SECONDS = 300
+
+
+class SimulatedClock:
+    """
+    Replaces time.time, the time only moves when the test advances it
+    """
+    def __init__(self, start_time=1700000000):
+        self.now = start_time
+
+    def time(self):
+        return self.now
+
+
+class BedrockAgentStandIn:
+    """
+    Stand-in of the bedrock agent client, every ingestion job completes INGESTION_JOB_DURATION_IN_SECONDS after it started
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.jobs = {}
+
+    def start_ingestion_job(self, knowledgeBaseId, dataSourceId): # pylint: disable=invalid-name,unused-argument
+        job_id = f"job-{len(self.jobs)}"
+        self.jobs[job_id] = self.clock.now
+        return {"ingestionJob": {"ingestionJobId": job_id, "status": commonUtil.RUN_STATUS_STARTING}}
+
+    def get_ingestion_job(self, knowledgeBaseId, dataSourceId, ingestionJobId): # pylint: disable=invalid-name,unused-argument
+        is_running = self.clock.now < self.jobs[ingestionJobId] + INGESTION_JOB_DURATION_IN_SECONDS
+        return {"ingestionJob": {"ingestionJobId": ingestionJobId, "status": commonUtil.RUN_STATUS_IN_PROGRESS if is_running else "COMPLETE"}}
+
+    def get_max_concurrent_jobs(self):
+        return max(sum(start_time <= job_start < start_time + INGESTION_JOB_DURATION_IN_SECONDS for job_start in self.jobs.values())
+                   for start_time in self.jobs.values())
+
+
+class StepFunctionsStandIn:
+    """
+    Records the executions of the execute input lambda state machine, fails them while error is set
+    """
+    def __init__(self):
+        self.executions = []
+        self.error = None
+
+    def start_execution(self, stateMachineArn, input, name): # pylint: disable=invalid-name,unused-argument,redefined-builtin
+        if self.error:
+            raise self.error
+        self.executions.append(syncFiles.json.loads(input))
+        return {"executionArn": f"{stateMachineArn}:{name}", "ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def get_scheduler_executions(self):
+        return [execution for execution in self.executions if execution["Operation"] == "run_pending_ingestion"]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    simulated_clock = SimulatedClock()
+    monkeypatch.setattr(time, "time", simulated_clock.time)
+    return simulated_clock
+
+
+@pytest.fixture
+def dynamodb_resource(monkeypatch):
+    resource = StubDynamoDBResource({workspaces.WORKSPACES_TABLE: ["WorkspaceId"], workspaces.WORKSPACES_EXECUTIONS_TABLE: ["WorkspaceId", "RunId"]})
+    resource.Table(workspaces.WORKSPACES_TABLE).put_item(Item=dict(WORKSPACE_ITEM))
+    monkeypatch.setattr(syncFiles, "DYNAMODB_RESOURCE", resource)
+    monkeypatch.setattr(workspaces, "DYNAMODB_RESOURCE", resource)
+    return resource
+
+
+@pytest.fixture
+def aws_clients(monkeypatch, clock): # pylint: disable=redefined-outer-name
+    bedrock_agent_client, step_functions_client = BedrockAgentStandIn(clock), StepFunctionsStandIn()
+    monkeypatch.setattr(workspaces, "BEDROCK_AGENT_CLIENT", bedrock_agent_client)
+    monkeypatch.setattr(workspaces, "STEP_FUNCTION_CLIENT", step_functions_client)
+    monkeypatch.setattr(syncFiles, "STEP_FUNCTION_CLIENT", step_functions_client)
+    return bedrock_agent_client, step_functions_client
+
+
+def get_workspace(resource):
+    return resource.Table(workspaces.WORKSPACES_TABLE).get_item(Key={"WorkspaceId": WORKSPACE_ID})["Item"]
+
+
+def simulate_uploads(clock, step_functions_client, upload_times):
+    """
+    Requests ingestion at every upload time and runs the scheduler executions the state machine would run, each one
+    waking up WaitTimeInSec after its previous poll, until every scheduler has stopped
+    """
+    start_time, upload_times = clock.now, sorted(upload_times)
+    schedulers, started_executions = [], 0
+    while upload_times or schedulers:
+        next_upload_time = start_time + upload_times[0] if upload_times else None
+        next_scheduler = min(schedulers, key=lambda scheduler: scheduler[0]) if schedulers else None
+        if next_scheduler is None or (next_upload_time is not None and next_upload_time <= next_scheduler[0]):
+            clock.now = next_upload_time
+            upload_times.pop(0)
+            syncFiles.request_workspace_ingestion(USER_ID, WORKSPACE_ID)
+        else:
+            schedulers.remove(next_scheduler)
+            clock.now = next_scheduler[0]
+            event = workspaces.run_pending_ingestion(next_scheduler[1], syncFiles.WORKSPACES_LAMBDA_ARN)
+            if event["Operation"] != "Complete":
+                schedulers.append([clock.now + event["WaitTimeInSec"], event])
+        for event in step_functions_client.get_scheduler_executions()[started_executions:]:
+            schedulers.append([clock.now + event["WaitTimeInSec"], dict(event)])
+        started_executions = len(step_functions_client.get_scheduler_executions())
+
+
+def test_burst_of_uploads_starts_a_single_job(dynamodb_resource, aws_clients, clock):
+    bedrock_agent_client, step_functions_client = aws_clients
+
+    simulate_uploads(clock, step_functions_client, [index * 0.15 for index in range(200)])
+
+    assert len(bedrock_agent_client.jobs) == 1
+    assert len(step_functions_client.get_scheduler_executions()) == 1
+    workspace = get_workspace(dynamodb_resource)
+    assert not workspace["IngestionPending"] and not workspace["IngestionScheduled"]
+
+
+def test_uploads_during_a_running_job_get_one_follow_up_job(dynamodb_resource, aws_clients, clock): # pylint: disable=unused-argument
+    bedrock_agent_client, step_functions_client = aws_clients
+    first_burst = [index * 0.5 for index in range(60)]
+    # arrives after the first job started and before it completes
+    second_burst = [120 + index * 0.5 for index in range(60)]
+
+    simulate_uploads(clock, step_functions_client, first_burst + second_burst)
+
+    assert len(bedrock_agent_client.jobs) == 2
+    assert bedrock_agent_client.get_max_concurrent_jobs() == 1
+    assert len(step_functions_client.get_scheduler_executions()) == 1
+
+
+def test_continuous_uploads_are_ingested_within_the_max_delay(dynamodb_resource, aws_clients, clock): # pylint: disable=unused-argument
+    bedrock_agent_client, step_functions_client = aws_clients
+    start_time = clock.now
+    upload_times = list(range(0, 1500, 10))
+
+    simulate_uploads(clock, step_functions_client, upload_times)
+
+    job_start_times = sorted(bedrock_agent_client.jobs.values())
+    assert job_start_times[0] - start_time <= commonUtil.INGESTION_MAX_DELAY_IN_SECONDS
+    # one job per max delay window plus the job of the last changes, instead of one per upload
+    assert len(job_start_times) <= len(upload_times) * 10 // commonUtil.INGESTION_MAX_DELAY_IN_SECONDS + 2
+    assert bedrock_agent_client.get_max_concurrent_jobs() == 1
+
+
+def test_failed_scheduler_start_releases_the_schedule(dynamodb_resource, aws_clients, clock):
+    bedrock_agent_client, step_functions_client = aws_clients
+    step_functions_client.error = RuntimeError("ThrottlingException")
+
+    with pytest.raises(RuntimeError):
+        syncFiles.request_workspace_ingestion(USER_ID, WORKSPACE_ID)
+    workspace = get_workspace(dynamodb_resource)
+    assert workspace["IngestionPending"] and not workspace["IngestionScheduled"]
+
+    # the next file change schedules the ingestion right away instead of waiting for the stale timeout
+    step_functions_client.error = None
+    simulate_uploads(clock, step_functions_client, [1])
+    assert len(step_functions_client.get_scheduler_executions()) == 1
+    assert len(bedrock_agent_client.jobs) == 1
+
+
+def test_failed_scheduler_start_keeps_a_newer_schedule(dynamodb_resource, aws_clients, clock):
+    _, step_functions_client = aws_clients
+    newer_scheduled_time = clock.now + 5
+
+    class ReplacedScheduleError(Exception):
+        """
+        Raised after another request took over the schedule while the execution was being started
+        """
+    def start_replaced_execution(**kwargs): # pylint: disable=unused-argument
+        dynamodb_resource.Table(workspaces.WORKSPACES_TABLE).update_item(
+            Key={"WorkspaceId": WORKSPACE_ID}, UpdateExpression="SET IngestionScheduledTime = :now", ExpressionAttributeValues={":now": newer_scheduled_time})
+        raise ReplacedScheduleError()
+    step_functions_client.start_execution = start_replaced_execution
+
+    with pytest.raises(ReplacedScheduleError):
+        syncFiles.request_workspace_ingestion(USER_ID, WORKSPACE_ID)
+
+    workspace = get_workspace(dynamodb_resource)
+    assert workspace["IngestionScheduled"] and workspace["IngestionScheduledTime"] == newer_scheduled_time
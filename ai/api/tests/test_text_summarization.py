@@ -0,0 +1,83 @@
+"""
+Tests of the map reduce summarization against a stand-in of the llm with a fixed latency per call. The chunks must be
+summarized with bounded concurrency and the final reduce call must stay within the reduce token budget
+"""
+import math
+import time
+import threading
+
+import pytest
+
+import textSummarization
+
+LLM_LATENCY_IN_SECONDS = 0.05
+PROMPT_PREFIX, PROMPT_SUFFIX = textSummarization.SUMMARIZATION_PROMPT.format(text="{text}").split("{text}")
+
+
+class LLMStandIn:
+    """
+    Stand-in of the langchain llm, every call waits for the latency and returns the first summary_size characters of the
+    text of the prompt, the whole text if it is None. Tokens are counted as 4 characters
+    """
+    def __init__(self, latency=LLM_LATENCY_IN_SECONDS, summary_size=200):
+        self.latency = latency
+        self.summary_size = summary_size
+        self.prompts = []
+        self.running_calls = 0
+        self.max_running_calls = 0
+        self.lock = threading.Lock()
+
+    def invoke(self, prompt):
+        with self.lock:
+            self.prompts.append(prompt)
+            self.running_calls += 1
+            self.max_running_calls = max(self.max_running_calls, self.running_calls)
+        time.sleep(self.latency)
+        with self.lock:
+            self.running_calls -= 1
+        return prompt[len(PROMPT_PREFIX):len(prompt) - len(PROMPT_SUFFIX)][:self.summary_size]
+
+    def get_num_tokens(self, text):
+        return len(text) // 4
+
+
+@pytest.mark.parametrize("chunks_count", [5, 20, 40])
+def test_wall_time_scales_with_chunks_over_the_concurrency(chunks_count):
+    llm = LLMStandIn()
+
+    start_time = time.monotonic()
+    summaries = textSummarization.summarize_texts(llm, [f"chunk {index}" for index in range(chunks_count)])
+    elapsed_time = time.monotonic() - start_time
+
+    rounds = math.ceil(chunks_count / textSummarization.SUMMARIZATION_MAX_CONCURRENCY)
+    assert len(summaries) == chunks_count
+    assert llm.max_running_calls == min(chunks_count, textSummarization.SUMMARIZATION_MAX_CONCURRENCY)
+    assert rounds * LLM_LATENCY_IN_SECONDS <= elapsed_time < (rounds + 1) * LLM_LATENCY_IN_SECONDS + 0.1
+
+
+def test_summaries_are_returned_in_the_order_of_the_texts():
+    texts = [f"chunk {index}" for index in range(12)]
+
+    summaries = textSummarization.summarize_texts(LLMStandIn(), texts)
+
+    assert [summary.split("chunk ")[-1].split()[0] for summary in summaries] == [str(index) for index in range(12)]
+
+
+def test_summaries_fitting_the_budget_are_reduced_in_a_single_call():
+    llm = LLMStandIn(latency=0)
+
+    textSummarization.reduce_summaries(llm, ["x" * 400 for _ in range(10)])
+
+    assert len(llm.prompts) == 1
+
+
+def test_final_reduce_stays_within_the_budget_once_the_levels_are_exhausted(monkeypatch):
+    monkeypatch.setattr(textSummarization, "SUMMARIZATION_MAX_REDUCE_LEVELS", 1)
+    # the stand-in summaries don't shrink below the budget of a group, so the levels can't combine them into one group
+    llm = LLMStandIn(latency=0, summary_size=None)
+    summaries = [f"{index} ".ljust(2000 * 4, "x") for index in range(20)]
+
+    textSummarization.reduce_summaries(llm, summaries)
+
+    final_prompt = llm.prompts[-1]
+    assert llm.get_num_tokens(final_prompt) - llm.get_num_tokens(PROMPT_PREFIX + PROMPT_SUFFIX) <= textSummarization.SUMMARIZATION_REDUCE_MAX_TOKENS + len(summaries)
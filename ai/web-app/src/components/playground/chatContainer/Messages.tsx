@@ -22,6 +22,7 @@ interface IMessagesProps {
     setLocalHistory?: React.Dispatch<React.SetStateAction<IMessage[]>>;
     sendMessages: any;
     waitingForResponse: boolean;
+    progressMessage?: string;
     sentMessage?: boolean;
 }
 
@@ -29,7 +30,8 @@ const Messages = ({
   sessionId,
   localHistory = [],
   setLocalHistory,
-  waitingForResponse }: IMessagesProps ): JSX.Element => {
+  waitingForResponse,
+  progressMessage }: IMessagesProps ): JSX.Element => {
   const { playground } = usePermanentPaths();
   const navigate = useNavigate();
   const [showSuccessNotification] = useSuccessNotification();
@@ -209,11 +211,11 @@ const Messages = ({
             <ChatBubble message={message} scrollToTheBottom={scrollToTheBottom} key={index} isLastMessage={ index === localHistory.length - 1 }
               isLoading={ !( message.isComplete ?? true )} />
           )}
-        { waitingForResponse && <ChatBubble message={{
+        { ( waitingForResponse || progressMessage ) && <ChatBubble message={{
           MessageId: "loading",
           MessageTime: new Date().toISOString(),
           Type: "ai",
-          Data: "Churning data...",
+          Data: progressMessage || "Churning data...",
           isComplete: true
         }} isLoading scrollToTheBottom={scrollToTheBottom} /> }
       </PerfectScrollbar> : <div className="flex h-full w-full items-center justify-center gap-2">
@@ -29,6 +29,7 @@ type ChatWebSocketResponse = {
     modelKwargs: string;
     workspaceId: string;
     IsComplete: boolean,
+    Progress?: boolean;
     MessageId: string;
     Sources?: { Domain: string, Workspace: string, FileName: string, WebsiteURL?: string }[];
   }
@@ -48,6 +49,7 @@ const ChatContainer = (): JSX.Element => {
   const [ selectedFile, setSelectedFile ] = useState<string | undefined>();
   const [ waitingForResponse, setWaitingForResponse ] = useState( false );
   const [ isResponseComplete, setIsResponseComplete ] = useState( true );
+  const [ progressMessage, setProgressMessage ] = useState<string | undefined>();
   const [ reconnecting, setReconnecting ] = useState( false );
   const [showInfoNotification] = useInfoNotification();
   const [showErrorNotification] = useErrorNotification();
@@ -61,6 +63,14 @@ const ChatContainer = (): JSX.Element => {
     }
     setMessage( "" );
     setWaitingForResponse( false );
+
+    // Progress updates of long running tools are shown as a transient status, they are not part of the answer
+    if ( data?.Metadata?.Progress ) {
+      setIsResponseComplete( false );
+      setProgressMessage( data?.AIMessage );
+      return;
+    }
+    setProgressMessage( undefined );
     setIsResponseComplete( data?.Metadata?.IsComplete ?? true );
 
     if ( !( data?.Metadata?.IsComplete ?? true ) && data?.Metadata?.Sources ) {
@@ -275,6 +285,7 @@ const ChatContainer = (): JSX.Element => {
                   sessionId={sessionId}
                   sendMessages={sendMessages}
                   waitingForResponse={waitingForResponse}
+                  progressMessage={progressMessage}
                   key={sessionId} />
               </PerfectScrollbar>
             </div>
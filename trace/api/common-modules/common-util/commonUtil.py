@@ -3,6 +3,7 @@ This file has all the common functions that are used.
 """
 import os
 import json
+import time
 import logging
 import decimal
 from io import BytesIO
@@ -25,6 +26,15 @@ AWS_REGION = os.environ["awsRegion"]
 ENABLE_IDP = os.environ["enableIDP"]
 VERTICAL_NAME = os.environ['verticalName']
 
+# Cognito user validation cache, entries are keyed by UserId and hold the allowed apps of the user or None for users who are
+# not active in cognito. The cache is local to each lambda container and users are disabled or deleted outside of the application,
+# so entries are invalidated only by their TTL, the short TTL of the negative entries bounds how long a re-enabled user stays rejected
+USER_VALIDATION_CACHE_TTL_IN_SECONDS = 300
+USER_VALIDATION_NEGATIVE_CACHE_TTL_IN_SECONDS = 30
+USER_VALIDATION_CACHE_MAX_ENTRIES = 5000
+USER_VALIDATION_CACHE = {}
+COGNITO_UTIL = None
+
 class RedactAuthTokensClass(dict):
     """
     Helper class to prevent printing of authorization header in event
@@ -209,38 +219,135 @@ def get_current_time():
     current_time = str(datetime.now(timezone.utc).strftime(DATETIME_ISO_FORMAT))
     return current_time
 
+def get_cognito_util():
+    """
+    Returns the CognitoUtil object of the user pool, the object is created once per execution environment
+    """
+    global COGNITO_UTIL # pylint: disable=global-statement
+    if not COGNITO_UTIL:
+        COGNITO_UTIL = cognitoUtil.CognitoUtil(USER_POOL_ID, AWS_REGION)
+    return COGNITO_UTIL
+
+def invalidate_user_validation_cache(user_id=None):
+    """
+    Removes the cached validation result of a user, clears the whole cache if no user is specified
+    :param user_id: UserId of the user to be removed from the cache
+    """
+    LOGGER.info("In commonUtil.invalidate_user_validation_cache, invalidating cache for UserId: %s", user_id)
+    if user_id:
+        USER_VALIDATION_CACHE.pop(user_id, None)
+    else:
+        USER_VALIDATION_CACHE.clear()
+
+def get_cognito_user_name(cognito_user, attributes_key='Attributes'):
+    """
+    Returns the name by which the user is identified in the application, custom:username takes precedence over the Username
+    :param cognito_user: user object as returned by cognito
+    :param attributes_key: key which holds the attributes in the user object
+    """
+    user_name = cognito_user['Username']
+    for each_attr in cognito_user.get(attributes_key, []):
+        if each_attr["Name"] == "custom:username":
+            user_name = each_attr["Value"]
+    return user_name
+
+def get_cognito_user_allowed_apps(cognito_user, attributes_key='Attributes'):
+    """
+    Returns the list of apps the user has access to
+    :param cognito_user: user object as returned by cognito
+    :param attributes_key: key which holds the attributes in the user object
+    """
+    allowed_apps = ["amorphic"]
+    for each_attr in cognito_user.get(attributes_key, []):
+        if str(each_attr["Name"]) == "custom:attr3":
+            # Value will be in format of "allowed_apps=amorphic,idp"
+            allowed_apps = each_attr["Value"].split("=")[1].split(",")
+    return list(set(allowed_apps))
+
+def is_active_cognito_user(cognito_user):
+    """
+    Checks if the user is enabled and has the status expected for the idp configuration
+    :param cognito_user: user object as returned by cognito
+    """
+    expected_status = "CONFIRMED" if ENABLE_IDP == "no" else "EXTERNAL_PROVIDER"
+    return cognito_user.get('Enabled', True) and cognito_user.get('UserStatus') == expected_status
+
+def cache_user_allowed_apps(user_id, allowed_apps):
+    """
+    Stores the allowed apps of the user in the validation cache, the expired entries and then the oldest entries are evicted
+    once the cache is full
+    :param user_id: UserId of the user
+    :param allowed_apps: list of apps the user has access to, None for a user who is not an active cognito user
+    """
+    if user_id not in USER_VALIDATION_CACHE and len(USER_VALIDATION_CACHE) >= USER_VALIDATION_CACHE_MAX_ENTRIES:
+        current_time = time.time()
+        for cache_key in [cache_key for cache_key, entry in USER_VALIDATION_CACHE.items() if entry["ExpiryTime"] <= current_time]:
+            USER_VALIDATION_CACHE.pop(cache_key)
+        if len(USER_VALIDATION_CACHE) >= USER_VALIDATION_CACHE_MAX_ENTRIES:
+            USER_VALIDATION_CACHE.pop(next(iter(USER_VALIDATION_CACHE)))
+    cache_ttl = USER_VALIDATION_CACHE_TTL_IN_SECONDS if allowed_apps is not None else USER_VALIDATION_NEGATIVE_CACHE_TTL_IN_SECONDS
+    USER_VALIDATION_CACHE[user_id] = {
+        "AllowedApps": allowed_apps,
+        "ExpiryTime": time.time() + cache_ttl
+    }
+
+def get_user_allowed_apps(user_id):
+    """
+    Retrieves the list of apps the user has access to, returns None if the user is not an active cognito user.
+    Lookup order is the validation cache, a point lookup on the username and finally a listing of all the
+    active users of the pool, which also warms the cache for the other users.
+    Users who are not found or not active are cached with a short TTL so that unknown users can't force repeated pool listings
+    :param user_id: UserId of the user
+    """
+    cache_entry = USER_VALIDATION_CACHE.get(user_id)
+    if cache_entry and cache_entry["ExpiryTime"] > time.time():
+        LOGGER.info("In commonUtil.get_user_allowed_apps, validation cache hit for UserId: %s", user_id)
+        return cache_entry["AllowedApps"]
+    invalidate_user_validation_cache(user_id)
+
+    cognito_util = get_cognito_util()
+    cognito_user = cognito_util.get_user(user_id)
+    if cognito_user and get_cognito_user_name(cognito_user, 'UserAttributes') == user_id:
+        LOGGER.info("In commonUtil.get_user_allowed_apps, user %s found with point lookup", user_id)
+        if not is_active_cognito_user(cognito_user):
+            cache_user_allowed_apps(user_id, None)
+            return None
+        allowed_apps = get_cognito_user_allowed_apps(cognito_user, 'UserAttributes')
+        cache_user_allowed_apps(user_id, allowed_apps)
+        return allowed_apps
+
+    # Federated users are identified by custom:username which can't be used in list_users filters
+    LOGGER.info("In commonUtil.get_user_allowed_apps, listing all the active users of the pool")
+    filter_cond = 'cognito:user_status = "CONFIRMED"' if ENABLE_IDP == "no" else 'cognito:user_status = "EXTERNAL_PROVIDER"'
+    allowed_apps = None
+    for each_user in cognito_util.get_users_list(filter_condition=filter_cond):
+        if not is_active_cognito_user(each_user):
+            continue
+        user_name = get_cognito_user_name(each_user)
+        user_allowed_apps = get_cognito_user_allowed_apps(each_user)
+        cache_user_allowed_apps(user_name, user_allowed_apps)
+        if user_name == user_id:
+            allowed_apps = user_allowed_apps
+    if allowed_apps is None:
+        cache_user_allowed_apps(user_id, None)
+    return allowed_apps
+
 def is_valid_user(user_id):
     """
     This method will check if user have permission to do specific operations
     """
     LOGGER.info("In commonUtil.is_valid_user, starting method with UserId: %s", user_id)
 
-    cognito_util = cognitoUtil.CognitoUtil(USER_POOL_ID, AWS_REGION)
-    filter_cond = 'cognito:user_status = "CONFIRMED"' if ENABLE_IDP == "no" else 'cognito:user_status = "EXTERNAL_PROVIDER"'
-    cognito_user_response = cognito_util.get_users_list(filter_condition=filter_cond)
     # Check if user have access to the vertical
-    user_allowed_apps = []
-    invalid_user = True
-    for each_user in cognito_user_response:
-        allowed_apps = ["amorphic"]
-        user_name = each_user['Username'] if each_user['Username'] == user_id else None
-        for each_attr in each_user.get('Attributes', []):
-            if each_attr["Name"] == "custom:username":
-                user_name = each_user['Username'] if user_id == each_attr["Value"] else None
-            if str(each_attr["Name"]) == "custom:attr3":
-                # Value will be in format of "allowed_apps=amorphic,idp"
-                allowed_apps = (each_attr["Value"].split("=")[1].split(","))
-        # If a user is found then no need to continue the iteration, break the loop
-        if user_name:
-            invalid_user = False
-            break
-    user_allowed_apps = list(set(allowed_apps))
+    user_allowed_apps = get_user_allowed_apps(user_id)
 
     LOGGER.info("In commonUtil.is_valid_user, checking if user have access to the vertical or invalid user")
-    if not invalid_user and VERTICAL_NAME.lower() not in user_allowed_apps:
+    if user_allowed_apps is not None and VERTICAL_NAME.lower() not in user_allowed_apps:
         LOGGER.error("In commonUtil.is_valid_user, user doesn't have access to the vertical")
+        # there is no users table in trace to notice a changed user, don't keep serving a rejection cached for the full TTL
+        invalidate_user_validation_cache(user_id)
         errorUtil.raise_exception(EVENT_INFO, "GF", "GE-1034", "User doesn't have access to the vertical")
 
-    if invalid_user:
+    if user_allowed_apps is None:
         LOGGER.error("In commonUtil.is_valid_user, user doesn't have access to the vertical")
         errorUtil.raise_exception(EVENT_INFO, "GF", "GE-1034", "User does not exist")